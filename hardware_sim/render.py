@@ -0,0 +1,298 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+
+Offline rendering of recorded port writes to frames of the board's seven segment display and LEDs.
+Needs NumPy, which the rest of the simulator does not import.
+"""
+import json
+import os
+import struct
+import zlib
+from typing import List, Dict, Tuple, Optional, Sequence
+
+import numpy as np
+
+from hardware_sim.seven_segment_display import SevenSegmentDisplay
+
+# canonical segment order of the (frames, digits, 8) pattern arrays, p is the decimal point
+SEGMENTS = "abcdefgp"
+
+
+class PortTrace(object):
+    """Port writes as parallel arrays sorted by cycle, as recorded by "picosim run" in either --format"""
+    RECORD = np.dtype([("cycle", "<u8"), ("port", "u1"), ("value", "u1")])
+
+    def __init__(self, cycles: np.ndarray, ports: np.ndarray, values: np.ndarray):
+        order = np.argsort(cycles, kind="stable")
+        self.cycles = np.asarray(cycles, dtype=np.uint64)[order]
+        self.ports = np.asarray(ports, dtype=np.uint8)[order]
+        self.values = np.asarray(values, dtype=np.uint8)[order]
+
+    @staticmethod
+    def load(path: str) -> "PortTrace":
+        with open(path, "rb") as f:
+            head = f.read(1)
+        if head == b"{":
+            records = []  # type: List[Tuple[int, int, int]]
+            with open(path) as f:
+                for line in f:
+                    if len(line.strip()):
+                        write = json.loads(line)
+                        records.append((write["cycle"], write["port"], write["value"]))
+            return PortTrace.from_records(records)
+        data = np.fromfile(path, dtype=PortTrace.RECORD)
+        return PortTrace(data["cycle"], data["port"], data["value"])
+
+    @staticmethod
+    def from_records(records: Sequence[Tuple[int, int, int]]) -> "PortTrace":
+        data = np.array(list(records), dtype=np.uint64).reshape(-1, 3)
+        return PortTrace(data[:, 0], data[:, 1] & 0xFF, data[:, 2] & 0xFF)
+
+    def port(self, port_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """cycles and values of the writes to port_id"""
+        mask = self.ports == port_id
+        return self.cycles[mask], self.values[mask]
+
+    @property
+    def end(self) -> int:
+        return int(self.cycles[-1]) if len(self.cycles) else 0
+
+
+def latest(cycles: np.ndarray, values: np.ndarray, at: np.ndarray, default: int) -> np.ndarray:
+    """value of the last write at or before each cycle of at"""
+    idx = np.searchsorted(cycles, at, side="right") - 1
+    if not len(values):
+        return np.full(len(at), default, dtype=np.uint8)
+    return np.where(idx >= 0, values[np.maximum(idx, 0)], default).astype(np.uint8)
+
+
+def bits(values: np.ndarray) -> np.ndarray:
+    """(n, 8) booleans, bit 0 first"""
+    return np.unpackbits(values.astype(np.uint8)[:, None], axis=1, bitorder="little").astype(bool)
+
+
+class Board(object):
+    """
+    How the display and LEDs hang off the ports: a cathode port with one bit per segment, an anode port
+    selecting the multiplexed digits (None when every digit is always enabled) and any number of LED ports.
+    Digilent boards drive both active low with segments a-g, dp on bits 0-7 and digit 0 rightmost.
+    """
+    def __init__(self, cathode_port: int, anode_port: Optional[int] = None, led_ports: Sequence[int] = (),
+                 digits: int = 8, active_low: bool = True, segment_order: str = SEGMENTS):
+        if sorted(segment_order) != sorted(SEGMENTS):
+            raise ValueError("segment_order must name each of %s once" % SEGMENTS)
+        self.cathode_port = cathode_port
+        self.anode_port = anode_port
+        self.led_ports = list(led_ports)
+        self.digits = digits
+        self.active_low = active_low
+        # column of the cathode bit driving each canonical segment
+        self._columns = [segment_order.index(s) for s in SEGMENTS]
+
+    def sample(self, trace: PortTrace, every: int, start: int = 0, end: int = None,
+               persistence: int = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Display state every `every` cycles from start to end: (cycles, segments (frames, digits, 8),
+        leds (frames, 8 per LED port)). A multiplexed digit shows the pattern it was last enabled with,
+        or nothing once that is more than persistence cycles ago.
+        """
+        end = trace.end if end is None else end
+        at = np.arange(start, end + 1, every, dtype=np.uint64)
+        idle = 0xFF if self.active_low else 0x00
+        cathode_cycles, cathode_values = trace.port(self.cathode_port)
+        if self.anode_port is None:
+            anode_cycles, anode_values = np.zeros(1, dtype=np.uint64), np.array([idle ^ 0xFF], dtype=np.uint8)
+        else:
+            anode_cycles, anode_values = trace.port(self.anode_port)
+        # what the display shows changes at every write to either port
+        events = np.union1d(cathode_cycles, anode_cycles)
+        cathodes = latest(cathode_cycles, cathode_values, events, idle)
+        anodes = latest(anode_cycles, anode_values, events, idle)
+        if self.active_low:
+            cathodes, anodes = ~cathodes, ~anodes
+        patterns = bits(cathodes)[:, self._columns]
+        enabled = bits(anodes)[:, :self.digits]
+
+        segments = np.zeros((len(at), self.digits, len(SEGMENTS)), dtype=bool)
+        for digit in range(self.digits):
+            shown = enabled[:, digit]
+            times, digit_patterns = events[shown], patterns[shown]
+            if not len(times):
+                continue
+            idx = np.searchsorted(times, at, side="right") - 1
+            visible = idx >= 0
+            if persistence is not None:
+                visible &= at - times[np.maximum(idx, 0)] <= persistence
+            segments[:, digit, :] = np.where(visible[:, None], digit_patterns[np.maximum(idx, 0)], False)
+
+        leds = np.zeros((len(at), 8 * len(self.led_ports)), dtype=bool)
+        for n, port_id in enumerate(self.led_ports):
+            led_cycles, led_values = trace.port(port_id)
+            leds[:, 8 * n:8 * (n + 1)] = bits(latest(led_cycles, led_values, at, 0))
+        return at, segments, leds
+
+    @staticmethod
+    def from_display(display: SevenSegmentDisplay) -> np.ndarray:
+        """(digits, 8) pattern of a live SevenSegmentDisplay, the model has no segment g"""
+        return np.array([[segment.anode and segment.cathodes.get(s if s != "p" else "dp", False)
+                          for s in SEGMENTS] for segment in display.segments], dtype=bool)
+
+
+class Renderer(object):
+    """
+    Draws frames from tiles: the segment masks are composed once into a digit tile for each of the 256
+    segment patterns, then every digit of every frame in a chunk is one gather from the tiles, with no per
+    frame Python work. Digits are drawn with the highest index leftmost, LEDs in a row underneath.
+    """
+    # segment rectangles (x0, y0, x1, y1) on a 14 x 22 digit cell
+    CELL = (14, 22)
+    RECTS = {
+        "a": (3, 1, 10, 3),
+        "b": (10, 3, 12, 10),
+        "c": (10, 12, 12, 19),
+        "d": (3, 19, 10, 21),
+        "e": (1, 12, 3, 19),
+        "f": (1, 3, 3, 10),
+        "g": (3, 10, 10, 12),
+        "p": (12, 19, 14, 21),
+    }  # type: Dict[str, Tuple[int, int, int, int]]
+    LED_CELL = (7, 7)
+
+    ON = (255, 40, 20)
+    OFF = (40, 10, 8)
+    LED_ON = (40, 255, 60)
+    LED_OFF = (10, 40, 12)
+    BACKGROUND = (12, 12, 12)
+
+    CHUNK = 1024
+
+    def __init__(self, scale: int = 2):
+        self.scale = scale
+        width, height = Renderer.CELL
+        masks = np.zeros((len(SEGMENTS), height, width), dtype=bool)
+        for idx, segment in enumerate(SEGMENTS):
+            x0, y0, x1, y1 = Renderer.RECTS[segment]
+            masks[idx, y0:y1, x0:x1] = True
+        masks = self._scaled(masks)
+        # lit pixels of every pattern: (256, 8) pattern bits times the (8, h * w) masks
+        lit = bits(np.arange(256)).astype(np.float32) @ masks.reshape(len(SEGMENTS), -1).astype(np.float32) > 0
+        self.tiles = Renderer._paint(lit.reshape((256,) + masks.shape[1:]), masks.any(axis=0),
+                                     Renderer.ON, Renderer.OFF)  # type: np.ndarray
+        led_width, led_height = Renderer.LED_CELL
+        led = np.zeros((1, led_height, led_width), dtype=bool)
+        led[0, 1:-1, 1:-1] = True
+        led = self._scaled(led)
+        self.led_tiles = Renderer._paint(np.stack([np.zeros_like(led[0]), led[0]]), led[0],
+                                         Renderer.LED_ON, Renderer.LED_OFF)  # type: np.ndarray
+
+    def _scaled(self, masks: np.ndarray) -> np.ndarray:
+        return masks.repeat(self.scale, axis=1).repeat(self.scale, axis=2)
+
+    @staticmethod
+    def _paint(lit: np.ndarray, shape: np.ndarray, on: Tuple[int, int, int], off: Tuple[int, int, int]) -> np.ndarray:
+        """(tiles, h, w) lit pixels over a (h, w) cell shape to (tiles, h, w, 3) colors"""
+        index = lit.astype(np.uint8)
+        index += shape
+        return np.array([Renderer.BACKGROUND, off, on], dtype=np.uint8)[index]
+
+    @staticmethod
+    def _row(tiles: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """(frames, cells) tile indices to (frames, h, cells * w, 3) images"""
+        frames, cells = codes.shape
+        height, width = tiles.shape[1:3]
+        return tiles[codes].transpose(0, 2, 1, 3, 4).reshape(frames, height, cells * width, 3)
+
+    def _chunk(self, segments: np.ndarray, leds: np.ndarray) -> np.ndarray:
+        # highest digit leftmost
+        codes = np.packbits(segments[:, ::-1, :], axis=2, bitorder="little")[:, :, 0]
+        image = Renderer._row(self.tiles, codes)
+        if leds.shape[1]:
+            row = Renderer._row(self.led_tiles, leds[:, ::-1].astype(np.uint8))
+            width = max(image.shape[2], row.shape[2])
+            image = np.concatenate([Renderer._pad(image, width), Renderer._pad(row, width)], axis=1)
+        return image
+
+    @staticmethod
+    def _pad(image: np.ndarray, width: int) -> np.ndarray:
+        if image.shape[2] == width:
+            return image
+        padded = np.empty(image.shape[:2] + (width, 3), dtype=np.uint8)
+        padded[...] = Renderer.BACKGROUND
+        padded[:, :, :image.shape[2]] = image
+        return padded
+
+    def render(self, segments: np.ndarray, leds: np.ndarray = None) -> np.ndarray:
+        """(frames, height, width, 3) uint8 RGB frames from Board.sample output"""
+        if leds is None:
+            leds = np.zeros((len(segments), 0), dtype=bool)
+        if not len(segments):
+            return self._chunk(np.zeros((1,) + segments.shape[1:], dtype=bool), leds[:1].reshape(1, -1))[:0]
+        return np.concatenate([self._chunk(segments[idx:idx + Renderer.CHUNK], leds[idx:idx + Renderer.CHUNK])
+                               for idx in range(0, len(segments), Renderer.CHUNK)])
+
+
+# PNG and APNG without an imaging library
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+
+def _header(image: np.ndarray) -> bytes:
+    height, width = image.shape[:2]
+    # 8 bit RGB
+    return _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+
+def _compressed(image: np.ndarray) -> bytes:
+    height = image.shape[0]
+    # filter type 0 in front of every row
+    rows = np.concatenate([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, -1)], axis=1)
+    return zlib.compress(rows.tobytes(), 6)
+
+
+def write_png(path: str, image: np.ndarray):
+    with open(path, "wb") as f:
+        f.write(PNG_SIGNATURE + _header(image) + _png_chunk(b"IDAT", _compressed(image)) + _png_chunk(b"IEND", b""))
+
+
+def write_pngs(directory: str, frames: np.ndarray, prefix: str = "frame") -> List[str]:
+    paths = []
+    for idx, image in enumerate(frames):
+        path = os.path.join(directory, "%s_%05d.png" % (prefix, idx))
+        write_png(path, image)
+        paths.append(path)
+    return paths
+
+
+def write_apng(path: str, frames: np.ndarray, delay_ms: int = 100, loops: int = 0) -> int:
+    """
+    Animated PNG of frames shown delay_ms each, runs of identical frames become one longer frame.
+    Returns the number of frames written.
+    """
+    if not len(frames):
+        raise ValueError("No frames to write")
+    changed = np.ones(len(frames), dtype=bool)
+    changed[1:] = (frames[1:] != frames[:-1]).reshape(len(frames) - 1, -1).any(axis=1)
+    starts = np.flatnonzero(changed)
+    lengths = np.diff(np.append(starts, len(frames)))
+    height, width = frames.shape[1:3]
+    out = [PNG_SIGNATURE, _header(frames[0]), _png_chunk(b"acTL", struct.pack(">II", len(starts), loops))]
+    sequence = 0
+    for n, (start, length) in enumerate(zip(starts, lengths)):
+        delay = int(delay_ms * length)
+        out.append(_png_chunk(b"fcTL", struct.pack(">IIIIIHHBB", sequence, width, height, 0, 0,
+                                                min(delay, 0xFFFF), 1000, 0, 0)))
+        sequence += 1
+        data = _compressed(frames[start])
+        if n == 0:
+            out.append(_png_chunk(b"IDAT", data))
+        else:
+            out.append(_png_chunk(b"fdAT", struct.pack(">I", sequence) + data))
+            sequence += 1
+    out.append(_png_chunk(b"IEND", b""))
+    with open(path, "wb") as f:
+        f.write(b"".join(out))
+    return len(starts)
@@ -0,0 +1,488 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+
+Static analysis of an assembled program: control flow graph, best and worst case cycle counts of every
+subroutine and of the ISR, stack depth and a bound on the interrupt latency. Nothing is run, so the bounds
+hold for every input, which simulation can not show.
+"""
+import json
+import re
+from typing import List, Dict, Tuple, Optional, Set, Iterable
+
+import ops.operations as op
+from ops.assembler import Assembler, ParseError
+from system.memory import Memory
+from system.processor import Processor
+
+# edge target for leaving the analyzed code: a return, or the end of an interrupt disabled window
+EXIT = -1
+
+C = Processor.CLOCKS_PER_INSTRUCTION
+
+F = op.FlowOperation
+JUMPS = (F.jump,)
+CONDITIONAL_JUMPS = (F.jump_c, F.jump_nc, F.jump_nz, F.jump_z)
+CALLS = (F.call,)
+CONDITIONAL_CALLS = (F.call_c, F.call_nc, F.call_nz, F.call_z)
+RETURNS = (F.return_,)
+CONDITIONAL_RETURNS = (F.return_c, F.return_nc, F.return_nz, F.return_z)
+RETURNIS = (F.return_i_disable, F.return_i_enable)
+# instructions leaving interrupts enabled, they end an interrupt disabled window
+ENABLES = (F.en_interrupt, F.return_i_enable)
+
+# comment annotations: "; @loop 10" or "; @loop 2..10" on a loop's header or backward branch,
+# "; @targets tag, tag" on a JUMP@ or CALL@
+LOOP = re.compile(r"@loop\s+(\d+)(?:\s*\.\.\s*(\d+))?", re.IGNORECASE)
+TARGETS = re.compile(r"@targets\s+([\w\s,]+)", re.IGNORECASE)
+
+
+def _add(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    return None if a is None or b is None else a + b
+
+
+def _worst(a: Optional[int], b: Optional[int]) -> Optional[int]:
+    """the larger bound, None is unbounded"""
+    return None if a is None or b is None else max(a, b)
+
+
+def _merge(edges: Dict[int, List[Optional[int]]], target: int, best: int, worst: Optional[int]):
+    cost = edges.get(target)
+    if cost is None:
+        edges[target] = [best, worst]
+    else:
+        cost[0] = min(cost[0], best)
+        cost[1] = _worst(cost[1], worst)
+
+
+class Subroutine(object):
+    """What the analyzer found out about the code reached from one entry address"""
+    def __init__(self, entry: int, name: str):
+        self.entry = entry
+        self.name = name
+        # cycles from the first instruction to the end of the return, None when there is no bound
+        self.best = None  # type: Optional[int]
+        self.worst = None  # type: Optional[int]
+        # stack rows pushed by the calls it makes, not counting the CALL that entered it
+        self.depth = 0  # type: Optional[int]
+        self.calls = set()  # type: Set[int]
+        # control flow graph: successors of each instruction, EXIT for returns
+        self.graph = {}  # type: Dict[int, List[int]]
+        self.problems = []  # type: List[str]
+
+    def report(self, names: Dict[int, str]) -> Dict[str, object]:
+        return {
+            "entry": self.entry,
+            "name": self.name,
+            "best": self.best,
+            "worst": self.worst,
+            "depth": self.depth,
+            "calls": sorted(names.get(c, "0x%03X" % c) for c in self.calls),
+            "instructions": len(self.graph),
+            "problems": self.problems,
+        }
+
+
+class StaticAnalyzer(object):
+    """
+    Works on the Assembler.convert() output. Every instruction takes CLOCKS_PER_INSTRUCTION, a call costs its
+    CALL plus the callee. Loops are found as back edges of the control flow graph and collapsed innermost
+    first, so each needs a bound: bounds maps a loop's header or backward branch to (least, most) times its
+    body runs. Most is counted as back edge traversals, which is exact for loops testing at the top and one
+    iteration pessimistic for loops testing at the bottom. targets maps JUMP@ and CALL@ addresses to where
+    they can go. Anything unbounded or unresolved leaves worst as None and says why in problems.
+    """
+    def __init__(self, operations: Dict[int, op.Instruction], isr_addr: int = 0x3FF,
+                 bounds: Dict[int, Tuple[int, int]] = None, targets: Dict[int, List[int]] = None,
+                 names: Dict[int, str] = None):
+        self.operations = operations
+        self.isr_addr = isr_addr
+        self.bounds = bounds or {}
+        self.targets = targets or {}
+        self.names = names or {}
+        self.subroutines = {}  # type: Dict[int, Subroutine]
+        self._in_progress = set()  # type: Set[int]
+
+    @staticmethod
+    def from_assembler(assembler: Assembler, isr_addr: int = 0x3FF) -> "StaticAnalyzer":
+        """analyzer of an assembled program with the @loop and @targets annotations of its source"""
+        if not len(assembler.operations):
+            assembler.parse()
+            assembler.convert()
+        bounds, targets = annotations(assembler)
+        names = {address: tag for tag, address in assembler.tag_addresses.items()}
+        return StaticAnalyzer(assembler.operations, isr_addr, bounds, targets, names)
+
+    def name(self, address: int) -> str:
+        return self.names.get(address, "0x%03X" % address)
+
+    """CONTROL FLOW"""
+
+    def _edges(self, addr: int, window: bool) -> Tuple[List[Tuple[int, int, Optional[int]]], List[int], List[str]]:
+        """(target, best, worst) edges leaving addr, the subroutines it calls and any problems"""
+        instr = self.operations.get(addr)
+        nxt = (addr + 1) % Memory.PROGRAM_LENGTH
+        if instr is None or isinstance(instr, op.AssemblerDirective):
+            # the processor halts once the pc leaves the program
+            return [(EXIT, 0, 0)], [], ["leaves the program at %s" % self.name(addr)]
+        if instr.__class__ is op.TableOperation:
+            return [(EXIT, C, C)], [], []
+        if not isinstance(instr, op.FlowOperation):
+            return [(nxt, C, C)], [], []
+
+        operator = instr.operator
+        if window and operator in ENABLES:
+            return [(EXIT, C, C)], [], []
+        if operator in JUMPS:
+            return [(instr.address % Memory.PROGRAM_LENGTH, C, C)], [], []
+        if operator in CONDITIONAL_JUMPS:
+            return [(nxt, C, C), (instr.address % Memory.PROGRAM_LENGTH, C, C)], [], []
+        if operator in RETURNS or operator in RETURNIS:
+            if window:
+                return [], [], ["interrupts stay disabled past the return at %s" % self.name(addr)]
+            return [(EXIT, C, C)], [], []
+        if operator in CONDITIONAL_RETURNS:
+            if window:
+                return [(nxt, C, C)], [], ["interrupts stay disabled past the return at %s" % self.name(addr)]
+            return [(EXIT, C, C), (nxt, C, C)], [], []
+        if operator is F.jump_at:
+            targets = self.targets.get(addr)
+            if targets is None:
+                return [], [], ["JUMP@ at %s has no @targets" % self.name(addr)]
+            return [(t % Memory.PROGRAM_LENGTH, C, C) for t in targets], [], []
+        if operator in CALLS or operator in CONDITIONAL_CALLS or operator is F.call_at:
+            if operator is F.call_at:
+                callees = self.targets.get(addr)
+                if callees is None:
+                    return [], [], ["CALL@ at %s has no @targets" % self.name(addr)]
+            else:
+                callees = [instr.address]
+            best, worst, problems = None, 0, []
+            for callee in callees:
+                callee %= Memory.PROGRAM_LENGTH
+                sub = self.subroutine(callee)
+                if sub is None:
+                    problems.append("recursive call to %s at %s" % (self.name(callee), self.name(addr)))
+                    worst = None
+                    continue
+                if sub.worst is None:
+                    problems.append("call to unbounded %s at %s" % (sub.name, self.name(addr)))
+                worst = _worst(worst, sub.worst)
+                if sub.best is not None:
+                    best = sub.best if best is None else min(best, sub.best)
+            if operator in CONDITIONAL_CALLS or best is None:
+                best = 0
+            return [(nxt, C + best, _add(C, worst))], [c % Memory.PROGRAM_LENGTH for c in callees], problems
+        return [(nxt, C, C)], [], []
+
+    def _graph(self, entry: int, window: bool):
+        succ = {}  # type: Dict[int, Dict[int, List[Optional[int]]]]
+        callees = set()  # type: Set[int]
+        problems = []  # type: List[str]
+        pending = [entry]
+        while len(pending):
+            addr = pending.pop()
+            if addr in succ:
+                continue
+            edges, calls, issues = self._edges(addr, window)
+            callees.update(calls)
+            problems.extend(issues)
+            out = succ[addr] = {}
+            for target, best, worst in edges:
+                _merge(out, target, best, worst)
+                if target != EXIT and target not in succ:
+                    pending.append(target)
+        return succ, callees, problems
+
+    @staticmethod
+    def _back_edges(succ: Dict[int, Dict[int, List[Optional[int]]]], entry: int) -> Dict[int, List[int]]:
+        """header -> sources of the edges back to it, from a depth first walk"""
+        loops = {}  # type: Dict[int, List[int]]
+        on_stack = {entry: True}
+        stack = [(entry, iter(succ[entry]))]
+        while len(stack):
+            node, successors = stack[-1]
+            for target in successors:
+                if target == EXIT:
+                    continue
+                state = on_stack.get(target)
+                if state is None:
+                    on_stack[target] = True
+                    stack.append((target, iter(succ[target])))
+                    break
+                if state:
+                    loops.setdefault(target, []).append(node)
+            else:
+                on_stack[node] = False
+                stack.pop()
+        return loops
+
+    @staticmethod
+    def _order(succ: Dict[int, Dict[int, List[Optional[int]]]], start: int, nodes: Set[int] = None,
+               skip: int = None) -> Optional[List[int]]:
+        """topological order of what start reaches inside nodes, without edges to skip, None on a cycle"""
+        order = []  # type: List[int]
+        state = {start: True}
+        stack = [(start, iter(succ[start]))]
+        while len(stack):
+            node, successors = stack[-1]
+            for target in successors:
+                if target == EXIT or target == skip or (nodes is not None and target not in nodes):
+                    continue
+                visiting = state.get(target)
+                if visiting is None:
+                    state[target] = True
+                    stack.append((target, iter(succ[target])))
+                    break
+                if visiting:
+                    return None
+            else:
+                state[node] = False
+                order.append(node)
+                stack.pop()
+        order.reverse()
+        return order
+
+    @staticmethod
+    def _distances(succ: Dict[int, Dict[int, List[Optional[int]]]], order: List[int], nodes: Set[int] = None,
+                   skip: int = None) -> Tuple[Dict[int, int], Dict[int, Optional[int]]]:
+        best = {order[0]: 0}  # type: Dict[int, int]
+        worst = {order[0]: 0}  # type: Dict[int, Optional[int]]
+        for node in order:
+            if node not in best:
+                continue
+            for target, (b, w) in succ[node].items():
+                if target == skip or (nodes is not None and target not in nodes and target != EXIT):
+                    continue
+                d = best[node] + b
+                if target not in best or d < best[target]:
+                    best[target] = d
+                w = _add(worst[node], w)
+                worst[target] = _worst(worst[target], w) if target in worst else w
+        return best, worst
+
+    def _loop_bound(self, header: int, tails: List[int]) -> Optional[Tuple[int, int]]:
+        if header in self.bounds:
+            return self.bounds[header]
+        if all(tail in self.bounds for tail in tails):
+            return (sum(self.bounds[tail][0] for tail in tails), sum(self.bounds[tail][1] for tail in tails))
+        return None
+
+    def _timing(self, entry: int, window: bool = False):
+        """(best, worst, callees, graph, problems) from entry to a return, or to the end of the window"""
+        succ, callees, problems = self._graph(entry, window)
+        graph = {node: sorted(edges) for node, edges in succ.items()}
+        loops = StaticAnalyzer._back_edges(succ, entry)
+        preds = {}  # type: Dict[int, Set[int]]
+        for node, edges in succ.items():
+            for target in edges:
+                preds.setdefault(target, set()).add(node)
+        bodies = {}  # type: Dict[int, Set[int]]
+        for header, tails in loops.items():
+            body = {header}
+            pending = list(tails)
+            while len(pending):
+                node = pending.pop()
+                if node not in body:
+                    body.add(node)
+                    pending.extend(preds.get(node, ()))
+            for node in body:
+                if node != header and not preds.get(node, set()) <= body:
+                    problems.append("loop at %s is entered other than through its header" % self.name(header))
+                    return None, None, callees, graph, problems
+            bodies[header] = body
+
+        # collapse loops innermost first, a collapsed loop is its header with edges to the loop's exits
+        rep = {}  # type: Dict[int, int]
+        for header in sorted(bodies, key=lambda h: len(bodies[h])):
+            nodes = {rep.get(node, node) for node in bodies[header]}
+            order = StaticAnalyzer._order(succ, header, nodes, skip=header)
+            if order is None:
+                problems.append("loop at %s is not reducible" % self.name(header))
+                return None, None, callees, graph, problems
+            best, worst = StaticAnalyzer._distances(succ, order, nodes, skip=header)
+            iter_best, iter_worst = None, 0  # type: Optional[int], Optional[int]
+            exits = []  # type: List[Tuple[int, int, int, Optional[int]]]
+            for node in order:
+                for target, (b, w) in succ[node].items():
+                    if target == header:
+                        d = best[node] + b
+                        iter_best = d if iter_best is None else min(iter_best, d)
+                        iter_worst = _worst(iter_worst, _add(worst[node], w))
+                    elif target not in nodes:
+                        exits.append((node, target, b, w))
+            bound = self._loop_bound(header, loops[header])
+            if bound is None:
+                # a loop without exits never ends anyway, only loops that can be left need a bound
+                if len(exits):
+                    problems.append("loop at %s has no @loop bound" % self.name(header))
+                least, most = 0, None
+            else:
+                least, most = max(bound[0] - 1, 0), bound[1]
+            out = {}  # type: Dict[int, List[Optional[int]]]
+            for node, target, b, w in exits:
+                spin_worst = None if most is None or iter_worst is None else most * iter_worst
+                _merge(out, target, least * (iter_best or 0) + best[node] + b,
+                       _add(spin_worst, _add(worst[node], w)))
+            for node in nodes:
+                if node != header:
+                    del succ[node]
+            for node in bodies[header]:
+                rep[node] = header
+            for node in list(rep):
+                if rep[node] in nodes:
+                    rep[node] = header
+            succ[header] = out
+
+        order = StaticAnalyzer._order(succ, entry)
+        if order is None:
+            problems.append("control flow from %s is not reducible" % self.name(entry))
+            return None, None, callees, graph, problems
+        best, worst = StaticAnalyzer._distances(succ, order)
+        if EXIT not in best:
+            problems.append("interrupts are never enabled again" if window else "never returns")
+            return None, None, callees, graph, problems
+        return best[EXIT], worst[EXIT], callees, graph, problems
+
+    """RESULTS"""
+
+    def subroutine(self, entry: int) -> Optional[Subroutine]:
+        """analysis of the code called at entry, None while it is still being analyzed (a recursive call)"""
+        if entry in self.subroutines:
+            return self.subroutines[entry]
+        if entry in self._in_progress:
+            return None
+        self._in_progress.add(entry)
+        sub = Subroutine(entry, self.name(entry))
+        sub.best, sub.worst, sub.calls, sub.graph, sub.problems = self._timing(entry)
+        self._in_progress.discard(entry)
+        depth = 0  # type: Optional[int]
+        for callee in sub.calls:
+            called = self.subroutines.get(callee)
+            if called is None or called.depth is None:
+                depth = None
+                break
+            depth = max(depth, 1 + called.depth)
+        sub.depth = depth
+        self.subroutines[entry] = sub
+        return sub
+
+    def main(self) -> Subroutine:
+        return self.subroutine(0)
+
+    def isr(self) -> Optional[Subroutine]:
+        if self.isr_addr not in self.operations:
+            return None
+        return self.subroutine(self.isr_addr)
+
+    def max_stack_depth(self) -> Optional[int]:
+        """deepest stack the program can reach, an interrupt pushes one row on top of the deepest call chain"""
+        main = self.main()
+        isr = self.isr()
+        if main.depth is None or (isr is not None and isr.depth is None):
+            return None
+        return main.depth + (1 + isr.depth if isr is not None else 0)
+
+    def windows(self) -> Dict[int, Tuple[Optional[int], List[str]]]:
+        """worst cycles from each reachable DISABLE INTERRUPT outside the ISR to interrupts being enabled again"""
+        self.main()
+        isr = self.isr()
+        inside = set(isr.graph) if isr is not None else set()
+        reached = set()  # type: Set[int]
+        for sub in list(self.subroutines.values()):
+            reached.update(sub.graph)
+        windows = {}  # type: Dict[int, Tuple[Optional[int], List[str]]]
+        for addr in sorted(reached - inside):
+            instr = self.operations.get(addr)
+            if isinstance(instr, op.FlowOperation) and instr.operator is F.dis_interrupt:
+                _, worst, _, _, problems = self._timing(addr, window=True)
+                windows[addr] = (worst, problems)
+        return windows
+
+    def interrupt_latency(self) -> Dict[str, object]:
+        """
+        Cycles from the interrupt line rising to the first ISR instruction: the instruction under way, any
+        interrupt disabled window including a previous interrupt's ISR, and the interrupt response. Startup
+        code before the first ENABLE INTERRUPT is not counted.
+        """
+        isr = self.isr()
+        windows = self.windows()
+        wait = C  # type: Optional[int]
+        longest = None  # type: Optional[int]
+        for addr, (worst, _) in windows.items():
+            wait = _worst(wait, worst)
+            if worst is not None and (longest is None or worst > windows[longest][0]):
+                longest = addr
+        if isr is not None:
+            wait = _worst(wait, isr.worst)
+        return {
+            "worst": _add(wait, Processor.INTERRUPT_RESPONSE_CLOCKS) if isr is not None else None,
+            "isr": isr.worst if isr is not None else None,
+            "longest_window": self.name(longest) if longest is not None else None,
+            "windows": {self.name(addr): {"worst": worst, "problems": problems}
+                        for addr, (worst, problems) in windows.items()},
+        }
+
+    def report(self) -> Dict[str, object]:
+        main = self.main()
+        isr = self.isr()
+        depth = self.max_stack_depth()
+        latency = self.interrupt_latency()
+        return {
+            "stack_length": Memory.STACK_LENGTH,
+            "max_stack_depth": depth,
+            "stack_ok": depth is not None and depth <= Memory.STACK_LENGTH,
+            "interrupt_latency": latency,
+            "main": main.report(self.names),
+            "isr": isr.report(self.names) if isr is not None else None,
+            "subroutines": [sub.report(self.names) for entry, sub in sorted(self.subroutines.items())
+                            if sub is not main and sub is not isr],
+        }
+
+    def to_json(self, path: str = None) -> str:
+        text = json.dumps(self.report(), indent=2)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+                f.write("\n")
+        return text
+
+
+def annotations(assembler: Assembler) -> Tuple[Dict[int, Tuple[int, int]], Dict[int, List[int]]]:
+    """
+    @loop and @targets comments of every source file, by the address of the instruction on their line or,
+    for a comment on a line of its own, of the next instruction
+    """
+    bounds = {}  # type: Dict[int, Tuple[int, int]]
+    targets = {}  # type: Dict[int, List[int]]
+    for source in assembler.files.values():
+        pending = []  # type: List[str]
+        for raw, (_, line, _) in zip(source.text, source.entries):
+            if ";" in raw:
+                pending.append(raw[raw.index(";"):])
+            if line is None or line.instruction_name in op.AssemblerDirective.OPS or not len(pending):
+                continue
+            for comment in pending:
+                loop = LOOP.search(comment)
+                if loop is not None:
+                    least, most = loop.group(1), loop.group(2)
+                    bounds[line.address] = (int(least), int(most)) if most is not None else (0, int(least))
+                found = TARGETS.search(comment)
+                if found is not None:
+                    targets[line.address] = list(_resolve(assembler, found.group(1).split(",")))
+            pending = []
+    return bounds, targets
+
+
+def _resolve(assembler: Assembler, names: Iterable[str]) -> Iterable[int]:
+    for name in names:
+        name = name.strip()
+        if not len(name):
+            continue
+        address = assembler.tag_addresses.get(name.lower())
+        if address is None:
+            try:
+                address = int(name, 16)
+            except ValueError:
+                raise ParseError("@targets names unknown tag %s" % name)
+        yield address
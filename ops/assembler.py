@@ -2,9 +2,13 @@
 PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
 Copyright (C) 2017  Vadim Korolik - see LICENCE
 """
-from typing import List, Dict, Callable
+import itertools
+import os
+import re
+from typing import List, Dict, Callable, Iterator, Optional, Set, Tuple
 
 import ops.operations as op
+from ops.tables import link_tables
 
 
 class ParseError(Exception):
@@ -79,64 +83,211 @@ class Line(object):
                         longest = len(instr_name)
         if self.instruction_name is None:
             raise ParseError(self.debug_string)
+        # operands that may name a constant or tag
+        self.symbols = frozenset(x for x in self.instruction_rest if isinstance(x, str))  # type: Set[str]
 
     def __repr__(self):
         return self.debug_string if self.debug_string is not None else "Error: Unknown Line"
 
+    def move(self, address: hex, tag: str):
+        """place a line decoded for an earlier assembly at its new address"""
+        self.address = address
+        self.tag = tag
+        self.debug_string = "%d (tag %s): %s" % (address, tag, self.debug_string.split(": ", 1)[1])
+
     def parse(self, constants: Dict[str, hex], tag_addresses: Dict[str, hex]):
         if self.instruction_name == "ADDRESS":
             # already converted from hex by the convert_literal calc
             self.address = int(self.instruction_rest[0])
         else:
-            for idx, each in enumerate(self.instruction_rest):
+            # resolved into a copy, the symbols stay in instruction_rest for reassembly
+            rest = list(self.instruction_rest)
+            for idx, each in enumerate(rest):
                 for x in [constants, tag_addresses]:
                     if each in x.keys():
-                        self.instruction_rest[idx] = x[each]
-            self.instruction = self.instruction_class(self.instruction_operator, self.instruction_rest)
+                        rest[idx] = x[each]
+            self.instruction = self.instruction_class(self.instruction_operator, rest)
+
+
+class SourceFile(object):
+    """A PSM file and what each of its raw lines decoded to, kept across reassembly"""
+    def __init__(self, path: str):
+        self.path = path
+        # (mtime_ns, size) of the text read from disk, None for text given with Assembler.set_source
+        self.stamp = None  # type: Optional[Tuple[int, int]]
+        self.text = []  # type: List[str]
+        # per raw line: (tag, Line or None, included path or None)
+        self.entries = []  # type: List[Tuple[str, Optional[Line], Optional[str]]]
+        self.includes = []  # type: List[str]
+        # text given with set_source, the file on disk is not read
+        self.pinned = False  # type: bool
+        self.pending = None  # type: Optional[List[str]]
+
+    def update(self, text: List[str]) -> int:
+        """
+        Take new text, only lines between the unchanged head and tail are decoded again.
+        Returns the number of lines decoded.
+        """
+        old, entries = self.text, self.entries
+        head = 0
+        limit = min(len(old), len(text))
+        while head < limit and old[head] == text[head]:
+            head += 1
+        tail = 0
+        while tail < limit - head and old[len(old) - 1 - tail] == text[len(text) - 1 - tail]:
+            tail += 1
+        middle = [self.decode(raw) for raw in text[head:len(text) - tail]]
+        self.entries = entries[:head] + middle + entries[len(entries) - tail:]
+        self.text = text
+        self.includes = [include for _, _, include in self.entries if include is not None]
+        return len(middle)
+
+    def decode(self, raw: str) -> Tuple[str, Optional[Line], Optional[str]]:
+        line = raw.split(';')[0]
+        line = line.split(':')
+        tag = ""
+        if len(line) > 1:
+            tag, line = line[0].strip().lower(), "".join(line[1:])
+        else:
+            line = line[0]
+        line = line.strip()
+        if not len(line):
+            return tag, None, None
+        include = Assembler.INCLUDE.match(line)
+        if include is not None:
+            return tag, None, os.path.normpath(os.path.join(os.path.dirname(self.path), include.group(1)))
+        return tag, Line(0, line, tag), None
 
 
 class Assembler(object):
+    """
+    Assembles a PSM file and the files it INCLUDEs. Keep the assembler around while editing: parse() only
+    re-reads files that changed and only decodes their changed lines, convert() only resolves lines that are
+    new or name a constant or tag whose value changed. reassemble() does both and returns what changed for
+    Processor.patch.
+    """
+    INCLUDE = re.compile(r'INCLUDE\s+"([^"]+)"', re.IGNORECASE)
+
     def set_constant(self, l: Line):
         self.constants[l.instruction_rest[0]] = l.instruction_rest[1]
 
     def __init__(self, path: str):
-        self.path = path
+        self.path = os.path.normpath(path)
         self.instructions = []  # type: List[Line]
         self.tag_addresses = {}  # type: Dict[str, hex]
         self.start_address = 0x0  # type: hex
         self.constants = {}  # type: Dict[str, hex]
+        # every file reached from path, the include graph is SourceFile.includes
+        self.files = {}  # type: Dict[str, SourceFile]
+        self.operations = {}  # type: Dict[int, op.Instruction]
+        # lines decoded by the last parse() and resolved by the last convert()
+        self.decoded = 0  # type: int
+        self.resolved = 0  # type: int
+        # what every constant and tag name resolved to in the last convert()
+        self._symbols = {}  # type: Dict[str, object]
+
+    def set_source(self, path: str, text: str):
+        """assemble text instead of the file at path from now on, for unsaved editor buffers"""
+        path = os.path.normpath(path)
+        source = self.files.get(path)
+        if source is None:
+            source = self.files[path] = SourceFile(path)
+        source.pinned = True
+        source.pending = text.splitlines()
+
+    def _load(self, path: str) -> SourceFile:
+        source = self.files.get(path)
+        if source is None:
+            source = self.files[path] = SourceFile(path)
+        if source.pending is not None:
+            self.decoded += source.update(source.pending)
+            source.pending = None
+        elif not source.pinned:
+            st = os.stat(path)
+            stamp = (st.st_mtime_ns, st.st_size)
+            if stamp != source.stamp:
+                with open(path) as f:
+                    self.decoded += source.update(f.read().splitlines())
+                source.stamp = stamp
+        return source
+
+    def _entries(self, path: str, including: List[str], seen: Set[str]) -> Iterator[Tuple[str, Optional[Line]]]:
+        """(tag, line) for every raw line of path with INCLUDEs expanded in place"""
+        if path in including:
+            raise ParseError("INCLUDE loop %s" % " -> ".join(including + [path]))
+        if path in seen:
+            # its lines and tags would be placed twice
+            raise ParseError("%s is included more than once" % path)
+        seen.add(path)
+        including.append(path)
+        for tag, line, include in self._load(path).entries:
+            if include is not None:
+                yield tag, None
+                yield from self._entries(include, including, seen)
+            else:
+                yield tag, line
+        including.pop()
 
     def parse(self):
-        with open(self.path) as f:
-            counter = 0
-            tag = ""
-            for line in f.readlines():
-                line = line.split(';')[0]
-                line = line.split(':')
-                if len(line) > 1:
-                    tag, line = line[0].strip().lower(), "".join(line[1:])
-                else:
-                    line = line[0]
-                line = line.strip()
-                if not len(line):
-                    continue
-                l = Line(self.start_address + counter, line, tag)
-                if l.instruction_name == "CONSTANT":
-                    self.set_constant(l)
-                else:
-                    self.instructions.append(l)
-
-                # set tag constants (addresses)
-                if len(tag):
-                    self.tag_addresses[tag] = self.start_address + counter
-                    tag = ""
-
-                if l.instruction_name not in op.AssemblerDirective.OPS.keys():
-                    counter += 1
+        self.decoded = 0
+        self.instructions = []
+        self.tag_addresses = {}
+        self.constants = {}
+        counter = 0
+        tag = ""
+        directives = op.AssemblerDirective.OPS
+        append = self.instructions.append
+        for line_tag, l in self._entries(self.path, [], set()):
+            if line_tag:
+                tag = line_tag
+            if l is None:
+                continue
+            address = self.start_address + counter
+            if l.address != address or l.tag != tag:
+                l.move(address, tag)
+            if l.instruction_name == "CONSTANT":
+                self.set_constant(l)
+            else:
+                append(l)
+
+            # set tag constants (addresses)
+            if tag:
+                self.tag_addresses[tag] = address
+                tag = ""
+
+            if l.instruction_name not in directives:
+                counter += 1
+
+    def symbols(self) -> Dict[str, object]:
+        """what each constant and tag name resolves to, following Line.parse"""
+        resolved = {}  # type: Dict[str, object]
+        for name in itertools.chain(self.constants, self.tag_addresses):
+            value = self.constants.get(name, name)
+            resolved[name] = self.tag_addresses.get(value, value) if isinstance(value, str) else value
+        return resolved
 
     def convert(self) -> Dict[int, op.Instruction]:
+        symbols = self.symbols()
+        previous = self._symbols
+        changed = {name for name in set(symbols) | set(previous) if symbols.get(name) != previous.get(name)}
         operations = {}  # type: Dict[int, op.Instruction]
+        self.resolved = 0
         for instr in self.instructions:
-            instr.parse(self.constants, self.tag_addresses)
+            # instructions do not depend on their own address, moved lines keep theirs
+            if instr.instruction is None or (changed and not changed.isdisjoint(instr.symbols)):
+                instr.parse(self.constants, self.tag_addresses)
+                self.resolved += 1
             operations[instr.address] = instr.instruction
+        link_tables(operations, self.operations)
+        self._symbols = symbols
+        self.operations = operations
         return operations
+
+    def reassemble(self) -> Tuple[Dict[int, op.Instruction], List[int]]:
+        """parse() and convert() again, returns the instructions that changed by address and the removed addresses"""
+        old = self.operations
+        self.parse()
+        new = self.convert()
+        changes = {address: instr for address, instr in new.items() if old.get(address) is not instr}
+        removed = [address for address in old if address not in new]
+        return changes, removed
@@ -0,0 +1,235 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+from typing import List, Dict, Callable, Tuple
+
+import ops.operations as op
+from system.memory import Memory
+from system.processor import Processor
+
+
+def is_arithmetic(instr: op.Instruction) -> bool:
+    return isinstance(instr, (op.ArithmeticOperation, op.SlowArithmeticOperation))
+
+
+def is_compare(instr: op.Instruction) -> bool:
+    return isinstance(instr, op.CompareOperation)
+
+
+def is_load(instr: op.Instruction) -> bool:
+    return isinstance(instr, op.DataOperation) and instr.operator is op.DataOperation.load
+
+
+def is_output(instr: op.Instruction) -> bool:
+    return isinstance(instr, op.DataOperation) and instr.operator is op.DataOperation.output
+
+
+CONDITIONAL_JUMPS = (
+    op.FlowOperation.jump_c,
+    op.FlowOperation.jump_nc,
+    op.FlowOperation.jump_z,
+    op.FlowOperation.jump_nz,
+)
+
+
+def is_conditional_jump(instr: op.Instruction) -> bool:
+    return isinstance(instr, op.FlowOperation) and instr.operator in CONDITIONAL_JUMPS
+
+
+# longest patterns first, the first match at an address wins
+FUSION_PATTERNS = [
+    (is_arithmetic, is_compare, is_conditional_jump),
+    (is_compare, is_conditional_jump),
+    (is_arithmetic, is_conditional_jump),
+    (is_load, is_output),
+]  # type: List[Tuple[Callable[[op.Instruction], bool], ...]]
+
+
+class FusedOperation(op.Instruction):
+    """
+    Superinstruction executing a straight-line group of instructions in a single dispatch.
+    Only the last member may change the pc non-linearly, every earlier member just increments it.
+    If an interrupt becomes pending between members, execution stops at the boundary so that the
+    next Processor.execute takes it exactly where the unfused program would have.
+    """
+    __slots__ = ("instructions",)
+
+    def __init__(self, instructions: List[op.Instruction]):
+        self.instructions = instructions
+
+    def exec(self, proc: Processor):
+        self.instructions[0].exec(proc)
+        for instr in self.instructions[1:]:
+            if proc.interrupt_enabled and proc.interrupt:
+                return
+            # Processor.execute only accounts for the first member
+            proc.cycles += Processor.CLOCKS_PER_INSTRUCTION
+            instr.exec(proc)
+
+    def __repr__(self):
+        return self.__class__.__name__ + " " + " + ".join(repr(x) for x in self.instructions)
+
+
+class FusedPair(FusedOperation):
+    __slots__ = ("first", "second")
+
+    def __init__(self, instructions: List[op.Instruction]):
+        super(FusedPair, self).__init__(instructions)
+        self.first, self.second = instructions
+
+    def exec(self, proc: Processor):
+        self.first.exec(proc)
+        if proc.interrupt_enabled and proc.interrupt:
+            return
+        proc.cycles += Processor.CLOCKS_PER_INSTRUCTION
+        self.second.exec(proc)
+
+
+class CompareJump(FusedOperation):
+    """COMPARE or TEST followed by a conditional JUMP, flags and branch are computed inline"""
+    CONDITIONS = {
+        op.FlowOperation.jump_c: (True, True),
+        op.FlowOperation.jump_nc: (True, False),
+        op.FlowOperation.jump_z: (False, True),
+        op.FlowOperation.jump_nz: (False, False),
+    }  # type: Dict[Callable[[Processor], None], Tuple[bool, bool]]
+
+    __slots__ = ("test", "register", "argument", "literal", "on_carry", "when", "target", "jump_address",
+                 "fallthrough")
+
+    def __init__(self, instructions: List[op.Instruction], address: int):
+        super(CompareJump, self).__init__(instructions)
+        compare, jump = instructions
+        self.test = compare.operator is op.CompareOperation.test
+        self.register = compare.o_args[0].lower()
+        if isinstance(compare.o_args[1], int):
+            self.argument = None
+            self.literal = compare.o_args[1]
+        else:
+            self.argument = compare.o_args[1].lower()
+            self.literal = None
+        self.on_carry, self.when = CompareJump.CONDITIONS[jump.operator]
+        self.target = jump.address
+        self.jump_address = address + 1
+        self.fallthrough = address + 2
+
+    def exec(self, proc: Processor):
+        registers = proc.memory.REGISTERS
+        a = registers[self.register].value
+        b = self.literal if self.argument is None else registers[self.argument].value
+        if self.test:
+            v = a & b
+            if v:
+                proc.set_zero(True)
+            proc.set_carry(op.CompareOperation.odd_parity(v))
+        elif a == b:
+            proc.set_zero(True)
+        elif a < b:
+            proc.set_carry(True)
+
+        if proc.interrupt_enabled and proc.interrupt:
+            proc.manager.jump(self.jump_address)
+            return
+        proc.cycles += Processor.CLOCKS_PER_INSTRUCTION
+        flag = proc.p_carry if self.on_carry else proc.p_zero
+        proc.manager.jump(self.target if flag is self.when else self.fallthrough)
+
+
+class LoadOutput(FusedOperation):
+    """LOAD followed by an OUTPUT, a constant loaded into the output register is written out directly"""
+    __slots__ = ("load_register", "load_source", "load_bits", "load_value", "out_register", "port_register", "port",
+                 "direct", "output_address", "fallthrough")
+
+    def __init__(self, instructions: List[op.Instruction], address: int):
+        super(LoadOutput, self).__init__(instructions)
+        load, output = instructions
+        self.load_register = load.register.lower()
+        if isinstance(load.second, int):
+            self.load_source = None
+            row = Memory.MEMORY_IMPL(Memory.REGISTER_WIDTH, False)
+            row.set_value(load.second)
+            self.load_bits = tuple(row.values)
+            self.load_value = row.value
+        else:
+            self.load_source = load.second.lower()
+            self.load_bits = None
+            self.load_value = None
+        self.out_register = output.register.lower()
+        if isinstance(output.second, int):
+            self.port_register = None
+            self.port = output.second
+        else:
+            self.port_register = output.second.lower()
+            self.port = None
+        # the OUTPUT sends the constant just loaded, no need to read it back from the register
+        self.direct = self.load_source is None and self.out_register == self.load_register
+        self.output_address = address + 1
+        self.fallthrough = address + 2
+
+    def exec(self, proc: Processor):
+        registers = proc.memory.REGISTERS
+        if self.load_source is None:
+            registers[self.load_register].values = list(self.load_bits)
+        else:
+            registers[self.load_register].values = list(registers[self.load_source].values)
+
+        if proc.interrupt_enabled and proc.interrupt:
+            proc.manager.jump(self.output_address)
+            return
+        proc.cycles += Processor.CLOCKS_PER_INSTRUCTION
+        proc.set_port_id(self.port if self.port_register is None else registers[self.port_register].value)
+        proc.set_out_port(self.load_value if self.direct else registers[self.out_register].value)
+        proc.set_write_strobe(True)
+        proc.manager.jump(self.fallthrough)
+
+
+class Fuser(object):
+    """
+    Post-assembly peephole pass over Assembler.convert() output.
+    Every address keeps an entry: a fused group starts at its head address, and addresses covered by a
+    group keep their own (possibly shorter fused) instruction, so branches into the middle still work.
+    """
+    def __init__(self, operations: Dict[int, op.Instruction]):
+        self.operations = operations
+        # head address -> addresses of every member of the group
+        self.address_map = {}  # type: Dict[int, Tuple[int, ...]]
+
+    def match(self, address: int) -> List[op.Instruction]:
+        for pattern in FUSION_PATTERNS:
+            group = []  # type: List[op.Instruction]
+            for offset, predicate in enumerate(pattern):
+                instr = self.operations.get(address + offset)
+                if instr is None or not predicate(instr):
+                    break
+                group.append(instr)
+            else:
+                return group
+        return []
+
+    @staticmethod
+    def build(group: List[op.Instruction], address: int) -> FusedOperation:
+        if len(group) == 3:
+            # the compare + jump tail is fused inline as well
+            return FusedPair([group[0], CompareJump(group[1:], address + 1)])
+        if is_compare(group[0]):
+            return CompareJump(group, address)
+        if is_load(group[0]):
+            return LoadOutput(group, address)
+        return FusedPair(group)
+
+    def fuse(self) -> Dict[int, op.Instruction]:
+        fused = {}  # type: Dict[int, op.Instruction]
+        self.address_map = {}
+        for address, instr in self.operations.items():
+            group = self.match(address)
+            if not len(group):
+                fused[address] = instr
+                continue
+            fused[address] = Fuser.build(group, address)
+            self.address_map[address] = tuple(range(address, address + len(group)))
+        return fused
+
+
+def fuse(operations: Dict[int, op.Instruction]) -> Dict[int, op.Instruction]:
+    return Fuser(operations).fuse()
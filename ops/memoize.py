@@ -0,0 +1,319 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+from collections import OrderedDict
+from typing import List, Dict, Callable, Union, Tuple, Optional, Set
+
+import ops.operations as op
+from system.memory import Memory
+from system.processor import Processor, installed_hook
+
+
+def is_register(arg: Union[str, int]) -> bool:
+    return isinstance(arg, str)
+
+
+def register_name(arg: str) -> str:
+    # Memory.REGISTERS is keyed by lower case names, keep cache keys consistent with it
+    return arg.lower()
+
+
+class Summary(object):
+    """Registers and scratchpad addresses a subroutine reads and writes, None if it is not pure"""
+    def __init__(self):
+        self.reg_reads = set()  # type: Set[str]
+        self.reg_writes = set()  # type: Set[str]
+        self.mem_reads = set()  # type: Set[int]
+        self.mem_writes = set()  # type: Set[int]
+
+    def merge(self, other: 'Summary'):
+        self.reg_reads |= other.reg_reads
+        self.reg_writes |= other.reg_writes
+        self.mem_reads |= other.mem_reads
+        self.mem_writes |= other.mem_writes
+
+    @property
+    def footprint(self) -> int:
+        return len(self.mem_reads | self.mem_writes)
+
+
+class PurityAnalyzer(object):
+    """
+    Finds subroutines of an assembled program that are pure functions of the registers, flags and
+    constant scratchpad addresses they read: no I/O, no interrupt enable changes, no computed jumps.
+    """
+    MAX_SCRATCHPAD_FOOTPRINT = 16  # type: int
+
+    IMPURE_FLOW = (
+        op.FlowOperation.jump_at,
+        op.FlowOperation.call_at,
+        op.FlowOperation.en_interrupt,
+        op.FlowOperation.dis_interrupt,
+        op.FlowOperation.return_i_disable,
+        op.FlowOperation.return_i_enable,
+    )
+    RETURNS = (
+        op.FlowOperation.return_,
+    )
+    CONDITIONAL_RETURNS = (
+        op.FlowOperation.return_c,
+        op.FlowOperation.return_nc,
+        op.FlowOperation.return_nz,
+        op.FlowOperation.return_z,
+    )
+    CALLS = (
+        op.FlowOperation.call,
+        op.FlowOperation.call_c,
+        op.FlowOperation.call_nc,
+        op.FlowOperation.call_nz,
+        op.FlowOperation.call_z,
+    )
+    JUMPS = (
+        op.FlowOperation.jump,
+    )
+
+    def __init__(self, operations: Dict[int, op.Instruction]):
+        self.operations = operations
+        self.summaries = {}  # type: Dict[int, Optional[Summary]]
+        self._in_progress = set()  # type: Set[int]
+
+    def analyze(self, entry: int) -> Optional[Summary]:
+        if entry in self.summaries:
+            return self.summaries[entry]
+        if entry in self._in_progress:
+            # recursion can not be bounded statically
+            return None
+        self._in_progress.add(entry)
+        summary = self._walk(entry)
+        self._in_progress.discard(entry)
+        if summary is not None and summary.footprint > PurityAnalyzer.MAX_SCRATCHPAD_FOOTPRINT:
+            summary = None
+        self.summaries[entry] = summary
+        return summary
+
+    def _walk(self, entry: int) -> Optional[Summary]:
+        summary = Summary()
+        pending = [entry]
+        visited = set()  # type: Set[int]
+        while len(pending):
+            addr = pending.pop()
+            if addr in visited:
+                continue
+            visited.add(addr)
+            instr = self.operations.get(addr)
+            if instr is None:
+                return None
+            successors = self._instruction(instr, addr, summary)
+            if successors is None:
+                return None
+            pending.extend(successors)
+        return summary
+
+    def _instruction(self, instr: op.Instruction, addr: int, summary: Summary) -> Optional[List[int]]:
+        nxt = (addr + 1) % Memory.PROGRAM_LENGTH
+        if isinstance(instr, (op.ArithmeticOperation, op.LogicOperation)):
+            summary.reg_reads.add(register_name(instr.register))
+            if not instr.literal:
+                summary.reg_reads.add(register_name(instr.argument))
+            summary.reg_writes.add(register_name(instr.register))
+        elif isinstance(instr, op.SlowArithmeticOperation):
+            summary.reg_reads.update(register_name(x) for x in instr.o_args if is_register(x))
+            summary.reg_writes.add(register_name(instr.register))
+        elif isinstance(instr, op.BitwiseOperation):
+            summary.reg_reads.add(register_name(instr.register))
+            summary.reg_writes.add(register_name(instr.register))
+        elif isinstance(instr, op.CompareOperation):
+            summary.reg_reads.update(register_name(x) for x in instr.o_args if is_register(x))
+        elif isinstance(instr, op.DataOperation):
+            if instr.operator is op.DataOperation.load:
+                if is_register(instr.second):
+                    summary.reg_reads.add(register_name(instr.second))
+                summary.reg_writes.add(register_name(instr.register))
+            elif instr.operator in (op.DataOperation.fetch, op.DataOperation.store):
+                # register indirect addressing makes the footprint unbounded
+                if is_register(instr.second):
+                    return None
+                if instr.operator is op.DataOperation.fetch:
+                    summary.mem_reads.add(instr.second)
+                    summary.reg_writes.add(register_name(instr.register))
+                else:
+                    summary.reg_reads.add(register_name(instr.register))
+                    summary.mem_writes.add(instr.second)
+            else:
+                # port I/O
+                return None
+        elif isinstance(instr, op.FlowOperation):
+            if instr.operator in PurityAnalyzer.IMPURE_FLOW:
+                return None
+            if instr.operator in PurityAnalyzer.RETURNS:
+                return []
+            if instr.operator in PurityAnalyzer.CONDITIONAL_RETURNS:
+                return [nxt]
+            if instr.operator in PurityAnalyzer.JUMPS:
+                return [instr.address % Memory.PROGRAM_LENGTH]
+            if instr.operator in PurityAnalyzer.CALLS:
+                callee = self.analyze(instr.address % Memory.PROGRAM_LENGTH)
+                if callee is None:
+                    return None
+                summary.merge(callee)
+                return [nxt]
+            # conditional jumps
+            return [nxt, instr.address % Memory.PROGRAM_LENGTH]
+        else:
+            return None
+        return [nxt]
+
+
+class CacheEntry(object):
+    def __init__(self, registers: List[Tuple[str, int]], data: List[Tuple[int, int]], carry: bool, zero: bool,
+                 pc_offset: int, cycles: int, depth: int):
+        self.registers = registers
+        self.data = data
+        self.carry = carry
+        self.zero = zero
+        # return address relative to the call site, so call sites of one subroutine can share a cache
+        self.pc_offset = pc_offset
+        self.cycles = cycles
+        self.depth = depth
+
+
+class MemoizedCall(op.Instruction):
+    """
+    Replaces a CALL to a pure subroutine. The first call with a given input state runs the subroutine to
+    completion and records its effects, repeated calls apply them with one lookup and a cycle counter bump.
+    The input state covers every register and scratchpad address the subroutine may write as well as those
+    it reads, so replaying all of them is right for paths that leave some untouched.
+    A replayed subroutine runs atomically, so the call falls back to a plain CALL whenever an interrupt is
+    pending. An interrupt the harness raises while a call is recorded is taken inside the subroutine as usual
+    and that call is not cached.
+    """
+    CONDITIONS = {
+        op.FlowOperation.call: lambda p: True,
+        op.FlowOperation.call_c: lambda p: p.external.carry is True,
+        op.FlowOperation.call_nc: lambda p: p.external.carry is False,
+        op.FlowOperation.call_nz: lambda p: p.external.zero is False,
+        op.FlowOperation.call_z: lambda p: p.external.zero is True,
+    }  # type: Dict[Callable[[Processor], None], Callable[[Processor], bool]]
+
+    __slots__ = ("call", "condition", "reg_reads", "reg_writes", "mem_reads", "mem_writes", "key_registers",
+                 "key_data", "cache_size", "cache", "hits", "misses")
+
+    MAX_STEPS = 100000  # type: int
+    CACHE_SIZE = 4096  # type: int
+
+    def __init__(self, call: op.FlowOperation, summary: Summary, cache_size: int = CACHE_SIZE):
+        self.call = call
+        self.condition = MemoizedCall.CONDITIONS[call.operator]
+        self.reg_reads = sorted(summary.reg_reads)  # type: List[str]
+        self.reg_writes = sorted(summary.reg_writes)  # type: List[str]
+        self.mem_reads = sorted(summary.mem_reads)  # type: List[int]
+        self.mem_writes = sorted(summary.mem_writes)  # type: List[int]
+        self.key_registers = sorted(summary.reg_reads | summary.reg_writes)  # type: List[str]
+        self.key_data = sorted(summary.mem_reads | summary.mem_writes)  # type: List[int]
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # type: OrderedDict
+        self.hits = 0  # type: int
+        self.misses = 0  # type: int
+
+    def key(self, proc: Processor) -> tuple:
+        mem = proc.memory
+        return (proc.p_carry, proc.p_zero,
+                tuple(mem.fetch_register(r) for r in self.key_registers),
+                tuple(mem.fetch_data(a) for a in self.key_data))
+
+    def exec(self, proc: Processor):
+        if (proc.interrupt_enabled and proc.interrupt) or not self.condition(proc):
+            self.call.exec(proc)
+            return
+
+        key = self.key(proc)
+        entry = self.cache.get(key)
+        mem = proc.memory
+        if entry is not None and mem.stack_pointer + entry.depth <= Memory.STACK_LENGTH:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            for reg, val in entry.registers:
+                mem.set_register(reg, val)
+            for addr, val in entry.data:
+                mem.store_data(addr, val)
+            # leave the return address in the stack memory like the real call would
+            mem.push_stack(proc.manager.pc)
+            mem.pop_stack()
+            proc.set_carry(entry.carry)
+            proc.set_zero(entry.zero)
+            proc.manager.jump(proc.manager.pc + entry.pc_offset)
+            proc.cycles += entry.cycles
+            return
+
+        self.misses += 1
+        self.record(proc, key)
+
+    def record(self, proc: Processor, key: tuple):
+        mem = proc.memory
+        entry_sp = mem.stack_pointer
+        call_pc = proc.manager.pc
+        start_cycles = proc.cycles
+        self.call.exec(proc)
+        depth = mem.stack_pointer - entry_sp
+        steps = 0
+        interrupted = []  # type: List[int]
+        previous = installed_hook(proc, "enter_interrupt")
+        enter_interrupt = proc.enter_interrupt
+
+        def recorded_interrupt():
+            interrupted.append(proc.cycles)
+            enter_interrupt()
+
+        proc.enter_interrupt = recorded_interrupt
+        try:
+            while mem.stack_pointer > entry_sp:
+                if steps > MemoizedCall.MAX_STEPS:
+                    # let the processor finish the subroutine normally, it is not worth caching
+                    return
+                proc.execute()
+                depth = max(depth, mem.stack_pointer - entry_sp)
+                steps += 1
+        finally:
+            if previous is not None:
+                proc.enter_interrupt = previous
+            else:
+                del proc.enter_interrupt
+        if len(interrupted):
+            # the ISR's effects and cycles are not part of the subroutine
+            return
+
+        self.cache[key] = CacheEntry([(r, mem.fetch_register(r)) for r in self.reg_writes],
+                                     [(a, mem.fetch_data(a)) for a in self.mem_writes],
+                                     proc.p_carry, proc.p_zero, proc.manager.pc - call_pc,
+                                     proc.cycles - start_cycles, depth)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+
+class Memoizer(object):
+    def __init__(self, operations: Dict[int, op.Instruction], cache_size: int = MemoizedCall.CACHE_SIZE):
+        self.operations = operations
+        self.cache_size = cache_size
+        self.analyzer = PurityAnalyzer(operations)
+
+    def memoize(self) -> Dict[int, op.Instruction]:
+        memoized = {}  # type: Dict[int, op.Instruction]
+        calls = {}  # type: Dict[int, List[MemoizedCall]]
+        for address, instr in self.operations.items():
+            memoized[address] = instr
+            if isinstance(instr, op.FlowOperation) and instr.operator in PurityAnalyzer.CALLS:
+                target = instr.address % Memory.PROGRAM_LENGTH
+                summary = self.analyzer.analyze(target)
+                if summary is not None:
+                    memoized[address] = MemoizedCall(instr, summary, self.cache_size)
+                    calls.setdefault(target, []).append(memoized[address])
+        # call sites of the same subroutine share one cache
+        for sites in calls.values():
+            for site in sites[1:]:
+                site.cache = sites[0].cache
+        return memoized
+
+
+def memoize(operations: Dict[int, op.Instruction]) -> Dict[int, op.Instruction]:
+    return Memoizer(operations).memoize()
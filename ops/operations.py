@@ -2,18 +2,33 @@
 PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
 Copyright (C) 2017  Vadim Korolik - see LICENCE
 """
-import inspect
 import operator
-import sys
 from functools import reduce
 
-from typing import List, Dict, Callable, Union, Tuple
+from typing import List, Dict, Callable, Union, Tuple, Optional
 
 from system.memory import Memory
 from system.processor import Processor
 
 
+def resolve_register(arg: Union[str, int]) -> Optional[str]:
+    """Memory.REGISTERS key of a register operand, None for a literal"""
+    return arg.lower() if isinstance(arg, str) else None
+
+
+def literal_bits(value: int) -> Tuple[bool, ...]:
+    row = Memory.MEMORY_IMPL(Memory.REGISTER_WIDTH, False)
+    row.set_value(value)
+    return tuple(row.values)
+
+
 class Instruction(object):
+    """
+    Decoded instructions are immutable flyweights: operands are resolved when decoding and exec only
+    touches the processor it is given, so one decoded program can be shared by any number of processors.
+    """
+    __slots__ = ()
+
     OPS = {}
 
     def exec(self, proc: Processor):
@@ -24,6 +39,8 @@ class Instruction(object):
 
 
 class AssemblerDirective(Instruction):
+    __slots__ = ()
+
     OPS = {
         "ADDRESS": None,
         "CONSTANT": None
@@ -31,68 +48,68 @@ class AssemblerDirective(Instruction):
 
 
 class BitwiseOperation(Instruction):
-    def rotate_left(self, register_row: Memory.MEMORY_IMPL) -> List[bool]:
+    def rotate_left(self, proc: Processor, register_row: Memory.MEMORY_IMPL) -> List[bool]:
         bits = register_row.values[1:8]
         bits.append(register_row.values[0])
-        self.proc.set_carry(register_row.values[0])
+        proc.set_carry(register_row.values[0])
         return bits
 
-    def rotate_right(self, register_row: Memory.MEMORY_IMPL) -> List[bool]:
+    def rotate_right(self, proc: Processor, register_row: Memory.MEMORY_IMPL) -> List[bool]:
         bits = [register_row.values[7]]
         bits += register_row.values[0:7]
-        self.proc.set_carry(register_row.values[7])
+        proc.set_carry(register_row.values[7])
         return bits
 
-    def shift_left_zero(self, register_row: Memory.MEMORY_IMPL) -> List[bool]:
+    def shift_left_zero(self, proc: Processor, register_row: Memory.MEMORY_IMPL) -> List[bool]:
         bits = register_row.values[1:8]
         bits.append(False)
-        self.proc.set_carry(register_row.values[0])
+        proc.set_carry(register_row.values[0])
         return bits
 
-    def shift_left_one(self, register_row: Memory.MEMORY_IMPL) -> List[bool]:
+    def shift_left_one(self, proc: Processor, register_row: Memory.MEMORY_IMPL) -> List[bool]:
         bits = register_row.values[1:8]
         bits.append(True)
-        self.proc.set_carry(register_row.values[0])
-        self.proc.set_zero(False)
+        proc.set_carry(register_row.values[0])
+        proc.set_zero(False)
         return bits
 
-    def shift_left_x(self, register_row: Memory.MEMORY_IMPL) -> List[bool]:
+    def shift_left_x(self, proc: Processor, register_row: Memory.MEMORY_IMPL) -> List[bool]:
         bits = register_row.values[1:8]
         bits.append(register_row.values[7])
-        self.proc.set_carry(register_row.values[0])
+        proc.set_carry(register_row.values[0])
         return bits
 
-    def shift_left_a(self, register_row: Memory.MEMORY_IMPL, carry: bool = False) -> List[bool]:
+    def shift_left_a(self, proc: Processor, register_row: Memory.MEMORY_IMPL, carry: bool = False) -> List[bool]:
         bits = register_row.values[1:8]
         bits.append(bool(carry))
-        self.proc.set_carry(register_row.values[0])
-        self.proc.set_zero(False)
+        proc.set_carry(register_row.values[0])
+        proc.set_zero(False)
         return bits
 
-    def shift_right_zero(self, register_row: Memory.MEMORY_IMPL) -> List[bool]:
+    def shift_right_zero(self, proc: Processor, register_row: Memory.MEMORY_IMPL) -> List[bool]:
         bits = [False]
         bits += register_row.values[0:7]
-        self.proc.set_carry(register_row.values[7])
+        proc.set_carry(register_row.values[7])
         return bits
 
-    def shift_right_one(self, register_row: Memory.MEMORY_IMPL) -> List[bool]:
+    def shift_right_one(self, proc: Processor, register_row: Memory.MEMORY_IMPL) -> List[bool]:
         bits = [True]
         bits += register_row.values[0:7]
-        self.proc.set_carry(register_row.values[7])
-        self.proc.set_zero(False)
+        proc.set_carry(register_row.values[7])
+        proc.set_zero(False)
         return bits
 
-    def shift_right_x(self, register_row: Memory.MEMORY_IMPL) -> List[bool]:
+    def shift_right_x(self, proc: Processor, register_row: Memory.MEMORY_IMPL) -> List[bool]:
         bits = [register_row.values[0]]
         bits += register_row.values[0:7]
-        self.proc.set_carry(register_row.values[7])
+        proc.set_carry(register_row.values[7])
         return bits
 
-    def shift_right_a(self, register_row: Memory.MEMORY_IMPL, carry: bool = False) -> List[bool]:
+    def shift_right_a(self, proc: Processor, register_row: Memory.MEMORY_IMPL, carry: bool = False) -> List[bool]:
         bits = [bool(carry)]
         bits += register_row.values[0:7]
-        self.proc.set_carry(register_row.values[7])
-        self.proc.set_zero(False)
+        proc.set_carry(register_row.values[7])
+        proc.set_zero(False)
         return bits
 
     OPS = {
@@ -106,26 +123,27 @@ class BitwiseOperation(Instruction):
         "SRX": shift_right_x,
         "SLA": shift_left_a,
         "SRA": shift_right_a,
-    }  # type: Dict[str, Callable[[Memory.MEMORY_IMPL], List[bool]]
+    }  # type: Dict[str, Callable[[Processor, Memory.MEMORY_IMPL], List[bool]]
 
-    def __init__(self, op: Callable[[Memory.MEMORY_IMPL], List[bool]], args: List[Union[str, int]]):
+    __slots__ = ("operator", "register", "shift_carry")
+
+    def __init__(self, op: Callable[[Processor, Memory.MEMORY_IMPL], List[bool]], args: List[Union[str, int]]):
         self.operator = op
-        self.register = args[0]
-        self.proc = None  # type: Processor
-        self.reg_row = None  # type: Memory.MEMORY_IMPL
+        self.register = resolve_register(args[0])  # type: str
+        self.shift_carry = op is BitwiseOperation.shift_left_a or op is BitwiseOperation.shift_right_a  # type: bool
 
     def exec(self, proc: Processor):
-        self.proc = proc
-        self.reg_row = self.proc.memory.REGISTERS[self.register.lower()]  # retrieve register memory row
-        if self.operator is BitwiseOperation.shift_left_a or self.operator is BitwiseOperation.shift_right_a:
-            bits = self.operator(self, self.reg_row, self.proc.external.carry)
+        registers = proc.memory.REGISTERS
+        reg_row = registers[self.register]  # retrieve register memory row
+        if self.shift_carry:
+            bits = self.operator(self, proc, reg_row, proc.external.carry)
         else:
-            bits = self.operator(self, self.reg_row)
+            bits = self.operator(self, proc, reg_row)
         # directly set result to memory
-        self.proc.memory.REGISTERS[self.register.lower()].values = bits
+        registers[self.register].values = bits
 
         # increment pc
-        self.proc.manager.next()
+        proc.manager.next()
 
     def __repr__(self):
         return self.__class__.__name__ + " " + str(self.operator.__name__)
@@ -139,16 +157,18 @@ class LogicOperation(Instruction):
         "XOR": operator.xor
     }  # type: Dict[str, Callable[[bool, bool], bool]]
 
+    __slots__ = ("operator", "register", "argument", "literal", "literal_bits")
+
     def __init__(self, op: Callable[[bool, bool], bool], args: List[Union[str, int]]):
         self.operator = op
-        self.register = args[0]
-        if isinstance(args[1], str):
-            self.argument = args[1]
-            self.literal = False
+        self.register = resolve_register(args[0])  # type: str
+        self.literal = not isinstance(args[1], str)  # type: bool
+        if not self.literal:
+            self.argument = resolve_register(args[1])
+            self.literal_bits = None
         else:
-            self.argument = Memory.MEMORY_IMPL(Memory.REGISTER_WIDTH, False)
-            self.argument.set_value(args[1])
-            self.literal = True
+            self.argument = args[1]
+            self.literal_bits = literal_bits(args[1])
 
     def exec(self, processor: Processor):
         # retrieve the memory rows' binary directly without converting to decimal
@@ -157,11 +177,10 @@ class LogicOperation(Instruction):
             # look up the register binary
             bits = processor.memory.REGISTERS[self.argument].values
         else:
-            # retrieve the converted literal as binary
-            bits = self.argument.values
+            # the literal was converted to binary when decoding
+            bits = self.literal_bits
 
-        zipped = zip(reg_row, bits)
-        bits = list(map(lambda t: self.operator(t[0], t[1]), zipped))
+        bits = list(map(self.operator, reg_row, bits))
         # set the memory row bits directly
         processor.memory.REGISTERS[self.register].values = bits
 
@@ -247,46 +266,40 @@ class ArithmeticOperation(Instruction):
         "SUBCY": operator.sub,
     }
 
-    def expand(self, arg):
-        if not isinstance(arg, int) and 's' in arg:
-            return self.proc.memory.fetch_register(arg)
-        else:
-            return arg
+    __slots__ = ("operator", "register", "argument", "literal", "literal_bits")
 
     def __init__(self, op: Callable[[List[bool], List[bool]], List[bool]], args: List[Union[str, int]]):
         self.operator = op
-        self.register = args[0]
-        if isinstance(args[1], str):
-            self.argument = args[1]
-            self.literal = False
+        self.register = resolve_register(args[0])  # type: str
+        self.literal = not isinstance(args[1], str)  # type: bool
+        if not self.literal:
+            self.argument = resolve_register(args[1])
+            self.literal_bits = None
         else:
-            self.argument = Memory.MEMORY_IMPL(Memory.REGISTER_WIDTH, False)
-            self.argument.set_value(args[1])
-            self.literal = True
-        self.proc = None  # type: Processor
-        self.zero_bits = [False for _ in range(Memory.REGISTER_WIDTH)]  # type: List[bool]
+            self.argument = args[1]
+            self.literal_bits = literal_bits(args[1])
 
     def exec(self, proc: Processor):
-        self.proc = proc
-
-        first_bits = self.proc.memory.REGISTERS[self.register].values
+        registers = proc.memory.REGISTERS
+        first_bits = registers[self.register].values
         if not self.literal:
             # look up the register binary
-            second_bits = self.proc.memory.REGISTERS[self.argument].values
+            second_bits = registers[self.argument].values
         else:
-            # retrieve the converted literal as binary
-            second_bits = self.argument.values
+            # the literal was converted to binary when decoding
+            second_bits = self.literal_bits
 
         result = self.operator(first_bits, second_bits)
         # add the carry if needed
         if self.operator is ripple_add_c or ripple_sub_c:
-            self.zero_bits[len(self.zero_bits) - 1] = self.proc.external.carry
-            result = ripple_add(result, self.zero_bits)
+            carry_bits = [False] * (Memory.REGISTER_WIDTH - 1)
+            carry_bits.append(proc.external.carry)
+            result = ripple_add(result, carry_bits)
 
-        self.proc.memory.REGISTERS[self.register].values = result
+        registers[self.register].values = result
 
         # increment pc
-        self.proc.manager.next()
+        proc.manager.next()
 
 
 # 67% slower than ArithmeticOperation
@@ -310,31 +323,27 @@ class SlowArithmeticOperation(Instruction):
         "SUBCY": operator.sub,
     }
 
-    def expand(self, arg):
-        if not isinstance(arg, int) and 's' in arg:
-            return self.proc.memory.fetch_register(arg)
-        else:
-            return arg
+    __slots__ = ("operator", "register", "o_args", "sources")
 
     def __init__(self, op: Callable[[int, int], int], args: List[Union[str, int]]):
         self.operator = op
-        self.register = args[0]
-        self.o_args = args
-        self.args = []  # type: List[int]
-        self.proc = None  # type: Processor
+        self.register = resolve_register(args[0])  # type: str
+        self.o_args = tuple(args)  # type: Tuple[Union[str, int], ...]
+        # (register key, literal) per operand
+        self.sources = tuple((resolve_register(x), x) for x in args)  # type: Tuple[Tuple[Optional[str], int], ...]
 
     def exec(self, proc: Processor):
-        self.proc = proc
-        self.args = map(self.expand, self.o_args)  # load register values
-        val = reduce(self.operator, self.args)  # apply operator
+        registers = proc.memory.REGISTERS
+        args = [registers[reg].value if reg is not None else lit for reg, lit in self.sources]  # load register values
+        val = reduce(self.operator, args)  # apply operator
         if operator is addc or operator is subc:
-            val += int(self.proc.external.carry)
+            val += int(proc.external.carry)
         proc.memory.set_register(self.register, val)  # set result
         if operator is operator.and_ or operator is operator.or_ or operator is operator.xor:
-            self.proc.set_carry(False)
+            proc.set_carry(False)
 
         # increment pc
-        self.proc.manager.next()
+        proc.manager.next()
 
 
 class CompareOperation(Instruction):
@@ -347,73 +356,83 @@ class CompareOperation(Instruction):
 
         return parity
 
-    def comp(self, args):
+    def comp(self, proc: Processor, args: List[int]):
         if args[0] == args[1]:
-            self.proc.set_zero(True)
+            proc.set_zero(True)
         elif args[0] < args[1]:
-            self.proc.set_carry(True)
+            proc.set_carry(True)
 
-    def test(self, args):
+    def test(self, proc: Processor, args: List[int]):
         v = args[0] & args[1]
         if v:
-            self.proc.set_zero(True)
-        self.proc.set_carry(CompareOperation.odd_parity(v))
+            proc.set_zero(True)
+        proc.set_carry(CompareOperation.odd_parity(v))
 
     OPS = {
         "COMP": comp,
         "COMPARE": comp,
         "TEST": test,
-    }  # type: Dict[str, Callable[[List[Union[str, int]]], None]]
+    }  # type: Dict[str, Callable[[Processor, List[int]], None]]
 
-    def expand(self, arg):
-        if not isinstance(arg, int) and 's' in arg:
-            return self.proc.memory.fetch_register(arg)
-        else:
-            return arg
+    __slots__ = ("operator", "register", "o_args", "sources")
 
-    def __init__(self, op: Callable[[List[Union[str, int]]], None], args: List[Union[str, int]]):
+    def __init__(self, op: Callable[[Processor, List[int]], None], args: List[Union[str, int]]):
         self.operator = op
-        self.register = args[0]
-        self.o_args = args
-        self.proc = None  # type: Processor
+        self.register = resolve_register(args[0])  # type: str
+        self.o_args = tuple(args)  # type: Tuple[Union[str, int], ...]
+        # (register key, literal) per operand
+        self.sources = tuple((resolve_register(x), x) for x in args)  # type: Tuple[Tuple[Optional[str], int], ...]
 
     def exec(self, proc: Processor):
-        self.proc = proc
-        args = list(map(self.expand, self.o_args))  # load register values
-        self.operator(self, args)
+        registers = proc.memory.REGISTERS
+        args = [registers[reg].value if reg is not None else lit for reg, lit in self.sources]  # load register values
+        self.operator(self, proc, args)
 
         # increment pc
-        self.proc.manager.next()
+        proc.manager.next()
 
 
 class DataOperation(Instruction):
-    def fetch(self, args):
-        if self.proc.memory.REGISTER_WIDTH == self.proc.memory.DATA_WIDTH:
-            self.proc.memory.REGISTERS[args[0]] = self.proc.memory.DATA_MEMORY[args[1]]
+    def fetch(self, proc: Processor, args: List[Union[str, int]]):
+        mem = proc.memory
+        if mem.REGISTER_WIDTH == mem.DATA_WIDTH:
+            # copy the bits, sharing the row or its list would alias the register with the scratchpad
+            mem.REGISTERS[args[0]].values = list(mem.DATA_MEMORY[args[1] & mem.data_mask].values)
         else:
-            self.proc.memory.set_register(args[0], self.proc.memory.fetch_data(args[1]))
+            mem.set_register(args[0], mem.fetch_data(args[1] & mem.data_mask))
 
-    def store(self, args):
-        if self.proc.memory.REGISTER_WIDTH == self.proc.memory.DATA_WIDTH:
-            self.proc.memory.DATA_MEMORY[args[1]] = self.proc.memory.REGISTERS[args[0]]
+    def store(self, proc: Processor, args: List[Union[str, int]]):
+        mem = proc.memory
+        if mem.REGISTER_WIDTH == mem.DATA_WIDTH:
+            mem.DATA_MEMORY[args[1] & mem.data_mask].values = list(mem.REGISTERS[args[0]].values)
         else:
-            self.proc.memory.store_data(args[1], self.proc.memory.fetch_register(args[0]))
-
-    def input_(self, args):
-        self.proc.set_port_id(args[1])
-        self.proc.memory.set_register(args[0], self.proc.in_port)
-
-    def output(self, args):
-        self.proc.set_port_id(args[1])
-        self.proc.set_out_port(self.proc.memory.fetch_register(args[0]))
-
-    # TODO outputk
-    def outputk(self, args):
-        pass
-
-    def load(self, args):
+            mem.store_data(args[1] & mem.data_mask, mem.fetch_register(args[0]))
+
+    def input_(self, proc: Processor, args: List[Union[str, int]]):
+        proc.set_port_id(args[1])
+        # external logic may drive in_port in response to the read strobe
+        proc.set_read_strobe(True)
+        proc.memory.set_register(args[0], proc.in_port)
+
+    def output(self, proc: Processor, args: List[Union[str, int]]):
+        proc.set_port_id(args[1])
+        proc.set_out_port(proc.memory.fetch_register(args[0]))
+        proc.set_write_strobe(True)
+
+    def outputk(self, proc: Processor, args: List[Union[str, int]]):
+        # OUTPUTK kk, p: constant kk to the 4 bit port p, strobed on k_write_strobe
+        proc.set_port_id(args[1] & 0x0F)
+        proc.set_out_port(args[0] & 0xFF)
+        proc.set_k_write_strobe(True)
+
+    def hwbuild(self, proc: Processor, args: List[Union[str, int]]):
+        proc.memory.set_register(args[0], proc.hwbuild)
+        proc.set_carry(True)
+        proc.set_zero(proc.hwbuild == 0)
+
+    def load(self, proc: Processor, args: List[Union[str, int]]):
         # load constant int (args[1] onto register args[0])
-        self.proc.memory.set_register(args[0], args[1])
+        proc.memory.set_register(args[0], args[1])
 
     OPS = {
         "FETCH": fetch,
@@ -423,109 +442,191 @@ class DataOperation(Instruction):
         "OUT": output,
         "OUTPUT": output,
         "OUTPUTK": outputk,
+        "HWBUILD": hwbuild,
         "LOAD": load,
-    }  # type: Dict[str, Callable[[List[Union[str, int]]], None]]
+    }  # type: Dict[str, Callable[[Processor, List[Union[str, int]]], None]]
+
+    __slots__ = ("operator", "register", "second", "second_register")
 
-    def __init__(self, op: Callable[[List[Union[str, int]]], None], args: List[Union[str, int]]):
+    def __init__(self, op: Callable[[Processor, List[Union[str, int]]], None], args: List[Union[str, int]]):
         self.operator = op
-        self.register = args[0]
-        self.second = args[1]
-        self.proc = None  # type: Processor
+        # OUTPUTK takes a constant where the others take a register
+        self.register = resolve_register(args[0]) if isinstance(args[0], str) else args[0]  # type: str
+        self.second = args[1] if len(args) > 1 else None  # type: Union[str, int]
+        self.second_register = resolve_register(self.second)  # type: Optional[str]
 
     def exec(self, proc: Processor):
-        self.proc = proc
-
-        if not isinstance(self.second, int) and 's' in self.second:
-            second = self.proc.memory.fetch_register(self.second)
+        if self.second_register is not None:
+            second = proc.memory.REGISTERS[self.second_register].value
         else:
             second = self.second
 
-        self.operator(self, [self.register, second])
+        self.operator(self, proc, [self.register, second])
 
         # increment pc
-        self.proc.manager.next()
+        proc.manager.next()
 
 
-class FlowOperation(Instruction):
-    def call(self):
-        self.proc.memory.push_stack(self.proc.manager.pc)
-        self.jump()
+class BankOperation(Instruction):
+    def regbank_a(self, proc: Processor):
+        proc.memory.select_bank(0)
 
-    def call_c(self):
-        self.call() if self.proc.external.carry is True else self.proc.manager.next()
+    def regbank_b(self, proc: Processor):
+        proc.memory.select_bank(1)
 
-    def call_nc(self):
-        self.call() if self.proc.external.carry is False else self.proc.manager.next()
+    def star(self, proc: Processor):
+        # STAR sX, sY: sY of the active bank (or a constant) to sX of the inactive bank
+        mem = proc.memory
+        if self.second_register is not None:
+            bits = list(mem.REGISTERS[self.second_register].values)
+        else:
+            bits = list(literal_bits(self.second))
+        mem.inactive_bank()[self.register].values = bits
 
-    def call_nz(self):
-        self.call() if self.proc.external.zero is False else self.proc.manager.next()
+    OPS = {
+        "REGBANK A": regbank_a,
+        "REGBANK B": regbank_b,
+        "STAR": star,
+    }  # type: Dict[str, Callable[[Processor], None]]
 
-    def call_z(self):
-        self.call() if self.proc.external.zero is True else self.proc.manager.next()
+    __slots__ = ("operator", "register", "second", "second_register")
 
-    def jump(self):
-        self.proc.manager.jump(self.address)
+    def __init__(self, op: Callable[[Processor], None], args: List[Union[str, int]]):
+        self.operator = op
+        self.register = resolve_register(args[0]) if len(args) else None  # type: Optional[str]
+        self.second = args[1] if len(args) > 1 else None  # type: Union[str, int]
+        self.second_register = resolve_register(self.second)  # type: Optional[str]
 
-    def jump_c(self):
-        self.jump() if self.proc.external.carry is True else self.proc.manager.next()
+    def exec(self, proc: Processor):
+        self.operator(self, proc)
+        proc.manager.next()
 
-    def jump_nc(self):
-        self.jump() if self.proc.external.carry is False else self.proc.manager.next()
 
-    def jump_nz(self):
-        self.jump() if self.proc.external.zero is False else self.proc.manager.next()
+class TableOperation(Instruction):
+    def load_return(self, proc: Processor):
+        proc.memory.REGISTERS[self.register].values = list(self.bits)
+        proc.manager.jump(proc.memory.pop_stack() + 1)
 
-    def jump_z(self):
-        self.jump() if self.proc.external.zero is True else self.proc.manager.next()
+    OPS = {
+        "LOAD&RETURN": load_return,
+    }  # type: Dict[str, Callable[[Processor], None]]
 
-    def jump_at(self):
-        upper = self.proc.memory.REGISTERS[self.address_parts[0]].values
-        lower = self.proc.memory.REGISTERS[self.address_parts[1]].values
-        # 12 bit JUMP@ instruction
-        complete_row = Memory.MEMORY_IMPL(12, False)
-        # lower 4 bits of upper segment
-        complete_row.values = upper[3:7]
-        # all of the lower segment
-        complete_row.values.extend(lower)
-        # jump to the address value
-        self.address = complete_row.value
-        self.jump()
+    __slots__ = ("operator", "register", "value", "bits", "table")
 
-    def return_(self):
-        self.proc.manager.jump(self.proc.memory.pop_stack() + Memory.PROGRAM_WIDTH)
+    def __init__(self, op: Callable[[Processor], None], args: List[Union[str, int]], table=None):
+        self.operator = op
+        self.register = resolve_register(args[0])  # type: str
+        self.value = args[1] & 0xFF  # type: int
+        self.bits = literal_bits(self.value)  # type: Tuple[bool, ...]
+        # the ops.tables.LookupTable set by link_tables, CALL@ serves linked entries without dispatching them
+        self.table = table
 
-    def return_c(self):
-        self.return_() if self.proc.external.carry is True else self.proc.manager.next()
+    def exec(self, proc: Processor):
+        self.operator(self, proc)
 
-    def return_nc(self):
-        self.return_() if self.proc.external.carry is False else self.proc.manager.next()
 
-    def return_nz(self):
-        self.return_() if self.proc.external.zero is False else self.proc.manager.next()
+class FlowOperation(Instruction):
+    def call(self, proc: Processor):
+        proc.memory.push_stack(proc.manager.pc)
+        self.jump(proc)
+
+    def call_c(self, proc: Processor):
+        self.call(proc) if proc.external.carry is True else proc.manager.next()
+
+    def call_nc(self, proc: Processor):
+        self.call(proc) if proc.external.carry is False else proc.manager.next()
 
-    def return_z(self):
-        self.return_() if self.proc.external.zero is True else self.proc.manager.next()
+    def call_nz(self, proc: Processor):
+        self.call(proc) if proc.external.zero is False else proc.manager.next()
 
-    def en_interrupt(self):
-        self.proc.set_interrupt_enabled(True)
-        self.proc.manager.next()
+    def call_z(self, proc: Processor):
+        self.call(proc) if proc.external.zero is True else proc.manager.next()
 
-    def dis_interrupt(self):
-        self.proc.set_interrupt_enabled(False)
-        self.proc.manager.next()
+    def jump(self, proc: Processor):
+        proc.manager.jump(self.address)
 
-    def return_i(self):
-        self.proc.manager.jump(self.proc.memory.pop_stack())
-        self.proc.recover_zero()
-        self.proc.recover_carry()
+    def jump_c(self, proc: Processor):
+        self.jump(proc) if proc.external.carry is True else proc.manager.next()
 
-    def return_i_disable(self):
-        self.return_i()
-        self.proc.set_interrupt_enabled(False)
+    def jump_nc(self, proc: Processor):
+        self.jump(proc) if proc.external.carry is False else proc.manager.next()
 
-    def return_i_enable(self):
-        self.return_i()
-        self.proc.set_interrupt_enabled(True)
+    def jump_nz(self, proc: Processor):
+        self.jump(proc) if proc.external.zero is False else proc.manager.next()
+
+    def jump_z(self, proc: Processor):
+        self.jump(proc) if proc.external.zero is True else proc.manager.next()
+
+    def computed_address(self, proc: Processor) -> int:
+        upper = proc.memory.REGISTERS[self.address_parts[0]].values
+        lower = proc.memory.REGISTERS[self.address_parts[1]].values
+        # 12 bit address, computed per execution so it is not stored on the instruction
+        complete_row = Memory.MEMORY_IMPL(12, False)
+        # lower 4 bits of upper segment, the rows are msb first
+        complete_row.values = upper[4:8]
+        # all of the lower segment
+        complete_row.values.extend(lower)
+        return complete_row.value
+
+    def jump_at(self, proc: Processor):
+        proc.manager.jump(self.computed_address(proc))
+
+    def call_at(self, proc: Processor):
+        mem = proc.memory
+        target = self.computed_address(proc)
+        try:
+            entry = proc.fetch_program(target % Memory.PROGRAM_LENGTH)
+        except KeyError:
+            entry = None
+        if entry.__class__ is TableOperation and entry.table is not None:
+            # a linked table entry would load and return straight away: serve it from the table and charge
+            # both instructions. The pair is one dispatch, an interrupt raised by an execute hook after the
+            # CALL@ is taken after the LOAD&RETURN instead of before it
+            table = entry.table
+            mem.push_stack(proc.manager.pc)
+            mem.REGISTERS[table.register].values = list(table.bits[target % Memory.PROGRAM_LENGTH - table.start])
+            proc.manager.jump(mem.pop_stack() + 1)
+            proc.cycles += Processor.CLOCKS_PER_INSTRUCTION
+            return
+        mem.push_stack(proc.manager.pc)
+        proc.manager.jump(target)
+
+    def return_(self, proc: Processor):
+        # the stack holds the address of the CALL, resume at the instruction after it
+        proc.manager.jump(proc.memory.pop_stack() + 1)
+
+    def return_c(self, proc: Processor):
+        self.return_(proc) if proc.external.carry is True else proc.manager.next()
+
+    def return_nc(self, proc: Processor):
+        self.return_(proc) if proc.external.carry is False else proc.manager.next()
+
+    def return_nz(self, proc: Processor):
+        self.return_(proc) if proc.external.zero is False else proc.manager.next()
+
+    def return_z(self, proc: Processor):
+        self.return_(proc) if proc.external.zero is True else proc.manager.next()
+
+    def en_interrupt(self, proc: Processor):
+        proc.set_interrupt_enabled(True)
+        proc.manager.next()
+
+    def dis_interrupt(self, proc: Processor):
+        proc.set_interrupt_enabled(False)
+        proc.manager.next()
+
+    def return_i(self, proc: Processor):
+        proc.manager.jump(proc.memory.pop_stack())
+        proc.recover_zero()
+        proc.recover_carry()
+
+    def return_i_disable(self, proc: Processor):
+        self.return_i(proc)
+        proc.set_interrupt_enabled(False)
+
+    def return_i_enable(self, proc: Processor):
+        self.return_i(proc)
+        proc.set_interrupt_enabled(True)
 
     OPS = {
         "CALL": call,
@@ -549,6 +650,7 @@ class FlowOperation(Instruction):
         "JUMP NZ": jump_nz,
         "JUMP Z": jump_z,
         "JUMP@": jump_at,
+        "CALL@": call_at,
         "EINT": en_interrupt,
         "ENABLE INTERRUPT": en_interrupt,
         "DINT": dis_interrupt,
@@ -558,24 +660,38 @@ class FlowOperation(Instruction):
         "RETI ENABLE": return_i_enable,
         "RETURNI ENABLE": return_i_enable,
 
-    }  # type: Dict[str, Callable[[], None]]
+    }  # type: Dict[str, Callable[[Processor], None]]
+
+    __slots__ = ("operator", "address", "address_parts")
 
-    def __init__(self, op: Callable[[], None], args: List[Union[hex, int, str]]):
+    def __init__(self, op: Callable[[Processor], None], args: List[Union[hex, int, str]]):
         self.operator = op
-        if self.operator is FlowOperation.jump_at:
-            self.address_parts = [args[0], args[1]]
+        if self.operator in (FlowOperation.jump_at, FlowOperation.call_at):
+            self.address = None
+            self.address_parts = (resolve_register(args[0]), resolve_register(args[1]))
         else:
             self.address = int(args[0]) if len(args) else None
-        self.proc = None  # type: Processor
+            self.address_parts = None
 
     def exec(self, proc: Processor):
-        self.proc = proc
-        self.operator(self)
-
-
-OP_CLASSES = [obj for name, obj in inspect.getmembers(sys.modules[__name__],
-                                                      lambda member: inspect.isclass(member)
-                                                      and member.__module__ == __name__)]
+        self.operator(self, proc)
+
+
+# static registry instead of scanning the module with inspect on every import, keep it sorted by class name:
+# when two classes share a mnemonic the later class wins (ADD resolves to SlowArithmeticOperation)
+OP_CLASSES = [
+    ArithmeticOperation,
+    AssemblerDirective,
+    BankOperation,
+    BitwiseOperation,
+    CompareOperation,
+    DataOperation,
+    FlowOperation,
+    Instruction,
+    LogicOperation,
+    SlowArithmeticOperation,
+    TableOperation,
+]  # type: List[type]
 
 ALL_OPS = {}
 
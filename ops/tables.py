@@ -0,0 +1,58 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+from typing import List, Dict, Tuple
+
+import ops.operations as op
+from system.memory import Memory
+
+
+class LookupTable(object):
+    """A run of LOAD&RETURN instructions at consecutive addresses loading the same register"""
+    __slots__ = ("start", "register", "data", "bits")
+
+    def __init__(self, start: int, register: str, data: bytes):
+        self.start = start
+        self.register = register
+        self.data = data
+        value_bits = Memory.bit_table(Memory.REGISTER_WIDTH)[1]
+        self.bits = tuple(value_bits[value] for value in data)  # type: Tuple[Tuple[bool, ...], ...]
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+def link_tables(operations: Dict[int, op.Instruction], previous: Dict[int, op.Instruction] = None) \
+        -> List[LookupTable]:
+    """
+    Group consecutive LOAD&RETURN instructions loading the same register into LookupTables and replace them
+    with linked copies in operations, returns the tables. Tables that are unchanged from the linked program
+    previous keep its instructions.
+    """
+    tables = []  # type: List[LookupTable]
+    addresses = sorted(a for a, instr in operations.items() if instr.__class__ is op.TableOperation)
+    idx = 0
+    while idx < len(addresses):
+        start = addresses[idx]
+        register = operations[start].register
+        end = idx + 1
+        while end < len(addresses) and addresses[end] == start + end - idx and \
+                operations[addresses[end]].register == register:
+            end += 1
+        run = addresses[idx:end]
+        data = bytes(operations[a].value for a in run)
+        old = previous.get(start) if previous is not None else None
+        if old.__class__ is op.TableOperation and old.table is not None and \
+                (old.table.start, old.table.register, old.table.data) == (start, register, data):
+            table = old.table
+            for address in run:
+                operations[address] = previous[address]
+        else:
+            table = LookupTable(start, register, data)
+            for address in run:
+                entry = operations[address]
+                operations[address] = op.TableOperation(entry.operator, [entry.register, entry.value], table)
+        tables.append(table)
+        idx = end
+    return tables
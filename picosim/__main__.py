@@ -0,0 +1,9 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import sys
+
+from picosim.cli import main
+
+sys.exit(main())
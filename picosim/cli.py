@@ -0,0 +1,588 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+
+Command line runner: python -m picosim run|bench|trace|render|batch|stimulus|analyze|faults|sweep|worker|assemble
+"""
+import argparse
+import json
+import os
+import pickle
+import resource
+import struct
+import sys
+import time
+from typing import List, Dict, IO, Optional, Tuple
+
+import ops.operations as op
+from ops.assembler import Assembler
+from ops.fusion import fuse
+from ops.memoize import memoize
+from system.memory import Memory
+from system.processor import Processor, RunResult
+from verification.faults import Fault
+
+
+def load_program(path: str, cache: Dict[str, Dict[int, op.Instruction]] = None) -> Dict[int, op.Instruction]:
+    """assemble a .psm file, anything else is a program pickled by the assemble command"""
+    if cache is not None and path in cache:
+        return cache[path]
+    if path.lower().endswith(".psm"):
+        assembler = Assembler(path)
+        assembler.parse()
+        program = assembler.convert()
+    else:
+        with open(path, "rb") as f:
+            program = pickle.load(f)
+    if cache is not None:
+        cache[path] = program
+    return program
+
+
+def optimize(program: Dict[int, op.Instruction], args: argparse.Namespace) -> Dict[int, op.Instruction]:
+    if args.memoize:
+        program = memoize(program)
+    if args.fuse:
+        program = fuse(program)
+    return program
+
+
+class Stimulus(object):
+    """
+    in_port values per port_id, one "port value" pair of hex numbers per line.
+    Every INPUT from a port takes its next value, the last value is held once the port runs dry.
+    """
+    def __init__(self, lines: List[str]):
+        self.values = {}  # type: Dict[int, List[int]]
+        self.cursor = {}  # type: Dict[int, int]
+        for line in lines:
+            line = line.split(';')[0].strip()
+            if not len(line):
+                continue
+            port, value = line.replace(',', ' ').split()
+            self.values.setdefault(int(port, 16), []).append(int(value, 16))
+
+    @staticmethod
+    def open(path: str) -> 'Stimulus':
+        if path == "-":
+            return Stimulus(sys.stdin.read().splitlines())
+        with open(path) as f:
+            return Stimulus(f.read().splitlines())
+
+    def next(self, port: int) -> Optional[int]:
+        values = self.values.get(port)
+        if values is None:
+            return None
+        idx = self.cursor.get(port, 0)
+        self.cursor[port] = min(idx + 1, len(values) - 1)
+        return values[idx]
+
+    def attach(self, proc: Processor):
+        set_read_strobe = proc.set_read_strobe
+
+        def read_strobe(val: bool):
+            set_read_strobe(val)
+            if val:
+                value = self.next(proc.p_port_id)
+                if value is not None:
+                    proc.external.set_int_port(value)
+
+        proc.set_read_strobe = read_strobe
+
+
+class PortWriter(object):
+    """Streams every OUTPUT and OUTPUTK as a JSON line or a packed (cycle, port_id, value) record"""
+    RECORD = struct.Struct("<QBB")
+
+    def __init__(self, out: IO, fmt: str):
+        self.out = out
+        self.binary = fmt == "binary"
+        self.writes = 0  # type: int
+
+    def attach(self, proc: Processor):
+        set_write_strobe = proc.set_write_strobe
+        set_k_write_strobe = proc.set_k_write_strobe
+        out = self.out
+
+        def write():
+            self.writes += 1
+            if self.binary:
+                out.write(PortWriter.RECORD.pack(proc.cycles, proc.p_port_id & 0xFF, proc.p_out_port & 0xFF))
+            else:
+                out.write('{"cycle": %d, "port": %d, "value": %d}\n' % (proc.cycles, proc.p_port_id, proc.p_out_port))
+
+        def write_strobe(val: bool):
+            set_write_strobe(val)
+            if val:
+                write()
+
+        def k_write_strobe(val: bool):
+            set_k_write_strobe(val)
+            if val:
+                write()
+
+        proc.set_write_strobe = write_strobe
+        proc.set_k_write_strobe = k_write_strobe
+
+
+def stats(proc: Processor, result: RunResult, writes: int) -> Dict[str, object]:
+    dur = result.wall_seconds
+    instructions = proc.cycles // Processor.CLOCKS_PER_INSTRUCTION
+    ops_per_sec = instructions / dur if dur > 0 else 0.0
+    return {
+        "instructions": instructions,
+        "dispatches": result.dispatches,
+        "cycles": proc.cycles,
+        "pc": proc.manager.pc,
+        "port_writes": writes,
+        "seconds": round(dur, 6),
+        "simulated_us": round(result.simulated_us, 3),
+        "realtime_ratio": round(result.realtime_ratio, 6) if dur > 0 else None,
+        "ops_per_sec": round(ops_per_sec, 1),
+        # simulated clock cycles per wall clock second
+        "eff_khz": round(result.cycles / dur / 1000.0, 1) if dur > 0 else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_memory_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def new_processor(args: argparse.Namespace) -> Processor:
+    proc = Processor(isr_addr=args.isr, clock_hz=clock_hz(args), data_length=args.scratchpad)
+    if args.preload:
+        proc.memory.load_data_file(args.preload)
+    return proc
+
+
+def run_once(program: Dict[int, op.Instruction], args: argparse.Namespace, out: IO,
+             stimulus: Stimulus = None) -> Dict[str, object]:
+    proc = new_processor(args)
+    proc.set_instructions(program)
+    if stimulus is not None:
+        stimulus.attach(proc)
+    player = None
+    if getattr(args, "playback", None):
+        from system.stimulus import StimulusPlayer
+        player = StimulusPlayer(args.playback)
+        player.attach(proc)
+    writer = None
+    if out is not None:
+        writer = PortWriter(out, args.format)
+        writer.attach(proc)
+    profiler = None
+    if getattr(args, "host_profile", None):
+        from system.hostprofile import HostProfiler
+        profiler = HostProfiler(proc)
+    analytics = None
+    if getattr(args, "analytics", None):
+        from system.analytics import PortAnalytics
+        analytics = PortAnalytics(proc)
+    publisher = server = None
+    if getattr(args, "serve", None) is not None:
+        from system.publisher import StatePublisher, StateServer
+        publisher = StatePublisher(proc, fps=args.fps)
+        server = StateServer(publisher, host=args.host, port=args.serve,
+                             protocol=StateServer.WEBSOCKET if args.websocket else StateServer.TCP)
+        print("serving state on %s:%d" % server.address, file=sys.stderr)
+    runner = profiler or publisher or proc
+    instructions, cycles, microseconds = args.instructions, args.cycles, getattr(args, "us", None)
+    checkpointer = None
+    if getattr(args, "checkpoint", None):
+        from system.checkpoint import Checkpointer, program_digest
+
+        def extras() -> Dict[str, object]:
+            return {"port_writes": writer.writes if writer is not None else 0,
+                    "stimulus": stimulus.cursor if stimulus is not None else {}}
+
+        every_seconds = args.checkpoint_seconds
+        if args.checkpoint_cycles is None and every_seconds is None:
+            every_seconds = 60.0
+        checkpointer = runner = Checkpointer(proc, args.checkpoint, every_cycles=args.checkpoint_cycles,
+                                             every_seconds=every_seconds, player=player,
+                                             digest=program_digest(load_program(args.program)),
+                                             extras=extras, runner=runner)
+        resumed = checkpointer.resume()
+        if resumed is not None:
+            # budgets count from power-on, so the interrupted command line resumes as is
+            if writer is not None:
+                writer.writes = resumed["port_writes"]
+            if stimulus is not None:
+                stimulus.cursor = {int(port): idx for port, idx in resumed["stimulus"].items()}
+            if instructions is not None:
+                instructions = max(0, instructions - checkpointer.dispatches)
+            if cycles is not None:
+                cycles = max(0, cycles - proc.cycles)
+            if microseconds is not None:
+                microseconds = max(0.0, microseconds - proc.microseconds())
+    result = runner.run(instructions=instructions, cycles=cycles, microseconds=microseconds)
+    if checkpointer is not None:
+        checkpointer.close()
+    if server is not None:
+        server.close()
+    if player is not None:
+        player.close()
+    if analytics is not None:
+        analytics.to_json(args.analytics)
+    if profiler is not None:
+        profiler.to_json(args.host_profile)
+        print(profiler.table(), file=sys.stderr)
+    return stats(proc, result, writer.writes if writer is not None else 0)
+
+
+def clock_hz(args: argparse.Namespace) -> int:
+    return int(round(getattr(args, "mhz", Processor.CLOCK_HZ / 1000000.0) * 1000000))
+
+
+def describe(instr: op.Instruction) -> str:
+    """class and operator name of an instruction, fused groups list their members"""
+    members = getattr(instr, "instructions", None)
+    if members is not None:
+        return " + ".join(describe(x) for x in members)
+    operator = getattr(instr, "operator", None)
+    if operator is None:
+        return instr.__class__.__name__
+    return instr.__class__.__name__ + " " + operator.__name__
+
+
+def output_stream(args: argparse.Namespace) -> IO:
+    return sys.stdout.buffer if args.format == "binary" else sys.stdout
+
+
+def cmd_run(args: argparse.Namespace) -> int:
+    program = optimize(load_program(args.program), args)
+    stimulus = Stimulus.open(args.stimulus) if args.stimulus else None
+    result = run_once(program, args, None if args.quiet else output_stream(args), stimulus)
+    print(json.dumps(result), file=sys.stderr)
+    return 0
+
+
+def cmd_bench(args: argparse.Namespace) -> int:
+    program = optimize(load_program(args.program), args)
+    best = None
+    for _ in range(0, args.repeat):
+        result = run_once(program, args, None)
+        if best is None or result["ops_per_sec"] > best["ops_per_sec"]:
+            best = result
+    best["repeat"] = args.repeat
+    print(json.dumps(best))
+    return 0
+
+
+def cmd_trace(args: argparse.Namespace) -> int:
+    program = optimize(load_program(args.program), args)
+    proc = new_processor(args)
+    proc.set_instructions(program)
+    if args.stimulus:
+        Stimulus.open(args.stimulus).attach(proc)
+    if args.playback:
+        from system.stimulus import StimulusPlayer
+        StimulusPlayer(args.playback).attach(proc)
+    writer = None
+    if args.vcd:
+        from system.vcd import VCDWriter
+        writer = VCDWriter(proc, args.vcd, registers=args.registers)
+    executed = 0
+    end_cycle = args.cycles
+    if args.us is not None:
+        end_cycle = proc.cycles_for(args.us) if end_cycle is None else min(end_cycle, proc.cycles_for(args.us))
+    try:
+        while not proc.outside_program():
+            if args.instructions is not None and executed >= args.instructions:
+                break
+            if end_cycle is not None and proc.cycles >= end_cycle:
+                break
+            if writer is None:
+                print("%6d %03X %s" % (proc.cycles, proc.manager.pc, describe(proc.fetch_program(proc.manager.pc))))
+            proc.execute()
+            executed += 1
+    finally:
+        if writer is not None:
+            writer.close()
+    return 0
+
+
+def cmd_batch(args: argparse.Namespace) -> int:
+    """
+    One run per manifest line: {"program": path, "instructions": n, "cycles": n, "us": n, "stimulus": path,
+    "playback": path, "preload": path, "output": path}. Programs are assembled once and shared, results are
+    printed as JSON lines.
+    """
+    cache = {}  # type: Dict[str, Dict[int, op.Instruction]]
+    with (sys.stdin if args.manifest == "-" else open(args.manifest)) as f:
+        lines = [line for line in f.read().splitlines() if len(line.strip())]
+    for line in lines:
+        job = json.loads(line)
+        run_args = argparse.Namespace(**vars(args))
+        run_args.instructions = job.get("instructions", args.instructions)
+        run_args.cycles = job.get("cycles", args.cycles)
+        run_args.us = job.get("us", args.us)
+        run_args.playback = job.get("playback")
+        run_args.preload = job.get("preload", args.preload)
+        program = optimize(load_program(job["program"], cache), run_args)
+        stimulus = Stimulus.open(job["stimulus"]) if job.get("stimulus") else None
+        out = None
+        if job.get("output"):
+            out = open(job["output"], "wb" if args.format == "binary" else "w")
+        try:
+            result = run_once(program, run_args, out, stimulus)
+        finally:
+            if out is not None:
+                out.close()
+        result["program"] = job["program"]
+        print(json.dumps(result))
+    return 0
+
+
+def cmd_assemble(args: argparse.Namespace) -> int:
+    program = load_program(args.program)
+    with open(args.output, "wb") as f:
+        pickle.dump(program, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return 0
+
+
+def cmd_analyze(args: argparse.Namespace) -> int:
+    """static report of the program, fails when the stack can overflow or the latency bound is exceeded"""
+    from ops.analysis import StaticAnalyzer
+    if args.program.lower().endswith(".psm"):
+        assembler = Assembler(args.program)
+        assembler.parse()
+        assembler.convert()
+        analyzer = StaticAnalyzer.from_assembler(assembler, args.isr)
+    else:
+        analyzer = StaticAnalyzer(load_program(args.program), args.isr)
+    report = analyzer.report()
+    text = analyzer.to_json(args.output)
+    if args.output is None:
+        print(text)
+    latency = report["interrupt_latency"]["worst"]
+    if not report["stack_ok"]:
+        return 1
+    if args.max_latency is not None and (latency is None or latency > args.max_latency):
+        return 1
+    return 0
+
+
+def cmd_faults(args: argparse.Namespace) -> int:
+    """random bit flip campaign against the golden run, prints the outcome counts"""
+    from verification.faults import Campaign
+    campaign = Campaign(load_program(args.program), args.cycles, args.isr, stimulus=args.playback,
+                        checkpoint_every=args.checkpoint_every, hang_margin=args.hang_margin, timing=args.timing,
+                        processes=args.processes, data_length=args.scratchpad)
+    faults = campaign.random_faults(args.count, args.seed, args.bits, args.targets or Fault.TARGETS)
+    start = time.perf_counter()
+    outcomes = campaign.run(faults)
+    if args.output:
+        with open(args.output, "w") as f:
+            for o in outcomes:
+                f.write(json.dumps(o.to_dict()) + "\n")
+    result = Campaign.summary(outcomes)
+    result["golden_cycles"] = campaign.end
+    result["golden_writes"] = len(campaign.writes)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    print(json.dumps(result))
+    return 0
+
+
+def address(text: str) -> Tuple[str, int]:
+    host, _, port = text.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def cmd_sweep(args: argparse.Namespace) -> int:
+    """
+    Coordinate a sweep across worker nodes, one job per manifest line: {"program": path, "cycles": n,
+    "instructions": n, "playback": path, "start": n, "isr": n}. Results are printed as JSON lines in job order.
+    """
+    from system.sweep import SweepCoordinator
+    cache = {}  # type: Dict[str, Dict[int, op.Instruction]]
+    with (sys.stdin if args.manifest == "-" else open(args.manifest)) as f:
+        lines = [line for line in f.read().splitlines() if len(line.strip())]
+    host, port = address(args.listen)
+    with SweepCoordinator(host, port, max_attempts=args.max_attempts, timeout=args.timeout) as coordinator:
+        for line in lines:
+            job = json.loads(line)
+            program = coordinator.add_program(load_program(job["program"], cache))
+            stimulus = coordinator.add_stimulus(job["playback"]) if job.get("playback") else None
+            coordinator.submit(program, cycles=job.get("cycles"), instructions=job.get("instructions"),
+                               stimulus=stimulus, start=job.get("start", 0), isr=job.get("isr", 0x3FF))
+        coordinator.start()
+        print("coordinating %d jobs on %s:%d" % ((len(lines),) + tuple(coordinator.address)), file=sys.stderr)
+        sys.stderr.flush()
+        results = coordinator.wait(args.wait)
+        for result in results:
+            print(json.dumps(result.to_dict()))
+        print(json.dumps({"nodes": coordinator.nodes, "workers_lost": coordinator.workers_lost}), file=sys.stderr)
+    return 1 if any(r.error is not None for r in results) else 0
+
+
+def cmd_worker(args: argparse.Namespace) -> int:
+    from system.sweep import SweepWorker
+    host, port = address(args.coordinator)
+    jobs = SweepWorker(host, port, processes=args.processes, cache=args.cache, heartbeat=args.heartbeat).run()
+    print(json.dumps({"jobs": jobs}), file=sys.stderr)
+    return 0
+
+
+def cmd_stimulus(args: argparse.Namespace) -> int:
+    from system.stimulus import convert_csv
+    print(json.dumps({"records": convert_csv(args.csv, args.output)}))
+    return 0
+
+
+def cmd_render(args: argparse.Namespace) -> int:
+    from hardware_sim.render import Board, PortTrace, Renderer, write_apng, write_pngs
+    import numpy as np
+    board = Board(args.cathode_port, args.anode_port, led_ports=args.led_ports, digits=args.digits,
+                  active_low=not args.active_high)
+    cycles, segments, leds = board.sample(PortTrace.load(args.trace), args.every, persistence=args.persistence)
+    frames = Renderer(scale=args.scale).render(segments, leds)
+    result = {"frames": len(frames)}  # type: Dict[str, object]
+    if args.npy:
+        np.save(args.npy, frames)
+    if args.png:
+        os.makedirs(args.png, exist_ok=True)
+        write_pngs(args.png, frames)
+    if args.apng:
+        # each frame covers `every` cycles of simulated time
+        delay_ms = max(1, int(round(args.every * 1000.0 / clock_hz(args))))
+        result["apng_frames"] = write_apng(args.apng, frames, delay_ms=delay_ms)
+    print(json.dumps(result))
+    return 0
+
+
+def parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(prog="picosim", description="PicoBlaze assembly simulator")
+    sub = p.add_subparsers(dest="command")
+    sub.required = True
+
+    def common(s: argparse.ArgumentParser, program: bool = True):
+        if program:
+            s.add_argument("program", help=".psm source or a program saved by the assemble command")
+        s.add_argument("--instructions", type=int, default=None, help="dispatch budget")
+        s.add_argument("--cycles", type=int, default=None, help="clock cycle budget")
+        s.add_argument("--us", type=float, default=None, help="simulated time budget in microseconds")
+        s.add_argument("--mhz", type=float, default=Processor.CLOCK_HZ / 1000000.0, help="simulated clock frequency")
+        s.add_argument("--isr", type=lambda x: int(x, 0), default=0x3FF, help="interrupt vector")
+        s.add_argument("--fuse", action="store_true", help="fuse common instruction pairs")
+        s.add_argument("--memoize", action="store_true", help="memoize pure subroutines")
+        s.add_argument("--format", choices=["jsonl", "binary"], default="jsonl", help="port write format")
+        s.add_argument("--scratchpad", type=int, choices=Memory.DATA_LENGTHS, default=Memory.DATA_LENGTH,
+                       help="scratchpad size in bytes")
+        s.add_argument("--preload", help="binary file loaded into the scratchpad from address 0 before the run")
+
+    s = sub.add_parser("run", help="run a program, port writes go to stdout and stats to stderr")
+    common(s)
+    s.add_argument("--stimulus", help="in_port values, '-' reads stdin")
+    s.add_argument("--playback", help="binary stimulus file driving in_port and interrupt by cycle")
+    s.add_argument("--quiet", action="store_true", help="do not stream port writes")
+    s.add_argument("--host-profile", help="sample where the simulator's time goes, JSON to this path and a table "
+                                          "to stderr")
+    s.add_argument("--analytics", help="port and interrupt statistics of the run, JSON to this path")
+    s.add_argument("--serve", type=int, default=None, metavar="PORT", help="stream state frames to viewers")
+    s.add_argument("--host", default="127.0.0.1", help="address to serve state frames on")
+    s.add_argument("--websocket", action="store_true", help="serve state frames over WebSocket instead of TCP")
+    s.add_argument("--fps", type=float, default=30.0, help="state frames per second")
+    s.add_argument("--checkpoint", help="checkpoint file, the run resumes from it when it exists. Port writes "
+                                        "made after the last checkpoint are written again")
+    s.add_argument("--checkpoint-cycles", type=int, default=None, help="simulated cycles between checkpoints")
+    s.add_argument("--checkpoint-seconds", type=float, default=None, help="wall clock seconds between checkpoints, "
+                                                                          "60 when neither interval is given")
+    s.set_defaults(func=cmd_run)
+
+    s = sub.add_parser("bench", help="run a program repeatedly and report the best throughput")
+    common(s)
+    s.add_argument("--repeat", type=int, default=5)
+    s.set_defaults(func=cmd_bench)
+
+    s = sub.add_parser("trace", help="print every executed instruction or write a VCD")
+    common(s)
+    s.add_argument("--stimulus", help="in_port values, '-' reads stdin")
+    s.add_argument("--playback", help="binary stimulus file driving in_port and interrupt by cycle")
+    s.add_argument("--vcd", help="write a Value Change Dump instead of the text trace")
+    s.add_argument("--registers", nargs="*", default=[], help="registers to include in the VCD")
+    s.set_defaults(func=cmd_trace)
+
+    s = sub.add_parser("render", help="render port writes recorded by run to seven segment display frames")
+    s.add_argument("trace", help="port writes recorded by run, jsonl or binary")
+    s.add_argument("--cathode-port", type=lambda x: int(x, 0), required=True, help="segment port_id")
+    s.add_argument("--anode-port", type=lambda x: int(x, 0), default=None, help="digit select port_id")
+    s.add_argument("--led-ports", type=lambda x: int(x, 0), nargs="*", default=[], help="LED port_ids")
+    s.add_argument("--digits", type=int, default=8)
+    s.add_argument("--active-high", action="store_true", help="segments and anodes are active high")
+    s.add_argument("--every", type=int, default=100000, help="cycles between frames")
+    s.add_argument("--persistence", type=int, default=None, help="cycles a multiplexed digit stays lit")
+    s.add_argument("--mhz", type=float, default=Processor.CLOCK_HZ / 1000000.0, help="simulated clock frequency")
+    s.add_argument("--scale", type=int, default=2)
+    s.add_argument("--png", help="directory to write one PNG per frame to")
+    s.add_argument("--apng", help="animated PNG to write")
+    s.add_argument("--npy", help="NumPy file to save the (frames, height, width, 3) stack to")
+    s.set_defaults(func=cmd_render)
+
+    s = sub.add_parser("batch", help="run every job of a JSON lines manifest in this interpreter")
+    common(s, program=False)
+    s.add_argument("manifest", help="manifest path, '-' reads stdin")
+    s.set_defaults(func=cmd_batch)
+
+    s = sub.add_parser("stimulus", help="convert a cycle,port,value CSV into a binary stimulus file")
+    s.add_argument("csv")
+    s.add_argument("-o", "--output", required=True)
+    s.set_defaults(func=cmd_stimulus)
+
+    s = sub.add_parser("analyze", help="worst case cycles, stack depth and interrupt latency without running")
+    s.add_argument("program", help=".psm source with @loop and @targets annotations, or an assembled program")
+    s.add_argument("--isr", type=lambda x: int(x, 0), default=0x3FF, help="interrupt vector")
+    s.add_argument("--max-latency", type=int, default=None, help="fail when the interrupt latency bound in "
+                                                                  "cycles is higher")
+    s.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+    s.set_defaults(func=cmd_analyze)
+
+    s = sub.add_parser("faults", help="inject random bit flips and classify how each run ends")
+    s.add_argument("program", help=".psm source or a program saved by the assemble command")
+    s.add_argument("--cycles", type=int, required=True, help="length of the golden run")
+    s.add_argument("--count", type=int, default=1000, help="faults to inject")
+    s.add_argument("--bits", type=int, default=1, help="bits flipped per fault")
+    s.add_argument("--targets", nargs="*", choices=Fault.TARGETS, default=None, help="where faults may land")
+    s.add_argument("--seed", type=int, default=0)
+    s.add_argument("--processes", type=int, default=None, help="worker processes, every CPU by default")
+    s.add_argument("--isr", type=lambda x: int(x, 0), default=0x3FF, help="interrupt vector")
+    s.add_argument("--playback", help="binary stimulus file driving in_port and interrupt by cycle")
+    s.add_argument("--scratchpad", type=int, choices=Memory.DATA_LENGTHS, default=Memory.DATA_LENGTH,
+                   help="scratchpad size in bytes")
+    s.add_argument("--checkpoint-every", type=int, default=1000, help="cycles between golden run checkpoints")
+    s.add_argument("--hang-margin", type=int, default=None, help="cycles past the golden run before a hang")
+    s.add_argument("--timing", action="store_true", help="a port write at a different cycle is a corruption")
+    s.add_argument("-o", "--output", help="one JSON line per injected fault")
+    s.set_defaults(func=cmd_faults)
+
+    s = sub.add_parser("sweep", help="hand the jobs of a JSON lines manifest to worker nodes over TCP")
+    s.add_argument("manifest", help="manifest path, '-' reads stdin")
+    s.add_argument("--listen", default="127.0.0.1:0", help="host:port for workers to connect to")
+    s.add_argument("--max-attempts", type=int, default=3, help="workers lost running a job before it fails")
+    s.add_argument("--timeout", type=float, default=60.0,
+                   help="seconds without a result or heartbeat before a worker is lost")
+    s.add_argument("--wait", type=float, default=None, help="give up when the sweep takes longer, in seconds")
+    s.set_defaults(func=cmd_sweep)
+
+    s = sub.add_parser("worker", help="run sweep jobs for a coordinator on every core of this machine")
+    s.add_argument("coordinator", help="host:port of the coordinator")
+    s.add_argument("--processes", type=int, default=None, help="worker processes, every CPU by default")
+    s.add_argument("--cache", help="directory keeping shipped programs and stimuli across restarts")
+    s.add_argument("--heartbeat", type=float, default=5.0,
+                   help="seconds between heartbeats while jobs run, below the coordinator's --timeout")
+    s.set_defaults(func=cmd_worker)
+
+    s = sub.add_parser("assemble", help="assemble a .psm file into a program file")
+    s.add_argument("program")
+    s.add_argument("-o", "--output", required=True)
+    s.set_defaults(func=cmd_assemble)
+    return p
+
+
+def main(argv: List[str] = None) -> int:
+    args = parser().parse_args(argv)
+    try:
+        return args.func(args)
+    except BrokenPipeError:
+        # the reader of stdout went away (e.g. piped into head), stop quietly
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 1
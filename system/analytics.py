@@ -0,0 +1,213 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import json
+from array import array
+from typing import List, Dict, Callable, Tuple, Optional
+
+from system.processor import Processor, installed_hook
+
+PORTS = 256
+# log2 buckets of cycle counts, bucket n holds values with bit_length n
+BUCKETS = 33
+NEVER = 0xFFFFFFFFFFFFFFFF
+
+
+class Histogram(object):
+    """count, min, max, sum and log2 buckets of non-negative cycle counts, for rows of fixed size arrays"""
+    def __init__(self, rows: int):
+        self.rows = rows
+        self.count = array("Q", bytes(8 * rows))
+        self.min = array("Q", [NEVER]) * rows
+        self.max = array("Q", bytes(8 * rows))
+        self.sum = array("Q", bytes(8 * rows))
+        self.buckets = array("Q", bytes(8 * rows * BUCKETS))
+
+    def add(self, row: int, value: int):
+        self.count[row] += 1
+        if value < self.min[row]:
+            self.min[row] = value
+        if value > self.max[row]:
+            self.max[row] = value
+        self.sum[row] += value
+        self.buckets[row * BUCKETS + min(value.bit_length(), BUCKETS - 1)] += 1
+
+    def report(self, row: int) -> Optional[Dict[str, object]]:
+        count = self.count[row]
+        if not count:
+            return None
+        buckets = self.buckets[row * BUCKETS:(row + 1) * BUCKETS]
+        return {
+            "count": count,
+            "min": self.min[row],
+            "max": self.max[row],
+            "mean": round(self.sum[row] / count, 3),
+            # upper bound (exclusive) of each log2 bucket that has values
+            "log2": {str(1 << n): c for n, c in enumerate(buckets) if c},
+        }
+
+
+class PortAnalytics(object):
+    """
+    Aggregate port and interrupt statistics updated as the processor runs, for soak runs too long to trace.
+    Everything lives in arrays allocated up front, so memory stays the same however long the run:
+        per port_id  OUTPUT/OUTPUTK and INPUT counts, value histograms, cycles between writes and
+                     the cycles each bit of the written value was high
+        interrupts   cycles from the interrupt line rising to the first ISR instruction, and ISR
+                     durations from that instruction to the end of its RETURNI
+    Hooks the strobes, the interrupt response and RETURNI's flag recovery, the instructions in between run
+    untouched. report() can be called at any point of the run. detach() removes the hooks.
+    """
+    # interrupts rows: the response latency and the ISR duration
+    LATENCY = 0
+    ISR = 1
+
+    def __init__(self, proc: Processor):
+        self.proc = proc
+        self.writes = array("Q", bytes(8 * PORTS))
+        self.reads = array("Q", bytes(8 * PORTS))
+        self.write_values = array("Q", bytes(8 * PORTS * 256))
+        self.read_values = array("Q", bytes(8 * PORTS * 256))
+        self.intervals = Histogram(PORTS)
+        # output latch per port: value, cycle it was written, cycle of the first write
+        self.latched = array("B", bytes(PORTS))
+        self.latched_at = array("Q", bytes(8 * PORTS))
+        self.first_write = array("Q", bytes(8 * PORTS))
+        # cycles each bit of each port's output latch was high, up to its last write
+        self.high = array("Q", bytes(8 * PORTS * 8))
+        self.interrupts = Histogram(2)
+        self._requested = None  # type: Optional[int]
+        self._entered = None  # type: Optional[int]
+        self._hooked = []  # type: List[Tuple[object, str, Optional[Callable]]]
+        self._attach()
+
+    def _hook(self, target: object, name: str, hook: Callable):
+        self._hooked.append((target, name, installed_hook(target, name)))
+        setattr(target, name, hook)
+
+    def _attach(self):
+        proc = self.proc
+        set_write_strobe = proc.set_write_strobe
+        set_k_write_strobe = proc.set_k_write_strobe
+        set_read_strobe = proc.set_read_strobe
+        enter_interrupt = proc.enter_interrupt
+        recover_carry = proc.recover_carry
+        set_interrupt = proc.external.set_interrupt
+
+        def write_strobe(val: bool):
+            set_write_strobe(val)
+            if val:
+                self.write(proc.p_port_id & 0xFF, proc.p_out_port & 0xFF, proc.cycles)
+
+        def k_write_strobe(val: bool):
+            set_k_write_strobe(val)
+            if val:
+                self.write(proc.p_port_id & 0xFF, proc.p_out_port & 0xFF, proc.cycles)
+
+        def read_strobe(val: bool):
+            set_read_strobe(val)
+            if val:
+                port_id = proc.p_port_id & 0xFF
+                self.reads[port_id] += 1
+                self.read_values[port_id << 8 | proc.in_port & 0xFF] += 1
+
+        def interrupt(val: bool):
+            if val and not proc.interrupt:
+                self._requested = proc.cycles
+            set_interrupt(val)
+
+        def timed_enter_interrupt():
+            enter_interrupt()
+            # the response clocks are spent, the ISR starts at proc.cycles
+            self._entered = proc.cycles
+            if self._requested is not None:
+                self.interrupts.add(PortAnalytics.LATENCY, proc.cycles - self._requested)
+                self._requested = None
+
+        def timed_recover_carry():
+            # only RETURNI recovers the preserved flags
+            recover_carry()
+            if self._entered is not None:
+                end = proc.cycles + Processor.CLOCKS_PER_INSTRUCTION
+                self.interrupts.add(PortAnalytics.ISR, end - self._entered)
+                self._entered = None
+
+        self._hook(proc, "set_write_strobe", write_strobe)
+        self._hook(proc, "set_k_write_strobe", k_write_strobe)
+        self._hook(proc, "set_read_strobe", read_strobe)
+        self._hook(proc, "enter_interrupt", timed_enter_interrupt)
+        self._hook(proc, "recover_carry", timed_recover_carry)
+        self._hook(proc.external, "set_interrupt", interrupt)
+
+    def detach(self):
+        for target, name, previous in reversed(self._hooked):
+            if previous is not None:
+                setattr(target, name, previous)
+            else:
+                delattr(target, name)
+        self._hooked = []
+
+    def write(self, port_id: int, value: int, cycle: int):
+        count = self.writes[port_id]
+        if count:
+            since = cycle - self.latched_at[port_id]
+            self.intervals.add(port_id, since)
+            old = self.latched[port_id]
+            base = port_id << 3
+            bit = 0
+            while old:
+                if old & 1:
+                    self.high[base + bit] += since
+                old >>= 1
+                bit += 1
+        else:
+            self.first_write[port_id] = cycle
+        self.writes[port_id] = count + 1
+        self.write_values[port_id << 8 | value] += 1
+        self.latched[port_id] = value
+        self.latched_at[port_id] = cycle
+
+    """QUERIES"""
+
+    def duty_cycles(self, port_id: int, cycle: int = None) -> List[float]:
+        """share of the cycles since the first write each bit of the port's output was high, bit 0 first"""
+        if not self.writes[port_id]:
+            return [0.0] * 8
+        cycle = self.proc.cycles if cycle is None else cycle
+        elapsed = cycle - self.first_write[port_id]
+        if elapsed <= 0:
+            return [float(self.latched[port_id] >> bit & 1) for bit in range(8)]
+        since = cycle - self.latched_at[port_id]
+        value = self.latched[port_id]
+        return [(self.high[(port_id << 3) + bit] + (since if value >> bit & 1 else 0)) / elapsed
+                for bit in range(8)]
+
+    def port(self, port_id: int) -> Dict[str, object]:
+        writes = self.write_values[port_id << 8:(port_id + 1) << 8]
+        reads = self.read_values[port_id << 8:(port_id + 1) << 8]
+        return {
+            "port_id": port_id,
+            "writes": self.writes[port_id],
+            "reads": self.reads[port_id],
+            "write_values": {str(v): c for v, c in enumerate(writes) if c},
+            "read_values": {str(v): c for v, c in enumerate(reads) if c},
+            "write_interval": self.intervals.report(port_id),
+            "duty_cycles": [round(x, 6) for x in self.duty_cycles(port_id)],
+        }
+
+    def report(self) -> Dict[str, object]:
+        return {
+            "cycles": self.proc.cycles,
+            "ports": [self.port(p) for p in range(PORTS) if self.writes[p] or self.reads[p]],
+            "interrupt_latency": self.interrupts.report(PortAnalytics.LATENCY),
+            "isr_duration": self.interrupts.report(PortAnalytics.ISR),
+        }
+
+    def to_json(self, path: str = None) -> str:
+        text = json.dumps(self.report(), indent=2)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+                f.write("\n")
+        return text
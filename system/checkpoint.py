@@ -0,0 +1,277 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import hashlib
+import json
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, Callable, Optional
+
+import ops.operations as op
+from system.processor import Processor, RunResult
+
+
+def program_digest(program: Dict[int, op.Instruction]) -> bytes:
+    """
+    Identifies an assembled program, checkpoints refuse to resume with another one. Take it before fusing or
+    memoizing, optimized programs hold closures that do not pickle.
+    """
+    data = pickle.dumps(sorted(program.items(), key=lambda item: item[0]), protocol=4)
+    return hashlib.blake2b(data, digest_size=CheckpointFormat.DIGEST_SIZE).digest()
+
+
+class CheckpointFormat(object):
+    """
+    Header followed by the zlib compressed state: the processor fields of Processor.snapshot(), the program
+    digest, the memory snapshot and a JSON object of extras (cursors and counters of attached sources and sinks).
+    """
+    MAGIC = b"PSCP"
+    VERSION = 1
+    DIGEST_SIZE = 16
+    HEADER = struct.Struct("<4sHHQQI")  # magic, version, flags, cycles, dispatches, crc32 of the compressed state
+    # pc, out_port, port_id, in_port, flag bits, digest, memory snapshot length, extras length
+    STATE = struct.Struct("<HIIIH%dsII" % DIGEST_SIZE)
+
+    # indices into Processor.snapshot() of the boolean fields, bit n of the flag bits is FLAGS[n]
+    FLAGS = (3, 4, 5, 8, 9, 10, 11, 12, 13, 14, 16)
+    MEMORY, PC, CYCLES, OUT_PORT, PORT_ID, IN_PORT = 0, 1, 2, 6, 7, 15
+    FIELDS = 17
+
+
+class Checkpoint(object):
+    """A Processor.snapshot() with the dispatch count, program digest and extras of the run it was taken in"""
+    __slots__ = ("snapshot", "dispatches", "digest", "extras")
+
+    def __init__(self, snapshot: tuple, dispatches: int = 0, digest: bytes = None, extras: Dict[str, object] = None):
+        self.snapshot = snapshot
+        self.dispatches = dispatches
+        self.digest = digest if digest is not None else bytes(CheckpointFormat.DIGEST_SIZE)
+        self.extras = extras if extras is not None else {}
+
+    @property
+    def cycles(self) -> int:
+        return self.snapshot[CheckpointFormat.CYCLES]
+
+    def to_bytes(self, level: int = 6) -> bytes:
+        fmt = CheckpointFormat
+        snapshot = self.snapshot
+        flags = 0
+        for bit, idx in enumerate(fmt.FLAGS):
+            flags |= bool(snapshot[idx]) << bit
+        memory = snapshot[fmt.MEMORY]
+        extras = json.dumps(self.extras, sort_keys=True).encode()
+        state = fmt.STATE.pack(snapshot[fmt.PC], snapshot[fmt.OUT_PORT], snapshot[fmt.PORT_ID], snapshot[fmt.IN_PORT],
+                               flags, self.digest, len(memory), len(extras))
+        body = zlib.compress(state + memory + extras, level)
+        return fmt.HEADER.pack(fmt.MAGIC, fmt.VERSION, 0, self.cycles, self.dispatches,
+                               zlib.crc32(body) & 0xFFFFFFFF) + body
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'Checkpoint':
+        fmt = CheckpointFormat
+        if len(data) < fmt.HEADER.size:
+            raise ValueError("Truncated checkpoint")
+        magic, version, _, cycles, dispatches, crc = fmt.HEADER.unpack_from(data, 0)
+        if magic != fmt.MAGIC:
+            raise ValueError("Not a PicoSim checkpoint")
+        if version != fmt.VERSION:
+            raise ValueError("Checkpoint version %d is not supported, expected %d" % (version, fmt.VERSION))
+        body = data[fmt.HEADER.size:]
+        if zlib.crc32(body) & 0xFFFFFFFF != crc:
+            raise ValueError("Corrupt checkpoint")
+        body = zlib.decompress(body)
+        pc, out_port, port_id, in_port, flags, digest, memory_length, extras_length = fmt.STATE.unpack_from(body, 0)
+        offset = fmt.STATE.size
+        snapshot = [None] * fmt.FIELDS
+        snapshot[fmt.MEMORY] = body[offset:offset + memory_length]
+        offset += memory_length
+        extras = json.loads(body[offset:offset + extras_length].decode())
+        snapshot[fmt.PC], snapshot[fmt.CYCLES] = pc, cycles
+        snapshot[fmt.OUT_PORT], snapshot[fmt.PORT_ID], snapshot[fmt.IN_PORT] = out_port, port_id, in_port
+        for bit, idx in enumerate(fmt.FLAGS):
+            snapshot[idx] = bool(flags >> bit & 1)
+        return Checkpoint(tuple(snapshot), dispatches, digest, extras)
+
+    def save(self, path: str, level: int = 6):
+        """replace path atomically, a reader sees the previous checkpoint or this one in full"""
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.to_bytes(level))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path: str) -> 'Checkpoint':
+        with open(path, "rb") as f:
+            return Checkpoint.from_bytes(f.read())
+
+
+class Checkpointer(object):
+    """
+    Processor.run in chunks, checkpointing to path every every_cycles simulated cycles (at the first instruction
+    boundary at or after each multiple) and/or every every_seconds of wall time, and once more when the run
+    returns. The simulation thread only takes the snapshot, compression and the atomic replace happen on a writer
+    thread. A checkpoint still waiting for the writer is superseded by the next one.
+    resume() refuses a checkpoint of another program when digest (see program_digest) is given.
+    A StimulusPlayer passed as player is sought to the restored cycle by resume(). State of other hooks can be
+    carried in extras, a callable returning a JSON object that resume() hands back.
+    runner is what gets run, the processor itself or a wrapper with the same run() (StatePublisher, HostProfiler).
+    """
+    # instructions per chunk when checkpointing by wall time, adapted to about eight chunks per interval
+    FIRST_CHUNK = 4096
+
+    def __init__(self, proc: Processor, path: str, every_cycles: int = None, every_seconds: float = None,
+                 digest: bytes = None, player=None,
+                 extras: Callable[[], Dict[str, object]] = None, runner=None, level: int = 6):
+        if every_cycles is not None and every_cycles <= 0 or every_seconds is not None and every_seconds <= 0:
+            raise ValueError("Checkpoint intervals must be positive")
+        self.proc = proc
+        self.path = path
+        self.every_cycles = every_cycles
+        self.every_seconds = every_seconds
+        self.digest = digest
+        self.player = player
+        self.extras = extras
+        self.runner = runner if runner is not None else proc
+        self.level = level
+        # dispatches since power-on, carried across resumes
+        self.dispatches = 0  # type: int
+        self.taken = 0  # type: int
+        self.written = 0  # type: int
+        self.superseded = 0  # type: int
+        self._chunk = Checkpointer.FIRST_CHUNK  # type: int
+        self._next_cycle = None  # type: Optional[int]
+        self._next_time = None  # type: Optional[float]
+        self._pending = None  # type: Optional[Checkpoint]
+        self._writing = False  # type: bool
+        self._error = None  # type: Optional[BaseException]
+        self._closed = False  # type: bool
+        self._ready = threading.Condition()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def resume(self) -> Optional[Dict[str, object]]:
+        """restore the processor from path if a checkpoint is there, returns its extras, None for a fresh run"""
+        if not os.path.exists(self.path):
+            return None
+        checkpoint = Checkpoint.load(self.path)
+        if self.digest is not None and checkpoint.digest != self.digest:
+            raise ValueError("%s was taken running a different program" % self.path)
+        self.proc.restore(checkpoint.snapshot)
+        self.dispatches = checkpoint.dispatches
+        if self.player is not None:
+            # records at exactly the restored cycle are applied before its next instruction
+            self.player.seek(self.proc.cycles - 1)
+        return checkpoint.extras
+
+    def checkpoint(self):
+        """snapshot now and queue it for the writer"""
+        checkpoint = Checkpoint(self.proc.snapshot(), self.dispatches, self.digest,
+                                self.extras() if self.extras is not None else None)
+        with self._ready:
+            if self._error is not None:
+                raise self._error
+            if self._pending is not None:
+                self.superseded += 1
+            self._pending = checkpoint
+            self.taken += 1
+            self._ready.notify_all()
+
+    def _schedule(self):
+        if self.every_cycles is not None:
+            self._next_cycle = (self.proc.cycles // self.every_cycles + 1) * self.every_cycles
+        if self.every_seconds is not None:
+            self._next_time = time.perf_counter() + self.every_seconds
+
+    def run(self, instructions: int = None, cycles: int = None, microseconds: float = None) -> RunResult:
+        """Processor.run with checkpoints, the result covers the whole run"""
+        proc = self.proc
+        if microseconds is not None:
+            budget = proc.cycles_for(microseconds)
+            cycles = budget if cycles is None else min(cycles, budget)
+        start_cycle = proc.cycles
+        end_cycle = start_cycle + cycles if cycles is not None else None
+        executed = 0
+        start_time = time.perf_counter()
+        self._schedule()
+        while True:
+            remaining = None if instructions is None else instructions - executed
+            chunk = remaining
+            if self.every_seconds is not None:
+                chunk = self._chunk if remaining is None else min(self._chunk, remaining)
+            left = None if end_cycle is None else max(0, end_cycle - proc.cycles)
+            if self._next_cycle is not None:
+                left = self._next_cycle - proc.cycles if left is None else min(left, self._next_cycle - proc.cycles)
+            result = self.runner.run(instructions=chunk, cycles=left)
+            executed += result.dispatches
+            self.dispatches += result.dispatches
+            if self.every_seconds is not None and result.wall_seconds > 0:
+                rate = result.dispatches / result.wall_seconds
+                self._chunk = max(64, int(rate * self.every_seconds / 8))
+            if result.reason not in (RunResult.INSTRUCTIONS, RunResult.CYCLES):
+                reason, detail = result.reason, result.detail
+                break
+            if remaining is not None and executed >= instructions:
+                reason, detail = RunResult.INSTRUCTIONS, None
+                break
+            if end_cycle is not None and proc.cycles >= end_cycle:
+                reason, detail = RunResult.CYCLES, None
+                break
+            if (self._next_cycle is not None and proc.cycles >= self._next_cycle
+                    or self._next_time is not None and time.perf_counter() >= self._next_time):
+                self.checkpoint()
+                self._schedule()
+        self.checkpoint()
+        return RunResult(executed, proc.cycles - start_cycle, time.perf_counter() - start_time, proc.clock_hz,
+                         reason, proc.manager.pc, detail)
+
+    """WRITER"""
+
+    def _write_loop(self):
+        while True:
+            with self._ready:
+                while self._pending is None and not self._closed:
+                    self._ready.wait()
+                if self._pending is None:
+                    return
+                checkpoint, self._pending = self._pending, None
+                self._writing = True
+            try:
+                checkpoint.save(self.path, self.level)
+            except BaseException as e:
+                with self._ready:
+                    self._error = e
+            with self._ready:
+                self._writing = False
+                if self._error is None:
+                    self.written += 1
+                self._ready.notify_all()
+
+    def flush(self):
+        """wait until the last checkpoint taken is on disk"""
+        with self._ready:
+            while (self._pending is not None or self._writing) and self._error is None:
+                self._ready.wait()
+            if self._error is not None:
+                raise self._error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self._ready:
+                self._closed = True
+                self._ready.notify_all()
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,261 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import struct
+import time
+from multiprocessing import shared_memory
+from typing import List, Callable, Tuple, Optional
+
+from system.processor import Processor, installed_hook
+
+
+class Ring(object):
+    """
+    Single producer, single consumer ring of fixed size records in a shared buffer.
+    The producer only writes head, the consumer only writes tail, both are free running 32 bit counters.
+    """
+    RECORD = struct.Struct("<BBBBI")  # kind, port_id, value, reserved, cycle
+    INDEX = struct.Struct("<I")
+    # head and tail on separate cache lines
+    HEAD = 0
+    TAIL = 64
+    SLOTS = 128
+
+    @staticmethod
+    def size(capacity: int) -> int:
+        return Ring.SLOTS + capacity * Ring.RECORD.size
+
+    def __init__(self, buf: memoryview, offset: int, capacity: int):
+        if capacity & (capacity - 1):
+            raise ValueError("Ring capacity must be a power of two")
+        self.buf = buf
+        self.offset = offset
+        self.capacity = capacity
+        self.mask = capacity - 1
+
+    def _index(self, pos: int) -> int:
+        return Ring.INDEX.unpack_from(self.buf, self.offset + pos)[0]
+
+    def _set_index(self, pos: int, val: int):
+        Ring.INDEX.pack_into(self.buf, self.offset + pos, val & 0xFFFFFFFF)
+
+    def reset(self):
+        self._set_index(Ring.HEAD, 0)
+        self._set_index(Ring.TAIL, 0)
+
+    def push(self, kind: int, port_id: int = 0, value: int = 0, cycle: int = 0) -> bool:
+        head = self._index(Ring.HEAD)
+        if (head - self._index(Ring.TAIL)) & 0xFFFFFFFF >= self.capacity:
+            return False
+        Ring.RECORD.pack_into(self.buf, self.offset + Ring.SLOTS + (head & self.mask) * Ring.RECORD.size,
+                              kind, port_id & 0xFF, value & 0xFF, 0, cycle & 0xFFFFFFFF)
+        # publish the record only after it is written
+        self._set_index(Ring.HEAD, head + 1)
+        return True
+
+    def pop(self) -> Optional[Tuple[int, int, int, int]]:
+        tail = self._index(Ring.TAIL)
+        if tail == self._index(Ring.HEAD):
+            return None
+        kind, port_id, value, _, cycle = Ring.RECORD.unpack_from(
+            self.buf, self.offset + Ring.SLOTS + (tail & self.mask) * Ring.RECORD.size)
+        self._set_index(Ring.TAIL, tail + 1)
+        return kind, port_id, value, cycle
+
+
+class Channel(object):
+    """Both rings of a co-simulation link in one shared memory segment"""
+    MAGIC = 0x50534D31  # "PSM1"
+    HEADER = struct.Struct("<II")  # magic, capacity
+    HEADER_SIZE = 64
+
+    # CPU -> HDL
+    WRITE = 1
+    READ = 2
+    INTERRUPT_ACK = 3
+    STOP = 4
+    # OUTPUTK, strobed on k_write_strobe
+    WRITE_K = 5
+    # HDL -> CPU
+    READ_DATA = 16
+    INTERRUPT = 17
+
+    def __init__(self, name: str = None, capacity: int = 4096, create: bool = True):
+        self.owner = create
+        if create:
+            size = Channel.HEADER_SIZE + 2 * Ring.size(capacity)
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            Channel.HEADER.pack_into(self.shm.buf, 0, Channel.MAGIC, capacity)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            magic, capacity = Channel.HEADER.unpack_from(self.shm.buf, 0)
+            if magic != Channel.MAGIC:
+                raise ValueError("Shared memory %s is not a PicoSim co-simulation channel" % name)
+        self.name = self.shm.name
+        self.to_hdl = Ring(self.shm.buf, Channel.HEADER_SIZE, capacity)
+        self.to_cpu = Ring(self.shm.buf, Channel.HEADER_SIZE + Ring.size(capacity), capacity)
+        if create:
+            self.to_hdl.reset()
+            self.to_cpu.reset()
+
+    @staticmethod
+    def send(ring: Ring, kind: int, port_id: int = 0, value: int = 0, cycle: int = 0):
+        while not ring.push(kind, port_id, value, cycle):
+            time.sleep(0)
+
+    def close(self):
+        self.to_hdl.buf = self.to_cpu.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class CoSimBridge(object):
+    """
+    Exposes the processor ExternalInterface to an external HDL simulator through a shared memory Channel.
+    OUTPUT sends a WRITE, OUTPUTK a WRITE_K, INPUT sends a READ and blocks until the HDL answers with READ_DATA,
+    interrupt_ack is forwarded, and INTERRUPT levels from the HDL are applied every poll_interval
+    instructions and before each read. Records carry the processor cycle counter.
+    """
+    def __init__(self, proc: Processor, name: str = None, capacity: int = 4096, poll_interval: int = 16,
+                 timeout: float = 10.0):
+        self.proc = proc
+        self.channel = Channel(name, capacity, create=True)
+        self.name = self.channel.name
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._countdown = poll_interval
+        self._hooked = []  # type: List[Tuple[str, Callable]]
+        self._hook()
+
+    def _hook(self):
+        proc = self.proc
+        channel = self.channel
+        set_read_strobe = proc.set_read_strobe
+        set_write_strobe = proc.set_write_strobe
+        set_k_write_strobe = proc.set_k_write_strobe
+        set_interrupt_ack = proc.set_interrupt_ack
+        execute = proc.execute
+
+        def read_strobe(val: bool):
+            set_read_strobe(val)
+            if val:
+                Channel.send(channel.to_hdl, Channel.READ, proc.p_port_id, 0, proc.cycles)
+                proc.external.set_int_port(self.wait_read_data())
+
+        def write_strobe(val: bool):
+            set_write_strobe(val)
+            if val:
+                Channel.send(channel.to_hdl, Channel.WRITE, proc.p_port_id, proc.p_out_port, proc.cycles)
+
+        def k_write_strobe(val: bool):
+            set_k_write_strobe(val)
+            if val:
+                Channel.send(channel.to_hdl, Channel.WRITE_K, proc.p_port_id, proc.p_out_port, proc.cycles)
+
+        def interrupt_ack(val: bool):
+            set_interrupt_ack(val)
+            if val:
+                Channel.send(channel.to_hdl, Channel.INTERRUPT_ACK, 0, 0, proc.cycles)
+
+        def polled_execute():
+            self._countdown -= 1
+            if not self._countdown:
+                self._countdown = self.poll_interval
+                self.poll()
+            execute()
+
+        for name, hook in [("set_read_strobe", read_strobe), ("set_write_strobe", write_strobe),
+                           ("set_k_write_strobe", k_write_strobe), ("set_interrupt_ack", interrupt_ack),
+                           ("execute", polled_execute)]:
+            self._hooked.append((name, installed_hook(proc, name)))
+            setattr(proc, name, hook)
+
+    def _apply(self, record: Tuple[int, int, int, int]) -> Optional[int]:
+        kind, _, value, _ = record
+        if kind == Channel.INTERRUPT:
+            self.proc.external.set_interrupt(bool(value))
+        elif kind == Channel.READ_DATA:
+            return value
+        return None
+
+    def poll(self):
+        """apply interrupt changes the HDL sent since the last poll"""
+        record = self.channel.to_cpu.pop()
+        while record is not None:
+            self._apply(record)
+            record = self.channel.to_cpu.pop()
+
+    def wait_read_data(self) -> int:
+        deadline = time.time() + self.timeout
+        while True:
+            record = self.channel.to_cpu.pop()
+            if record is None:
+                if time.time() > deadline:
+                    raise TimeoutError("HDL never answered the INPUT from port 0x%02X" % self.proc.p_port_id)
+                time.sleep(0)
+                continue
+            value = self._apply(record)
+            if value is not None:
+                return value
+
+    def close(self):
+        for name, previous in reversed(self._hooked):
+            if previous is not None:
+                setattr(self.proc, name, previous)
+            else:
+                delattr(self.proc, name)
+        self._hooked = []
+        Channel.send(self.channel.to_hdl, Channel.STOP, 0, 0, self.proc.cycles)
+        self.channel.close()
+
+
+class HDLPeer(object):
+    """The external simulator side of a CoSimBridge channel"""
+    def __init__(self, name: str):
+        self.channel = Channel(name, create=False)
+
+    def receive(self) -> Optional[Tuple[int, int, int, int]]:
+        return self.channel.to_hdl.pop()
+
+    def wait(self, timeout: float = 10.0) -> Tuple[int, int, int, int]:
+        deadline = time.time() + timeout
+        record = self.receive()
+        while record is None:
+            if time.time() > deadline:
+                raise TimeoutError("CPU sent nothing within %.1f seconds" % timeout)
+            time.sleep(0)
+            record = self.receive()
+        return record
+
+    def read_data(self, value: int):
+        Channel.send(self.channel.to_cpu, Channel.READ_DATA, 0, value)
+
+    def set_interrupt(self, level: bool):
+        Channel.send(self.channel.to_cpu, Channel.INTERRUPT, 0, int(level))
+
+    def close(self):
+        self.channel.close()
+
+
+def register_file_device(name: str, timeout: float = 10.0):
+    """
+    Stand-in HDL process: a 256 entry register file behind the ports. Writes (OUTPUT and OUTPUTK) store the value,
+    reads return the stored value, and writing port 0xFF drives the interrupt line with bit 0 of the value.
+    """
+    peer = HDLPeer(name)
+    ports = [0] * 256
+    try:
+        while True:
+            kind, port_id, value, _ = peer.wait(timeout)
+            if kind == Channel.STOP:
+                break
+            if kind in (Channel.WRITE, Channel.WRITE_K):
+                ports[port_id] = value
+                if port_id == 0xFF:
+                    peer.set_interrupt(bool(value & 1))
+            elif kind == Channel.READ:
+                peer.read_data(ports[port_id])
+    finally:
+        peer.close()
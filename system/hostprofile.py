@@ -0,0 +1,273 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import json
+import random
+import time
+from typing import List, Dict, Callable, Tuple, Optional
+
+from system.processor import Processor, RunResult, StopRun, installed_hook
+
+
+class Bucket(object):
+    __slots__ = ("count", "ns")
+
+    def __init__(self):
+        self.count = 0  # type: int
+        self.ns = 0  # type: int
+
+
+class _TimedInstruction(object):
+    """stands in for the fetched instruction during a sampled step and times its exec"""
+    __slots__ = ("profiler", "instr")
+
+    def __init__(self, profiler: "HostProfiler", instr):
+        self.profiler = profiler
+        self.instr = instr
+
+    def exec(self, proc: Processor):
+        profiler = self.profiler
+        io = profiler.io
+        start = time.perf_counter_ns()
+        profiler.nested = True
+        try:
+            self.instr.exec(proc)
+        finally:
+            profiler.nested = False
+            # io callbacks made by exec are in the io bucket already
+            spent = time.perf_counter_ns() - start - (profiler.io - io)
+            profiler.add(profiler.label(self.instr), spent)
+            profiler.accounted += spent
+
+
+class _TimedProgram(object):
+    """the program as fetch_program sees it during a sampled step"""
+    __slots__ = ("profiler", "program")
+
+    def __init__(self, profiler: "HostProfiler", program):
+        self.profiler = profiler
+        self.program = program
+
+    def __getitem__(self, addr: int):
+        profiler = self.profiler
+        if profiler.nested:
+            # executes inside a memoized call belong to its exec time
+            return self.program[addr]
+        start = time.perf_counter_ns()
+        instr = self.program[addr]
+        spent = time.perf_counter_ns() - start
+        profiler.add(HostProfiler.FETCH, spent)
+        profiler.accounted += spent
+        return _TimedInstruction(profiler, instr)
+
+    def __len__(self) -> int:
+        return len(self.program)
+
+
+class HostProfiler(object):
+    """
+    Where the simulator's own Python time goes. run() executes like Processor.run, timing about one top level
+    execute() in sample_every with perf_counter_ns and splitting it into:
+        exec <class> <operator>  the instruction's exec without its io, nested executes of memoized calls included
+        fetch                    looking the instruction up
+        io                       strobe callbacks, including whatever peripherals hooked them
+        interrupt                the interrupt response sequence
+        dispatch                 the rest of execute: clearing strobes, the interrupt check, cycle accounting
+    The buckets do not overlap and add up to the sampled time. The steps between samples run through
+    Processor.run, the io and interrupt hooks only check a flag. Gaps between samples are randomized so loops
+    whose length divides sample_every are not aliased. detach() removes the hooks.
+    """
+    SAMPLE_EVERY = 128  # type: int
+
+    FETCH = "fetch"
+    IO = "io"
+    INTERRUPT = "interrupt"
+    DISPATCH = "dispatch"
+
+    def __init__(self, proc: Processor, sample_every: int = SAMPLE_EVERY, seed: int = 0):
+        if sample_every < 1:
+            raise ValueError("sample_every must be at least 1")
+        self.proc = proc
+        self.sample_every = sample_every
+        self.buckets = {}  # type: Dict[str, Bucket]
+        # top level executes run through the profiler, and how many of them were timed
+        self.steps = 0  # type: int
+        self.samples = 0  # type: int
+        self.sampled_ns = 0  # type: int
+        # ns accounted to buckets and spent in io during the sampled step
+        self.accounted = 0  # type: int
+        self.io = 0  # type: int
+        self._rng = random.Random(seed)
+        self._gap = self._next_gap()  # type: int
+        self._labels = {}  # type: Dict[Tuple[type, object], str]
+        self.sampling = False  # type: bool
+        self.nested = False  # type: bool
+        self._hooked = []  # type: List[Tuple[str, Optional[Callable]]]
+        self._attach()
+
+    def label(self, instr) -> str:
+        key = (instr.__class__, getattr(instr, "operator", None))
+        label = self._labels.get(key)
+        if label is None:
+            label = "exec " + instr.__class__.__name__
+            if key[1] is not None:
+                label += " " + key[1].__name__
+            self._labels[key] = label
+        return label
+
+    def add(self, name: str, ns: int):
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = self.buckets[name] = Bucket()
+        bucket.count += 1
+        bucket.ns += ns
+
+    def _next_gap(self) -> int:
+        # unsampled steps before the next sample, sample_every - 1 on average
+        return self._rng.randint(0, 2 * (self.sample_every - 1))
+
+    def run(self, instructions: int = None, cycles: int = None, microseconds: float = None) -> RunResult:
+        """Processor.run with sampling, the result covers the whole run"""
+        proc = self.proc
+        if microseconds is not None:
+            budget = proc.cycles_for(microseconds)
+            cycles = budget if cycles is None else min(cycles, budget)
+        start_cycle = proc.cycles
+        end_cycle = start_cycle + cycles if cycles is not None else None
+        executed = 0
+        reason = RunResult.HALTED
+        detail = None
+        start_time = time.perf_counter()
+        while True:
+            remaining = None if instructions is None else instructions - executed
+            chunk = self._gap if remaining is None else min(self._gap, remaining)
+            left = None if end_cycle is None else max(0, end_cycle - proc.cycles)
+            result = proc.run(instructions=chunk, cycles=left)
+            executed += result.dispatches
+            self.steps += result.dispatches
+            self._gap -= result.dispatches
+            if result.reason != RunResult.INSTRUCTIONS or (remaining is not None and executed >= instructions):
+                reason, detail = result.reason, result.detail
+                break
+            if end_cycle is not None and proc.cycles >= end_cycle:
+                reason = RunResult.CYCLES
+                break
+            try:
+                self.step()
+            except StopRun as stop:
+                executed += 1
+                reason, detail = stop.reason, stop.detail
+                break
+            executed += 1
+        return RunResult(executed, proc.cycles - start_cycle, time.perf_counter() - start_time, proc.clock_hz,
+                         reason, proc.manager.pc, detail)
+
+    def step(self):
+        """one timed execute"""
+        self._gap = self._next_gap()
+        self.steps += 1
+        self._sample(self.proc.execute)
+
+    def _attach(self):
+        """
+        The io and interrupt hooks stay installed and only time while sampling. Adding and removing instance
+        attributes around every sample would make CPython drop its specialized attribute lookups for the
+        processor each time, which costs far more than the sample itself.
+        """
+        proc = self.proc
+        perf_counter_ns = time.perf_counter_ns
+
+        def timed(method: str, bucket: str):
+            original = getattr(proc, method)
+
+            def hook(*args):
+                if not self.sampling:
+                    return original(*args)
+                start = perf_counter_ns()
+                try:
+                    return original(*args)
+                finally:
+                    spent = perf_counter_ns() - start
+                    self.add(bucket, spent)
+                    self.accounted += spent
+                    if bucket is HostProfiler.IO:
+                        self.io += spent
+
+            self._hooked.append((method, installed_hook(proc, method)))
+            setattr(proc, method, hook)
+
+        timed("set_read_strobe", HostProfiler.IO)
+        timed("set_write_strobe", HostProfiler.IO)
+        timed("set_k_write_strobe", HostProfiler.IO)
+        timed("enter_interrupt", HostProfiler.INTERRUPT)
+
+    def detach(self):
+        for name, previous in reversed(self._hooked):
+            if previous is not None:
+                setattr(self.proc, name, previous)
+            else:
+                delattr(self.proc, name)
+        self._hooked = []
+
+    def _sample(self, execute: Callable[[], None]):
+        proc = self.proc
+        program = proc._instructions
+        # fetches go through the timed view of the program for this step, swapping the value of an existing
+        # attribute leaves the processor's attribute layout alone
+        proc._instructions = _TimedProgram(self, program)
+        self.accounted = 0
+        self.io = 0
+        self.sampling = True
+        try:
+            start = time.perf_counter_ns()
+            execute()
+            spent = time.perf_counter_ns() - start
+        finally:
+            self.sampling = False
+            proc._instructions = program
+        self.samples += 1
+        self.sampled_ns += spent
+        self.add(HostProfiler.DISPATCH, max(0, spent - self.accounted))
+
+    """REPORTS"""
+
+    def report(self) -> Dict[str, object]:
+        total = self.sampled_ns or 1
+        # sampled time to time over every step
+        scale = self.steps / self.samples if self.samples else 0.0
+        rows = []
+        for name, bucket in sorted(self.buckets.items(), key=lambda x: -x[1].ns):
+            rows.append({
+                "name": name,
+                "samples": bucket.count,
+                "ns_per_call": round(bucket.ns / bucket.count, 1),
+                "estimated_ns": int(bucket.ns * scale),
+                "share": round(100.0 * bucket.ns / total, 2),
+            })
+        return {
+            "sample_every": self.sample_every,
+            "steps": self.steps,
+            "samples": self.samples,
+            "ns_per_step": round(self.sampled_ns / self.samples, 1) if self.samples else 0.0,
+            "estimated_ns": int(self.sampled_ns * scale),
+            "buckets": rows,
+        }
+
+    def to_json(self, path: str = None) -> str:
+        text = json.dumps(self.report(), indent=2)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+                f.write("\n")
+        return text
+
+    def table(self) -> str:
+        report = self.report()
+        lines = ["%-40s %8s %10s %7s" % ("host time", "samples", "ns/call", "share"),
+                 "-" * 68]
+        for row in report["buckets"]:
+            lines.append("%-40s %8d %10.1f %6.2f%%" % (row["name"], row["samples"], row["ns_per_call"], row["share"]))
+        lines.append("-" * 68)
+        lines.append("%-40s %8d %10.1f" % ("execute", report["samples"], report["ns_per_step"]))
+        return "\n".join(lines)
@@ -2,20 +2,25 @@
 PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
 Copyright (C) 2017  Vadim Korolik - see LICENCE
 """
-import itertools
 import math
+import operator
 import random
-from typing import Dict, List
-
-import numpy as np
+from typing import Dict, List, Tuple, Optional, Callable, Sequence, Union
 
 
 class Memory(object):
     class MemoryRow(object):
+        # processors hold over a hundred rows each, keep them free of a per instance __dict__
+        __slots__ = ("width", "max_value", "min_value", "default")
+        # (max_value, min_value) per width
+        BOUNDS = {}  # type: Dict[int, Tuple[float, float]]
+
         def __init__(self, width: int, default: bool = False) -> None:
             self.width = width
-            self.max_value = math.pow(2, self.width) - 1
-            self.min_value = -math.pow(2, self.width - 1)
+            bounds = Memory.MemoryRow.BOUNDS.get(width)
+            if bounds is None:
+                bounds = Memory.MemoryRow.BOUNDS[width] = (math.pow(2, width) - 1, -math.pow(2, width - 1))
+            self.max_value, self.min_value = bounds
             self.default = default
 
         """If its too big and negative and too small, wrap"""
@@ -38,49 +43,133 @@ class Memory(object):
             return binary
 
     # DO NOT USE POOR PERFORMANCE
+    # NumPy is only imported once a NumpyRow is created, importing Memory does not pay for it
     class NumpyRow(MemoryRow):
         WIDTH = 8
         DEFAULT = False
-        BIN_MULT = np.array([1 << (8 - 1 - idx) for idx, _ in enumerate(range(8))])
+        BIN_MULT = None
+
+        __slots__ = ("values",)
 
         def __init__(self) -> None:
+            import numpy as np
             super(Memory.NumpyRow, self).__init__(Memory.NumpyRow.WIDTH, Memory.NumpyRow.DEFAULT)
+            if Memory.NumpyRow.BIN_MULT is None:
+                Memory.NumpyRow.BIN_MULT = np.array([1 << (8 - 1 - idx) for idx, _ in enumerate(range(8))])
             self.values = np.array(np.zeros(self.width, np.uint8))
 
         @property
         def value(self) -> int:
+            import numpy as np
             return int(np.sum(self.values * Memory.NumpyRow.BIN_MULT))
 
         def set_value(self, value: int) -> None:
+            import numpy as np
             value = self.bounds(value)
             # automatically performs 2s comp if needed
             binary = np.binary_repr(value, width=8)
             self.values = np.array(list(binary), dtype=np.uint8)
 
     class ArrayRow(MemoryRow):
+        __slots__ = ("values",)
+
         def __init__(self, width: int, default: bool = False) -> None:
             super(Memory.ArrayRow, self).__init__(width, default)
-            self.values = [self.default if self.default is not None
-                           else bool(random.randint(0, 1)) for _ in range(0, self.width)]
+            if default is not None:
+                self.values = [default] * width
+            else:
+                self.values = [bool(random.randint(0, 1)) for _ in range(0, self.width)]
 
         @property
         def value(self) -> int:
             """returns the decimal value of the memory row"""
-            return sum([int(v) * (1 << (len(self.values) - 1 - index))
-                        for index, v in enumerate(self.values)])
+            values = self.values
+            value = Memory.bit_table(self.width)[0].get(tuple(values))
+            if value is None:
+                return sum([int(v) * (1 << (len(values) - 1 - index)) for index, v in enumerate(values)])
+            return value
 
         def set_value(self, value: int) -> None:
             """set the memory row value to a decimal value, converted to two's comp if negative"""
             value = self.bounds(value)
-            binary = self.binary(value)
-            # 0 extend with itertools chain
-            self.values = [bool(int(x)) for x in itertools.chain(
-                [False for _ in range(0, len(self.values) - len(binary))], binary)]
+            # the bits of value & mask are the two's complement of a negative value
+            self.values = list(Memory.bit_table(self.width)[1][value & ((1 << self.width) - 1)])
+
+    class RowView(object):
+        """
+        Live view of a run of rows as unsigned values: reads convert the current bits, writes go through the
+        rows' bit tables, so there is no copy to keep in step with the processor. Slices read as lists and take
+        any iterable of ints, bytes included. np.asarray(view) gives a copy as a uint8/uint16 array.
+        """
+        __slots__ = ("_rows", "_keys", "width")
+
+        def __init__(self, rows: Callable[[], Union[List, Dict]], keys: Sequence, width: int) -> None:
+            # rows is called on every access: REGBANK and watchpoints swap the containers and rows underneath
+            self._rows = rows
+            self._keys = keys
+            self.width = width
+
+        def __len__(self) -> int:
+            return len(self._keys)
+
+        def __iter__(self):
+            to_int = Memory.bit_table(self.width)[0]
+            rows = self._rows()
+            return iter([to_int[tuple(rows[key].values)] for key in self._keys])
+
+        def __getitem__(self, idx: Union[int, slice]) -> Union[int, List[int]]:
+            to_int = Memory.bit_table(self.width)[0]
+            rows = self._rows()
+            if isinstance(idx, slice):
+                return [to_int[tuple(rows[key].values)] for key in self._keys[idx]]
+            return to_int[tuple(rows[self._keys[idx]].values)]
+
+        def __setitem__(self, idx: Union[int, slice], value: Union[int, Sequence[int]]) -> None:
+            to_bits = Memory.bit_table(self.width)[1]
+            mask = (1 << self.width) - 1
+            rows = self._rows()
+            if isinstance(idx, slice):
+                keys = self._keys[idx]
+                values = list(value)
+                if len(values) != len(keys):
+                    raise ValueError("Expected %d values, got %d" % (len(keys), len(values)))
+                for key, v in zip(keys, values):
+                    rows[key].values = list(to_bits[int(v) & mask])
+            else:
+                rows[self._keys[idx]].values = list(to_bits[int(value) & mask])
+
+        def __eq__(self, other: object) -> bool:
+            try:
+                return len(self) == len(other) and list(self) == list(other)
+            except TypeError:
+                return NotImplemented
+
+        __hash__ = None
+
+        def __repr__(self) -> str:
+            return "RowView(%r)" % list(self)
+
+        def tolist(self) -> List[int]:
+            return list(self)
+
+        def tobytes(self) -> bytes:
+            """one byte per row, rows wider than 8 bits are two bytes big endian"""
+            if self.width <= 8:
+                return bytes(self)
+            return b"".join(v.to_bytes(2, "big") for v in self)
+
+        def __array__(self, dtype=None, copy=None):
+            import numpy as np
+            if dtype is None:
+                dtype = np.uint8 if self.width <= 8 else np.uint16
+            return np.array(list(self), dtype=dtype)
 
     PROGRAM_WIDTH = 18  # type: int
     PROGRAM_LENGTH = 1024  # type: int
     DATA_WIDTH = 8  # type: int
     DATA_LENGTH = 64  # type: int
+    # scratchpad sizes of the KCPSM3 (64) and KCPSM6 (64, 128 or 256) builds
+    DATA_LENGTHS = (64, 128, 256)  # type: Tuple[int, ...]
     REGISTER_WIDTH = 8  # type: int
     NUM_REGISTERS = 16  # type: int
     STACK_WIDTH = 10  # type: int
@@ -88,12 +177,145 @@ class Memory(object):
 
     MEMORY_IMPL = ArrayRow
 
-    def __init__(self):
+    REGISTER_NAMES = ['s%0.1x' % x for x in range(0, NUM_REGISTERS)]  # type: List[str]
+    ROW_VALUES = operator.attrgetter("values")
+
+    # the scratchpad and stack are not cleared at power-on, their contents come from a seeded pattern
+    POWER_ON_SEED = 0  # type: int
+    POWER_ON_CACHE = 64  # type: int
+    _power_on = {}  # type: Dict[Tuple[int, int], Tuple[Tuple[Tuple[bool, ...], ...], Tuple[Tuple[bool, ...], ...]]]
+
+    # (bits -> value, value -> bits) per row width
+    _bit_tables = {}  # type: Dict[int, Tuple[Dict[Tuple[bool, ...], int], Tuple[Tuple[bool, ...], ...]]]
+
+    # KCPSM6 register banks A and B
+    NUM_BANKS = 2  # type: int
+
+    def __init__(self, seed: int = None, data_length: int = DATA_LENGTH):
+        if data_length not in Memory.DATA_LENGTHS:
+            raise ValueError("Scratchpad size must be one of %s" % (Memory.DATA_LENGTHS,))
+        # the scratchpad decodes the low address bits only, like the hardware
+        self.data_mask = data_length - 1  # type: int
         self.REGISTERS = Memory.init_reg(Memory.REGISTER_WIDTH, Memory.NUM_REGISTERS)
-        self.DATA_MEMORY = Memory.init_mem(Memory.DATA_WIDTH, Memory.DATA_LENGTH)
+        # REGISTERS is the active bank, bank B is only built once a program selects it
+        self.banks = [self.REGISTERS, None]  # type: List[Optional[Dict[str, Memory.MEMORY_IMPL]]]
+        self.bank = 0  # type: int
+        self.DATA_MEMORY = Memory.init_mem(Memory.DATA_WIDTH, data_length)
         self.STACK = Memory.init_mem(Memory.STACK_WIDTH, Memory.STACK_LENGTH)
 
         self.stack_pointer = 0  # type: int
+        self.reset(seed)
+
+    @staticmethod
+    def power_on_pattern(seed: int = None, data_length: int = DATA_LENGTH) -> Tuple[Tuple[Tuple[bool, ...], ...],
+                                                                                   Tuple[Tuple[bool, ...], ...]]:
+        """bits of every scratchpad and stack row at power-on, the same seed always gives the same pattern"""
+        seed = Memory.POWER_ON_SEED if seed is None else seed
+        pattern = Memory._power_on.get((seed, data_length))
+        if pattern is None:
+            rng = random.Random(seed)
+
+            def rows(width: int, length: int) -> Tuple[Tuple[bool, ...], ...]:
+                return tuple(tuple(bool(v >> (width - 1 - i) & 1) for i in range(0, width))
+                             for v in (rng.getrandbits(width) for _ in range(0, length)))
+
+            pattern = (rows(Memory.DATA_WIDTH, data_length), rows(Memory.STACK_WIDTH, Memory.STACK_LENGTH))
+            if len(Memory._power_on) >= Memory.POWER_ON_CACHE:
+                Memory._power_on.clear()
+            Memory._power_on[seed, data_length] = pattern
+        return pattern
+
+    def reset(self, seed: int = None) -> None:
+        """return every row to its power-on value in place, registers are cleared"""
+        data, stack = Memory.power_on_pattern(seed, len(self.DATA_MEMORY))
+        cleared = [False] * Memory.REGISTER_WIDTH
+        self.select_bank(0)
+        for bank in self.banks:
+            for row in (bank.values() if bank is not None else ()):
+                row.values = list(cleared)
+        for row, bits in zip(self.DATA_MEMORY, data):
+            row.values = list(bits)
+        for row, bits in zip(self.STACK, stack):
+            row.values = list(bits)
+        self.stack_pointer = 0
+
+    def select_bank(self, bank: int) -> None:
+        """REGBANK: make bank the active register file, no register is copied"""
+        registers = self.banks[bank]
+        if registers is None:
+            registers = self.banks[bank] = Memory.init_reg(Memory.REGISTER_WIDTH, Memory.NUM_REGISTERS)
+        self.REGISTERS = registers
+        self.bank = bank
+
+    def inactive_bank(self) -> Dict[str, MEMORY_IMPL]:
+        """the register file STAR writes to"""
+        other = 1 - self.bank
+        if self.banks[other] is None:
+            self.banks[other] = Memory.init_reg(Memory.REGISTER_WIDTH, Memory.NUM_REGISTERS)
+        return self.banks[other]
+
+    @staticmethod
+    def bit_table(width: int) -> Tuple[Dict[Tuple[bool, ...], int], Tuple[Tuple[bool, ...], ...]]:
+        table = Memory._bit_tables.get(width)
+        if table is None:
+            to_bits = tuple(tuple(bool(v >> (width - 1 - i) & 1) for i in range(0, width))
+                            for v in range(0, 1 << width))
+            table = Memory._bit_tables[width] = ({bits: v for v, bits in enumerate(to_bits)}, to_bits)
+        return table
+
+    def _encode(self, stack_rows: int) -> bytes:
+        # registers and scratchpad are one byte per row, stack rows are split into high and low bytes,
+        # register bank B and the active bank follow the stack pointer
+        reg_int = Memory.bit_table(Memory.REGISTER_WIDTH)[0].__getitem__
+        data_int = Memory.bit_table(Memory.DATA_WIDTH)[0].__getitem__
+        stack_int = Memory.bit_table(Memory.STACK_WIDTH)[0].__getitem__
+        bank_a, bank_b = self.banks
+        out = bytearray(map(reg_int, map(tuple, (bank_a[name].values for name in Memory.REGISTER_NAMES))))
+        out.extend(map(data_int, map(tuple, map(Memory.ROW_VALUES, self.DATA_MEMORY))))
+        stack = list(map(stack_int, map(tuple, map(Memory.ROW_VALUES, self.STACK[:stack_rows]))))
+        out.extend(v >> 8 for v in stack)
+        out.extend(v & 0xFF for v in stack)
+        out.append(self.stack_pointer)
+        if bank_b is None:
+            out.extend(bytes(Memory.NUM_REGISTERS))
+        else:
+            out.extend(map(reg_int, map(tuple, (bank_b[name].values for name in Memory.REGISTER_NAMES))))
+        out.append(self.bank)
+        return bytes(out)
+
+    def snapshot(self) -> bytes:
+        """compact copy of every row and the stack pointer, see restore"""
+        return self._encode(Memory.STACK_LENGTH)
+
+    def state_key(self) -> bytes:
+        """like snapshot, but stack rows above the stack pointer are left out since they can not be read"""
+        return self._encode(self.stack_pointer)
+
+    def restore(self, snapshot: bytes) -> None:
+        reg_bits = Memory.bit_table(Memory.REGISTER_WIDTH)[1]
+        data_bits = Memory.bit_table(Memory.DATA_WIDTH)[1]
+        stack_bits = Memory.bit_table(Memory.STACK_WIDTH)[1]
+        registers = self.banks[0]
+        for name, value in zip(Memory.REGISTER_NAMES, snapshot):
+            registers[name].values = list(reg_bits[value])
+        offset = Memory.NUM_REGISTERS
+        data_length = len(self.DATA_MEMORY)
+        for row, value in zip(self.DATA_MEMORY, snapshot[offset:offset + data_length]):
+            row.values = list(data_bits[value])
+        offset += data_length
+        high = snapshot[offset:offset + Memory.STACK_LENGTH]
+        low = snapshot[offset + Memory.STACK_LENGTH:offset + 2 * Memory.STACK_LENGTH]
+        for row, h, l in zip(self.STACK, high, low):
+            row.values = list(stack_bits[h << 8 | l])
+        offset += 2 * Memory.STACK_LENGTH
+        self.stack_pointer = snapshot[offset]
+        bank_b = snapshot[offset + 1:offset + 1 + Memory.NUM_REGISTERS]
+        bank = snapshot[-1]
+        if self.banks[1] is not None or bank or any(bank_b):
+            self.select_bank(1)
+            for name, value in zip(Memory.REGISTER_NAMES, bank_b):
+                self.REGISTERS[name].values = list(reg_bits[value])
+        self.select_bank(bank)
 
     @staticmethod
     def init_reg(width: int, num_reg: int) -> Dict[str, MEMORY_IMPL]:
@@ -101,7 +323,8 @@ class Memory(object):
 
     @staticmethod
     def init_mem(width: int, length: int) -> List[MEMORY_IMPL]:
-        return [Memory.MEMORY_IMPL(width) for _ in range(0, length)]
+        # contents are filled in by reset
+        return [Memory.MEMORY_IMPL(width, default=False) for _ in range(0, length)]
 
     def fetch_register(self, reg_name: str) -> int:
         return self.REGISTERS[reg_name.lower()].value
@@ -130,3 +353,64 @@ class Memory(object):
             raise IndexError("Stack underflow")
         self.stack_pointer -= 1
         return self.STACK[self.stack_pointer].value
+
+    """VIEWS AND BULK ACCESS"""
+
+    def registers(self, bank: int = None) -> "Memory.RowView":
+        """s0-sF of bank, by default of whichever bank is active when the view is read"""
+        if bank is None:
+            return Memory.RowView(lambda: self.REGISTERS, Memory.REGISTER_NAMES, Memory.REGISTER_WIDTH)
+        if self.banks[bank] is None:
+            self.banks[bank] = Memory.init_reg(Memory.REGISTER_WIDTH, Memory.NUM_REGISTERS)
+        return Memory.RowView(lambda: self.banks[bank], Memory.REGISTER_NAMES, Memory.REGISTER_WIDTH)
+
+    def data(self) -> "Memory.RowView":
+        return Memory.RowView(lambda: self.DATA_MEMORY, range(0, len(self.DATA_MEMORY)), Memory.DATA_WIDTH)
+
+    def stack(self) -> "Memory.RowView":
+        """every stack row, including those above the stack pointer"""
+        return Memory.RowView(lambda: self.STACK, range(0, Memory.STACK_LENGTH), Memory.STACK_WIDTH)
+
+    def load_registers(self, values: Sequence[int], bank: int = None) -> None:
+        self.registers(bank)[:] = values
+
+    def load_data(self, data: Sequence[int], offset: int = 0) -> None:
+        """copy bytes (or any ints) into the scratchpad from offset, the rest is left as it is"""
+        data = list(data)
+        if offset < 0 or offset + len(data) > len(self.DATA_MEMORY):
+            raise IndexError("%d bytes at 0x%02X do not fit the %d byte scratchpad"
+                             % (len(data), offset, len(self.DATA_MEMORY)))
+        self.data()[offset:offset + len(data)] = data
+
+    def load_data_file(self, path: str, offset: int = 0) -> None:
+        with open(path, "rb") as f:
+            self.load_data(f.read(), offset)
+
+    def diff(self, other: "Memory") -> List[Tuple[str, Union[str, int], Optional[int], Optional[int]]]:
+        """
+        (space, location, value here, value in other) of every row that differs, for comparing runs. A register
+        bank B only one side ever selected is compared against None, neither memory gets one allocated.
+        """
+        def bank_b(mem: Memory) -> Sequence[int]:
+            if mem.banks[1] is None:
+                return ()
+            return Memory.RowView(lambda: mem.banks[1], Memory.REGISTER_NAMES, Memory.REGISTER_WIDTH)
+
+        changes = []  # type: List[Tuple[str, Union[str, int], Optional[int], Optional[int]]]
+        spaces = [("registers", Memory.REGISTER_NAMES, self.registers(0), other.registers(0)),
+                  ("data", range(0, max(len(self.DATA_MEMORY), len(other.DATA_MEMORY))), self.data(), other.data()),
+                  ("stack", range(0, Memory.STACK_LENGTH), self.stack(), other.stack())]
+        if self.banks[1] is not None or other.banks[1] is not None:
+            spaces.insert(1, ("registers_b", Memory.REGISTER_NAMES, bank_b(self), bank_b(other)))
+        for space, keys, mine, theirs in spaces:
+            mine, theirs = list(mine), list(theirs)
+            for idx, key in enumerate(keys):
+                a = mine[idx] if idx < len(mine) else None
+                b = theirs[idx] if idx < len(theirs) else None
+                if a != b:
+                    changes.append((space, key, a, b))
+        if self.stack_pointer != other.stack_pointer:
+            changes.append(("stack_pointer", 0, self.stack_pointer, other.stack_pointer))
+        if self.bank != other.bank:
+            changes.append(("bank", 0, self.bank, other.bank))
+        return changes
@@ -0,0 +1,294 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import heapq
+import multiprocessing
+from typing import List, Dict, Iterable, Tuple, Optional
+
+import ops.operations as op
+from system.processor import Processor
+
+# cycle, source core, port_id, value
+Event = Tuple[int, int, int, int]
+# cycle, sequence, target core, kind, port_id, value
+Delivery = Tuple[int, int, int, str, int, int]
+
+
+class Link(object):
+    """
+    An OUTPUT or OUTPUTK of source to port reaches target latency cycles later. PORT links latch the value for INPUTs of
+    target_port, INTERRUPT links drive the target interrupt line with bit 0 of the value.
+    """
+    PORT = "port"
+    INTERRUPT = "interrupt"
+
+    def __init__(self, source: int, port: int, target: int, target_port: int = None, kind: str = PORT,
+                 latency: int = Processor.CLOCKS_PER_INSTRUCTION):
+        if latency < 1:
+            raise ValueError("Link latency must be at least one cycle")
+        if kind not in (Link.PORT, Link.INTERRUPT):
+            raise ValueError("Unknown link kind %s" % kind)
+        self.source = source
+        self.port = port
+        self.target = target
+        self.target_port = port if target_port is None else target_port
+        self.kind = kind
+        self.latency = latency
+
+    def __repr__(self):
+        return "Link(%d:%02X -> %d:%s %02X, %d cycles)" % (self.source, self.port, self.target, self.kind,
+                                                           self.target_port, self.latency)
+
+
+class Core(object):
+    """One Processor of a System, with the port latches its INPUTs read and the deliveries not yet due"""
+    def __init__(self, index: int, program: Dict[int, op.Instruction], isr_addr: int = 0x3FF):
+        self.index = index
+        self.proc = Processor(isr_addr=isr_addr)
+        self.proc.set_instructions(program)
+        self.ports = [0] * 256  # type: List[int]
+        self.pending = []  # type: List[Delivery]
+        self.events = []  # type: List[Event]
+        self._hook()
+
+    def _hook(self):
+        proc = self.proc
+        set_read_strobe = proc.set_read_strobe
+        set_write_strobe = proc.set_write_strobe
+        set_k_write_strobe = proc.set_k_write_strobe
+
+        def read_strobe(val: bool):
+            set_read_strobe(val)
+            if val:
+                proc.external.set_int_port(self.ports[proc.p_port_id & 0xFF])
+
+        def write_strobe(val: bool):
+            set_write_strobe(val)
+            if val:
+                # the cycle the OUTPUT started in, Processor.execute counts it after the instruction
+                self.events.append((proc.cycles, self.index, proc.p_port_id & 0xFF, proc.p_out_port & 0xFF))
+
+        def k_write_strobe(val: bool):
+            set_k_write_strobe(val)
+            if val:
+                self.events.append((proc.cycles, self.index, proc.p_port_id & 0xFF, proc.p_out_port & 0xFF))
+
+        proc.set_read_strobe = read_strobe
+        proc.set_write_strobe = write_strobe
+        proc.set_k_write_strobe = k_write_strobe
+
+    @property
+    def halted(self) -> bool:
+        return self.proc.outside_program()
+
+    def deliver(self, delivery: Delivery):
+        heapq.heappush(self.pending, delivery)
+
+    def _apply_due(self):
+        pending = self.pending
+        cycles = self.proc.cycles
+        while len(pending) and pending[0][0] <= cycles:
+            _, _, _, kind, port, value = heapq.heappop(pending)
+            if kind == Link.PORT:
+                self.ports[port] = value
+            else:
+                self.proc.external.set_interrupt(bool(value & 1))
+
+    def run_until(self, end_cycle: int):
+        proc = self.proc
+        while proc.cycles < end_cycle and not proc.outside_program():
+            if len(self.pending) and self.pending[0][0] <= proc.cycles:
+                self._apply_due()
+            proc.execute()
+        # a halted core still sees what arrives, and idles until the end of the window
+        self._apply_due()
+        if proc.cycles < end_cycle and proc.outside_program():
+            proc.cycles = end_cycle
+
+
+class CoreGroup(object):
+    """The cores one scheduler (the System loop itself or a worker process) runs window by window"""
+    def __init__(self, cores: List[Tuple[int, Dict[int, op.Instruction], int]]):
+        self.cores = {index: Core(index, program, isr_addr) for index, program, isr_addr in cores}
+
+    def run_window(self, end_cycle: int, deliveries: List[Delivery]) -> Tuple[List[Event], Dict[int, bool]]:
+        for delivery in deliveries:
+            self.cores[delivery[2]].deliver(delivery)
+        events = []  # type: List[Event]
+        for core in self.cores.values():
+            core.run_until(end_cycle)
+            events.extend(core.events)
+            core.events = []
+        return events, {index: core.halted and not len(core.pending) for index, core in self.cores.items()}
+
+    def snapshots(self) -> Dict[int, tuple]:
+        return {index: core.proc.snapshot() for index, core in self.cores.items()}
+
+
+def _worker(conn, cores: List[Tuple[int, Dict[int, op.Instruction], int]]):
+    group = CoreGroup(cores)
+    while True:
+        message = conn.recv()
+        if message[0] == "run":
+            conn.send(group.run_window(message[1], message[2]))
+        elif message[0] == "snapshots":
+            conn.send(group.snapshots())
+        else:
+            break
+    conn.close()
+
+
+class System(object):
+    """
+    Several PicoBlaze cores wired together by Links. Cores run in lockstep windows of quantum cycles: OUTPUTs
+    of a window are routed to their targets between windows, ordered by (cycle, source core, emission order),
+    and applied before the first instruction the target starts at or after the arrival cycle.
+    Delivery is cycle accurate while the quantum is not larger than the smallest link latency, which is the
+    default. With processes > 1 the cores are spread over worker processes, results are identical.
+    """
+    IDLE_QUANTUM = 1024  # type: int
+
+    def __init__(self, programs: List[Dict[int, op.Instruction]], isr_addrs: List[int] = None,
+                 links: Iterable[Link] = (), quantum: int = None, processes: int = 0, record: bool = False):
+        self.programs = programs
+        self.isr_addrs = list(isr_addrs) if isr_addrs is not None else [0x3FF] * len(programs)
+        self.links = {}  # type: Dict[Tuple[int, int], List[Link]]
+        for link in links:
+            self.link(link)
+        self._quantum = quantum
+        self.processes = processes
+        # every routed OUTPUT when recording
+        self.record = record
+        self.events = []  # type: List[Event]
+        self.cycles = 0  # type: int
+        # deliveries that arrived after the target already passed their cycle, only with a large quantum
+        self.late = 0  # type: int
+        self._sequence = 0  # type: int
+        self._outbox = {}  # type: Dict[int, List[Delivery]]
+        self._halted = {}  # type: Dict[int, bool]
+        self._group = None  # type: Optional[CoreGroup]
+        self._workers = []  # type: List[Tuple[multiprocessing.Process, object, List[int]]]
+        self._owner = {}  # type: Dict[int, int]
+
+    def link(self, link: Link):
+        for core in (link.source, link.target):
+            if not 0 <= core < len(self.programs):
+                raise ValueError("%r refers to core %d of %d" % (link, core, len(self.programs)))
+        self.links.setdefault((link.source, link.port), []).append(link)
+
+    def connect(self, source: int, port: int, target: int, target_port: int = None,
+                latency: int = Processor.CLOCKS_PER_INSTRUCTION):
+        self.link(Link(source, port, target, target_port, Link.PORT, latency))
+
+    def interrupt(self, source: int, port: int, target: int, latency: int = Processor.CLOCKS_PER_INSTRUCTION):
+        self.link(Link(source, port, target, None, Link.INTERRUPT, latency))
+
+    @property
+    def quantum(self) -> int:
+        if self._quantum is not None:
+            return self._quantum
+        latencies = [link.latency for links in self.links.values() for link in links]
+        return min(latencies) if len(latencies) else System.IDLE_QUANTUM
+
+    @property
+    def cores(self) -> List[Processor]:
+        """the processors, only available when the cores run in this process"""
+        if self._group is None:
+            self._start()
+        if self._group is None:
+            raise RuntimeError("Cores run in worker processes, use snapshots()")
+        return [self._group.cores[index].proc for index in range(0, len(self.programs))]
+
+    def _start(self):
+        if self._group is not None or len(self._workers):
+            return
+        specs = [(index, program, self.isr_addrs[index]) for index, program in enumerate(self.programs)]
+        workers = min(self.processes, len(specs))
+        if workers <= 1:
+            self._group = CoreGroup(specs)
+            return
+        for worker in range(0, workers):
+            chunk = specs[worker::workers]
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker, args=(child, chunk), daemon=True)
+            process.start()
+            child.close()
+            self._workers.append((process, parent, [index for index, _, _ in chunk]))
+            for index, _, _ in chunk:
+                self._owner[index] = worker
+
+    def _route(self, events: List[Event]):
+        # a stable order that does not depend on how the cores are spread over workers
+        events.sort(key=lambda e: (e[0], e[1]))
+        for event in events:
+            cycle, source, port, value = event
+            if self.record:
+                self.events.append(event)
+            for link in self.links.get((source, port), ()):
+                arrival = cycle + link.latency
+                if arrival < self.cycles:
+                    self.late += 1
+                self._sequence += 1
+                delivery = (arrival, self._sequence, link.target, link.kind, link.target_port, value)
+                self._outbox.setdefault(self._owner.get(link.target, 0), []).append(delivery)
+
+    def run_window(self):
+        self._start()
+        end_cycle = self.cycles + self.quantum
+        outbox, self._outbox = self._outbox, {}
+        events = []  # type: List[Event]
+        if self._group is not None:
+            produced, halted = self._group.run_window(end_cycle, outbox.get(0, []))
+            events.extend(produced)
+            self._halted.update(halted)
+        else:
+            for worker, (_, conn, _) in enumerate(self._workers):
+                conn.send(("run", end_cycle, outbox.get(worker, [])))
+            for _, conn, _ in self._workers:
+                produced, halted = conn.recv()
+                events.extend(produced)
+                self._halted.update(halted)
+        self.cycles = end_cycle
+        self._route(events)
+
+    @property
+    def halted(self) -> bool:
+        """every core left its program and nothing is left to deliver"""
+        return (len(self._halted) == len(self.programs) and all(self._halted.values())
+                and not any(len(x) for x in self._outbox.values()))
+
+    def run(self, cycles: int = None) -> int:
+        """run windows until every core halted or the cycle budget is used, returns the system cycle count"""
+        end_cycle = self.cycles + cycles if cycles is not None else None
+        while not self.halted:
+            if end_cycle is not None and self.cycles >= end_cycle:
+                break
+            self.run_window()
+        return self.cycles
+
+    def snapshots(self) -> List[tuple]:
+        """Processor.snapshot() of every core, in core order"""
+        self._start()
+        if self._group is not None:
+            found = self._group.snapshots()
+        else:
+            found = {}
+            for _, conn, _ in self._workers:
+                conn.send(("snapshots",))
+            for _, conn, _ in self._workers:
+                found.update(conn.recv())
+        return [found[index] for index in range(0, len(self.programs))]
+
+    def close(self):
+        for process, conn, _ in self._workers:
+            conn.send(("stop",))
+            conn.close()
+            process.join()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
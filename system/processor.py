@@ -2,10 +2,78 @@
 PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
 Copyright (C) 2017  Vadim Korolik - see LICENCE
 """
+import time
+from contextlib import contextmanager
+from types import FunctionType
+from typing import List, Dict, Iterable, Iterator
+
 from system.manager import ProgramManager
 from system.memory import Memory
 
 
+def installed_hook(target: object, name: str):
+    """
+    The instance attribute hooking method name of target, None when the class method is in place.
+    Reading vars(target) instead would make CPython build the instance __dict__, which slows every later
+    attribute access of the simulator's hottest objects by 15-20%.
+    """
+    value = getattr(target, name)
+    if getattr(value, "__self__", None) is target and getattr(value, "__func__", None) is getattr(type(target), name):
+        return None
+    return value
+
+
+class StopRun(Exception):
+    """
+    Raised by a hook once an instruction completed to make Processor.run return with reason.
+    Outside of run() it reaches whoever called execute().
+    """
+    def __init__(self, reason: str, detail: object = None):
+        super(StopRun, self).__init__(reason)
+        self.reason = reason
+        self.detail = detail
+
+
+class RunResult(object):
+    """What one Processor.run did and why it stopped, in simulated and in wall clock time"""
+    # the program counter left the program
+    HALTED = "halted"
+    INSTRUCTIONS = "instructions"
+    CYCLES = "cycles"
+    WATCHPOINT = "watchpoint"
+
+    def __init__(self, dispatches: int, cycles: int, wall_seconds: float, clock_hz: int, reason: str = HALTED,
+                 pc: int = 0, detail: object = None):
+        self.dispatches = dispatches
+        # clock cycles simulated by this run
+        self.cycles = cycles
+        self.wall_seconds = wall_seconds
+        self.clock_hz = clock_hz
+        self.reason = reason
+        # where execution resumes
+        self.pc = pc
+        # StopRun.detail when a hook stopped the run
+        self.detail = detail
+
+    @property
+    def simulated_seconds(self) -> float:
+        return self.cycles / self.clock_hz
+
+    @property
+    def simulated_us(self) -> float:
+        return self.cycles * 1000000.0 / self.clock_hz
+
+    @property
+    def realtime_ratio(self) -> float:
+        """simulated time per wall clock time, above 1 the simulation runs faster than the hardware"""
+        return self.simulated_seconds / self.wall_seconds if self.wall_seconds > 0 else float("inf")
+
+    def __repr__(self):
+        return "%s at 0x%03X: %d dispatches, %d cycles, %.3f us simulated in %.3f us (%.4fx real time)" % (
+            self.reason, self.pc, self.dispatches, self.cycles, self.simulated_us, self.wall_seconds * 1000000.0,
+            self.realtime_ratio)
+
+
 class Processor(object):
     """
     ExternalInterface is public to the outside of the CPU
@@ -37,21 +105,52 @@ class Processor(object):
         def port_id(self) -> hex:
             return self.p.p_port_id
 
+        @property
+        def read_strobe(self) -> bool:
+            return self.p.p_read_strobe
+
+        @property
+        def write_strobe(self) -> bool:
+            return self.p.p_write_strobe
+
+        @property
+        def k_write_strobe(self) -> bool:
+            return self.p.p_k_write_strobe
+
         @property
         def out_port(self) -> hex:
             return self.p.p_out_port
 
-    def __init__(self, isr_addr=0x3FF):
-        self._mem = Memory()
+    CLOCKS_PER_INSTRUCTION = 2  # type: int
+    # taking an interrupt pushes the pc and jumps to the ISR like a CALL, before the ISR starts
+    INTERRUPT_RESPONSE_CLOCKS = 2  # type: int
+    CLOCK_HZ = 100000000  # type: int
+
+    def __init__(self, isr_addr=0x3FF, seed: int = None, clock_hz: int = None, hwbuild: int = 0x00,
+                 data_length: int = Memory.DATA_LENGTH):
+        self.clock_hz = Processor.CLOCK_HZ if clock_hz is None else clock_hz  # type: int
+        # the KCPSM6 hwbuild generic, read by HWBUILD
+        self.hwbuild = hwbuild & 0xFF  # type: int
+        self._mem = Memory(seed, data_length)
         self.manager = ProgramManager(isr_addr=isr_addr)
         self._last_instruction = 0
         self._instructions = {}  # type Dict[hex, Instruction]
+        self._power_on()
 
+        self.external = Processor.ExternalInterface(self)
+
+    def _power_on(self):
         self.p_carry = False  # type: bool
         self.p_zero = False  # type: bool
         self.p_interrupt_ack = False  # type: bool
         self.p_out_port = 0x00  # type: hex
         self.p_port_id = 0x00  # type: hex
+        self.p_read_strobe = False  # type: bool
+        self.p_write_strobe = False  # type: bool
+        # OUTPUTK asserts k_write_strobe instead of write_strobe
+        self.p_k_write_strobe = False  # type: bool
+        # a strobe or interrupt_ack is asserted for the instruction that raised it
+        self._strobed = False  # type: bool
 
         self._interrupt_enabled = False  # type: bool
         self._interrupt = False  # type: bool
@@ -61,7 +160,59 @@ class Processor(object):
 
         self._in_port = 0x00  # type: hex
 
-        self.external = Processor.ExternalInterface(self)
+        # clock cycles elapsed, every instruction takes CLOCKS_PER_INSTRUCTION clocks and taking an interrupt
+        # INTERRUPT_RESPONSE_CLOCKS more
+        self.cycles = 0  # type: int
+
+    def reset(self, program=None, seed: int = None):
+        """
+        Return to the power-on state in place: registers, flags, ports, pc and cycle counter are cleared and
+        the scratchpad and stack get the seeded power-on pattern. Loads program if given, otherwise the program
+        is emptied for add_instruction(). Hooks stay installed.
+        """
+        self._mem.reset(seed)
+        self.manager.jump(0)
+        self._power_on()
+        if program is not None:
+            self.set_instructions(program)
+        else:
+            # a fresh dict, the previous one may be shared with other processors
+            self._instructions = {}
+            self._last_instruction = 0
+
+    def snapshot(self) -> tuple:
+        """everything needed to restore this exact state, hooks and the program are not included"""
+        return (self._mem.snapshot(), self.manager.pc, self.cycles, self.p_carry, self.p_zero, self.p_interrupt_ack,
+                self.p_out_port, self.p_port_id, self.p_read_strobe, self.p_write_strobe, self._strobed,
+                self._interrupt_enabled, self._interrupt, self._preserved_carry, self._preserved_zero, self._in_port,
+                self.p_k_write_strobe)
+
+    def restore(self, snapshot: tuple):
+        """return to a snapshot, fields are assigned directly so hooked setters do not see the change"""
+        (mem, pc, self.cycles, self.p_carry, self.p_zero, self.p_interrupt_ack,
+         self.p_out_port, self.p_port_id, self.p_read_strobe, self.p_write_strobe, self._strobed,
+         self._interrupt_enabled, self._interrupt, self._preserved_carry, self._preserved_zero,
+         self._in_port, self.p_k_write_strobe) = snapshot
+        self._mem.restore(mem)
+        self.manager.jump(pc)
+
+    def state_key(self) -> bytes:
+        """
+        Hashable encoding of the state that decides future behaviour: memory, pc and flags.
+        The cycle counter, output ports and in_port (only read by INPUT) are left out.
+        """
+        pc = self.manager.pc
+        flags = (self.p_carry | self.p_zero << 1 | self._interrupt_enabled << 2 | self._preserved_carry << 3
+                 | self._preserved_zero << 4)
+        return self._mem.state_key() + bytes((pc >> 8, pc & 0xFF, flags))
+
+    def cycles_for(self, microseconds: float) -> int:
+        """clock cycles in a span of simulated time, rounded to the nearest cycle"""
+        return int(round(microseconds * self.clock_hz / 1000000.0))
+
+    def microseconds(self, cycles: int = None) -> float:
+        """simulated time of a number of cycles, the time since power-on by default"""
+        return (self.cycles if cycles is None else cycles) * 1000000.0 / self.clock_hz
 
     """INTERNAL PUBLIC FUNCTIONS"""
 
@@ -98,6 +249,30 @@ class Processor(object):
 
     def set_interrupt_ack(self, val: bool):
         self.p_interrupt_ack = val
+        self._strobed = self._strobed or val
+
+    def set_read_strobe(self, val: bool):
+        self.p_read_strobe = val
+        self._strobed = self._strobed or val
+
+    def set_write_strobe(self, val: bool):
+        self.p_write_strobe = val
+        self._strobed = self._strobed or val
+
+    def set_k_write_strobe(self, val: bool):
+        self.p_k_write_strobe = val
+        self._strobed = self._strobed or val
+
+    def clear_strobes(self):
+        self._strobed = False
+        if self.p_read_strobe:
+            self.set_read_strobe(False)
+        if self.p_write_strobe:
+            self.set_write_strobe(False)
+        if self.p_k_write_strobe:
+            self.set_k_write_strobe(False)
+        if self.p_interrupt_ack:
+            self.set_interrupt_ack(False)
 
     def recover_zero(self):
         self.set_zero(self._preserved_zero)
@@ -106,14 +281,55 @@ class Processor(object):
         self.set_carry(self._preserved_carry)
 
     def execute(self) -> None:
+        if self._strobed:
+            self.clear_strobes()
         if self.interrupt_enabled:
             if self.interrupt:
-                self.memory.push_stack(self.manager.pc)
-                self._preserved_zero = self.p_zero
-                self._preserved_carry = self.p_carry
-                self.set_interrupt_enabled(False)
-                self.manager.jump(self.manager.isr_addr)
+                self.enter_interrupt()
         self.fetch_program(self.manager.pc).exec(self)
+        self.cycles += Processor.CLOCKS_PER_INSTRUCTION
+
+    def enter_interrupt(self) -> None:
+        """the interrupt response: push the pc, preserve the flags and jump to the ISR"""
+        self.memory.push_stack(self.manager.pc)
+        self._preserved_zero = self.p_zero
+        self._preserved_carry = self.p_carry
+        self.set_interrupt_enabled(False)
+        self.set_interrupt_ack(True)
+        self.cycles += Processor.INTERRUPT_RESPONSE_CLOCKS
+        self.manager.jump(self.manager.isr_addr)
+
+    def run(self, instructions: int = None, cycles: int = None, microseconds: float = None) -> RunResult:
+        """
+        Execute until the program counter leaves the program, a budget runs out or a hook raises StopRun.
+        Budgets are dispatches, clock cycles or simulated microseconds at clock_hz, an instruction is never cut
+        short by a cycle budget.
+        """
+        if microseconds is not None:
+            budget = self.cycles_for(microseconds)
+            cycles = budget if cycles is None else min(cycles, budget)
+        executed = 0
+        start_cycle = self.cycles
+        end_cycle = start_cycle + cycles if cycles is not None else None
+        reason = RunResult.HALTED
+        detail = None
+        start_time = time.perf_counter()
+        try:
+            while not self.outside_program():
+                if instructions is not None and executed >= instructions:
+                    reason = RunResult.INSTRUCTIONS
+                    break
+                if end_cycle is not None and self.cycles >= end_cycle:
+                    reason = RunResult.CYCLES
+                    break
+                self.execute()
+                executed += 1
+        except StopRun as stop:
+            # the instruction that stopped the run completed
+            executed += 1
+            reason, detail = stop.reason, stop.detail
+        return RunResult(executed, self.cycles - start_cycle, time.perf_counter() - start_time, self.clock_hz,
+                         reason, self.manager.pc, detail)
 
     def set_instructions(self, instructions):
         self._instructions = instructions
@@ -122,8 +338,66 @@ class Processor(object):
         self._instructions[self._last_instruction] = instr
         self._last_instruction += 1
 
+    def patch(self, changes: Dict[hex, object], removed: Iterable[hex] = ()):
+        """
+        Swap instructions of the loaded program in place, e.g. with what Assembler.reassemble() returns.
+        Registers, pc and cycles are kept, every processor sharing the program sees the patch.
+        """
+        program = self._instructions
+        for addr in removed:
+            program.pop(addr, None)
+        program.update(changes)
+
     def fetch_program(self, addr: hex):
         return self._instructions[addr]
 
     def outside_program(self) -> bool:
         return self.manager.pc == (len(self._instructions))
+
+
+class ProcessorPool(object):
+    """
+    Keeps released processors for reuse, a reset is much cheaper than building a new Memory.
+    Processors that still have instance hooks installed (VCDWriter, CoSimBridge, ...) are not pooled.
+    """
+    _hookable = None  # type: List[str]
+
+    @staticmethod
+    def hookable() -> List[str]:
+        """Processor methods instruments may hook"""
+        if ProcessorPool._hookable is None:
+            ProcessorPool._hookable = [name for name, value in vars(Processor).items()
+                                       if isinstance(value, FunctionType) and not name.startswith("__")]
+        return ProcessorPool._hookable
+
+    def __init__(self, size: int = 16, isr_addr=0x3FF):
+        self.size = size
+        self.isr_addr = isr_addr
+        self._free = []  # type: List[Processor]
+        self.created = 0  # type: int
+
+    def acquire(self, program=None, seed: int = None) -> Processor:
+        if len(self._free):
+            proc = self._free.pop()
+            proc.reset(program, seed)
+            return proc
+        self.created += 1
+        proc = Processor(isr_addr=self.isr_addr, seed=seed)
+        if program is not None:
+            proc.set_instructions(program)
+        return proc
+
+    def release(self, proc: Processor):
+        if len(self._free) >= self.size or proc.manager.isr_addr != self.isr_addr:
+            return
+        if any(installed_hook(proc, name) is not None for name in ProcessorPool.hookable()):
+            return
+        self._free.append(proc)
+
+    @contextmanager
+    def lease(self, program=None, seed: int = None) -> Iterator[Processor]:
+        proc = self.acquire(program, seed)
+        try:
+            yield proc
+        finally:
+            self.release(proc)
@@ -0,0 +1,433 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import base64
+import collections
+import hashlib
+import json
+import socket
+import struct
+import threading
+import time
+from typing import List, Dict, Callable, Tuple, Optional, Deque
+
+from hardware_sim.seven_segment_display import SevenSegmentDisplay
+from system.memory import Memory
+from system.processor import Processor, RunResult, installed_hook
+
+
+class StateFormat(object):
+    """
+    Every message starts with a kind byte.
+        HELLO  kind, JSON {"fields": [[name, offset, length], ...], "size": n, "fps": f, "clock_hz": n}
+        FULL   HEADER, the whole state image
+        DELTA  HEADER, then (offset, length, bytes) runs of the image that changed since the previous frame
+    Frames are numbered, a DELTA applies to the frame numbered one less. Over TCP every message is prefixed
+    with its u32 length, over WebSocket every message is one binary frame.
+    """
+    HELLO = 0
+    FULL = 1
+    DELTA = 2
+
+    HEADER = struct.Struct("<BIQ")  # kind, frame, cycles
+    RUN = struct.Struct("<HB")  # offset, length
+    LENGTH = struct.Struct("<I")
+
+    # flags byte of the image
+    CARRY = 1
+    ZERO = 2
+    INTERRUPT_ENABLED = 4
+    INTERRUPT = 8
+
+    # runs closer than this are sent as one, a run header costs 3 bytes
+    MERGE_GAP = 3
+    BLOCK = 16
+
+
+class StatePublisher(object):
+    """
+    Frames of the processor state for remote viewers, throttled to fps however fast the simulation runs.
+    The state image holds pc, flags, the port signals, the last value written to every port_id, the seven
+    segment display if one is given and the Memory snapshot. frame() diffs the image against the one last
+    sent and passes the encoded frame to every subscriber. run() is Processor.run in chunks sized to publish
+    between them, so nothing is added to the per instruction path. Only port writes are hooked, to latch them.
+    """
+    FPS = 30  # type: float
+
+    def __init__(self, proc: Processor, fps: float = FPS, display: SevenSegmentDisplay = None):
+        if fps <= 0:
+            raise ValueError("fps must be positive")
+        self.proc = proc
+        self.fps = fps
+        self.display = display
+        self.interval = 1.0 / fps  # type: float
+        self.outputs = bytearray(256)
+        self.fields = []  # type: List[Tuple[str, int, int]]
+        size = 0
+        for name, length in self._layout():
+            self.fields.append((name, size, length))
+            size += length
+        self.size = size  # type: int
+        self.frames = 0  # type: int
+        self.bytes_sent = 0  # type: int
+        self.lock = threading.Lock()
+        self._image = None  # type: Optional[bytes]
+        self._cycles = 0  # type: int
+        self._last_time = None  # type: Optional[float]
+        self._subscribers = []  # type: List[Callable[[bytes], None]]
+        # instructions per chunk of run(), adapted to the measured speed
+        self._chunk = 1024  # type: int
+        self._hooked = []  # type: List[Tuple[str, Optional[Callable]]]
+        self._attach()
+
+    def _layout(self) -> List[Tuple[str, int]]:
+        layout = [("pc", 2), ("flags", 1), ("port_id", 1), ("out_port", 1), ("in_port", 1), ("outputs", 256)]
+        if self.display is not None:
+            layout.append(("display", len(self.display.segments)))
+        layout.extend([
+            ("registers", Memory.NUM_REGISTERS),
+            ("scratchpad", len(self.proc.memory.DATA_MEMORY)),
+            ("stack_high", Memory.STACK_LENGTH),
+            ("stack_low", Memory.STACK_LENGTH),
+            ("stack_pointer", 1),
+            ("registers_b", Memory.NUM_REGISTERS),
+            ("bank", 1),
+        ])
+        return layout
+
+    def _attach(self):
+        proc = self.proc
+        outputs = self.outputs
+        for name in ("set_write_strobe", "set_k_write_strobe"):
+            setter = getattr(proc, name)
+
+            def latch(val: bool, setter=setter):
+                setter(val)
+                if val:
+                    outputs[proc.p_port_id & 0xFF] = proc.p_out_port & 0xFF
+
+            self._hooked.append((name, installed_hook(proc, name)))
+            setattr(proc, name, latch)
+
+    def detach(self):
+        for name, previous in reversed(self._hooked):
+            if previous is not None:
+                setattr(self.proc, name, previous)
+            else:
+                delattr(self.proc, name)
+        self._hooked = []
+
+    def subscribe(self, callback: Callable[[bytes], None]):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback: Callable[[bytes], None]):
+        self._subscribers.remove(callback)
+
+    """FRAMES"""
+
+    def image(self) -> bytes:
+        proc = self.proc
+        pc = proc.manager.pc
+        flags = (StateFormat.CARRY * proc.p_carry | StateFormat.ZERO * proc.p_zero
+                 | StateFormat.INTERRUPT_ENABLED * proc.interrupt_enabled | StateFormat.INTERRUPT * proc.interrupt)
+        out = bytearray((pc >> 8, pc & 0xFF, flags, proc.p_port_id & 0xFF, proc.p_out_port & 0xFF,
+                         proc.in_port & 0xFF))
+        out.extend(self.outputs)
+        if self.display is not None:
+            for segment in self.display.segments:
+                # a-f in bits 0-5, dp in bit 6, anode in bit 7
+                bits = sum(1 << idx for idx, c in enumerate("abcdef") if segment.cathodes[c])
+                out.append(bits | segment.cathodes["dp"] << 6 | segment.anode << 7)
+        out.extend(proc.memory.snapshot())
+        return bytes(out)
+
+    def hello(self) -> bytes:
+        info = {"fields": self.fields, "size": self.size, "fps": self.fps, "clock_hz": self.proc.clock_hz}
+        return bytes((StateFormat.HELLO,)) + json.dumps(info).encode()
+
+    def keyframe(self) -> bytes:
+        """the last frame in full, for viewers joining or falling behind"""
+        image = self._image if self._image is not None else self.image()
+        return StateFormat.HEADER.pack(StateFormat.FULL, self.frames, self._cycles) + image
+
+    @staticmethod
+    def delta(old: bytes, new: bytes) -> bytes:
+        """changed runs of new, compared a block at a time so unchanged blocks cost one slice compare"""
+        runs = []  # type: List[List[int]]
+        block = StateFormat.BLOCK
+        for start in range(0, len(new), block):
+            end = min(start + block, len(new))
+            if old[start:end] == new[start:end]:
+                continue
+            for idx in range(start, end):
+                if old[idx] != new[idx]:
+                    if len(runs) and idx - runs[-1][1] <= StateFormat.MERGE_GAP and idx - runs[-1][0] < 255:
+                        runs[-1][1] = idx + 1
+                    else:
+                        runs.append([idx, idx + 1])
+        out = bytearray()
+        for start, end in runs:
+            out.extend(StateFormat.RUN.pack(start, end - start))
+            out.extend(new[start:end])
+        return bytes(out)
+
+    def frame(self, force: bool = False) -> Optional[bytes]:
+        """
+        Publish a frame if one is due, returns it. Nothing is sent while the state and cycle count are unchanged.
+        """
+        now = time.perf_counter()
+        if not force and self._last_time is not None and now - self._last_time < self.interval:
+            return None
+        self._last_time = now
+        image = self.image()
+        cycles = self.proc.cycles
+        with self.lock:
+            if self._image is None:
+                message = StateFormat.HEADER.pack(StateFormat.FULL, self.frames + 1, cycles) + image
+            else:
+                runs = StatePublisher.delta(self._image, image)
+                if not len(runs) and cycles == self._cycles:
+                    return None
+                message = StateFormat.HEADER.pack(StateFormat.DELTA, self.frames + 1, cycles) + runs
+            self.frames += 1
+            self._image = image
+            self._cycles = cycles
+            self.bytes_sent += len(message)
+            for callback in self._subscribers:
+                callback(message)
+        return message
+
+    def run(self, instructions: int = None, cycles: int = None, microseconds: float = None) -> RunResult:
+        """Processor.run, publishing frames as they fall due"""
+        proc = self.proc
+        if microseconds is not None:
+            budget = proc.cycles_for(microseconds)
+            cycles = budget if cycles is None else min(cycles, budget)
+        end_cycle = proc.cycles + cycles if cycles is not None else None
+        start_cycle = proc.cycles
+        executed = 0
+        start_time = time.perf_counter()
+        self.frame()
+        while True:
+            remaining = None if instructions is None else instructions - executed
+            chunk = self._chunk if remaining is None else min(self._chunk, remaining)
+            left = None if end_cycle is None else max(0, end_cycle - proc.cycles)
+            result = proc.run(instructions=chunk, cycles=left)
+            executed += result.dispatches
+            # about four chunks per frame interval keeps the frame rate steady
+            if result.wall_seconds > 0:
+                rate = result.dispatches / result.wall_seconds
+                self._chunk = max(64, int(rate * self.interval / 4))
+            self.frame()
+            if result.reason != RunResult.INSTRUCTIONS or (remaining is not None and executed >= instructions):
+                reason, detail = result.reason, result.detail
+                break
+            if end_cycle is not None and proc.cycles >= end_cycle:
+                reason, detail = RunResult.CYCLES, None
+                break
+        self.frame(force=True)
+        return RunResult(executed, proc.cycles - start_cycle, time.perf_counter() - start_time, proc.clock_hz,
+                         reason, proc.manager.pc, detail)
+
+
+class StateViewer(object):
+    """Applies published messages to a copy of the state image, the Python end of the format"""
+    def __init__(self):
+        self.fields = {}  # type: Dict[str, Tuple[int, int]]
+        self.image = None  # type: Optional[bytearray]
+        self.frame = 0  # type: int
+        self.cycles = 0  # type: int
+        self.info = {}  # type: Dict[str, object]
+
+    def apply(self, message: bytes):
+        kind = message[0]
+        if kind == StateFormat.HELLO:
+            self.info = json.loads(message[1:].decode())
+            self.fields = {name: (offset, length) for name, offset, length in self.info["fields"]}
+            return
+        _, frame, cycles = StateFormat.HEADER.unpack_from(message, 0)
+        body = memoryview(message)[StateFormat.HEADER.size:]
+        if kind == StateFormat.FULL:
+            self.image = bytearray(body)
+        else:
+            if self.image is None or frame != self.frame + 1:
+                raise ValueError("Delta for frame %d does not follow frame %d" % (frame, self.frame))
+            pos = 0
+            while pos < len(body):
+                offset, length = StateFormat.RUN.unpack_from(body, pos)
+                pos += StateFormat.RUN.size
+                self.image[offset:offset + length] = body[pos:pos + length]
+                pos += length
+        self.frame = frame
+        self.cycles = cycles
+
+    def field(self, name: str) -> bytes:
+        offset, length = self.fields[name]
+        return bytes(self.image[offset:offset + length])
+
+    @property
+    def pc(self) -> int:
+        high, low = self.field("pc")
+        return high << 8 | low
+
+    def register(self, name: str) -> int:
+        return self.field("registers")[Memory.REGISTER_NAMES.index(name.lower())]
+
+
+class _Client(object):
+    """One connected viewer, sent to from its own thread so a slow link never blocks the simulation"""
+    def __init__(self, server: "StateServer", conn: socket.socket):
+        self.server = server
+        self.conn = conn
+        self.queue = collections.deque()  # type: Deque[bytes]
+        self.ready = threading.Condition()
+        self.closed = False  # type: bool
+        self.thread = threading.Thread(target=self._send_loop, daemon=True)
+
+    def send(self, message: bytes):
+        """called by StatePublisher.frame() under the publisher lock, after message was published"""
+        with self.ready:
+            if len(self.queue) >= self.server.max_backlog:
+                # too far behind: drop the deltas and send the latest state in full instead. Taking the keyframe
+                # here, in frame order, keeps later deltas after it and the send loop off the publisher lock.
+                self.queue.clear()
+                self.queue.append(self.server.publisher.keyframe())
+            else:
+                self.queue.append(message)
+            self.ready.notify()
+
+    def _send_loop(self):
+        try:
+            while True:
+                with self.ready:
+                    while not len(self.queue) and not self.closed:
+                        self.ready.wait()
+                    if self.closed:
+                        return
+                    message = self.queue.popleft()
+                self.conn.sendall(self.server.framed(message))
+        except OSError:
+            pass
+        finally:
+            self.server.drop(self)
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
+
+class StateServer(object):
+    """
+    Streams a StatePublisher to viewers over TCP (u32 length prefixed messages) or WebSocket (one binary
+    frame per message). A viewer gets HELLO and a FULL frame on connecting, then every published frame.
+    Viewers whose backlog reaches max_backlog messages skip ahead to a FULL frame of the latest state.
+    """
+    TCP = "tcp"
+    WEBSOCKET = "websocket"
+
+    WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    def __init__(self, publisher: StatePublisher, host: str = "127.0.0.1", port: int = 0, protocol: str = TCP,
+                 max_backlog: int = 64):
+        if protocol not in (StateServer.TCP, StateServer.WEBSOCKET):
+            raise ValueError("Unknown protocol %s" % protocol)
+        self.publisher = publisher
+        self.protocol = protocol
+        self.max_backlog = max_backlog
+        self.clients = []  # type: List[_Client]
+        self._lock = threading.Lock()
+        self._sock = socket.create_server((host, port))
+        self.address = self._sock.getsockname()[:2]  # type: Tuple[str, int]
+        publisher.subscribe(self._broadcast)
+        self._thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self._thread.start()
+
+    def framed(self, message: bytes) -> bytes:
+        if self.protocol == StateServer.TCP:
+            return StateFormat.LENGTH.pack(len(message)) + message
+        length = len(message)
+        if length < 126:
+            head = struct.pack("!BB", 0x82, length)
+        elif length < 1 << 16:
+            head = struct.pack("!BBH", 0x82, 126, length)
+        else:
+            head = struct.pack("!BBQ", 0x82, 127, length)
+        return head + message
+
+    def _handshake(self, conn: socket.socket):
+        request = b""
+        while b"\r\n\r\n" not in request:
+            chunk = conn.recv(4096)
+            if not chunk:
+                raise OSError("connection closed during the WebSocket handshake")
+            request += chunk
+        key = None
+        for line in request.split(b"\r\n"):
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"sec-websocket-key":
+                key = value.strip()
+        if key is None:
+            conn.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+            raise OSError("not a WebSocket request")
+        accept = base64.b64encode(hashlib.sha1(key + StateServer.WEBSOCKET_GUID).digest())
+        conn.sendall(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                     b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            try:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                if self.protocol == StateServer.WEBSOCKET:
+                    self._handshake(conn)
+                conn.sendall(self.framed(self.publisher.hello()))
+                client = _Client(self, conn)
+                # joining under the publisher lock: no frame falls between the keyframe and the first delta
+                with self.publisher.lock:
+                    client.queue.append(self.publisher.keyframe())
+                    with self._lock:
+                        self.clients.append(client)
+                client.thread.start()
+            except OSError:
+                conn.close()
+
+    def _broadcast(self, message: bytes):
+        with self._lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.send(message)
+
+    def drop(self, client: _Client):
+        with self._lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        client.close()
+
+    def close(self):
+        self.publisher.unsubscribe(self._broadcast)
+        try:
+            # wakes the accept loop, close alone does not on every platform
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._thread.join()
+        with self._lock:
+            clients, self.clients = self.clients, []
+        for client in clients:
+            client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,267 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import csv
+import mmap
+import struct
+from typing import List, Callable, Tuple, Optional, IO
+
+from system.processor import Processor, installed_hook
+
+
+class StimulusFormat(object):
+    """
+    Header followed by fixed size records sorted by cycle. An IN_PORT record holds value on in_port for INPUTs
+    from port_id from that cycle on, an INTERRUPT record sets the interrupt line to bit 0 of value.
+    """
+    MAGIC = b"PSTM"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHHQ")  # magic, version, flags, record count
+    RECORD = struct.Struct("<QBBBx")  # cycle, kind, port_id, value
+    CYCLE = struct.Struct("<Q")
+
+    IN_PORT = 0
+    INTERRUPT = 1
+
+    # header flags
+    HAS_INTERRUPTS = 1
+
+
+class StimulusWriter(object):
+    def __init__(self, path: str):
+        self._file = open(path, "wb")  # type: IO
+        self._file.write(StimulusFormat.HEADER.pack(StimulusFormat.MAGIC, StimulusFormat.VERSION, 0, 0))
+        self.count = 0  # type: int
+        self.flags = 0  # type: int
+        self._last = 0  # type: int
+
+    def _add(self, cycle: int, kind: int, port_id: int, value: int):
+        if cycle < self._last:
+            raise ValueError("Stimulus records must be sorted by cycle, %d after %d" % (cycle, self._last))
+        self._last = cycle
+        self._file.write(StimulusFormat.RECORD.pack(cycle, kind, port_id & 0xFF, value & 0xFF))
+        self.count += 1
+
+    def in_port(self, cycle: int, port_id: int, value: int):
+        self._add(cycle, StimulusFormat.IN_PORT, port_id, value)
+
+    def interrupt(self, cycle: int, level: bool):
+        self._add(cycle, StimulusFormat.INTERRUPT, 0, int(bool(level)))
+        self.flags |= StimulusFormat.HAS_INTERRUPTS
+
+    def close(self):
+        self._file.seek(0)
+        self._file.write(StimulusFormat.HEADER.pack(StimulusFormat.MAGIC, StimulusFormat.VERSION, self.flags,
+                                                    self.count))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def convert_csv(source: str, destination: str) -> int:
+    """
+    Convert cycle,port,value CSV rows (port "interrupt" for the interrupt line, numbers in any int() base
+    prefix notation) into a binary stimulus file, returns the record count. Rows must be sorted by cycle.
+    """
+    with open(source, newline="") as f, StimulusWriter(destination) as writer:
+        for row in csv.reader(f):
+            if not len(row) or row[0].strip().startswith("#"):
+                continue
+            try:
+                cycle = int(row[0], 0)
+            except ValueError:
+                # header row
+                continue
+            port, value = row[1].strip().lower(), int(row[2], 0)
+            if port in ("interrupt", "int"):
+                writer.interrupt(cycle, bool(value))
+            else:
+                writer.in_port(cycle, int(port, 0), value)
+        return writer.count
+
+
+class StimulusPlayer(object):
+    """
+    Plays a stimulus file into a processor by cycle. The file is memory mapped and walked with one cursor as
+    the cycle counter advances, so only records up to the current cycle are ever read. INPUTs see the latest
+    value recorded for their port_id at the cycle the INPUT starts, interrupt changes are applied before the
+    first instruction starting at or after their cycle. seek() binary searches to any cycle and looks values up
+    from a sparse index of the latest values every INDEX_STRIDE records, built forward as far as lookups need it.
+    """
+    INDEX_STRIDE = 1024
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.flags, self.count = StimulusFormat.HEADER.unpack_from(self._mmap, 0)
+        if magic != StimulusFormat.MAGIC or version != StimulusFormat.VERSION:
+            raise ValueError("%s is not a PicoSim stimulus file" % path)
+        # None until looked up after a seek
+        self.ports = [0] * 256  # type: List[Optional[int]]
+        self.interrupt = False  # type: bool
+        self._cursor = 0  # type: int
+        self._resume = 0  # type: int
+        self.next_cycle = self._cycle(0)  # type: Optional[int]
+        # _index[n] holds the port values and interrupt level set by the records before n * INDEX_STRIDE,
+        # None where no record has set them yet
+        self._index = [([None] * 256, None)]  # type: List[Tuple[List[Optional[int]], Optional[int]]]
+        self.proc = None  # type: Processor
+        self._hooked = []  # type: List[Tuple[str, Callable]]
+
+    def _offset(self, index: int) -> int:
+        return StimulusFormat.HEADER.size + index * StimulusFormat.RECORD.size
+
+    def _cycle(self, index: int) -> Optional[int]:
+        if index >= self.count:
+            return None
+        return StimulusFormat.CYCLE.unpack_from(self._mmap, self._offset(index))[0]
+
+    def advance(self, cycle: int):
+        """apply every record up to and including cycle"""
+        if self.next_cycle is None or self.next_cycle > cycle:
+            return
+        mm = self._mmap
+        record = StimulusFormat.RECORD
+        idx = self._cursor
+        offset = self._offset(idx)
+        while idx < self.count:
+            at, kind, port_id, value = record.unpack_from(mm, offset)
+            if at > cycle:
+                break
+            if kind == StimulusFormat.IN_PORT:
+                self.ports[port_id] = value
+            else:
+                self.interrupt = bool(value)
+            idx += 1
+            offset += record.size
+        self._cursor = idx
+        self.next_cycle = self._cycle(idx)
+        if self.proc is not None and self.proc.interrupt != self.interrupt:
+            self.proc.external.set_interrupt(self.interrupt)
+
+    def _first_after(self, cycle: int) -> int:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._cycle(mid) <= cycle:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _indexed(self, block: int) -> Tuple[List[Optional[int]], Optional[int]]:
+        index = self._index
+        mm = self._mmap
+        record = StimulusFormat.RECORD
+        while len(index) <= block:
+            ports, interrupt = index[-1]
+            ports = list(ports)
+            start = (len(index) - 1) * StimulusPlayer.INDEX_STRIDE
+            offset = self._offset(start)
+            for _ in range(start, start + StimulusPlayer.INDEX_STRIDE):
+                _, kind, port_id, value = record.unpack_from(mm, offset)
+                if kind == StimulusFormat.IN_PORT:
+                    ports[port_id] = value
+                else:
+                    interrupt = value
+                offset += record.size
+            index.append((ports, interrupt))
+        return index[block]
+
+    def _latest(self, end: int, kind: int, port_id: int) -> int:
+        """
+        value of the last record of kind (and port_id) before index end, scanning backwards to the start of its
+        block and taking the index entry from there
+        """
+        mm = self._mmap
+        record = StimulusFormat.RECORD
+        block = end // StimulusPlayer.INDEX_STRIDE
+        stop = block * StimulusPlayer.INDEX_STRIDE
+        idx = end - 1
+        while idx >= stop:
+            _, k, port, value = record.unpack_from(mm, self._offset(idx))
+            if k == kind and (kind == StimulusFormat.INTERRUPT or port == port_id):
+                return value
+            idx -= 1
+        ports, interrupt = self._indexed(block)
+        value = interrupt if kind == StimulusFormat.INTERRUPT else ports[port_id]
+        return 0 if value is None else value
+
+    def value_at(self, cycle: int, port_id: int) -> int:
+        """latest value recorded for port_id at cycle"""
+        return self._latest(self._first_after(cycle), StimulusFormat.IN_PORT, port_id)
+
+    def seek(self, cycle: int):
+        """
+        Position the cursor for a run resuming at cycle. Port latches are looked up again on their next INPUT,
+        so seeking never reads more of the file than the ports in use need.
+        """
+        end = self._first_after(cycle)
+        self._resume = end
+        self.ports = [None] * 256
+        self.interrupt = False
+        if self.flags & StimulusFormat.HAS_INTERRUPTS:
+            self.interrupt = bool(self._latest(end, StimulusFormat.INTERRUPT, 0))
+        self._cursor = end
+        self.next_cycle = self._cycle(end)
+
+    def port(self, port_id: int) -> int:
+        value = self.ports[port_id]
+        if value is None:
+            value = self.ports[port_id] = self._latest(self._resume, StimulusFormat.IN_PORT, port_id)
+        return value
+
+    def attach(self, proc: Processor):
+        self.proc = proc
+        set_read_strobe = proc.set_read_strobe
+        execute = proc.execute
+
+        def read_strobe(val: bool):
+            set_read_strobe(val)
+            if val:
+                # proc.cycles is still the cycle the INPUT started in
+                if self.next_cycle is not None and self.next_cycle <= proc.cycles:
+                    self.advance(proc.cycles)
+                proc.external.set_int_port(self.port(proc.p_port_id & 0xFF))
+
+        def timed_execute():
+            if self.next_cycle is not None and self.next_cycle <= proc.cycles:
+                self.advance(proc.cycles)
+            execute()
+
+        hooks = [("set_read_strobe", read_strobe)]
+        if self.flags & StimulusFormat.HAS_INTERRUPTS:
+            # only pay for a per instruction check when the file drives the interrupt line
+            hooks.append(("execute", timed_execute))
+        for name, hook in hooks:
+            self._hooked.append((name, installed_hook(proc, name)))
+            setattr(proc, name, hook)
+        self.seek(proc.cycles)
+        if self.interrupt != proc.interrupt:
+            proc.external.set_interrupt(self.interrupt)
+
+    def detach(self):
+        for name, previous in reversed(self._hooked):
+            if previous is not None:
+                setattr(self.proc, name, previous)
+            else:
+                delattr(self.proc, name)
+        self._hooked = []
+        self.proc = None
+
+    def close(self):
+        if self.proc is not None:
+            self.detach()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,475 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import select
+import socket
+import struct
+import tempfile
+import threading
+import time
+from typing import List, Dict, Tuple, Optional, Deque
+
+import ops.operations as op
+from system.checkpoint import program_digest
+from system.processor import Processor, RunResult
+
+
+class SweepFormat(object):
+    """
+    Frames of a kind byte and a u32 payload length, one TCP connection per worker node.
+        HELLO     node to coordinator, JSON {"name", "cores", "programs", "stimuli"}, the last two list the digests
+                  the node already holds in its cache
+        PROGRAM   16 byte digest and the pickled program, sent once per node before the first job running it
+        STIMULUS  16 byte digest and a stimulus file (see system.stimulus), also sent once per node
+        JOB       JSON {"id", "program", "stimulus", "start", "cycles", "instructions", "isr"}, digests in hex
+        RESULT    a RESULT record
+        ERROR     JSON {"id", "error"} of a job that raised
+        HEARTBEAT node to coordinator, empty, sent periodically while the node has jobs running
+    """
+    FRAME = struct.Struct("<BI")  # kind, payload length
+    HELLO, PROGRAM, STIMULUS, JOB, RESULT, ERROR, HEARTBEAT = range(0, 7)
+    DIGEST_SIZE = 16
+    # job id, reason, cycles, dispatches, port writes, pc, port write digest, state digest, wall seconds
+    RESULT_RECORD = struct.Struct("<IBQQQH%ds%dsd" % (DIGEST_SIZE, DIGEST_SIZE))
+    REASONS = (RunResult.HALTED, RunResult.INSTRUCTIONS, RunResult.CYCLES, RunResult.WATCHPOINT)
+    # port writes are hashed as they would be streamed by picosim run --format binary
+    WRITE = struct.Struct("<QBB")
+
+
+def send_frame(conn: socket.socket, kind: int, payload: bytes = b""):
+    conn.sendall(SweepFormat.FRAME.pack(kind, len(payload)) + payload)
+
+
+def _recv_exact(conn: socket.socket, length: int) -> Optional[bytes]:
+    buf = bytearray(length)
+    view = memoryview(buf)
+    pos = 0
+    while pos < length:
+        n = conn.recv_into(view[pos:])
+        if not n:
+            return None
+        pos += n
+    return bytes(buf)
+
+
+def recv_frame(conn: socket.socket) -> Optional[Tuple[int, bytes]]:
+    """the next (kind, payload), None once the peer closed the connection"""
+    head = _recv_exact(conn, SweepFormat.FRAME.size)
+    if head is None:
+        return None
+    kind, length = SweepFormat.FRAME.unpack(head)
+    payload = _recv_exact(conn, length)
+    if payload is None:
+        return None
+    return kind, payload
+
+
+def file_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=SweepFormat.DIGEST_SIZE).digest()
+
+
+class SweepResult(object):
+    """What one job did, port writes and the final state are reduced to digests"""
+    __slots__ = ("id", "reason", "cycles", "dispatches", "port_writes", "pc", "writes_digest", "state_digest",
+                 "seconds", "worker", "attempts", "error")
+
+    def __init__(self, job_id: int, reason: str = None, cycles: int = 0, dispatches: int = 0, port_writes: int = 0,
+                 pc: int = 0, writes_digest: bytes = b"", state_digest: bytes = b"", seconds: float = 0.0,
+                 error: str = None):
+        self.id = job_id
+        self.reason = reason
+        # the cycle counter when the job ended, jobs start at the first cycle of their stimulus range
+        self.cycles = cycles
+        self.dispatches = dispatches
+        self.port_writes = port_writes
+        self.pc = pc
+        self.writes_digest = writes_digest
+        self.state_digest = state_digest
+        self.seconds = seconds
+        self.worker = None  # type: Optional[str]
+        self.attempts = 1  # type: int
+        self.error = error
+
+    def pack(self) -> bytes:
+        return SweepFormat.RESULT_RECORD.pack(self.id, SweepFormat.REASONS.index(self.reason), self.cycles,
+                                              self.dispatches, self.port_writes, self.pc, self.writes_digest,
+                                              self.state_digest, self.seconds)
+
+    @staticmethod
+    def unpack(data: bytes) -> 'SweepResult':
+        job_id, reason, cycles, dispatches, writes, pc, writes_digest, state_digest, seconds = \
+            SweepFormat.RESULT_RECORD.unpack(data)
+        return SweepResult(job_id, SweepFormat.REASONS[reason], cycles, dispatches, writes, pc, writes_digest,
+                           state_digest, seconds)
+
+    def outcome(self) -> tuple:
+        """everything the simulation decided, equal for every run of the same job"""
+        return (self.reason, self.cycles, self.dispatches, self.port_writes, self.pc, self.writes_digest,
+                self.state_digest, self.error)
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"id": self.id, "reason": self.reason, "cycles": self.cycles, "dispatches": self.dispatches,
+                "port_writes": self.port_writes, "pc": self.pc, "writes_digest": self.writes_digest.hex(),
+                "state_digest": self.state_digest.hex(), "seconds": round(self.seconds, 6), "worker": self.worker,
+                "attempts": self.attempts, "error": self.error}
+
+
+def execute_job(program: Dict[int, op.Instruction], job: Dict[str, object], stimulus: str = None) -> SweepResult:
+    """
+    Run one job from power-on. A stimulus range starting at job["start"] is played by starting the cycle counter
+    there, so port writes are reported at the cycles of the stimulus file.
+    """
+    proc = Processor(isr_addr=job.get("isr", 0x3FF))
+    proc.set_instructions(program)
+    proc.cycles = job.get("start", 0)
+    digest = hashlib.blake2b(digest_size=SweepFormat.DIGEST_SIZE)
+    pack = SweepFormat.WRITE.pack
+    writes = [0]
+    set_write_strobe = proc.set_write_strobe
+    set_k_write_strobe = proc.set_k_write_strobe
+
+    def write():
+        writes[0] += 1
+        digest.update(pack(proc.cycles, proc.p_port_id & 0xFF, proc.p_out_port & 0xFF))
+
+    def write_strobe(val: bool):
+        set_write_strobe(val)
+        if val:
+            write()
+
+    def k_write_strobe(val: bool):
+        set_k_write_strobe(val)
+        if val:
+            write()
+
+    proc.set_write_strobe = write_strobe
+    proc.set_k_write_strobe = k_write_strobe
+    player = None
+    if stimulus is not None:
+        from system.stimulus import StimulusPlayer
+        player = StimulusPlayer(stimulus)
+        player.attach(proc)
+    try:
+        result = proc.run(instructions=job.get("instructions"), cycles=job.get("cycles"))
+    finally:
+        if player is not None:
+            player.close()
+    state = hashlib.blake2b(proc.state_key(), digest_size=SweepFormat.DIGEST_SIZE).digest()
+    return SweepResult(job["id"], result.reason, proc.cycles, result.dispatches, writes[0], proc.manager.pc,
+                       digest.digest(), state, result.wall_seconds)
+
+
+# programs loaded by this pool process, by digest
+_programs = {}  # type: Dict[str, Dict[int, op.Instruction]]
+
+
+def _job_worker(args: Tuple[str, Dict[str, object]]) -> Tuple[int, bytes]:
+    cache, job = args
+    try:
+        program = _programs.get(job["program"])
+        if program is None:
+            with open(os.path.join(cache, job["program"] + ".program"), "rb") as f:
+                program = _programs[job["program"]] = pickle.load(f)
+        stimulus = None
+        if job.get("stimulus"):
+            stimulus = os.path.join(cache, job["stimulus"] + ".stim")
+        return SweepFormat.RESULT, execute_job(program, job, stimulus).pack()
+    except Exception as e:
+        return SweepFormat.ERROR, json.dumps({"id": job["id"], "error": "%s: %s" % (type(e).__name__, e)}).encode()
+
+
+class SweepWorker(object):
+    """
+    One node: connects to the coordinator and runs its jobs on a pool of processes, every CPU by default.
+    Programs and stimulus files arrive once and are kept in cache, a directory that may outlive the worker so a
+    restarted node does not need them shipped again. run() returns when the coordinator closes the connection.
+    While jobs are running a HEARTBEAT goes out every heartbeat seconds, keep it well below the coordinator's
+    timeout so jobs longer than that are not taken for a lost node.
+    """
+    HEARTBEAT_SECONDS = 5.0
+
+    def __init__(self, host: str, port: int, processes: int = None, cache: str = None, name: str = None,
+                 heartbeat: float = HEARTBEAT_SECONDS):
+        self.address = (host, port)
+        self.processes = processes if processes is not None else multiprocessing.cpu_count()
+        self._tmp = None
+        if cache is None:
+            self._tmp = tempfile.TemporaryDirectory()
+            cache = self._tmp.name
+        os.makedirs(cache, exist_ok=True)
+        self.cache = cache
+        self.name = name if name is not None else "%s:%d" % (socket.gethostname(), os.getpid())
+        self.heartbeat = heartbeat
+        self.jobs = 0  # type: int
+        # jobs received and not replied to yet
+        self._running = 0  # type: int
+        self._send_lock = threading.Lock()
+
+    def _cached(self, suffix: str) -> List[str]:
+        return [name[:-len(suffix)] for name in os.listdir(self.cache) if name.endswith(suffix)]
+
+    def _store(self, payload: bytes, suffix: str):
+        digest, data = payload[:SweepFormat.DIGEST_SIZE], payload[SweepFormat.DIGEST_SIZE:]
+        path = os.path.join(self.cache, digest.hex() + suffix)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def run(self) -> int:
+        """serve jobs until the coordinator is done, returns how many ran here"""
+        conn = socket.create_connection(self.address)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        pool = multiprocessing.Pool(self.processes) if self.processes > 1 else None
+
+        stopped = threading.Event()
+
+        def reply(message: Tuple[int, bytes]):
+            with self._send_lock:
+                self.jobs += 1
+                self._running -= 1
+                try:
+                    send_frame(conn, *message)
+                except OSError:
+                    # the coordinator gave up on this node, it runs the job elsewhere
+                    pass
+
+        def heartbeat():
+            while not stopped.wait(self.heartbeat):
+                with self._send_lock:
+                    if not self._running:
+                        continue
+                    try:
+                        send_frame(conn, SweepFormat.HEARTBEAT)
+                    except OSError:
+                        return
+
+        beat = threading.Thread(target=heartbeat, daemon=True)
+        beat.start()
+        try:
+            send_frame(conn, SweepFormat.HELLO, json.dumps({
+                "name": self.name, "cores": self.processes,
+                "programs": self._cached(".program"), "stimuli": self._cached(".stim"),
+            }).encode())
+            while True:
+                frame = recv_frame(conn)
+                if frame is None:
+                    break
+                kind, payload = frame
+                if kind == SweepFormat.PROGRAM:
+                    self._store(payload, ".program")
+                elif kind == SweepFormat.STIMULUS:
+                    self._store(payload, ".stim")
+                elif kind == SweepFormat.JOB:
+                    args = (self.cache, json.loads(payload.decode()))
+                    with self._send_lock:
+                        self._running += 1
+                    if pool is None:
+                        reply(_job_worker(args))
+                    else:
+                        pool.apply_async(_job_worker, (args,), callback=reply)
+        except OSError:
+            pass
+        finally:
+            stopped.set()
+            beat.join()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            conn.close()
+            if self._tmp is not None:
+                self._tmp.cleanup()
+        return self.jobs
+
+
+class SweepCoordinator(object):
+    """
+    Hands jobs to the worker nodes that connect, up to window jobs per core in flight per node. A node that
+    disconnects, or sends nothing (no result or HEARTBEAT) for timeout seconds while it has jobs, is dropped and its jobs go back to the
+    front of the queue, a job is given up after max_attempts nodes were lost running it. Jobs that raise are not
+    retried, their result carries the error.
+    """
+    POLL_SECONDS = 0.05
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, max_attempts: int = 3, timeout: float = 60.0,
+                 window: int = 2):
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.window = window
+        self.programs = {}  # type: Dict[str, bytes]
+        self.stimuli = {}  # type: Dict[str, bytes]
+        self.jobs = {}  # type: Dict[int, Dict[str, object]]
+        self.results = {}  # type: Dict[int, SweepResult]
+        self.attempts = {}  # type: Dict[int, int]
+        # per node: name, programs and stimuli shipped, results received
+        self.nodes = []  # type: List[Dict[str, object]]
+        self.workers_lost = 0  # type: int
+        self._pending = collections.deque()  # type: Deque[int]
+        self._ready = threading.Condition()
+        self._closed = False  # type: bool
+        self._sock = socket.create_server((host, port))
+        self.address = self._sock.getsockname()[:2]  # type: Tuple[str, int]
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def add_program(self, program: Dict[int, op.Instruction]) -> str:
+        """register a program to ship, returns the digest jobs refer to it by"""
+        digest = program_digest(program).hex()
+        self.programs.setdefault(digest, pickle.dumps(program, protocol=pickle.HIGHEST_PROTOCOL))
+        return digest
+
+    def add_stimulus(self, path: str) -> str:
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = file_digest(data).hex()
+        self.stimuli.setdefault(digest, data)
+        return digest
+
+    def submit(self, program: str, cycles: int = None, instructions: int = None, stimulus: str = None,
+               start: int = 0, isr: int = 0x3FF) -> int:
+        """queue a job, stimulus and start select the range of a stimulus file played from power-on"""
+        if program not in self.programs or stimulus is not None and stimulus not in self.stimuli:
+            raise KeyError("Add programs and stimuli before submitting jobs using them")
+        with self._ready:
+            job_id = len(self.jobs)
+            self.jobs[job_id] = {"id": job_id, "program": program, "stimulus": stimulus, "start": start,
+                                 "cycles": cycles, "instructions": instructions, "isr": isr}
+            self.attempts[job_id] = 0
+            self._pending.append(job_id)
+            self._ready.notify_all()
+        return job_id
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._accept_loop, daemon=True)
+            self._thread.start()
+
+    def wait(self, timeout: float = None) -> List[SweepResult]:
+        """results in job order once every job has one, TimeoutError when timeout seconds pass first"""
+        self.start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._ready:
+            while len(self.results) < len(self.jobs):
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    raise TimeoutError("%d of %d jobs done" % (len(self.results), len(self.jobs)))
+                self._ready.wait(left)
+            return [self.results[job_id] for job_id in sorted(self.jobs)]
+
+    def close(self):
+        """stop accepting nodes and disconnect them, which ends their run()"""
+        with self._ready:
+            self._closed = True
+            self._ready.notify_all()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _done(self) -> bool:
+        return self._closed or len(self.results) >= len(self.jobs) and not len(self._pending)
+
+    def _serve(self, conn: socket.socket):
+        in_flight = {}  # type: Dict[int, float]
+        node = {"name": None, "programs": 0, "stimuli": 0, "results": 0}  # type: Dict[str, object]
+        try:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.settimeout(self.timeout)
+            frame = recv_frame(conn)
+            if frame is None or frame[0] != SweepFormat.HELLO:
+                raise ConnectionError("expected HELLO")
+            hello = json.loads(frame[1].decode())
+            node["name"] = hello["name"]
+            programs, stimuli = set(hello["programs"]), set(hello["stimuli"])
+            credit = max(1, int(hello["cores"])) * self.window
+            with self._ready:
+                self.nodes.append(node)
+            last_heard = time.monotonic()
+            while True:
+                with self._ready:
+                    if self._done():
+                        return
+                    jobs = []
+                    while len(in_flight) + len(jobs) < credit and len(self._pending):
+                        jobs.append(self.jobs[self._pending.popleft()])
+                    if len(jobs) and not len(in_flight):
+                        # an idle node owed nothing, its silence until now does not count
+                        last_heard = time.monotonic()
+                    for job in jobs:
+                        in_flight[job["id"]] = time.monotonic()
+                        self.attempts[job["id"]] += 1
+                for job in jobs:
+                    if job["program"] not in programs:
+                        send_frame(conn, SweepFormat.PROGRAM, bytes.fromhex(job["program"]) +
+                                   self.programs[job["program"]])
+                        programs.add(job["program"])
+                        node["programs"] += 1
+                    if job["stimulus"] is not None and job["stimulus"] not in stimuli:
+                        send_frame(conn, SweepFormat.STIMULUS, bytes.fromhex(job["stimulus"]) +
+                                   self.stimuli[job["stimulus"]])
+                        stimuli.add(job["stimulus"])
+                        node["stimuli"] += 1
+                    send_frame(conn, SweepFormat.JOB, json.dumps(job).encode())
+                if not select.select([conn], [], [], self.POLL_SECONDS)[0]:
+                    if len(in_flight) and time.monotonic() - last_heard > self.timeout:
+                        raise ConnectionError("nothing heard for %.1f seconds" % self.timeout)
+                    continue
+                frame = recv_frame(conn)
+                if frame is None:
+                    raise ConnectionError("node disconnected")
+                last_heard = time.monotonic()
+                kind, payload = frame
+                if kind == SweepFormat.HEARTBEAT:
+                    continue
+                if kind == SweepFormat.RESULT:
+                    result = SweepResult.unpack(payload)
+                elif kind == SweepFormat.ERROR:
+                    error = json.loads(payload.decode())
+                    result = SweepResult(error["id"], error=error["error"])
+                else:
+                    raise ConnectionError("unexpected frame kind %d" % kind)
+                in_flight.pop(result.id, None)
+                result.worker = node["name"]
+                result.attempts = self.attempts[result.id]
+                with self._ready:
+                    node["results"] += 1
+                    # a job requeued after a timeout may come back twice, the first result stands
+                    self.results.setdefault(result.id, result)
+                    self._ready.notify_all()
+        except (OSError, ValueError, KeyError, struct.error):
+            self._lost(in_flight)
+        finally:
+            conn.close()
+
+    def _lost(self, in_flight: Dict[int, float]):
+        with self._ready:
+            if self._closed:
+                return
+            self.workers_lost += 1
+            for job_id in sorted(in_flight, reverse=True):
+                if job_id in self.results:
+                    continue
+                if self.attempts[job_id] >= self.max_attempts:
+                    result = self.results[job_id] = SweepResult(job_id, error="%d workers lost running it"
+                                                                % self.attempts[job_id])
+                    result.attempts = self.attempts[job_id]
+                else:
+                    self._pending.appendleft(job_id)
+            self._ready.notify_all()
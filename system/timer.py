@@ -0,0 +1,61 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+from typing import List, Callable, Tuple
+
+from system.processor import Processor, installed_hook
+
+
+class IntervalTimer(object):
+    """
+    Periodic interrupt source: raises the interrupt line every period_us of simulated time, measured on
+    Processor.cycles from the cycle it was attached, and holds it until the processor acknowledges it.
+    An expiry is seen by the first instruction starting at or after its cycle. Expiries that pass while the
+    line is still raised are counted in missed.
+    """
+    def __init__(self, period_us: float):
+        if period_us <= 0:
+            raise ValueError("Timer period must be positive")
+        self.period_us = period_us
+        self.period = 0  # type: int
+        self.next_cycle = 0  # type: int
+        self.expired = 0  # type: int
+        self.missed = 0  # type: int
+        self.proc = None  # type: Processor
+        self._hooked = []  # type: List[Tuple[str, Callable]]
+
+    def attach(self, proc: Processor):
+        self.proc = proc
+        self.period = max(1, proc.cycles_for(self.period_us))
+        self.next_cycle = proc.cycles + self.period
+        execute = proc.execute
+        set_interrupt_ack = proc.set_interrupt_ack
+
+        def timed_execute():
+            if proc.cycles >= self.next_cycle:
+                while self.next_cycle <= proc.cycles:
+                    if proc.interrupt:
+                        self.missed += 1
+                    self.expired += 1
+                    proc.external.set_interrupt(True)
+                    self.next_cycle += self.period
+            execute()
+
+        def interrupt_ack(val: bool):
+            set_interrupt_ack(val)
+            if val:
+                proc.external.set_interrupt(False)
+
+        for name, hook in (("execute", timed_execute), ("set_interrupt_ack", interrupt_ack)):
+            self._hooked.append((name, installed_hook(proc, name)))
+            setattr(proc, name, hook)
+
+    def detach(self):
+        for name, previous in reversed(self._hooked):
+            if previous is not None:
+                setattr(self.proc, name, previous)
+            else:
+                delattr(self.proc, name)
+        self._hooked = []
+        self.proc = None
@@ -0,0 +1,169 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import gzip
+import time
+from typing import List, Dict, Callable, Iterable, Tuple
+
+from system.memory import Memory
+from system.processor import Processor, installed_hook
+
+
+def identifier(index: int) -> str:
+    """Packed VCD identifier code, base 94 over the printable ASCII range"""
+    code = chr(33 + index % 94)
+    index //= 94
+    while index:
+        code += chr(33 + index % 94)
+        index //= 94
+    return code
+
+
+class VCDWriter(object):
+    """
+    Streams a Value Change Dump of the processor ports, pc, flags and chosen registers.
+    The Processor setters are hooked so only actual changes are recorded, the pc and registers are
+    checked once per executed instruction. Time is the processor cycle counter scaled by clock_ns.
+    """
+    BUFFER_LINES = 16384  # type: int
+    FILE_BUFFER = 1 << 20  # type: int
+
+    # name, width, processor setter, ExternalInterface setter, initial value getter
+    SIGNALS = [
+        ("port_id", 8, "set_port_id", None, lambda p: p.p_port_id),
+        ("out_port", 8, "set_out_port", None, lambda p: p.p_out_port),
+        ("in_port", 8, None, "set_int_port", lambda p: p.in_port),
+        ("interrupt", 1, None, "set_interrupt", lambda p: p.interrupt),
+        ("interrupt_ack", 1, "set_interrupt_ack", None, lambda p: p.p_interrupt_ack),
+        ("read_strobe", 1, "set_read_strobe", None, lambda p: p.p_read_strobe),
+        ("write_strobe", 1, "set_write_strobe", None, lambda p: p.p_write_strobe),
+        ("k_write_strobe", 1, "set_k_write_strobe", None, lambda p: p.p_k_write_strobe),
+        ("interrupt_enabled", 1, "set_interrupt_enabled", None, lambda p: p.interrupt_enabled),
+        ("carry", 1, "set_carry", None, lambda p: p.p_carry),
+        ("zero", 1, "set_zero", None, lambda p: p.p_zero),
+    ]  # type: List[Tuple[str, int, str, str, Callable[[Processor], int]]]
+
+    def __init__(self, proc: Processor, path: str, registers: Iterable[str] = (), compress: bool = None,
+                 clock_ns: int = 10):
+        self.proc = proc
+        self.clock_ns = clock_ns
+        compress = path.endswith(".gz") if compress is None else compress
+        if compress:
+            self._file = gzip.open(path, "wt", compresslevel=6)
+        else:
+            self._file = open(path, "w", buffering=VCDWriter.FILE_BUFFER)
+        self._lines = []  # type: List[str]
+        self._time = -1  # type: int
+        self._values = {}  # type: Dict[str, int]
+        self._codes = {}  # type: Dict[str, str]
+        self._widths = {}  # type: Dict[str, int]
+        self._hooked = []  # type: List[Tuple[object, str, Callable]]
+
+        names = [(name, width) for name, width, _, _, _ in VCDWriter.SIGNALS]
+        names.append(("pc", Memory.STACK_WIDTH))
+        self.registers = [r.lower() for r in registers]
+        names.extend((r, Memory.REGISTER_WIDTH) for r in self.registers)
+        for idx, (name, width) in enumerate(names):
+            self._codes[name] = identifier(idx)
+            self._widths[name] = width
+        self._register_lists = {}  # type: Dict[str, List[bool]]
+
+        self._header()
+        self._hook()
+
+    def _header(self):
+        self._lines.append("$date %s $end" % time.strftime("%Y-%m-%d %H:%M:%S"))
+        self._lines.append("$version PicoSim $end")
+        self._lines.append("$timescale 1ns $end")
+        self._lines.append("$scope module picoblaze $end")
+        for name, code in self._codes.items():
+            self._lines.append("$var wire %d %s %s $end" % (self._widths[name], code, name))
+        self._lines.append("$upscope $end")
+        self._lines.append("$enddefinitions $end")
+
+        self._time = self.proc.cycles
+        self._lines.append("#%d" % (self._time * self.clock_ns))
+        self._lines.append("$dumpvars")
+        for name, _, _, _, getter in VCDWriter.SIGNALS:
+            self._emit(name, int(getter(self.proc)))
+        self._emit("pc", self.proc.manager.pc)
+        for r in self.registers:
+            row = self.proc.memory.REGISTERS[r]
+            self._register_lists[r] = row.values
+            self._emit(r, row.value)
+        self._lines.append("$end")
+
+    def _emit(self, name: str, value: int):
+        self._values[name] = value
+        if self._widths[name] == 1:
+            self._lines.append("%d%s" % (value, self._codes[name]))
+        else:
+            self._lines.append("b%s %s" % (format(value, "b"), self._codes[name]))
+        if len(self._lines) >= VCDWriter.BUFFER_LINES:
+            self.flush()
+
+    def change(self, name: str, value: int):
+        value = int(value)
+        if self._values[name] == value:
+            return
+        if self.proc.cycles != self._time:
+            self._time = self.proc.cycles
+            self._lines.append("#%d" % (self._time * self.clock_ns))
+        self._emit(name, value)
+
+    def _wrap(self, target: object, method: str, name: str):
+        original = getattr(target, method)
+
+        def hooked(val):
+            original(val)
+            self.change(name, val)
+
+        self._hooked.append((target, method, installed_hook(target, method)))
+        setattr(target, method, hooked)
+
+    def _hook(self):
+        for name, _, proc_setter, external_setter, _ in VCDWriter.SIGNALS:
+            if proc_setter is not None:
+                self._wrap(self.proc, proc_setter, name)
+            else:
+                self._wrap(self.proc.external, external_setter, name)
+
+        execute = self.proc.execute
+
+        def hooked_execute():
+            execute()
+            self.change("pc", self.proc.manager.pc)
+            registers = self.proc.memory.REGISTERS
+            for r, last in self._register_lists.items():
+                # every register write assigns a new bit list, only convert when it changed
+                row = registers[r]
+                if row.values is not last:
+                    self._register_lists[r] = row.values
+                    self.change(r, row.value)
+
+        self._hooked.append((self.proc, "execute", installed_hook(self.proc, "execute")))
+        self.proc.execute = hooked_execute
+
+    def flush(self):
+        if len(self._lines):
+            self._file.write("\n".join(self._lines))
+            self._file.write("\n")
+            self._lines = []
+
+    def close(self):
+        # restore whatever hook was installed before, or fall back to the class methods
+        for target, method, previous in reversed(self._hooked):
+            if previous is not None:
+                setattr(target, method, previous)
+            else:
+                delattr(target, method)
+        self._hooked = []
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
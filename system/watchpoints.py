@@ -0,0 +1,281 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+from typing import List, Dict, Callable, Tuple, Optional
+
+from system.memory import Memory
+from system.processor import Processor, RunResult, StopRun, installed_hook
+
+# (space, register name / address / port_id), stack locations are (STACK, None)
+Location = Tuple[str, object]
+
+
+class Watchpoint(object):
+    REGISTER = "register"
+    DATA = "data"
+    STACK = "stack"
+    PORT = "port"
+
+    READ = "read"
+    WRITE = "write"
+    # read or write
+    ACCESS = "access"
+
+    def __init__(self, space: str, location: object, access: str = WRITE, value: int = None, depth: int = None):
+        if access not in (Watchpoint.READ, Watchpoint.WRITE, Watchpoint.ACCESS):
+            raise ValueError("Unknown watchpoint access %s" % access)
+        self.space = space
+        self.location = location
+        self.access = access
+        # only hit when the value read or written equals value
+        self.value = value
+        # stack watchpoints: only hit when the stack holds at least depth return addresses after the access
+        self.depth = depth
+
+    def matches(self, access: str, value: int, depth: int) -> bool:
+        if self.access != Watchpoint.ACCESS and self.access != access:
+            return False
+        if self.value is not None and self.value != value:
+            return False
+        return self.depth is None or depth >= self.depth
+
+    def __repr__(self):
+        where = self.space if self.location is None else "%s %s" % (
+            self.space, self.location if isinstance(self.location, str) else "0x%02X" % self.location)
+        match = "" if self.value is None else " == 0x%02X" % self.value
+        return "%s %s%s%s" % (self.access, where, match, "" if self.depth is None else " depth >= %d" % self.depth)
+
+
+class Hit(object):
+    def __init__(self, watchpoint: Watchpoint, access: str, value: int, pc: int, cycle: int):
+        self.watchpoint = watchpoint
+        self.access = access
+        self.value = value
+        # pc and cycle of the instruction that made the access
+        self.pc = pc
+        self.cycle = cycle
+
+    def __repr__(self):
+        return "%r: %s 0x%02X at 0x%03X, cycle %d" % (self.watchpoint, self.access, self.value, self.pc, self.cycle)
+
+
+class WatchedRow(Memory.ArrayRow):
+    """
+    A register or scratchpad row that reports every access of its bits. Only watched rows are swapped for one,
+    every other row keeps the plain slot.
+    """
+    __slots__ = ("watchpoints", "location")
+
+    _VALUES = Memory.ArrayRow.__dict__["values"]
+
+    def __init__(self, row: Memory.ArrayRow, watchpoints: "Watchpoints", location: Location):
+        # MemoryRow.__init__ only, ArrayRow.__init__ would report its default bits as a write
+        Memory.MemoryRow.__init__(self, row.width, row.default)
+        WatchedRow._VALUES.__set__(self, row.values)
+        self.watchpoints = watchpoints
+        self.location = location
+
+    @property
+    def values(self) -> List[bool]:
+        bits = WatchedRow._VALUES.__get__(self, WatchedRow)
+        self.watchpoints.access(self.location, Watchpoint.READ, bits)
+        return bits
+
+    @values.setter
+    def values(self, bits: List[bool]):
+        WatchedRow._VALUES.__set__(self, bits)
+        self.watchpoints.access(self.location, Watchpoint.WRITE, bits)
+
+    def set_value(self, value: int) -> None:
+        # like ArrayRow.set_value, without reading the bits it replaces
+        binary = self.binary(self.bounds(value))
+        self.values = [False] * (self.width - len(binary)) + [bool(int(x)) for x in binary]
+
+    def plain(self) -> Memory.ArrayRow:
+        row = Memory.ArrayRow(self.width, self.default)
+        row.values = WatchedRow._VALUES.__get__(self, WatchedRow)
+        return row
+
+
+class Watchpoints(object):
+    """
+    Read, write and value-match watchpoints on registers, scratchpad addresses, the stack and port_ids.
+    Nothing is checked while no watchpoint is armed: arming swaps the watched rows for WatchedRows and hooks
+    the stack, strobe and execute methods, removing the last watchpoint restores the plain ones.
+    A hit stops Processor.run after the instruction that made the access, with reason RunResult.WATCHPOINT
+    and the hits of that instruction as detail. With stop=False hits are only collected.
+    Accesses made outside of execute (snapshots, VCD dumps, the test harness) are not reported.
+    """
+    def __init__(self, proc: Processor, stop: bool = True):
+        self.proc = proc
+        self.stop = stop
+        self.watchpoints = []  # type: List[Watchpoint]
+        self.hits = []  # type: List[Hit]
+        self._by_location = {}  # type: Dict[Location, List[Watchpoint]]
+        self._pending = []  # type: List[Hit]
+        # execute nesting depth, memoized calls run their body through proc.execute
+        self._depth = 0  # type: int
+        self._pc = 0  # type: int
+        self._start_cycle = 0  # type: int
+        self._hooked = []  # type: List[Tuple[object, str, Optional[Callable]]]
+
+    """ARMING"""
+
+    def register(self, name: str, access: str = Watchpoint.WRITE, value: int = None) -> Watchpoint:
+        name = name.lower()
+        if name not in self.proc.memory.REGISTERS:
+            raise ValueError("Unknown register %s" % name)
+        return self.add(Watchpoint(Watchpoint.REGISTER, name, access, value))
+
+    def data(self, address: int, access: str = Watchpoint.WRITE, value: int = None) -> Watchpoint:
+        if not 0 <= address < len(self.proc.memory.DATA_MEMORY):
+            raise ValueError("Scratchpad address 0x%02X out of range" % address)
+        return self.add(Watchpoint(Watchpoint.DATA, address, access, value))
+
+    def stack(self, access: str = Watchpoint.WRITE, value: int = None, depth: int = None) -> Watchpoint:
+        """pushes are writes and pops are reads of the return address"""
+        return self.add(Watchpoint(Watchpoint.STACK, None, access, value, depth))
+
+    def port(self, port_id: int, access: str = Watchpoint.WRITE, value: int = None) -> Watchpoint:
+        """INPUTs are reads and OUTPUTs and OUTPUTKs are writes of port_id"""
+        return self.add(Watchpoint(Watchpoint.PORT, port_id & 0xFF, access, value))
+
+    def add(self, watchpoint: Watchpoint) -> Watchpoint:
+        self.watchpoints.append(watchpoint)
+        self._rearm()
+        return watchpoint
+
+    def remove(self, watchpoint: Watchpoint):
+        self.watchpoints.remove(watchpoint)
+        self._rearm()
+
+    def clear(self):
+        self.watchpoints = []
+        self._rearm()
+
+    def _rearm(self):
+        self._disarm()
+        self._by_location = {}
+        for watchpoint in self.watchpoints:
+            self._by_location.setdefault((watchpoint.space, watchpoint.location), []).append(watchpoint)
+        if len(self.watchpoints):
+            self._arm()
+
+    """HOOKS"""
+
+    def _hook(self, target: object, name: str, hook: Callable):
+        self._hooked.append((target, name, installed_hook(target, name)))
+        setattr(target, name, hook)
+
+    def _arm(self):
+        proc = self.proc
+        mem = proc.memory
+        spaces = {space for space, _ in self._by_location}
+        for space, location in self._by_location:
+            if space == Watchpoint.REGISTER:
+                mem.REGISTERS[location] = WatchedRow(mem.REGISTERS[location], self, (space, location))
+            elif space == Watchpoint.DATA:
+                mem.DATA_MEMORY[location] = WatchedRow(mem.DATA_MEMORY[location], self, (space, location))
+
+        if Watchpoint.STACK in spaces:
+            push_stack = mem.push_stack
+            pop_stack = mem.pop_stack
+
+            def watched_push(value: int):
+                push_stack(value)
+                self.report((Watchpoint.STACK, None), Watchpoint.WRITE, value, mem.stack_pointer)
+
+            def watched_pop() -> int:
+                value = pop_stack()
+                self.report((Watchpoint.STACK, None), Watchpoint.READ, value, mem.stack_pointer)
+                return value
+
+            self._hook(mem, "push_stack", watched_push)
+            self._hook(mem, "pop_stack", watched_pop)
+
+        if Watchpoint.PORT in spaces:
+            set_read_strobe = proc.set_read_strobe
+            set_write_strobe = proc.set_write_strobe
+            set_k_write_strobe = proc.set_k_write_strobe
+
+            def read_strobe(val: bool):
+                set_read_strobe(val)
+                if val:
+                    # in_port is driven in response to the strobe, the value is read after it settles
+                    self.report((Watchpoint.PORT, proc.p_port_id & 0xFF), Watchpoint.READ, proc.in_port & 0xFF)
+
+            def write_strobe(val: bool):
+                set_write_strobe(val)
+                if val:
+                    self.report((Watchpoint.PORT, proc.p_port_id & 0xFF), Watchpoint.WRITE, proc.p_out_port & 0xFF)
+
+            def k_write_strobe(val: bool):
+                set_k_write_strobe(val)
+                if val:
+                    self.report((Watchpoint.PORT, proc.p_port_id & 0xFF), Watchpoint.WRITE, proc.p_out_port & 0xFF)
+
+            self._hook(proc, "set_read_strobe", read_strobe)
+            self._hook(proc, "set_write_strobe", write_strobe)
+            self._hook(proc, "set_k_write_strobe", k_write_strobe)
+
+        execute = proc.execute
+
+        def watched_execute():
+            if self._depth == 0:
+                self._pc = proc.manager.pc
+                self._start_cycle = proc.cycles
+            self._depth += 1
+            try:
+                execute()
+            finally:
+                self._depth -= 1
+            if self._depth == 0 and len(self._pending):
+                hits, self._pending = self._pending, []
+                if self.stop:
+                    raise StopRun(RunResult.WATCHPOINT, hits)
+
+        self._hook(proc, "execute", watched_execute)
+
+    def _disarm(self):
+        mem = self.proc.memory
+        for bank in mem.banks:
+            for name, row in (bank.items() if bank is not None else ()):
+                if isinstance(row, WatchedRow):
+                    bank[name] = row.plain()
+        for address, row in enumerate(mem.DATA_MEMORY):
+            if isinstance(row, WatchedRow):
+                mem.DATA_MEMORY[address] = row.plain()
+        for target, name, previous in reversed(self._hooked):
+            if previous is not None:
+                setattr(target, name, previous)
+            else:
+                delattr(target, name)
+        self._hooked = []
+        self._pending = []
+        self._depth = 0
+
+    """CHECKS"""
+
+    def access(self, location: Location, access: str, bits: List[bool]):
+        if self._depth == 0:
+            return
+        self.report(location, access, Memory.bit_table(len(bits))[0][tuple(bits)])
+
+    def report(self, location: Location, access: str, value: int, depth: int = 0):
+        if self._depth == 0:
+            return
+        for watchpoint in self._by_location.get(location, ()):
+            if watchpoint.matches(access, value, depth):
+                hit = Hit(watchpoint, access, value, self._pc, self._start_cycle)
+                self.hits.append(hit)
+                self._pending.append(hit)
+
+    def close(self):
+        self.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -2,20 +2,65 @@
 PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
 Copyright (C) 2017  Vadim Korolik - see LICENCE
 """
+import gzip
+import inspect
+import json
+import multiprocessing
+import os
 import random
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+import tracemalloc
 import unittest
+import zlib
 
 import ops.operations as op
-from ops.assembler import Assembler
+from ops.analysis import StaticAnalyzer
+from ops.assembler import Assembler, ParseError
+from ops.fusion import Fuser, FusedOperation, CompareJump, LoadOutput, fuse
+from ops.memoize import Memoizer, MemoizedCall, memoize
+from hardware_sim.render import Board, PortTrace, Renderer, write_apng, write_png, PNG_SIGNATURE
+from hardware_sim.seven_segment_display import SevenSegmentDisplay
+from picosim.cli import PortWriter
 from system.memory import Memory
-from system.processor import Processor
+from system.processor import Processor, ProcessorPool, RunResult, StopRun
+from system.publisher import StatePublisher, StateServer, StateViewer, StateFormat, _Client
+from system.multicore import System, Link
+from system.stimulus import StimulusPlayer, StimulusWriter, convert_csv
+from system.sweep import SweepCoordinator, SweepFormat, execute_job, recv_frame, send_frame
+from system.analytics import PortAnalytics
+from system.checkpoint import Checkpoint, Checkpointer, CheckpointFormat, program_digest
+from system.hostprofile import HostProfiler
+from system.timer import IntervalTimer
+from system.watchpoints import Watchpoints, Watchpoint, WatchedRow
+from system.cosim import CoSimBridge, Channel, HDLPeer, Ring, register_file_device
+from system.vcd import VCDWriter, identifier
+from verification.explorer import Explorer, Finding
+from verification.faults import Campaign, Fault, Outcome
+from verification.fuzzer import Fuzzer, ProgramGenerator, InitialState, architectural_state, build, run_differential
 
 MAX = 255
 MIN = -128
 ITERATIONS = 10000
 
 
+class SkipOutput(op.Instruction):
+    def exec(self, proc: Processor):
+        proc.manager.next()
+
+
+def drop_outputs(operations):
+    # deliberately broken engine for the fuzzer tests
+    return {a: SkipOutput() if isinstance(i, op.DataOperation) and i.operator is op.DataOperation.output else i
+            for a, i in operations.items()}
+
+
 def make_positive(a: int) -> int:
     # s = a if a > -1 else -(abs(a) % abs(MIN - 1)) + (1 << 8)
     if a >= 0:
@@ -75,6 +120,96 @@ class MemoryTests(unittest.TestCase):
         self.assertEqual(self.mem.fetch_register('s1'), 0)
 
 
+class MemoryViewTests(unittest.TestCase):
+    def setUp(self):
+        self.mem = Memory()
+
+    def test_views_are_live(self):
+        data = self.mem.data()
+        self.mem.store_data(0x10, 0xAB)
+        self.assertEqual(data[0x10], 0xAB)
+        data[0x11] = 0x1CD
+        self.assertEqual(self.mem.fetch_data(0x11), 0xCD)
+        registers = self.mem.registers()
+        self.mem.set_register("s3", 7)
+        self.assertEqual(registers[3], 7)
+        # the default view follows REGBANK, a bank's view stays on that bank
+        bank_a = self.mem.registers(0)
+        self.mem.select_bank(1)
+        self.assertEqual((registers[3], bank_a[3]), (0, 7))
+        self.mem.push_stack(0x3FF)
+        self.assertEqual(self.mem.stack()[0], 0x3FF)
+        self.assertEqual(self.mem.stack().tobytes()[:2], b"\x03\xff")
+
+    def test_bulk(self):
+        self.mem.load_data(bytes(range(0x20)), offset=0x20)
+        self.assertEqual([self.mem.fetch_data(a) for a in range(0x20, 0x40)], list(range(0x20)))
+        with self.assertRaises(IndexError):
+            self.mem.load_data(bytes(8), offset=60)
+        self.mem.load_registers(range(16, 32))
+        self.assertEqual(self.mem.registers().tolist(), list(range(16, 32)))
+        with self.assertRaises(ValueError):
+            self.mem.load_registers([1, 2])
+        with tempfile.NamedTemporaryFile(suffix=".bin", delete=False) as f:
+            f.write(b"\x01\x02\x03")
+        try:
+            self.mem.load_data_file(f.name)
+        finally:
+            os.remove(f.name)
+        self.assertEqual(self.mem.data()[:3], [1, 2, 3])
+        self.assertEqual(bytes(self.mem.data())[:3], b"\x01\x02\x03")
+
+    def test_numpy(self):
+        import numpy as np
+        self.mem.load_data(np.arange(64, dtype=np.uint8))
+        array = np.asarray(self.mem.data())
+        self.assertEqual((array.dtype, array.shape, int(array[63])), (np.uint8, (64,), 63))
+        self.assertEqual(np.asarray(self.mem.stack()).dtype, np.uint16)
+        self.mem.load_registers(np.full(16, 0x55, dtype=np.uint8))
+        self.assertEqual(self.mem.fetch_register("sf"), 0x55)
+
+    def test_diff(self):
+        other = Memory()
+        self.assertEqual(self.mem.diff(other), [])
+        self.assertEqual(self.mem.data(), other.data())
+        self.mem.store_data(5, self.mem.fetch_data(5) ^ 1)
+        self.mem.set_register("s2", 9)
+        self.assertEqual([(space, location) for space, location, _, _ in self.mem.diff(other)],
+                         [("registers", "s2"), ("data", 5)])
+        self.assertNotEqual(self.mem.data(), other.data())
+
+        # bank B of one side only is reported against None and not allocated on the other
+        self.mem.select_bank(1)
+        self.mem.select_bank(0)
+        changes = self.mem.diff(other)
+        self.assertEqual(len([c for c in changes if c[0] == "registers_b"]), Memory.NUM_REGISTERS)
+        self.assertTrue(all(theirs is None for space, _, _, theirs in changes if space == "registers_b"))
+        self.assertIsNone(other.banks[1])
+        self.assertEqual(len(other.diff(self.mem)), len(changes))
+        self.assertIsNone(other.banks[1])
+
+    def test_scratchpad_size(self):
+        for length in Memory.DATA_LENGTHS:
+            mem = Memory(data_length=length)
+            self.assertEqual(len(mem.data()), length)
+            mem.restore(mem.snapshot())
+        # the 64 byte power-on pattern is unchanged by the larger sizes
+        self.assertEqual(Memory(data_length=256).data()[:64], Memory().data()[:64])
+        with self.assertRaises(ValueError):
+            Memory(data_length=100)
+
+    def test_address_decode(self):
+        # a 64 byte scratchpad ignores address bits 6 and 7
+        proc = Processor()
+        proc.set_instructions(build([("LOAD", ["s0", 0x5A]), ("STORE", ["s0", 0xC1]), ("FETCH", ["s1", 0x01])]))
+        proc.run(instructions=3)
+        self.assertEqual((proc.memory.fetch_data(0x01), proc.memory.fetch_register("s1")), (0x5A, 0x5A))
+        proc = Processor(data_length=256)
+        proc.set_instructions(build([("LOAD", ["s0", 0x5A]), ("STORE", ["s0", 0xC1])]))
+        proc.run(instructions=2)
+        self.assertEqual(proc.memory.fetch_data(0xC1), 0x5A)
+
+
 class OperationTests(unittest.TestCase):
     def setUp(self):
         self.proc = Processor()
@@ -122,60 +257,60 @@ class OperationTests(unittest.TestCase):
                 operation.exec(self.proc)
                 r = Memory.MEMORY_IMPL(Memory.REGISTER_WIDTH)
                 r.set_value(v1)
-                r.values = o(operation, r)
+                r.values = o(operation, self.proc, r)
                 self.assertEqual(self.proc.memory.fetch_register('s1'), r.value)
 
     def test_bitwise_ops(self):
         dummy = op.BitwiseOperation(op.BitwiseOperation.OPS["RL"], ["DUMMY"])
-        dummy.proc = Processor()
+        proc = Processor()
         self.r.set_value(32)
-        self.r.values = op.BitwiseOperation.shift_right_zero(dummy, self.r)
+        self.r.values = op.BitwiseOperation.shift_right_zero(dummy, proc, self.r)
         self.assertEqual(self.r.value, 16)
 
         self.r.set_value(32)
-        self.r.values = op.BitwiseOperation.shift_left_zero(dummy, self.r)
+        self.r.values = op.BitwiseOperation.shift_left_zero(dummy, proc, self.r)
         self.assertEqual(self.r.value, 64)
 
         for i in range(0, ITERATIONS):
             v1 = random.randint(0, MAX)
             c = ((v1 << 1) | ((v1 & 0x80) >> 7)) % (MAX + 1)
             self.r.set_value(v1)
-            self.r.values = op.BitwiseOperation.rotate_left(dummy, self.r)
+            self.r.values = op.BitwiseOperation.rotate_left(dummy, proc, self.r)
             self.assertEqual(self.r.value, c)
 
             c = ((v1 >> 1) | ((v1 & 1) << 7))
             self.r.set_value(v1)
-            self.r.values = op.BitwiseOperation.rotate_right(dummy, self.r)
+            self.r.values = op.BitwiseOperation.rotate_right(dummy, proc, self.r)
             self.assertEqual(self.r.value, c)
 
             c = ((v1 << 1) & 0xFE) % (MAX + 1)
             self.r.set_value(v1)
-            self.r.values = op.BitwiseOperation.shift_left_zero(dummy, self.r)
+            self.r.values = op.BitwiseOperation.shift_left_zero(dummy, proc, self.r)
             self.assertEqual(self.r.value, c)
 
             c = ((v1 >> 1) & 0x7F) % (MAX + 1)
             self.r.set_value(v1)
-            self.r.values = op.BitwiseOperation.shift_right_zero(dummy, self.r)
+            self.r.values = op.BitwiseOperation.shift_right_zero(dummy, proc, self.r)
             self.assertEqual(self.r.value, c)
 
             c = ((v1 << 1) & 0xFE | 1) % (MAX + 1)
             self.r.set_value(v1)
-            self.r.values = op.BitwiseOperation.shift_left_one(dummy, self.r)
+            self.r.values = op.BitwiseOperation.shift_left_one(dummy, proc, self.r)
             self.assertEqual(self.r.value, c)
 
             c = ((v1 >> 1) & 0x7F | (1 << 7)) % (MAX + 1)
             self.r.set_value(v1)
-            self.r.values = op.BitwiseOperation.shift_right_one(dummy, self.r)
+            self.r.values = op.BitwiseOperation.shift_right_one(dummy, proc, self.r)
             self.assertEqual(self.r.value, c)
 
             c = ((v1 << 1) & 0xFE | (v1 & 1)) % (MAX + 1)
             self.r.set_value(v1)
-            self.r.values = op.BitwiseOperation.shift_left_x(dummy, self.r)
+            self.r.values = op.BitwiseOperation.shift_left_x(dummy, proc, self.r)
             self.assertEqual(self.r.value, c)
 
             c = ((v1 >> 1) & 0x7F | (v1 & 0x80)) % (MAX + 1)
             self.r.set_value(v1)
-            self.r.values = op.BitwiseOperation.shift_right_x(dummy, self.r)
+            self.r.values = op.BitwiseOperation.shift_right_x(dummy, proc, self.r)
             self.assertEqual(self.r.value, c)
 
             for b in [True, False]:
@@ -241,18 +376,16 @@ class ProcessorTests(unittest.TestCase):
         self.proc.add_instruction(op.CompareOperation(op.CompareOperation.OPS["COMPARE"], ['s3', 0xFF]))
         self.proc.add_instruction(op.FlowOperation(op.FlowOperation.OPS["JUMP NZ"], [0x000]))
 
-        executed = 0
-        start_time = time.time()
-        while not self.proc.outside_program():
-            self.proc.execute()
-            executed += 1
+        result = self.proc.run()
 
-        dur = time.time() - start_time
-        ops_per_sec = executed / dur
-        eff_khz = 2.0 / 1000.0 * ops_per_sec  # on PicoBlaze, one operation takes two clocks
-        print("--- %8.3f seconds, %d ops     ---" % (dur, executed))
+        dur = result.wall_seconds
+        ops_per_sec = result.dispatches / dur
+        eff_khz = result.cycles / dur / 1000.0
+        print("--- %8.3f seconds, %d ops     ---" % (dur, result.dispatches))
         print("--- %8.0f ops per sec ---" % ops_per_sec)
         print("--- %8.1f KHz clock   ---" % eff_khz)
+        print("--- %8.1f us simulated, %.4fx real time ---" % (result.simulated_us, result.realtime_ratio))
+        self.assertEqual(result.cycles, self.proc.cycles)
         self.assertGreater(ops_per_sec, 10000)
 
     def test_compare_jump(self):
@@ -290,6 +423,40 @@ class ProcessorTests(unittest.TestCase):
         self.assertEqual(self.proc.external.port_id, 0x40)
         self.assertEqual(self.proc.memory.fetch_register('s3'), 0x88)
 
+    def test_fetch_store_copy(self):
+        self.proc.add_instruction(op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x05]))
+        self.proc.add_instruction(op.DataOperation(op.DataOperation.OPS["STORE"], ['s1', 0x10]))
+        self.proc.add_instruction(op.DataOperation(op.DataOperation.OPS["FETCH"], ['s2', 0x10]))
+        self.proc.add_instruction(op.DataOperation(op.DataOperation.OPS["LOAD"], ['s2', 0x07]))
+        for _ in range(3):
+            self.proc.execute()
+
+        # register and scratchpad must not share a row or its bit list
+        self.assertIsNot(self.proc.memory.REGISTERS['s2'], self.proc.memory.DATA_MEMORY[0x10])
+        self.proc.memory.REGISTERS['s1'].values[7] = False
+        self.proc.memory.REGISTERS['s2'].values[0] = True
+        self.assertEqual(self.proc.memory.fetch_data(0x10), 0x05)
+
+        # writing the register after the FETCH leaves the scratchpad unchanged
+        self.proc.execute()
+        self.assertEqual(self.proc.memory.fetch_register('s2'), 0x07)
+        self.assertEqual(self.proc.memory.fetch_data(0x10), 0x05)
+
+    def test_call_return(self):
+        self.proc.add_instruction(op.FlowOperation(op.FlowOperation.OPS["CALL"], [0x003]))
+        self.proc.add_instruction(op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x11]))
+        self.proc.add_instruction(op.FlowOperation(op.FlowOperation.OPS["JUMP"], [0x005]))
+        self.proc.add_instruction(op.DataOperation(op.DataOperation.OPS["LOAD"], ['s2', 0x22]))
+        self.proc.add_instruction(op.FlowOperation(op.FlowOperation.OPS["RETURN"], []))
+
+        for expected_pc in [0x003, 0x004, 0x001, 0x002, 0x005]:
+            self.proc.execute()
+            self.assertEqual(self.proc.manager.pc, expected_pc)
+
+        self.assertEqual(self.proc.memory.stack_pointer, 0)
+        self.assertEqual(self.proc.memory.fetch_register('s1'), 0x11)
+        self.assertEqual(self.proc.memory.fetch_register('s2'), 0x22)
+
 
 class AssemblerTest(unittest.TestCase):
     TIMEOUT = 5.0
@@ -324,5 +491,2112 @@ class AssemblerTest(unittest.TestCase):
             self.assertTrue(True)
 
 
+class FusionTests(unittest.TestCase):
+    @staticmethod
+    def program():
+        return {
+            0x0: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s2', 0x42]),
+            0x1: op.DataOperation(op.DataOperation.OPS["OUTPUT"], ['s2', 0x10]),
+            0x2: op.ArithmeticOperation(op.ArithmeticOperation.OPS["ADD"], ['s1', 1]),
+            0x3: op.CompareOperation(op.CompareOperation.OPS["COMPARE"], ['s1', 0xFF]),
+            0x4: op.FlowOperation(op.FlowOperation.OPS["JUMP NZ"], [0x002]),
+        }
+
+    def test_fused_matches_reference(self):
+        ref, fused = Processor(), Processor()
+        ref.set_instructions(self.program())
+        fused.set_instructions(Fuser(self.program()).fuse())
+
+        while not ref.outside_program():
+            ref.execute()
+        steps = 0
+        while not fused.outside_program():
+            fused.execute()
+            steps += 1
+
+        self.assertLess(steps * 2, ref.cycles // Processor.CLOCKS_PER_INSTRUCTION)
+        self.assertEqual(fused.cycles, ref.cycles)
+        self.assertEqual(fused.manager.pc, ref.manager.pc)
+        self.assertEqual(fused.external.carry, ref.external.carry)
+        self.assertEqual(fused.external.zero, ref.external.zero)
+        self.assertEqual(fused.external.out_port, 0x42)
+        for reg in ['s1', 's2']:
+            self.assertEqual(fused.memory.fetch_register(reg), ref.memory.fetch_register(reg))
+
+    def test_test_jump_matches_reference(self):
+        for flow in ["JUMP Z", "JUMP NZ", "JUMP C", "JUMP NC"]:
+            for v in [0x00, 0x01, 0x03, 0x80]:
+                program = {
+                    0x0: op.CompareOperation(op.CompareOperation.OPS["TEST"], ['s1', 's2']),
+                    0x1: op.FlowOperation(op.FlowOperation.OPS[flow], [0x3FF]),
+                }
+                ref, fused = Processor(), Processor()
+                ref.set_instructions(program)
+                fused.set_instructions(Fuser(program).fuse())
+                self.assertIsInstance(fused.fetch_program(0x0), CompareJump)
+                for proc in [ref, fused]:
+                    proc.memory.set_register('s1', v)
+                    proc.memory.set_register('s2', 0xFF)
+                    proc.execute()
+                ref.execute()
+                self.assertEqual(fused.manager.pc, ref.manager.pc)
+                self.assertEqual(fused.cycles, ref.cycles)
+                self.assertEqual(fused.external.carry, ref.external.carry)
+                self.assertEqual(fused.external.zero, ref.external.zero)
+
+    def test_fewer_host_calls(self):
+        def calls_per_instruction(operations):
+            proc = Processor()
+            proc.set_instructions(operations)
+            proc.memory.set_register('s1', 0xF0)
+            calls = [0]
+
+            def count(frame, event, arg):
+                if event == 'call':
+                    calls[0] += 1
+
+            sys.setprofile(count)
+            try:
+                while not proc.outside_program():
+                    proc.execute()
+            finally:
+                sys.setprofile(None)
+            return calls[0] / (proc.cycles // Processor.CLOCKS_PER_INSTRUCTION)
+
+        fuser = Fuser(self.program())
+        fused = fuser.fuse()
+        self.assertIsInstance(fused[0x0], LoadOutput)
+        self.assertIsInstance(fused[0x3], CompareJump)
+        self.assertLess(calls_per_instruction(fused), 0.75 * calls_per_instruction(self.program()))
+
+    def test_branch_into_group(self):
+        fuser = Fuser(self.program())
+        fused = fuser.fuse()
+        self.assertEqual(fuser.address_map[0x0], (0x0, 0x1))
+        self.assertEqual(fuser.address_map[0x2], (0x2, 0x3, 0x4))
+        self.assertIsInstance(fused[0x3], FusedOperation)
+        self.assertIs(fused[0x1], fuser.operations[0x1])
+
+        # jumping to the OUTPUT in the middle of the LOAD + OUTPUT group only runs the OUTPUT
+        self.proc = Processor()
+        self.proc.set_instructions(fused)
+        self.proc.memory.set_register('s2', 0x17)
+        self.proc.manager.jump(0x1)
+        self.proc.execute()
+        self.assertEqual(self.proc.external.out_port, 0x17)
+        self.assertEqual(self.proc.manager.pc, 0x2)
+
+    def test_interrupt_boundary(self):
+        self.proc = Processor()
+        self.proc.set_instructions(Fuser(self.program()).fuse())
+        # group runs whole while interrupts are disabled
+        self.proc.external.set_interrupt(True)
+        self.proc.execute()
+        self.assertEqual(self.proc.manager.pc, 0x2)
+
+        # a pending interrupt stops the group after its first member
+        self.proc.manager.jump(0x0)
+        self.proc.set_interrupt_enabled(True)
+        group = FusedOperation([op.DataOperation(op.DataOperation.OPS["LOAD"], ['s3', 0x1]),
+                                op.DataOperation(op.DataOperation.OPS["LOAD"], ['s4', 0x1])])
+        group.exec(self.proc)
+        self.assertEqual(self.proc.manager.pc, 0x1)
+        self.assertEqual(self.proc.memory.fetch_register('s3'), 0x1)
+        self.assertEqual(self.proc.memory.fetch_register('s4'), 0x0)
+
+
+class MemoizeTests(unittest.TestCase):
+    @staticmethod
+    def program():
+        return {
+            0x0: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s0', 0x03]),
+            0x1: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s2', 0x20]),
+            # clears carry, ADD and SUB always add it in
+            0x2: op.LogicOperation(op.LogicOperation.OPS["AND"], ['s0', 's0']),
+            0x3: op.FlowOperation(op.FlowOperation.OPS["CALL"], [0x10]),
+            0x4: op.ArithmeticOperation(op.ArithmeticOperation.OPS["SUB"], ['s2', 1]),
+            0x5: op.CompareOperation(op.CompareOperation.OPS["COMPARE"], ['s2', 0x00]),
+            0x6: op.FlowOperation(op.FlowOperation.OPS["JUMP NZ"], [0x003]),
+            0x7: op.FlowOperation(op.FlowOperation.OPS["CALL"], [0x20]),
+            0x8: op.FlowOperation(op.FlowOperation.OPS["JUMP"], [0x3FF]),
+            # pure: s1 = s0 + s0, keeps a copy in the scratchpad
+            0x10: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 's0']),
+            0x11: op.ArithmeticOperation(op.ArithmeticOperation.OPS["ADD"], ['s1', 's0']),
+            0x12: op.DataOperation(op.DataOperation.OPS["STORE"], ['s1', 0x08]),
+            0x13: op.FlowOperation(op.FlowOperation.OPS["RETURN"], []),
+            # impure: writes a port
+            0x20: op.DataOperation(op.DataOperation.OPS["OUTPUT"], ['s1', 0x01]),
+            0x21: op.FlowOperation(op.FlowOperation.OPS["RETURN"], []),
+        }
+
+    MAX_STEPS = 10000
+
+    def test_analysis(self):
+        memoized = Memoizer(self.program()).memoize()
+        self.assertIsInstance(memoized[0x3], MemoizedCall)
+        self.assertEqual(memoized[0x3].reg_reads, ['s0', 's1'])
+        self.assertEqual(memoized[0x3].mem_writes, [0x08])
+        self.assertNotIsInstance(memoized[0x7], MemoizedCall)
+
+    def test_memoized_matches_reference(self):
+        ref, fast = Processor(), Processor()
+        ref.set_instructions(self.program())
+        memoized = Memoizer(self.program()).memoize()
+        fast.set_instructions(memoized)
+
+        for proc in [ref, fast]:
+            steps = 0
+            while proc.manager.pc != 0x3FF:
+                self.assertLess(steps, MemoizeTests.MAX_STEPS, "program never reached its end")
+                proc.execute()
+                steps += 1
+
+        self.assertGreater(memoized[0x3].hits, 0)
+        self.assertEqual(memoized[0x3].misses + memoized[0x3].hits, 0x20)
+        self.assertEqual(fast.cycles, ref.cycles)
+        self.assertEqual(fast.external.carry, ref.external.carry)
+        self.assertEqual(fast.external.zero, ref.external.zero)
+        self.assertEqual(fast.external.out_port, ref.external.out_port)
+        self.assertEqual(fast.memory.fetch_data(0x08), ref.memory.fetch_data(0x08))
+        for reg in ['s0', 's1', 's2']:
+            self.assertEqual(fast.memory.fetch_register(reg), ref.memory.fetch_register(reg))
+
+    def test_shared_cache(self):
+        program = self.program()
+        # 0x410 wraps around to the same subroutine, the upper case operand names the same register
+        program[0x7] = op.FlowOperation(op.FlowOperation.OPS["CALL"], [0x410])
+        program[0x10] = op.DataOperation(op.DataOperation.OPS["LOAD"], ['S1', 'S0'])
+        memoized = Memoizer(program).memoize()
+        self.assertIs(memoized[0x3].cache, memoized[0x7].cache)
+        self.assertEqual(memoized[0x3].reg_reads, ['s0', 's1'])
+
+    def test_assembled_arithmetic(self):
+        # the assembler resolves ADD and SUB to SlowArithmeticOperation through op.ALL_OPS
+        program = self.program()
+        add = op.ALL_OPS["ADD"]
+        program[0x11] = add[0](add[1], ['s1', 's0'])
+        memoized = Memoizer(program).memoize()
+        self.assertIsInstance(memoized[0x3], MemoizedCall)
+        self.assertEqual(memoized[0x3].reg_reads, ['s0', 's1'])
+
+    def test_bypass_pending_interrupt(self):
+        memoized = Memoizer(self.program()).memoize()
+        self.proc = Processor()
+        self.proc.set_instructions(memoized)
+        self.proc.set_interrupt_enabled(True)
+        self.proc.manager.jump(0x3)
+        # interrupts enabled but none pending: runs the subroutine and records it
+        memoized[0x3].exec(self.proc)
+        self.assertEqual(self.proc.manager.pc, 0x4)
+        self.assertEqual(memoized[0x3].misses, 1)
+
+        # a pending interrupt makes the call a plain CALL
+        self.proc.external.set_interrupt(True)
+        self.proc.manager.jump(0x3)
+        memoized[0x3].exec(self.proc)
+        self.assertEqual(self.proc.manager.pc, 0x10)
+        self.assertEqual(memoized[0x3].misses + memoized[0x3].hits, 1)
+
+    def test_path_leaving_register_untouched(self):
+        program = {
+            0x0: op.FlowOperation(op.FlowOperation.OPS["CALL"], [0x10]),
+            # s1 is only written when carry is clear
+            0x10: op.FlowOperation(op.FlowOperation.OPS["JUMP C"], [0x12]),
+            0x11: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x07]),
+            0x12: op.FlowOperation(op.FlowOperation.OPS["RETURN"], []),
+        }
+        memoized = Memoizer(program).memoize()
+        self.assertIsInstance(memoized[0x0], MemoizedCall)
+        proc = Processor()
+        proc.set_instructions(memoized)
+        proc.set_carry(True)
+        for value in [0x03, 0x09]:
+            proc.memory.set_register('s1', value)
+            proc.manager.jump(0x0)
+            proc.execute()
+            self.assertEqual(proc.manager.pc, 0x1)
+            self.assertEqual(proc.memory.fetch_register('s1'), value)
+
+    def test_interrupt_while_recording(self):
+        program = {
+            0x0: op.FlowOperation(op.FlowOperation.OPS["ENABLE INTERRUPT"], []),
+            0x1: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x00]),
+            0x2: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s3', 0x00]),
+            0x3: op.FlowOperation(op.FlowOperation.OPS["CALL"], [0x10]),
+            0x4: op.DataOperation(op.DataOperation.OPS["OUTPUT"], ['s1', 0x01]),
+            0x5: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x00]),
+            0x6: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s3', 0x00]),
+            0x7: op.FlowOperation(op.FlowOperation.OPS["CALL"], [0x10]),
+            0x8: op.DataOperation(op.DataOperation.OPS["OUTPUT"], ['s1', 0x01]),
+            0x9: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x00]),
+            0xA: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s3', 0x00]),
+            0xB: op.FlowOperation(op.FlowOperation.OPS["CALL"], [0x10]),
+            0xC: op.DataOperation(op.DataOperation.OPS["OUTPUT"], ['s1', 0x01]),
+            0xD: op.FlowOperation(op.FlowOperation.OPS["JUMP"], [0x3FF]),
+            0x10: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x03]),
+            0x11: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s3', 's1']),
+            0x12: op.DataOperation(op.DataOperation.OPS["LOAD"], ['s3', 's1']),
+            0x13: op.FlowOperation(op.FlowOperation.OPS["RETURN"], []),
+            0x20: op.ArithmeticOperation(op.ArithmeticOperation.OPS["ADD"], ['s1', 0x10]),
+            0x21: op.FlowOperation(op.FlowOperation.OPS["RETURNI ENABLE"], []),
+        }
+        memoized = Memoizer(program).memoize()
+        self.assertIsInstance(memoized[0x3], MemoizedCall)
+        results = []
+        for instructions in [program, memoized]:
+            proc = Processor()
+            proc.set_instructions(instructions)
+            proc.manager.isr_addr = 0x20
+            outputs = []
+            execute, ack = proc.execute, proc.set_interrupt_ack
+
+            def raise_line(proc=proc, execute=execute):
+                # once, in the middle of the first call
+                if proc.cycles == 10:
+                    proc.external.set_interrupt(True)
+                execute()
+
+            def clear_line(val, proc=proc, ack=ack):
+                ack(val)
+                if val:
+                    proc.external.set_interrupt(False)
+
+            proc.execute = raise_line
+            proc.set_interrupt_ack = clear_line
+            steps = 0
+            while proc.manager.pc != 0x3FF:
+                self.assertLess(steps, MemoizeTests.MAX_STEPS, "program never reached its end")
+                pc = proc.manager.pc
+                proc.execute()
+                if pc in (0x4, 0x8, 0xC):
+                    outputs.append(proc.external.out_port)
+                steps += 1
+            results.append((outputs, proc.cycles))
+
+        self.assertEqual(results[0], ([0x13, 0x03, 0x03], results[0][1]))
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(memoized[0x3].cache, memoized[0xB].cache)
+        self.assertEqual(memoized[0xB].hits, 1)
+
+
+class FuzzerTests(unittest.TestCase):
+    def test_engines_match_reference(self):
+        self.assertEqual(Fuzzer(length=24, max_cycles=1000, processes=1).run(20, seed=1234), [])
+
+    def test_process_pool(self):
+        self.assertEqual(Fuzzer(length=16, max_cycles=500, processes=2).run(8, seed=99), [])
+
+    def test_shrinks_divergence(self):
+        divergences = Fuzzer({"broken": drop_outputs}, length=32, processes=1).run(10, seed=7)
+        self.assertGreater(len(divergences), 0)
+        for d in divergences:
+            self.assertEqual(d.engine, "broken")
+            self.assertIn("OUTPUT", [name for name, _ in d.program])
+            self.assertLessEqual(len(d.program), 3)
+            self.assertGreater(len(d.differences), 0)
+            # the minimal program still reproduces the divergence
+            self.assertGreater(len(run_differential(d.program, d.state, drop_outputs)), 0)
+
+
+class VCDTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.proc = Processor()
+        self.proc.add_instruction(op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x42]))
+        self.proc.add_instruction(op.DataOperation(op.DataOperation.OPS["OUTPUT"], ['s1', 0x10]))
+        self.proc.add_instruction(op.DataOperation(op.DataOperation.OPS["OUTPUT"], ['s1', 0x10]))
+        self.proc.add_instruction(op.DataOperation(op.DataOperation.OPS["INPUT"], ['s2', 0x20]))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def run_program(self, path: str):
+        with VCDWriter(self.proc, path, registers=['s1']):
+            self.proc.external.set_int_port(0x77)
+            while not self.proc.outside_program():
+                self.proc.execute()
+
+    def test_identifier(self):
+        codes = set(identifier(x) for x in range(0, 94 * 94))
+        self.assertEqual(len(codes), 94 * 94)
+        self.assertEqual(identifier(0), "!")
+        self.assertEqual(len(identifier(93)), 1)
+        self.assertEqual(len(identifier(94)), 2)
+
+    def test_changes_only(self):
+        path = os.path.join(self.dir.name, "run.vcd")
+        self.run_program(path)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        header = lines[:lines.index("$enddefinitions $end")]
+        codes = {line.split()[4]: line.split()[3] for line in header if line.startswith("$var")}
+        changes = lines[lines.index("$end", lines.index("$dumpvars")) + 1:]
+
+        self.assertIn("$var wire 8 ! port_id $end", header)
+        self.assertIn("b1000010 " + codes["out_port"], changes)
+        self.assertIn("b1000010 " + codes["s1"], changes)
+        self.assertIn("b10000 " + codes["port_id"], changes)
+        # the second OUTPUT of the same value is not a change
+        self.assertEqual(len([x for x in changes if x.endswith(" " + codes["out_port"])]), 1)
+        self.assertEqual(changes[-1], "b100 " + codes["pc"])
+        # hooks are removed on close
+        self.assertNotIn("execute", vars(self.proc))
+
+    def test_gzip(self):
+        path = os.path.join(self.dir.name, "run.vcd.gz")
+        self.run_program(path)
+        with gzip.open(path, "rt") as f:
+            self.assertIn("$enddefinitions $end", f.read())
+
+
+class CoSimTests(unittest.TestCase):
+    def test_ring(self):
+        ring = Ring(memoryview(bytearray(Ring.size(4))), 0, 4)
+        ring.reset()
+        for x in range(0, 4):
+            self.assertTrue(ring.push(Channel.WRITE, x, x + 1, x * 2))
+        self.assertFalse(ring.push(Channel.WRITE))
+        self.assertEqual(ring.pop(), (Channel.WRITE, 0, 1, 0))
+        self.assertTrue(ring.push(Channel.READ, 9))
+        self.assertEqual([ring.pop() for _ in range(0, 4)][-1], (Channel.READ, 9, 0, 0))
+        self.assertIsNone(ring.pop())
+
+    def test_in_process_peer(self):
+        proc = Processor()
+        proc.add_instruction(op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x5A]))
+        proc.add_instruction(op.DataOperation(op.DataOperation.OPS["OUTPUT"], ['s1', 0x10]))
+        proc.add_instruction(op.DataOperation(op.DataOperation.OPS["OUTPUTK"], [0x41, 0x3]))
+        bridge = CoSimBridge(proc)
+        peer = HDLPeer(bridge.name)
+        try:
+            while not proc.outside_program():
+                proc.execute()
+            self.assertEqual(peer.receive(), (Channel.WRITE, 0x10, 0x5A, 2))
+            self.assertEqual(peer.receive(), (Channel.WRITE_K, 0x3, 0x41, 4))
+            self.assertIsNone(peer.receive())
+        finally:
+            peer.close()
+            bridge.close()
+        self.assertNotIn("execute", vars(proc))
+
+    def test_hdl_process(self):
+        proc = Processor(isr_addr=0x3F0)
+        program = [op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x5A]),
+                   op.DataOperation(op.DataOperation.OPS["OUTPUT"], ['s1', 0x10]),
+                   op.DataOperation(op.DataOperation.OPS["INPUT"], ['s2', 0x10]),
+                   op.FlowOperation(op.FlowOperation.OPS["EINT"], []),
+                   op.DataOperation(op.DataOperation.OPS["LOAD"], ['s3', 0x01]),
+                   # the HDL raises the interrupt line when port 0xFF is written
+                   op.DataOperation(op.DataOperation.OPS["OUTPUT"], ['s3', 0xFF]),
+                   op.FlowOperation(op.FlowOperation.OPS["JUMP"], [0x006])]
+        instructions = dict(enumerate(program))
+        instructions[0x3F0] = op.DataOperation(op.DataOperation.OPS["LOAD"], ['s5', 0xAA])
+        instructions[0x3F1] = op.FlowOperation(op.FlowOperation.OPS["JUMP"], [0x3F1])
+        proc.set_instructions(instructions)
+
+        bridge = CoSimBridge(proc, poll_interval=1)
+        hdl = multiprocessing.Process(target=register_file_device, args=(bridge.name,))
+        hdl.start()
+        try:
+            deadline = time.time() + 10.0
+            while proc.manager.pc != 0x3F1:
+                self.assertLess(time.time(), deadline)
+                proc.execute()
+            self.assertEqual(proc.memory.fetch_register('s2'), 0x5A)
+            self.assertEqual(proc.memory.fetch_register('s5'), 0xAA)
+            self.assertEqual(proc.memory.pop_stack(), 0x006)
+        finally:
+            bridge.close()
+            hdl.join(5)
+        self.assertEqual(hdl.exitcode, 0)
+
+
+class StartupTests(unittest.TestCase):
+    # seconds the simulator imports may add on top of a bare interpreter start
+    IMPORT_BUDGET = 0.25
+    ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    def cold_start(self, *args: str) -> float:
+        best = None
+        for _ in range(0, 3):
+            start_time = time.time()
+            subprocess.check_call([sys.executable] + list(args), cwd=StartupTests.ROOT,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            dur = time.time() - start_time
+            best = dur if best is None else min(best, dur)
+        return best
+
+    def test_static_registry(self):
+        # the same scan the registry replaced, skipping module level aliases like the ALL_OPS loop variable
+        scanned = [obj for name, obj in inspect.getmembers(op, lambda m: inspect.isclass(m)
+                                                           and m.__module__ == op.__name__) if name == obj.__name__]
+        self.assertEqual(op.OP_CLASSES, scanned)
+        self.assertIs(op.ALL_OPS["ADD"][0], op.SlowArithmeticOperation)
+
+    def test_no_numpy_on_import(self):
+        subprocess.check_call([sys.executable, "-c", "import sys, ops.assembler, system.processor; "
+                                                     "assert 'numpy' not in sys.modules"], cwd=StartupTests.ROOT)
+
+    def test_cold_start_budget(self):
+        bare = self.cold_start("-c", "pass")
+        imports = self.cold_start("-c", "import ops.assembler, ops.operations, system.processor")
+        print("--- %8.3f seconds bare, %8.3f seconds with imports ---" % (bare, imports))
+        self.assertLess(imports - bare, StartupTests.IMPORT_BUDGET)
+
+    def test_cli_cold_start_budget(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "prog.psm")
+            with open(path, "w") as f:
+                f.write(CLITests.PROGRAM)
+            bare = self.cold_start("-c", "pass")
+            cli = self.cold_start("-m", "picosim", "run", path, "--quiet")
+        print("--- %8.3f seconds bare, %8.3f seconds for a CLI run ---" % (bare, cli))
+        self.assertLess(cli - bare, StartupTests.IMPORT_BUDGET)
+
+
+class CLITests(unittest.TestCase):
+    PROGRAM = "\n".join([
+        "CONSTANT LED, 10",
+        "start: LOAD s1, 00",
+        "loop: ADD s1, 01",
+        "OUTPUT s1, LED",
+        "INPUT s2, 20",
+        "COMPARE s1, 05",
+        "JUMP NZ loop",
+    ]) + "\n"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.program = self.path("prog.psm", CLITests.PROGRAM)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name: str, content: str = None) -> str:
+        path = os.path.join(self.tmp.name, name)
+        if content is not None:
+            with open(path, "w") as f:
+                f.write(content)
+        return path
+
+    def picosim(self, *args: str, stdin: bytes = None) -> subprocess.CompletedProcess:
+        return subprocess.run([sys.executable, "-m", "picosim"] + list(args), cwd=StartupTests.ROOT, input=stdin,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, timeout=60)
+
+    def test_run_jsonl(self):
+        result = self.picosim("run", self.program)
+        writes = [json.loads(line) for line in result.stdout.decode().splitlines()]
+        self.assertEqual([w["value"] for w in writes], [1, 2, 3, 4, 5])
+        self.assertTrue(all(w["port"] == 0x10 for w in writes))
+        stats = json.loads(result.stderr.decode())
+        self.assertEqual(stats["instructions"], 26)
+        self.assertEqual(stats["cycles"], 52)
+        for key in ("ops_per_sec", "eff_khz", "peak_memory_kb"):
+            self.assertIn(key, stats)
+
+    def test_run_binary_and_budget(self):
+        result = self.picosim("run", self.program, "--format", "binary", "--cycles", "20")
+        records = [PortWriter.RECORD.unpack_from(result.stdout, i)
+                   for i in range(0, len(result.stdout), PortWriter.RECORD.size)]
+        self.assertEqual([(port, value) for _, port, value in records], [(0x10, 1), (0x10, 2)])
+        self.assertEqual(json.loads(result.stderr.decode())["cycles"], 20)
+        # 0.2 us at 50 MHz is 10 cycles
+        stats = json.loads(self.picosim("run", self.program, "--quiet", "--us", "0.2", "--mhz", "50").stderr.decode())
+        self.assertEqual((stats["cycles"], stats["simulated_us"]), (10, 0.2))
+
+    def test_stimulus(self):
+        # the loop writes the value read from port 0x20 on the next pass
+        program = self.path("echo.psm", "loop: INPUT s1, 20\nOUTPUT s1, 30\nCOMPARE s1, FF\nJUMP NZ loop\n")
+        result = self.picosim("run", program, "--stimulus", "-", stdin=b"20 05\n20 0A ; comment\n20 FF\n")
+        writes = [json.loads(line)["value"] for line in result.stdout.decode().splitlines()]
+        self.assertEqual(writes, [0x05, 0x0A, 0xFF])
+
+    def test_host_profile(self):
+        path = self.path("host.json")
+        result = self.picosim("run", self.program, "--quiet", "--host-profile", path)
+        self.assertIn("dispatch", result.stderr.decode())
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(report["steps"], 26)
+
+    def test_analytics(self):
+        path = self.path("analytics.json")
+        self.picosim("run", self.program, "--quiet", "--analytics", path)
+        with open(path) as f:
+            report = json.load(f)
+        self.assertTrue(all(port["writes"] + port["reads"] > 0 for port in report["ports"]))
+
+    def test_render(self):
+        trace = self.path("trace.jsonl", "\n".join(json.dumps({"cycle": c, "port": p, "value": v})
+                                                    for c, p, v in [(0, 1, 0xFE), (2, 2, 0xC0), (40, 3, 1)]))
+        npy = self.path("frames.npy")
+        result = self.picosim("render", trace, "--cathode-port", "2", "--anode-port", "1", "--led-ports", "3",
+                              "--digits", "2", "--every", "10", "--npy", npy, "--apng", self.path("frames.png"))
+        self.assertEqual(json.loads(result.stdout.decode()), {"frames": 5, "apng_frames": 3})
+        self.assertTrue(os.path.getsize(npy) > 0)
+
+    def test_preload(self):
+        program = self.path("fetch.psm", "FETCH s0, C0\nOUTPUT s0, 01\nFETCH s0, 40\nOUTPUT s0, 01\n")
+        small_data, data = self.path("small.bin"), self.path("data.bin")
+        with open(small_data, "wb") as f:
+            f.write(bytes(range(0x40))[::-1])
+        with open(data, "wb") as f:
+            f.write(bytes(range(0x100))[::-1])
+        # 64 byte builds alias 0xC0 and 0x40 onto 0x00
+        small = self.picosim("run", program, "--instructions", "4", "--preload", small_data).stdout.decode()
+        self.assertEqual([json.loads(line)["value"] for line in small.splitlines()], [0x3F, 0x3F])
+        large = self.picosim("run", program, "--instructions", "4", "--preload", data,
+                             "--scratchpad", "256").stdout.decode()
+        self.assertEqual([json.loads(line)["value"] for line in large.splitlines()], [0x3F, 0xBF])
+
+    def test_analyze(self):
+        program = self.path("delay.psm", "start: CALL delay\nJUMP start\ndelay: LOAD s0, 04\nspin: SUB s0, 01\n"
+                                         "COMPARE s0, 00\nJUMP NZ, spin ; @loop 4\nRETURN\n")
+        report = json.loads(self.picosim("analyze", program).stdout.decode())
+        self.assertEqual(report["subroutines"][0]["worst"], 2 + 4 * 6 + 6 + 2)
+        self.assertEqual(report["max_stack_depth"], 1)
+        result = subprocess.run([sys.executable, "-m", "picosim", "analyze", program, "--max-latency", "1"],
+                                cwd=StartupTests.ROOT, stdout=subprocess.PIPE, timeout=60)
+        self.assertEqual(result.returncode, 1)
+
+    def test_faults(self):
+        outcomes = self.path("outcomes.jsonl")
+        summary = json.loads(self.picosim("faults", self.program, "--cycles", "40", "--count", "12",
+                                          "--processes", "1", "-o", outcomes).stdout.decode())
+        self.assertEqual(summary["injections"], 12)
+        self.assertEqual(sum(summary["outcomes"].values()), 12)
+        with open(outcomes) as f:
+            self.assertEqual(len(f.readlines()), 12)
+
+    def test_checkpoint_resume(self):
+        full = self.picosim("run", self.program)
+        checkpoint = self.path("run.ckpt")
+        first = self.picosim("run", self.program, "--cycles", "20", "--checkpoint", checkpoint,
+                             "--checkpoint-cycles", "8")
+        rest = self.picosim("run", self.program, "--checkpoint", checkpoint)
+        self.assertEqual(first.stdout + rest.stdout, full.stdout)
+        stats = json.loads(rest.stderr.decode())
+        self.assertEqual((stats["cycles"], stats["port_writes"]), (52, 5))
+
+    def test_sweep(self):
+        manifest = self.path("sweep.jsonl", "\n".join(json.dumps({"program": self.program, "cycles": c})
+                                                       for c in (10, 20, 30)))
+        sweep = subprocess.Popen([sys.executable, "-m", "picosim", "sweep", manifest], cwd=StartupTests.ROOT,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        address = sweep.stderr.readline().decode().split()[-1]
+        subprocess.run([sys.executable, "-m", "picosim", "worker", address, "--processes", "1"],
+                       cwd=StartupTests.ROOT, stderr=subprocess.DEVNULL, check=True, timeout=60)
+        out, _ = sweep.communicate(timeout=60)
+        self.assertEqual(sweep.returncode, 0)
+        results = [json.loads(line) for line in out.decode().splitlines()]
+        self.assertEqual([r["cycles"] for r in results], [10, 20, 30])
+
+    def test_fused_matches(self):
+        plain = self.picosim("run", self.program).stdout
+        fused = self.picosim("run", self.program, "--fuse", "--memoize").stdout
+        self.assertEqual(plain, fused)
+
+    def test_batch_and_assemble(self):
+        compiled = self.path("prog.bin")
+        self.picosim("assemble", self.program, "-o", compiled)
+        manifest = self.path("jobs.jsonl", "\n".join([
+            json.dumps({"program": self.program, "cycles": 10}),
+            json.dumps({"program": compiled, "output": self.path("out.jsonl")}),
+            json.dumps({"program": self.program, "instructions": 3}),
+        ]))
+        results = [json.loads(line) for line in self.picosim("batch", manifest).stdout.decode().splitlines()]
+        self.assertEqual([r["cycles"] for r in results], [10, 52, 6])
+        with open(self.path("out.jsonl")) as f:
+            self.assertEqual(len(f.read().splitlines()), 5)
+
+    def test_playback(self):
+        program = self.path("echo.psm", "loop: INPUT s1, 20\nOUTPUT s1, 30\nJUMP loop\n")
+        csv_path = self.path("stim.csv", "cycle,port,value\n0,0x20,0x05\n7,0x20,0x06\n")
+        stim = self.path("stim.bin")
+        self.assertEqual(json.loads(self.picosim("stimulus", csv_path, "-o", stim).stdout.decode())["records"], 2)
+        result = self.picosim("run", program, "--playback", stim, "--cycles", "18")
+        writes = [json.loads(line)["value"] for line in result.stdout.decode().splitlines()]
+        # INPUTs start at cycles 0, 6 and 12
+        self.assertEqual(writes, [0x05, 0x05, 0x06])
+
+    def test_trace(self):
+        lines = self.picosim("trace", self.program, "--instructions", "3").stdout.decode().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertIn("load", lines[0])
+        vcd = self.path("trace.vcd")
+        self.picosim("trace", self.program, "--vcd", vcd, "--registers", "s1")
+        with open(vcd) as f:
+            self.assertIn("$enddefinitions $end", f.read())
+
+
+class FlyweightTests(unittest.TestCase):
+    LENGTH = 200
+    PROCESSORS = 8
+    STEPS = 500
+
+    def setUp(self):
+        self.program = build(ProgramGenerator(random.Random(33)).program(FlyweightTests.LENGTH))
+
+    @staticmethod
+    def slot_values(instr: op.Instruction) -> dict:
+        return {name: getattr(instr, name) for cls in type(instr).__mro__
+                for name in getattr(cls, "__slots__", ()) if hasattr(instr, name)}
+
+    def run_program(self, proc: Processor, seed: int):
+        InitialState(random.Random(seed)).apply(proc)
+        for _ in range(0, FlyweightTests.STEPS):
+            if proc.outside_program():
+                break
+            try:
+                proc.execute()
+            except (IndexError, KeyError):
+                # stack under/overflow of the random program
+                break
+
+    def test_no_instance_dict(self):
+        for program in (self.program, fuse(memoize(self.program))):
+            for instr in program.values():
+                self.assertFalse(hasattr(instr, "__dict__"), instr)
+        self.assertFalse(hasattr(Memory.MEMORY_IMPL(Memory.REGISTER_WIDTH), "__dict__"))
+
+    def test_exec_does_not_mutate(self):
+        program = fuse(self.program)
+        before = {a: self.slot_values(i) for a, i in program.items()}
+        for seed in range(0, 4):
+            proc = Processor()
+            proc.set_instructions(program)
+            self.run_program(proc, seed)
+        self.assertEqual(before, {a: self.slot_values(i) for a, i in program.items()})
+
+    def test_shared_between_threads(self):
+        expected = []
+        for seed in range(0, FlyweightTests.PROCESSORS):
+            proc = Processor()
+            proc.set_instructions(build(ProgramGenerator(random.Random(33)).program(FlyweightTests.LENGTH)))
+            self.run_program(proc, seed)
+            expected.append(architectural_state(proc))
+
+        procs = [Processor() for _ in range(0, FlyweightTests.PROCESSORS)]
+        for proc in procs:
+            proc.set_instructions(self.program)
+        threads = [threading.Thread(target=self.run_program, args=(proc, seed)) for seed, proc in enumerate(procs)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(expected, [architectural_state(proc) for proc in procs])
+
+    def test_memory_per_processor(self):
+        tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            procs = []
+            for _ in range(0, 1000):
+                proc = Processor()
+                proc.set_instructions(self.program)
+                procs.append(proc)
+            per_processor = (tracemalloc.get_traced_memory()[0] - start) / len(procs)
+        finally:
+            tracemalloc.stop()
+        print("--- %8.0f bytes per processor sharing a %d instruction program ---"
+              % (per_processor, FlyweightTests.LENGTH))
+        # the shared program is not copied into the processors
+        self.assertTrue(all(proc._instructions is self.program for proc in procs))
+        self.assertLess(per_processor, 34000)
+
+
+class ResetTests(unittest.TestCase):
+    @staticmethod
+    def full_state(proc: Processor) -> dict:
+        state = architectural_state(proc)
+        state["stack_memory"] = [row.value for row in proc.memory.STACK]
+        state["interrupt"] = proc.interrupt
+        state["in_port"] = proc.in_port
+        state["interrupt_ack"] = proc.external.interrupt_ack
+        return state
+
+    def test_deterministic_power_on(self):
+        self.assertEqual(self.full_state(Processor()), self.full_state(Processor()))
+        self.assertEqual(self.full_state(Processor(seed=7)), self.full_state(Processor(seed=7)))
+        self.assertNotEqual(self.full_state(Processor(seed=7))["data"], self.full_state(Processor(seed=8))["data"])
+        self.assertTrue(all(v == 0 for v in self.full_state(Processor(seed=7))["registers"]))
+
+    def test_reset_matches_new_processor(self):
+        program = build(ProgramGenerator(random.Random(34)).program(100))
+        proc = Processor(seed=3)
+        proc.set_instructions(program)
+        InitialState(random.Random(1)).apply(proc)
+        proc.external.set_interrupt(True)
+        for _ in range(0, 200):
+            if proc.outside_program():
+                break
+            try:
+                proc.execute()
+            except (IndexError, KeyError):
+                break
+        other = build(ProgramGenerator(random.Random(35)).program(10))
+        proc.reset(other, seed=5)
+        fresh = Processor(seed=5)
+        self.assertEqual(self.full_state(proc), self.full_state(fresh))
+        self.assertIs(proc.fetch_program(0), other[0])
+
+    def test_reset_cost(self):
+        proc = Processor()
+        start_time = time.time()
+        for _ in range(0, 1000):
+            Processor()
+        construct = time.time() - start_time
+        start_time = time.time()
+        for _ in range(0, 1000):
+            proc.reset()
+        reset = time.time() - start_time
+        print("--- %8.1f us per construction, %8.1f us per reset ---" % (construct * 1000, reset * 1000))
+        self.assertLess(reset, construct)
+
+    def test_pool(self):
+        program = build([("LOAD", ["s0", 0x12]), ("OUTPUT", ["s0", 0x01])])
+        pool = ProcessorPool(size=2)
+        with pool.lease(program) as proc:
+            proc.run()
+            self.assertEqual(proc.external.out_port, 0x12)
+        with pool.lease(program) as again:
+            self.assertIs(again, proc)
+            self.assertEqual(again.manager.pc, 0)
+            self.assertEqual(again.cycles, 0)
+            self.assertEqual(again.memory.fetch_register('s0'), 0)
+        self.assertEqual(pool.created, 1)
+
+        # a processor that is still hooked is dropped instead of leaking the hook to the next user
+        hooked = pool.acquire(program)
+        hooked.set_write_strobe = lambda val: None
+        pool.release(hooked)
+        self.assertIsNot(pool.acquire(program), hooked)
+
+    def test_pool_without_program(self):
+        program = build([("LOAD", ["s0", 0x12])])
+        pool = ProcessorPool(size=2)
+        proc = pool.acquire(program)
+        pool.release(proc)
+        again = pool.acquire()
+        self.assertIs(again, proc)
+        again.add_instruction(op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x34]))
+        pool.release(again)
+        again = pool.acquire()
+        again.add_instruction(op.DataOperation(op.DataOperation.OPS["LOAD"], ['s1', 0x56]))
+        self.assertEqual(len(again._instructions), 1)
+        self.assertEqual(len(program), 1)
+        again.execute()
+        self.assertEqual(again.memory.fetch_register('s1'), 0x56)
+        self.assertTrue(again.outside_program())
+
+
+class ExplorerTests(unittest.TestCase):
+    def test_snapshot_restore(self):
+        program = build(ProgramGenerator(random.Random(35)).program(100))
+        proc = Processor(seed=1)
+        proc.set_instructions(program)
+        InitialState(random.Random(2)).apply(proc)
+        proc.memory.push_stack(0x2AB)
+        snapshot = proc.snapshot()
+        key = proc.state_key()
+        expected = ResetTests.full_state(proc)
+        for _ in range(0, 50):
+            try:
+                proc.execute()
+            except (IndexError, KeyError):
+                break
+        proc.restore(snapshot)
+        self.assertEqual(ResetTests.full_state(proc), expected)
+        self.assertEqual(proc.state_key(), key)
+        self.assertEqual(len(proc.memory.snapshot()),
+                         2 * Memory.NUM_REGISTERS + Memory.DATA_LENGTH + 2 * Memory.STACK_LENGTH + 2)
+        # the cycle counter does not distinguish states
+        proc.cycles += 10
+        self.assertEqual(proc.state_key(), key)
+        proc.memory.store_data(3, proc.memory.fetch_data(3) ^ 1)
+        self.assertNotEqual(proc.state_key(), key)
+
+    def test_shortest_input_trace(self):
+        # SL1 clears the zero flag, COMPARE only ever sets it
+        program = build([("SL1", ["sf"]), ("INPUT", ["s0", 0x01]), ("COMPARE", ["s0", 0x12]), ("JUMP NZ", [0]),
+                         ("SL1", ["sf"]), ("INPUT", ["s0", 0x02]), ("COMPARE", ["s0", 0x34]), ("JUMP NZ", [0]),
+                         ("LOAD", ["s1", 0x01])])
+        explorer = Explorer(program, in_ports=range(0, 0x40), targets=[8], depth=20)
+        result = explorer.explore()
+        finding = result.first(Finding.TARGET)
+        self.assertIsNotNone(finding)
+        self.assertEqual([port for port, _ in finding.trace if port is not None], [0x12, 0x34])
+        self.assertEqual(len(finding.trace), 8)
+        self.assertEqual(explorer.replay(finding.trace).manager.pc, 8)
+
+    def test_interrupt_timing(self):
+        # the ISR stores s0, which is only 1 between the two LOADs
+        program = build([("ENABLE INTERRUPT", []), ("LOAD", ["s0", 0x01]), ("LOAD", ["s0", 0x00]), ("JUMP", [1])])
+        program.update({0x10: op.FlowOperation(op.FlowOperation.OPS["CALL"], [0x12]),
+                        0x11: op.FlowOperation(op.FlowOperation.OPS["RETURNI ENABLE"], []),
+                        0x12: op.DataOperation(op.DataOperation.OPS["STORE"], ["s0", 0x00]),
+                        0x13: op.FlowOperation(op.FlowOperation.OPS["RETURN"], [])})
+        explorer = Explorer(program, isr_addr=0x10, depth=16,
+                            assertions=[("flag", lambda p: p.memory.fetch_data(0) != 1)],
+                            initial=lambda p: p.memory.store_data(0, 0))
+        finding = explorer.explore().first()
+        self.assertEqual(finding.kind, Finding.ASSERTION)
+        self.assertEqual(finding.detail, "flag")
+        self.assertEqual(finding.trace, [(None, False), (None, False), (None, True), (None, False)])
+        self.assertEqual(explorer.replay(finding.trace).memory.fetch_data(0), 1)
+
+    def test_stack_faults(self):
+        program = build([("INPUT", ["s0", 0x01]), ("COMPARE", ["s0", 0x2A]), ("JUMP Z", [4]), ("JUMP", [0]),
+                         ("CALL", [4])])
+        finding = Explorer(program, in_ports=range(0, 0x40), depth=40).explore().first()
+        self.assertEqual(finding.kind, Finding.STACK_OVERFLOW)
+        self.assertEqual(finding.pc, 4)
+        self.assertEqual(len(finding.trace), 3 + Memory.STACK_LENGTH + 1)
+        self.assertEqual(finding.trace[0], (0x2A, False))
+
+        finding = Explorer(build([("LOAD", ["s0", 0x01]), ("RETURN", [])])).explore().first()
+        self.assertEqual((finding.kind, finding.pc, len(finding.trace)), (Finding.STACK_UNDERFLOW, 1, 2))
+
+    def test_bounds(self):
+        program = build([("INPUT", ["s0", 0x01]), ("ADD", ["s1", "s0"]), ("JUMP", [0])])
+        result = Explorer(program, max_states=500, depth=1000).explore()
+        self.assertFalse(result.complete)
+        self.assertEqual(result.states, 500)
+        self.assertEqual(result.findings, [])
+
+        result = Explorer(program, in_ports=[0, 1], depth=1000).explore()
+        # s1 only takes 256 values: the search ends on its own
+        self.assertTrue(result.complete)
+
+
+class MultiCoreTests(unittest.TestCase):
+    COUNTER = [("ADD", ["s0", 0x01]), ("OUTPUT", ["s0", 0x10]), ("LOAD", ["s2", 0x00]), ("JUMP", [0])]
+    ECHO = [("INPUT", ["s1", 0x10]), ("OUTPUT", ["s1", 0x20]), ("JUMP", [0])]
+
+    def pipeline(self, latency: int, quantum: int = None, processes: int = 0) -> System:
+        # core 0 counts, cores 1 and 2 echo what they read from the previous core
+        programs = [build(MultiCoreTests.COUNTER), build(MultiCoreTests.ECHO), build(MultiCoreTests.ECHO)]
+        links = [Link(0, 0x10, 1, latency=latency), Link(1, 0x20, 2, 0x10, latency=latency)]
+        return System(programs, links=links, quantum=quantum, processes=processes, record=True)
+
+    @staticmethod
+    def expected_read(writes: list, cycle: int, latency: int) -> int:
+        value = 0
+        for write_cycle, v in writes:
+            if write_cycle + latency <= cycle:
+                value = v
+        return value
+
+    def check_cycle_accurate(self, system: System, latency: int):
+        sources = {0: [], 1: []}  # type: dict
+        for cycle, core, port, value in system.events:
+            if core in sources:
+                sources[core].append((cycle, value))
+        for core in (1, 2):
+            echoes = [(c, v) for c, src, _, v in system.events if src == core]
+            self.assertGreater(len(echoes), 10)
+            for cycle, value in echoes:
+                # the echo OUTPUT follows the INPUT that read the value
+                read_cycle = cycle - Processor.CLOCKS_PER_INSTRUCTION
+                self.assertEqual(value, self.expected_read(sources[core - 1], read_cycle, latency))
+
+    def test_cycle_accurate_links(self):
+        for latency in (2, 6):
+            system = self.pipeline(latency)
+            self.assertEqual(system.quantum, latency)
+            system.run(400)
+            self.assertEqual(system.late, 0)
+            self.check_cycle_accurate(system, latency)
+            self.assertTrue(all(proc.cycles == system.cycles for proc in system.cores))
+
+    def test_large_quantum_counts_late(self):
+        system = self.pipeline(2, quantum=64)
+        system.run(400)
+        self.assertGreater(system.late, 0)
+
+    def test_worker_processes_match(self):
+        local = self.pipeline(4)
+        local.run(600)
+        with self.pipeline(4, processes=2) as spread:
+            spread.run(600)
+            self.assertEqual(local.events, spread.events)
+            self.assertEqual(local.snapshots(), spread.snapshots())
+
+    def test_interrupt_link_and_halt(self):
+        sender = build([("LOAD", ["s0", 0x01]), ("LOAD", ["s0", 0x01]), ("OUTPUT", ["s0", 0xFF])])
+        receiver = build([("ENABLE INTERRUPT", []), ("JUMP", [1])])
+        receiver[0x20] = op.DataOperation(op.DataOperation.OPS["OUTPUT"], ["s0", 0x30])
+        receiver[0x21] = op.FlowOperation(op.FlowOperation.OPS["JUMP"], [0x21])
+        system = System([sender, receiver], isr_addrs=[0x3FF, 0x20], record=True)
+        system.interrupt(0, 0xFF, 1, latency=10)
+        system.run(200)
+        (write_cycle, _, _, _), (isr_cycle, core, port, _) = system.events
+        self.assertEqual((core, port), (1, 0x30))
+        # the interrupt is taken by the first instruction starting at or after the arrival, the ISR starts after
+        # the interrupt response
+        self.assertEqual(isr_cycle, write_cycle + 10 + Processor.INTERRUPT_RESPONSE_CLOCKS)
+        self.assertTrue(system.cores[0].outside_program())
+        self.assertFalse(system.halted)
+        with self.assertRaises(ValueError):
+            system.connect(0, 0x01, 5)
+
+    def test_outputk_link(self):
+        sender = build([("OUTPUTK", [0x41, 0x3])])
+        receiver = build([("LOAD", ["s1", 0x00]), ("LOAD", ["s1", 0x00]), ("INPUT", ["s1", 0x03]),
+                          ("OUTPUT", ["s1", 0x30])])
+        system = System([sender, receiver], links=[Link(0, 0x3, 1)], record=True)
+        system.run(20)
+        self.assertEqual(system.events, [(0, 0, 0x3, 0x41), (6, 1, 0x30, 0x41)])
+
+
+class StimulusTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @staticmethod
+    def record_writes(proc: Processor) -> list:
+        writes = []
+        set_write_strobe = proc.set_write_strobe
+
+        def hooked(val: bool):
+            set_write_strobe(val)
+            if val:
+                writes.append((proc.cycles, proc.p_port_id, proc.p_out_port))
+
+        proc.set_write_strobe = hooked
+        return writes
+
+    def test_cycle_accurate_inputs(self):
+        path = os.path.join(self.tmp.name, "in.csv")
+        with open(path, "w") as f:
+            f.write("cycle,port,value\n0,1,0x10\n7,1,0x11\n12,1,0x12\n12,2,0x99\n")
+        stim = os.path.join(self.tmp.name, "in.stim")
+        self.assertEqual(convert_csv(path, stim), 4)
+        proc = Processor()
+        proc.set_instructions(build([("INPUT", ["s0", 0x01]), ("OUTPUT", ["s0", 0x02]), ("JUMP", [0])]))
+        writes = self.record_writes(proc)
+        with StimulusPlayer(stim) as player:
+            player.attach(proc)
+            proc.run(cycles=24)
+        # INPUTs start at cycles 0, 6, 12, 18 and see the latest record at or before that cycle
+        self.assertEqual([v for _, _, v in writes], [0x10, 0x10, 0x12, 0x12])
+        # closing the player removed its hooks
+        self.assertEqual(set(vars(proc)) & {"set_read_strobe", "execute"}, set())
+
+    def test_interrupt_schedule(self):
+        stim = os.path.join(self.tmp.name, "int.stim")
+        with StimulusWriter(stim) as writer:
+            writer.interrupt(10, True)
+            writer.interrupt(11, False)
+        program = build([("ENABLE INTERRUPT", []), ("JUMP", [1])])
+        program[0x20] = op.DataOperation(op.DataOperation.OPS["OUTPUT"], ["s0", 0x30])
+        program[0x21] = op.FlowOperation(op.FlowOperation.OPS["JUMP"], [0x21])
+        proc = Processor(isr_addr=0x20)
+        proc.set_instructions(program)
+        writes = self.record_writes(proc)
+        with StimulusPlayer(stim) as player:
+            player.attach(proc)
+            proc.run(cycles=40)
+            self.assertFalse(player.interrupt)
+        self.assertEqual(writes, [(10 + Processor.INTERRUPT_RESPONSE_CLOCKS, 0x30, 0)])
+        self.assertNotIn("execute", vars(proc))
+
+    def test_seek_and_lookup(self):
+        stim = os.path.join(self.tmp.name, "big.stim")
+        rng = random.Random(37)
+        records = []
+        with StimulusWriter(stim) as writer:
+            cycle = 0
+            for _ in range(0, 20000):
+                cycle += rng.randint(0, 5)
+                port, value = rng.randint(0, 3), rng.randint(0, 0xFF)
+                writer.in_port(cycle, port, value)
+                records.append((cycle, port, value))
+            with self.assertRaises(ValueError):
+                writer.in_port(cycle - 1, 0, 0)
+
+        def expected(at: int, port: int) -> int:
+            value = 0
+            for c, p, v in records:
+                if c > at:
+                    break
+                if p == port:
+                    value = v
+            return value
+
+        with StimulusPlayer(stim) as player:
+            for at in (0, 1, 777, 25000, cycle, cycle + 10):
+                for port in range(0, 5):
+                    self.assertEqual(player.value_at(at, port), expected(at, port))
+            player.seek(30001)
+            self.assertEqual([player.port(p) for p in range(0, 4)], [expected(30001, p) for p in range(0, 4)])
+            player.advance(30100)
+            self.assertEqual([player.port(p) for p in range(0, 4)], [expected(30100, p) for p in range(0, 4)])
+
+        with open(stim, "r+b") as f:
+            f.write(b"JUNK")
+        with self.assertRaises(ValueError):
+            StimulusPlayer(stim)
+
+    def test_seek_rarely_written_port(self):
+        stim = os.path.join(self.tmp.name, "sparse.stim")
+        with StimulusWriter(stim) as writer:
+            writer.in_port(0, 9, 0x5A)
+            writer.interrupt(1, True)
+            for cycle in range(2, 10002):
+                writer.in_port(cycle, 1, cycle & 0xFF)
+
+        with StimulusPlayer(stim) as player:
+            player.seek(9000)
+            self.assertEqual(player.port(9), 0x5A)
+            self.assertEqual(player.port(1), 9000 & 0xFF)
+            self.assertEqual(player.port(2), 0)
+            self.assertTrue(player.interrupt)
+            # the index only covers the blocks before the sought record
+            self.assertEqual(len(player._index), 9001 // StimulusPlayer.INDEX_STRIDE + 1)
+            self.assertEqual(player.value_at(100, 9), 0x5A)
+            self.assertEqual(player.value_at(5000, 1), 5000 & 0xFF)
+
+
+class TimingTests(unittest.TestCase):
+    @staticmethod
+    def isr_program() -> dict:
+        # the ISR counts interrupts in s1 and returns with interrupts enabled again
+        program = build([("ENABLE INTERRUPT", []), ("JUMP", [1])])
+        program[0x20] = op.ArithmeticOperation(op.ArithmeticOperation.OPS["ADD"], ["s1", 1])
+        program[0x21] = op.FlowOperation(op.FlowOperation.OPS["RETURNI ENABLE"], [])
+        return program
+
+    def test_instruction_and_interrupt_clocks(self):
+        proc = Processor(isr_addr=0x20)
+        proc.set_instructions(self.isr_program())
+        starts = []
+        execute = proc.execute
+
+        def timed():
+            starts.append((proc.cycles, proc.manager.pc))
+            execute()
+
+        proc.execute = timed
+        proc.run(instructions=3)
+        proc.external.set_interrupt(True)
+        proc.execute()
+        proc.external.set_interrupt(False)
+        proc.run(instructions=2)
+        del proc.execute
+        self.assertEqual([c for c, _ in starts], [0, 2, 4, 6, 10, 12])
+        # the ISR entry spends the response clocks before its first instruction
+        self.assertEqual(proc.cycles, 6 * Processor.CLOCKS_PER_INSTRUCTION + Processor.INTERRUPT_RESPONSE_CLOCKS)
+        self.assertEqual(proc.memory.fetch_register("s1"), 1)
+
+    def test_run_result(self):
+        proc = Processor(clock_hz=50000000)
+        proc.set_instructions(build([("LOAD", ["s0", 0x01]), ("JUMP", [1])]))
+        result = proc.run(microseconds=2)
+        self.assertIsInstance(result, RunResult)
+        # 2 us at 50 MHz is 100 cycles, 50 instructions
+        self.assertEqual((result.dispatches, result.cycles), (50, 100))
+        self.assertAlmostEqual(result.simulated_us, 2.0)
+        self.assertAlmostEqual(proc.microseconds(), 2.0)
+        self.assertGreater(result.wall_seconds, 0)
+        self.assertAlmostEqual(result.realtime_ratio, result.simulated_seconds / result.wall_seconds)
+        # the smaller of two budgets wins, an instruction is never cut short
+        result = proc.run(cycles=5, microseconds=1)
+        self.assertEqual(result.cycles, 6)
+        self.assertEqual(proc.cycles_for(1.5), 75)
+
+    def test_interval_timer(self):
+        proc = Processor(isr_addr=0x20)
+        proc.set_instructions(self.isr_program())
+        timer = IntervalTimer(period_us=0.5)
+        timer.attach(proc)
+        proc.run(microseconds=10)
+        self.assertEqual(timer.period, 50)
+        # the expiry at 10 us is only seen by the next instruction
+        self.assertEqual(timer.expired, 19)
+        self.assertEqual(timer.missed, 0)
+        self.assertEqual(proc.memory.fetch_register("s1"), 19)
+        timer.detach()
+        self.assertEqual(set(vars(proc)) & {"execute", "set_interrupt_ack"}, set())
+
+
+class WatchpointTests(unittest.TestCase):
+    def setUp(self):
+        self.proc = Processor()
+        self.proc.set_instructions(build([("LOAD", ["s0", 0x00]), ("ADD", ["s0", 1]), ("STORE", ["s0", 0x10]),
+                                          ("CALL", [6]), ("OUTPUT", ["s0", 0x20]), ("JUMP", [1]),
+                                          ("FETCH", ["s1", 0x10]), ("RETURN", [])]))
+
+    def test_scratchpad_value_match(self):
+        watch = Watchpoints(self.proc)
+        watch.data(0x10, value=6)
+        result = self.proc.run(instructions=1000)
+        self.assertEqual(result.reason, RunResult.WATCHPOINT)
+        # stopped after the STORE that wrote 6
+        self.assertEqual(result.pc, 3)
+        self.assertEqual([(hit.pc, hit.access, hit.value) for hit in result.detail], [(2, Watchpoint.WRITE, 6)])
+        self.assertEqual(self.proc.memory.fetch_data(0x10), 6)
+        # the harness reading the watched row is not an access
+        self.assertEqual(len(watch.hits), 1)
+        # a read watchpoint on the same address hits on the FETCH of the subroutine
+        watch.data(0x10, Watchpoint.READ)
+        result = self.proc.run()
+        self.assertEqual((result.reason, result.pc, result.detail[0].pc), (RunResult.WATCHPOINT, 7, 6))
+
+    def test_registers_ports_and_stack(self):
+        watch = Watchpoints(self.proc)
+        watch.register("S1", Watchpoint.WRITE)
+        watch.port(0x20, value=2)
+        watch.stack(Watchpoint.READ)
+        reasons = []
+        for _ in range(0, 4):
+            result = self.proc.run(instructions=100)
+            reasons.append((result.pc, [(h.watchpoint.space, h.value) for h in result.detail]))
+        self.assertEqual(reasons, [(7, [(Watchpoint.REGISTER, 1)]), (4, [(Watchpoint.STACK, 3)]),
+                                   (7, [(Watchpoint.REGISTER, 2)]), (4, [(Watchpoint.STACK, 3)])])
+        result = self.proc.run(instructions=1)
+        self.assertEqual(result.detail[0].watchpoint.space, Watchpoint.PORT)
+        self.assertEqual(result.detail[0].cycle, self.proc.cycles - Processor.CLOCKS_PER_INSTRUCTION)
+        # stop=False only collects, execute() outside run raises StopRun
+        watch.stop = False
+        self.assertEqual(self.proc.run(instructions=20).reason, RunResult.INSTRUCTIONS)
+        watch.stop = True
+        with self.assertRaises(StopRun):
+            while True:
+                self.proc.execute()
+
+    def test_outputk_port(self):
+        proc = Processor()
+        proc.set_instructions(build([("OUTPUT", ["s0", 0x03]), ("OUTPUTK", [0x41, 0x3]), ("JUMP", [2])]))
+        watch = Watchpoints(proc)
+        watch.port(0x3, value=0x41)
+        result = proc.run(instructions=100)
+        self.assertEqual(result.reason, RunResult.WATCHPOINT)
+        self.assertEqual([(hit.pc, hit.access, hit.value) for hit in result.detail], [(1, Watchpoint.WRITE, 0x41)])
+        watch.close()
+        self.assertNotIn("set_k_write_strobe", vars(proc))
+
+    def test_disarmed_is_untouched(self):
+        plain = Processor()
+        plain.set_instructions(self.proc._instructions)
+        watch = Watchpoints(self.proc)
+        wp = watch.data(0x10, Watchpoint.ACCESS)
+        watch.register("s0")
+        watch.stack()
+        watch.port(0x20)
+        self.assertIsInstance(self.proc.memory.DATA_MEMORY[0x10], WatchedRow)
+        self.assertEqual(set(vars(self.proc.memory)) & {"push_stack", "pop_stack"}, {"push_stack", "pop_stack"})
+        watch.remove(wp)
+        self.assertNotIsInstance(self.proc.memory.DATA_MEMORY[0x10], WatchedRow)
+        watch.close()
+        self.assertEqual(set(vars(self.proc)) & {"execute", "set_read_strobe", "set_write_strobe"}, set())
+        self.assertEqual(set(vars(self.proc.memory)) & {"push_stack", "pop_stack"}, set())
+        self.assertTrue(all(type(row) is Memory.ArrayRow
+                            for row in list(self.proc.memory.REGISTERS.values()) + self.proc.memory.DATA_MEMORY))
+        self.proc.run(instructions=200)
+        plain.run(instructions=200)
+        self.assertEqual(self.proc.snapshot(), plain.snapshot())
+
+
+class HostProfilerTests(unittest.TestCase):
+    PROGRAM = [("ENABLE INTERRUPT", []), ("LOAD", ["s0", 0x00]), ("ADD", ["s0", 1]), ("STORE", ["s0", 0x10]),
+               ("OUTPUT", ["s0", 0x20]), ("INPUT", ["s1", 0x03]), ("XOR", ["s1", 0x0F]), ("JUMP", [2])]
+
+    def processor(self) -> Processor:
+        proc = Processor(isr_addr=0x20)
+        program = build(HostProfilerTests.PROGRAM)
+        program[0x20] = op.FlowOperation(op.FlowOperation.OPS["RETURNI ENABLE"], [])
+        proc.set_instructions(program)
+        return proc
+
+    def test_buckets(self):
+        proc = self.processor()
+        profiler = HostProfiler(proc, sample_every=1)
+        profiler.run(instructions=20)
+        proc.external.set_interrupt(True)
+        profiler.run(instructions=1)
+        proc.external.set_interrupt(False)
+        profiler.run(instructions=20)
+        names = set(profiler.buckets)
+        self.assertTrue({HostProfiler.FETCH, HostProfiler.IO, HostProfiler.INTERRUPT, HostProfiler.DISPATCH,
+                         "exec DataOperation input_", "exec FlowOperation return_i_enable"} <= names)
+        self.assertEqual((profiler.steps, profiler.samples), (41, 41))
+        # the buckets split the sampled time without overlapping
+        self.assertEqual(sum(bucket.ns for bucket in profiler.buckets.values()), profiler.sampled_ns)
+        report = json.loads(profiler.to_json())
+        self.assertAlmostEqual(sum(row["share"] for row in report["buckets"]), 100.0, delta=0.1)
+        self.assertIn("exec DataOperation input_", profiler.table())
+        profiler.detach()
+        self.assertEqual(set(vars(proc)) & {"fetch_program", "set_read_strobe", "enter_interrupt"}, set())
+
+    def test_outputk_is_io(self):
+        proc = Processor()
+        proc.set_instructions(build([("OUTPUTK", [0x41, 0x3]), ("JUMP", [0])]))
+        profiler = HostProfiler(proc, sample_every=1)
+        profiler.run(instructions=10)
+        # OUTPUTK is the only port access
+        self.assertIn(HostProfiler.IO, profiler.buckets)
+        self.assertGreater(profiler.buckets[HostProfiler.IO].ns, 0)
+        profiler.detach()
+        self.assertNotIn("set_k_write_strobe", vars(proc))
+
+    def test_same_run(self):
+        plain = self.processor()
+        expected = plain.run(instructions=3000)
+        proc = self.processor()
+        profiler = HostProfiler(proc, sample_every=16)
+        result = profiler.run(instructions=3000)
+        self.assertEqual((result.dispatches, result.cycles, result.reason), (3000, expected.cycles, expected.reason))
+        self.assertEqual(proc.snapshot(), plain.snapshot())
+        self.assertEqual(profiler.steps, 3000)
+        # roughly one step in sample_every is timed
+        self.assertTrue(3000 // 32 < profiler.samples < 3000 // 8)
+        self.assertEqual(profiler.run(cycles=7).cycles, 8)
+
+    def test_overhead(self):
+        def timed(profile: bool) -> float:
+            proc = self.processor()
+            runner = HostProfiler(proc) if profile else proc
+            start_time = time.perf_counter()
+            runner.run(instructions=20000)
+            return time.perf_counter() - start_time
+
+        # interleaved so a load spike on the machine hits both, medians so one slow run does not decide
+        runs = [(timed(False), timed(True)) for _ in range(0, 9)]
+        plain = statistics.median(run[0] for run in runs)
+        profiled = statistics.median(run[1] for run in runs)
+        print("--- host profiling overhead %5.1f%% ---" % (100.0 * (profiled - plain) / plain))
+        # the target is a few percent, the bound only catches profiling that got expensive
+        self.assertLess(profiled, plain * 1.5)
+
+
+class KCPSM6Tests(unittest.TestCase):
+    SOURCE = """
+start:      HWBUILD s5
+            LOAD s0, 00
+            LOAD s1, table
+            ADD s1, 02
+            CALL@ (s0, s1)          ; third table entry
+            OUTPUTK 41, 3
+            STAR s2, s4
+            REGBANK B
+            LOAD s3, 07
+            REGBANK A
+loop:       JUMP loop
+table:      LOAD&RETURN s4, 0A
+            LOAD&RETURN s4, 0B
+            LOAD&RETURN s4, 0C
+            LOAD&RETURN s6, 01
+"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, "kcpsm6.psm")
+        with open(path, "w") as f:
+            f.write(KCPSM6Tests.SOURCE)
+        assembler = Assembler(path)
+        assembler.parse()
+        self.program = assembler.convert()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_program(self):
+        proc = Processor(hwbuild=0x42)
+        proc.set_instructions(self.program)
+        strobes = []
+        set_k_write_strobe = proc.set_k_write_strobe
+
+        def k_write_strobe(val: bool):
+            set_k_write_strobe(val)
+            if val:
+                strobes.append((proc.p_port_id, proc.p_out_port, proc.external.write_strobe))
+
+        proc.set_k_write_strobe = k_write_strobe
+        proc.run(instructions=12)
+        mem = proc.memory
+        self.assertEqual(mem.fetch_register("s5"), 0x42)
+        self.assertEqual(mem.fetch_register("s4"), 0x0C)
+        self.assertEqual(strobes, [(3, 0x41, False)])
+        self.assertFalse(proc.external.k_write_strobe)
+        # REGBANK switches register files without copying, STAR writes across
+        self.assertEqual(mem.bank, 0)
+        self.assertEqual(mem.fetch_register("s3"), 0)
+        self.assertEqual(mem.banks[1]["s3"].value, 7)
+        self.assertEqual(mem.banks[1]["s2"].value, 0x0C)
+        self.assertEqual(mem.fetch_register("s2"), 0)
+
+    def test_hwbuild_flags(self):
+        for hwbuild, zero in ((0x42, False), (0x00, True)):
+            proc = Processor(hwbuild=hwbuild)
+            proc.set_instructions({0: self.program[0]})
+            proc.execute()
+            self.assertEqual((proc.external.carry, proc.external.zero), (True, zero))
+
+    def test_tables(self):
+        tables = [instr.table for instr in self.program.values() if isinstance(instr, op.TableOperation)]
+        self.assertEqual([(t.start, t.register, t.data) for t in tables if t is not None][::3],
+                         [(11, "s4", b"\x0a\x0b\x0c"), (14, "s6", b"\x01")])
+        unlinked = {a: op.TableOperation(i.operator, [i.register, i.value]) if isinstance(i, op.TableOperation)
+                    else i for a, i in self.program.items()}
+        linked, plain = Processor(), Processor()
+        linked.set_instructions(self.program)
+        plain.set_instructions(unlinked)
+        served = linked.run(cycles=40)
+        dispatched = plain.run(cycles=40)
+        # CALL@ served the LOAD&RETURN from the table, charging both instructions
+        self.assertEqual(served.cycles, dispatched.cycles)
+        self.assertEqual(served.dispatches + 1, dispatched.dispatches)
+        self.assertEqual(linked.snapshot(), plain.snapshot())
+
+    def test_jump_at(self):
+        proc = Processor()
+        proc.set_instructions(build([("LOAD", ["s0", 0xF1]), ("LOAD", ["s1", 0x02]), ("JUMP@", ["s0", "s1"])]))
+        proc.run(instructions=3)
+        # the lower nibble of sX is the high part of the address
+        self.assertEqual(proc.manager.pc, 0x102)
+
+    def test_snapshot_bank_b(self):
+        proc = Processor()
+        proc.set_instructions(self.program)
+        proc.run(instructions=9)
+        self.assertEqual(proc.memory.bank, 1)
+        other = Processor()
+        self.assertIsNone(other.memory.banks[1])
+        other.restore(proc.snapshot())
+        self.assertEqual(other.memory.bank, 1)
+        self.assertEqual(other.memory.fetch_register("s3"), 7)
+        self.assertEqual(other.memory.banks[0]["s4"].value, 0x0C)
+        self.assertEqual(other.snapshot(), proc.snapshot())
+        fresh = Processor()
+        fresh.restore(Processor().snapshot())
+        self.assertIsNone(fresh.memory.banks[1])
+
+
+class IncrementalAssemblerTests(unittest.TestCase):
+    LIB = """CONSTANT step, 02
+CONSTANT port, 10
+bump:       ADD s0, step
+            OUTPUT s0, port
+            RETURN
+"""
+    MAIN = """INCLUDE "lib/util.psm"
+start:      LOAD s0, 00
+loop:       CALL bump
+            LOAD s1, 05
+            JUMP loop
+"""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.dir.name, "lib"))
+        self.lib = self.write("lib/util.psm", IncrementalAssemblerTests.LIB)
+        self.main = self.write("main.psm", IncrementalAssemblerTests.MAIN)
+        self.assembler = Assembler(self.main)
+        self.assembler.parse()
+        self.program = self.assembler.convert()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, name: str, text: str) -> str:
+        path = os.path.join(self.dir.name, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_include(self):
+        self.assertEqual(len(self.program), 7)
+        self.assertEqual(self.assembler.tag_addresses, {"bump": 0, "start": 3, "loop": 4})
+        self.assertEqual(self.assembler.files[self.main].includes, [os.path.normpath(self.lib)])
+        proc = Processor()
+        proc.set_instructions(dict(self.program))
+        proc.manager.jump(3)
+        proc.run(instructions=5)
+        self.assertEqual(proc.memory.fetch_register("s0"), 0x02)
+        self.assertEqual(proc.p_port_id, 0x10)
+
+    def test_include_loop(self):
+        self.write("lib/util.psm", 'INCLUDE "../main.psm"\n')
+        with self.assertRaises(ParseError):
+            Assembler(self.main).parse()
+
+    def test_noop(self):
+        self.assertEqual(self.assembler.reassemble(), ({}, []))
+        self.assertEqual((self.assembler.decoded, self.assembler.resolved), (0, 0))
+
+    def test_edit_line(self):
+        proc = Processor()
+        proc.set_instructions(dict(self.program))
+        proc.manager.jump(3)
+        proc.run(instructions=4)
+        self.assembler.set_source(self.main, IncrementalAssemblerTests.MAIN.replace("LOAD s1, 05", "LOAD s1, 07"))
+        changes, removed = self.assembler.reassemble()
+        # only the edited line is decoded and resolved again
+        self.assertEqual((self.assembler.decoded, self.assembler.resolved), (1, 1))
+        self.assertEqual((list(changes), removed), ([5], []))
+        proc.patch(changes, removed)
+        proc.run(instructions=5)
+        self.assertEqual(proc.memory.fetch_register("s1"), 0x07)
+        self.assertEqual(proc.memory.fetch_register("s0"), 0x04)
+
+    def test_constant_change(self):
+        # the include changed on disk, only lines naming the constant are resolved again
+        time.sleep(0.01)
+        self.write("lib/util.psm", IncrementalAssemblerTests.LIB.replace("step, 02", "step, 03"))
+        changes, removed = self.assembler.reassemble()
+        self.assertEqual((self.assembler.decoded, self.assembler.resolved), (1, 1))
+        self.assertEqual(list(changes), [0])
+        self.assertIs(self.assembler.operations[4], self.program[4])
+
+    def test_moved_lines(self):
+        self.assembler.set_source(self.main, IncrementalAssemblerTests.MAIN.replace("start:", "NOP: LOAD s2, 01\nstart:"))
+        changes, removed = self.assembler.reassemble()
+        self.assertEqual(self.assembler.tag_addresses["loop"], 5)
+        # the lines after the insert moved but only the JUMP to a moved tag was resolved again
+        self.assertEqual((self.assembler.decoded, self.assembler.resolved), (1, 2))
+        self.assertEqual(removed, [])
+        self.assertIs(self.assembler.operations[4], self.program[3])
+        # same program as assembling the edited text from scratch
+        fresh = Assembler(self.main)
+        fresh.set_source(self.main, IncrementalAssemblerTests.MAIN.replace("start:", "NOP: LOAD s2, 01\nstart:"))
+        fresh.parse()
+
+        def signature(instr: op.Instruction) -> tuple:
+            return (instr.__class__,) + tuple(getattr(instr, slot) for slot in instr.__class__.__slots__)
+
+        self.assertEqual({a: signature(i) for a, i in fresh.convert().items()},
+                         {a: signature(i) for a, i in self.assembler.operations.items()})
+
+
+class PublisherTests(unittest.TestCase):
+    def processor(self) -> Processor:
+        proc = Processor()
+        proc.set_instructions(build([("LOAD", ["s0", 0x00]), ("ADD", ["s0", 1]), ("STORE", ["s0", 0x08]),
+                                     ("OUTPUT", ["s0", 0x05]), ("JUMP", [1])]))
+        return proc
+
+    @staticmethod
+    def receive(sock: socket.socket) -> bytes:
+        def exactly(n: int) -> bytes:
+            data = b""
+            while len(data) < n:
+                chunk = sock.recv(n - len(data))
+                if not chunk:
+                    raise ConnectionError("closed")
+                data += chunk
+            return data
+
+        length, = StateFormat.LENGTH.unpack(exactly(StateFormat.LENGTH.size))
+        return exactly(length)
+
+    def test_deltas(self):
+        proc = self.processor()
+        display = SevenSegmentDisplay()
+        publisher = StatePublisher(proc, display=display)
+        viewer = StateViewer()
+        viewer.apply(publisher.hello())
+        sizes = []
+
+        def received(message: bytes):
+            viewer.apply(message)
+            sizes.append(len(message))
+
+        publisher.subscribe(received)
+        for _ in range(5):
+            proc.run(instructions=7)
+            display.segments[1].cathodes["a"] = not display.segments[1].cathodes["a"]
+            publisher.frame(force=True)
+            self.assertEqual(bytes(viewer.image), publisher.image())
+        self.assertEqual(viewer.pc, proc.manager.pc)
+        self.assertEqual(viewer.register("s0"), proc.memory.fetch_register("s0"))
+        self.assertEqual(viewer.field("outputs")[5], proc.p_out_port)
+        self.assertEqual(viewer.cycles, proc.cycles)
+        # the first frame is full, the rest only carry the few bytes that changed
+        self.assertEqual(sizes[0], StateFormat.HEADER.size + publisher.size)
+        self.assertTrue(all(size < 40 for size in sizes[1:]))
+        self.assertEqual(publisher.frames, 5)
+
+    def test_throttle(self):
+        proc = self.processor()
+        publisher = StatePublisher(proc, fps=5)
+        self.assertIsNotNone(publisher.frame())
+        proc.run(instructions=4)
+        self.assertIsNone(publisher.frame())
+        time.sleep(0.21)
+        self.assertIsNotNone(publisher.frame())
+        # nothing changed, nothing to send
+        self.assertIsNone(publisher.frame(force=True))
+        frames = publisher.frames
+        start_time = time.perf_counter()
+        result = publisher.run(instructions=20000)
+        elapsed = time.perf_counter() - start_time
+        self.assertEqual(result.dispatches, 20000)
+        self.assertLessEqual(publisher.frames - frames, elapsed * 5 + 3)
+        publisher.detach()
+        self.assertEqual(set(vars(proc)) & {"set_write_strobe", "set_k_write_strobe"}, set())
+
+    def test_tcp(self):
+        proc = self.processor()
+        publisher = StatePublisher(proc, fps=1000)
+        with StateServer(publisher) as server:
+            sock = socket.create_connection(server.address)
+            viewer = StateViewer()
+            for _ in range(2):
+                viewer.apply(self.receive(sock))
+            self.assertEqual(viewer.fields["registers"][1], Memory.NUM_REGISTERS)
+            while not len(server.clients):
+                time.sleep(0.001)
+            publisher.run(instructions=50)
+            while viewer.frame < publisher.frames:
+                viewer.apply(self.receive(sock))
+            self.assertEqual(bytes(viewer.image), publisher.image())
+            sock.close()
+
+    def test_websocket_resync(self):
+        proc = self.processor()
+        publisher = StatePublisher(proc)
+        # no backlog at all: every frame reaches the viewer as a full frame of the latest state
+        with StateServer(publisher, protocol=StateServer.WEBSOCKET, max_backlog=0) as server:
+            sock = socket.create_connection(server.address)
+            sock.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                         b"Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n")
+            response = b""
+            while b"\r\n\r\n" not in response:
+                response += sock.recv(1)
+            self.assertIn(b"Sec-WebSocket-Accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=", response)
+            while not len(server.clients):
+                time.sleep(0.001)
+            proc.run(instructions=9)
+            publisher.frame(force=True)
+            viewer = StateViewer()
+            while viewer.image is None or viewer.frame < publisher.frames:
+                opcode, length = sock.recv(2)
+                self.assertEqual(opcode, 0x82)
+                if length == 126:
+                    length, = struct.unpack("!H", sock.recv(2))
+                data = b""
+                while len(data) < length:
+                    data += sock.recv(length - len(data))
+                self.assertNotEqual(data[0], StateFormat.DELTA)
+                viewer.apply(data)
+            self.assertEqual(viewer.register("s0"), proc.memory.fetch_register("s0"))
+            sock.close()
+
+    def test_resync_order(self):
+        proc = self.processor()
+        publisher = StatePublisher(proc)
+        with StateServer(publisher, max_backlog=2) as server:
+            ours, theirs = socket.socketpair()
+            # a viewer whose sender has not run yet while four frames are published
+            client = _Client(server, ours)
+            with publisher.lock:
+                client.queue.append(publisher.keyframe())
+                server.clients.append(client)
+            for _ in range(4):
+                proc.run(instructions=3)
+                publisher.frame(force=True)
+            client.thread.start()
+            viewer = StateViewer()
+            while viewer.frame < publisher.frames:
+                viewer.apply(self.receive(theirs))
+            # whatever was queued before the viewer caught up is on its way, the next frame follows it
+            while len(client.queue):
+                time.sleep(0.001)
+            proc.run(instructions=3)
+            publisher.frame(force=True)
+            while viewer.frame < publisher.frames:
+                viewer.apply(self.receive(theirs))
+            self.assertEqual(bytes(viewer.image), publisher.image())
+            theirs.close()
+
+
+class AnalyticsTests(unittest.TestCase):
+    def test_ports(self):
+        proc = Processor()
+        proc.set_instructions(build([("LOAD", ["s0", 0x00]), ("XOR", ["s0", 0x01]), ("OUTPUT", ["s0", 0x05]),
+                                     ("INPUT", ["s1", 0x03]), ("JUMP", [1])]))
+        analytics = PortAnalytics(proc)
+        proc.run(instructions=1 + 4 * 100)
+        self.assertEqual((analytics.writes[5], analytics.reads[3]), (100, 100))
+        port = analytics.port(5)
+        self.assertEqual(port["write_values"], {"0": 50, "1": 50})
+        self.assertEqual(port["write_interval"]["count"], 99)
+        self.assertEqual((port["write_interval"]["min"], port["write_interval"]["max"]), (8, 8))
+        self.assertEqual(port["write_interval"]["log2"], {"16": 99})
+        self.assertEqual(analytics.port(3)["read_values"], {"0": 100})
+        # bit 0 toggles every write, held for 8 cycles each time
+        first = analytics.first_write[5]
+        self.assertEqual(analytics.duty_cycles(5, first + 800), [0.5] + [0.0] * 7)
+        report = json.loads(analytics.to_json())
+        self.assertEqual([p["port_id"] for p in report["ports"]], [3, 5])
+        self.assertIsNone(report["interrupt_latency"])
+        analytics.detach()
+        self.assertEqual(set(vars(proc)) & {"set_write_strobe", "set_read_strobe", "enter_interrupt"}, set())
+        self.assertNotIn("set_interrupt", vars(proc.external))
+
+    def test_interrupts(self):
+        proc = Processor(isr_addr=0x20)
+        proc.set_instructions(TimingTests.isr_program())
+        analytics = PortAnalytics(proc)
+        for _ in range(3):
+            proc.run(instructions=5)
+            proc.external.set_interrupt(True)
+            proc.execute()
+            proc.external.set_interrupt(False)
+            proc.run(instructions=1)
+        latency = analytics.interrupts.report(PortAnalytics.LATENCY)
+        isr = analytics.interrupts.report(PortAnalytics.ISR)
+        self.assertEqual((latency["count"], latency["min"], latency["max"]), (3, Processor.INTERRUPT_RESPONSE_CLOCKS,
+                                                                                Processor.INTERRUPT_RESPONSE_CLOCKS))
+        # the ADD and the RETURNI
+        self.assertEqual((isr["count"], isr["mean"]), (3, 2 * Processor.CLOCKS_PER_INSTRUCTION))
+        self.assertEqual(proc.memory.fetch_register("s1"), 3)
+
+
+class RenderTests(unittest.TestCase):
+    PATTERNS = [0x3F, 0x06, 0x5B, 0x4F]
+
+    @staticmethod
+    def multiplexed(rounds: int = 3):
+        """digits 0-3 enabled in turn on port 1 with their active low pattern on port 2, LEDs on port 3"""
+        records = []
+        cycle = 0
+        for n in range(rounds):
+            for digit, pattern in enumerate(RenderTests.PATTERNS):
+                records.append((cycle, 1, ~(1 << digit) & 0xFF))
+                records.append((cycle + 2, 2, ~pattern & 0xFF))
+                cycle += 100
+            records.append((cycle, 3, n))
+        return PortTrace.from_records(records)
+
+    def test_sample(self):
+        board = Board(2, 1, led_ports=[3], digits=4)
+        at, segments, leds = board.sample(self.multiplexed(), 50)
+        self.assertEqual(segments.shape, (len(at), 4, 8))
+        last = segments[-1]
+        for digit, pattern in enumerate(RenderTests.PATTERNS):
+            self.assertEqual(sum(int(lit) << bit for bit, lit in enumerate(last[digit])), pattern)
+        self.assertEqual(list(leds[-1]), [False, True] + [False] * 6)
+        # nothing lit before the first pattern, only digit 0 once it is written
+        self.assertFalse(segments[0].any())
+        self.assertTrue(segments[1, 0].any() and not segments[1, 1:].any())
+        # digits fade once they have not been refreshed for longer than the persistence
+        _, faded, _ = board.sample(self.multiplexed(), 50, persistence=150)
+        self.assertFalse(faded[-1, :3].any())
+        self.assertTrue(faded[-1, 3].any())
+
+    def test_render(self):
+        board = Board(2, 1, led_ports=[3], digits=4)
+        _, segments, leds = board.sample(self.multiplexed(), 10)
+        renderer = Renderer(scale=1)
+        frames = renderer.render(segments, leds)
+        width, height = Renderer.CELL
+        self.assertEqual(frames.shape, (len(segments), height + Renderer.LED_CELL[1], 4 * width, 3))
+        # the rightmost digit is digit 0, its g segment is off and its a segment lit
+        x0, y0, x1, y1 = Renderer.RECTS["a"]
+        digit0 = frames[-1, :height, 3 * width:]
+        self.assertEqual(tuple(digit0[y0, x0]), Renderer.ON)
+        x0, y0, x1, y1 = Renderer.RECTS["g"]
+        self.assertEqual(tuple(digit0[y0, x0]), Renderer.OFF)
+        self.assertEqual(renderer.render(segments[:0], leds[:0]).shape[0], 0)
+
+    def test_png(self):
+        board = Board(2, 1, digits=4)
+        _, segments, leds = board.sample(self.multiplexed(), 10)
+        frames = Renderer(scale=1).render(segments, leds)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "frame.png")
+            write_png(path, frames[-1])
+            with open(path, "rb") as f:
+                data = f.read()
+            self.assertTrue(data.startswith(PNG_SIGNATURE))
+            length, = struct.unpack(">I", data[33:37])
+            self.assertEqual(data[37:41], b"IDAT")
+            rows = zlib.decompress(data[41:41 + length])
+            height, width = frames.shape[1:3]
+            self.assertEqual(rows, b"".join(b"\x00" + frames[-1, y].tobytes() for y in range(height)))
+            self.assertEqual(struct.unpack(">II", data[16:24]), (width, height))
+            # identical consecutive frames merge into one
+            written = write_apng(os.path.join(tmp, "frames.png"), frames)
+            changes = 1 + sum((frames[n] != frames[n - 1]).any() for n in range(1, len(frames)))
+            self.assertEqual(written, changes)
+            self.assertLess(written, len(frames))
+
+
+class AnalysisTests(unittest.TestCase):
+    PROGRAM = """
+start:  LOAD s0, 00
+        ENABLE INTERRUPT
+main:   CALL delay
+        OUTPUT s0, 05
+        DISABLE INTERRUPT
+        ADD s0, 01
+        ENABLE INTERRUPT
+        JUMP main
+delay:  LOAD s1, 0A
+outer:  LOAD s2, 03
+inner:  SUB s2, 01
+        COMPARE s2, 00
+        JUMP NZ, inner      ; @loop 3
+        SUB s1, 01
+        COMPARE s1, 00
+        ; the outer loop runs ten times
+        JUMP NZ, outer      ; @loop 10
+        RETURN
+isr:    ADD s3, 01
+        RETURNI ENABLE
+"""
+
+    def analyzer(self, text: str, isr: str = "isr") -> StaticAnalyzer:
+        assembler = Assembler(os.path.join(tempfile.gettempdir(), "analysis.psm"))
+        assembler.set_source(assembler.path, text)
+        assembler.parse()
+        assembler.convert()
+        return StaticAnalyzer.from_assembler(assembler, assembler.tag_addresses.get(isr, 0x3FF))
+
+    def test_bounds_hold(self):
+        analyzer = self.analyzer(AnalysisTests.PROGRAM)
+        delay = analyzer.subroutine(analyzer.main().calls.pop())
+        self.assertEqual((delay.name, delay.problems, delay.depth), ("delay", [], 0))
+        self.assertEqual((delay.best, delay.worst), (18, 356))
+        self.assertIn("never returns", analyzer.main().problems)
+        analyzer = self.analyzer("start: CALL wait\ndone: JUMP done\nwait: LOAD s2, 05\nspin: SUB s2, 01\n"
+                                 "COMPARE s2, 00\nJUMP NZ, spin ; @loop 5\nRETURN\n")
+        wait = analyzer.subroutine(2)
+        proc = Processor()
+        proc.set_instructions(analyzer.operations)
+        proc.run(instructions=1)
+        start = proc.cycles
+        while proc.manager.pc != 1:
+            proc.execute()
+        # the loop tests at the bottom, so it is charged one iteration more than it runs
+        self.assertEqual((wait.best, proc.cycles - start, wait.worst), (10, 34, 40))
+
+    def test_stack_and_latency(self):
+        analyzer = self.analyzer(AnalysisTests.PROGRAM)
+        report = json.loads(analyzer.to_json())
+        # main calls delay, an interrupt pushes one more row
+        self.assertEqual((report["max_stack_depth"], report["stack_ok"]), (2, True))
+        latency = report["interrupt_latency"]
+        # the DISABLE INTERRUPT, ADD and ENABLE INTERRUPT window is longer than the ISR
+        self.assertEqual(latency["isr"], 4)
+        self.assertEqual(latency["worst"], 6 + Processor.INTERRUPT_RESPONSE_CLOCKS)
+
+    def test_unbounded(self):
+        analyzer = self.analyzer(AnalysisTests.PROGRAM.replace("; @loop 3", ""))
+        report = analyzer.report()
+        delay, = report["subroutines"]
+        self.assertIsNone(delay["worst"])
+        self.assertEqual(delay["best"], 18)
+        self.assertEqual(delay["problems"], ["loop at inner has no @loop bound"])
+        self.assertIsNone(report["main"]["worst"])
+        # the interrupt latency does not depend on the unbounded subroutine
+        self.assertEqual(report["interrupt_latency"]["worst"], 6 + Processor.INTERRUPT_RESPONSE_CLOCKS)
+
+    def test_recursion(self):
+        analyzer = self.analyzer("start: CALL first\nfirst: CALL second\nRETURN\nsecond: CALL Z, first\nRETURN\n")
+        self.assertIsNone(analyzer.max_stack_depth())
+        self.assertFalse(analyzer.report()["stack_ok"])
+        self.assertTrue(any(p.startswith("recursive call") for sub in analyzer.subroutines.values()
+                            for p in sub.problems))
+
+    def test_targets(self):
+        text = """
+start:  LOAD s0, 00
+        LOAD s1, 20
+        CALL@ (s0, s1)      ; @targets table
+        CALL@ (s0, s1)
+        JUMP start
+        ADDRESS 020
+table:  LOAD&RETURN s4, 0A
+        LOAD&RETURN s4, 0B
+"""
+        analyzer = self.analyzer(text)
+        self.assertEqual(analyzer.targets, {2: [5]})
+        main = analyzer.main()
+        self.assertEqual(main.problems, ["CALL@ at 0x003 has no @targets", "never returns"])
+        self.assertEqual(analyzer.subroutine(5).worst, Processor.CLOCKS_PER_INSTRUCTION)
+
+
+class FaultTests(unittest.TestCase):
+    PROGRAM = """
+start:  LOAD s0, 00
+loop:   ADD s0, 01
+        OUTPUT s0, 05
+        CALL work
+        JUMP loop
+work:   LOAD s1, s0
+        RETURN
+"""
+
+    def campaign(self, **kwargs) -> Campaign:
+        assembler = Assembler(os.path.join(tempfile.gettempdir(), "faults.psm"))
+        assembler.set_source(assembler.path, self.PROGRAM)
+        assembler.parse()
+        return Campaign(assembler.convert(), 2000, checkpoint_every=200, **kwargs)
+
+    def test_golden_run(self):
+        campaign = self.campaign(processes=1)
+        self.assertEqual(campaign.end, 2000)
+        self.assertEqual(campaign.writes[:3], [(4, 5, 1), (16, 5, 2), (28, 5, 3)])
+        self.assertEqual([c.cycle for c in campaign.checkpoints], list(range(0, 2001, 200)))
+
+    def test_outcomes(self):
+        campaign = self.campaign(processes=1)
+        corrupted = campaign.inject(Fault(100, Fault.REGISTER, "s0", 0x01))
+        self.assertEqual(corrupted.kind, Outcome.SDC)
+        self.assertEqual(corrupted.cycle, 100)
+        # s1 is reloaded before it is read, the run is back on the golden state at the next checkpoint
+        converged = campaign.inject(Fault(101, Fault.REGISTER, "s1", 0x01))
+        self.assertEqual((converged.kind, converged.cycle, converged.detail), (Outcome.MASKED, 200, "converged"))
+        latent = campaign.inject(Fault(100, Fault.REGISTER, "s5", 0x04))
+        self.assertEqual((latent.kind, latent.detail), (Outcome.MASKED, "latent"))
+        # 0x00C is past the program
+        self.assertEqual(campaign.inject(Fault(100, Fault.PC, 0, 0x08)).kind, Outcome.HANG)
+        with self.assertRaises(ValueError):
+            Fault(0, Fault.REGISTER, "s0", 0x100)
+
+    def test_checkpoints_do_not_change_outcomes(self):
+        faults = self.campaign(processes=1).random_faults(60, seed=5)
+        coarse = Campaign(self.campaign().program, 2000, checkpoint_every=5000, processes=1)
+        fine = self.campaign(processes=1)
+        for c, f in zip(coarse.run(faults), fine.run(faults)):
+            if "converged" in (c.detail, f.detail) or "latent" in (c.detail, f.detail):
+                self.assertEqual((c.kind, f.kind), (Outcome.MASKED, Outcome.MASKED))
+            else:
+                self.assertEqual(c.to_dict(), f.to_dict())
+
+    def test_process_pool(self):
+        serial = self.campaign(processes=1)
+        faults = serial.random_faults(40, seed=11, bits=2)
+        parallel = self.campaign(processes=2)
+        self.assertEqual([o.to_dict() for o in parallel.run(faults)], [o.to_dict() for o in serial.run(faults)])
+        summary = Campaign.summary(serial.run(faults))
+        self.assertEqual(summary["injections"], 40)
+        self.assertEqual(sum(summary["outcomes"].values()), 40)
+
+    def test_stimulus(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            stim = os.path.join(tmp, "stim.bin")
+            with StimulusWriter(stim) as writer:
+                for cycle in range(0, 2000, 50):
+                    writer.in_port(cycle, 0x01, cycle // 50)
+            program = build([("INPUT", ["s0", 0x01]), ("OUTPUT", ["s0", 0x05]), ("JUMP", [0])])
+            campaign = Campaign(program, 2000, stimulus=stim, checkpoint_every=300, processes=1)
+            self.assertEqual(sorted(set(v for _, _, v in campaign.writes)), list(range(0, 40)))
+            # INPUT overwrites s0 on every pass, restoring a checkpoint must pick the stimulus up where it was
+            for cycle in (0, 300, 306, 1236):
+                outcome = campaign.inject(Fault(cycle, Fault.REGISTER, "s0", 0x01))
+                self.assertEqual((outcome.kind, outcome.detail), (Outcome.MASKED, "converged"))
+            self.assertEqual(campaign.inject(Fault(302, Fault.REGISTER, "s0", 0x01)).kind, Outcome.SDC)
+
+
+class CheckpointTests(unittest.TestCase):
+    PROGRAM = """
+start:  ENABLE INTERRUPT
+loop:   INPUT s0, 01
+        ADD s1, s0
+        STORE s1, 10
+        OUTPUT s1, 02
+        CALL work
+        JUMP loop
+work:   LOAD s3, s1
+        RETURN
+isr:    ADD s2, 01
+        OUTPUT s2, 03
+        RETURNI ENABLE
+"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "run.ckpt")
+        self.stim = os.path.join(self.tmp.name, "run.stim")
+        with StimulusWriter(self.stim) as writer:
+            for cycle in range(0, 40000, 7):
+                writer.in_port(cycle, 0x01, cycle // 7)
+                if cycle % 500 < 7:
+                    writer.interrupt(cycle, True)
+                    writer.interrupt(cycle + 1, False)
+        assembler = Assembler(os.path.join(self.tmp.name, "run.psm"))
+        assembler.set_source(assembler.path, self.PROGRAM)
+        assembler.parse()
+        self.program = assembler.convert()
+        self.digest = program_digest(self.program)
+        self.isr = assembler.tag_addresses["isr"]
+        self.players = []
+
+    def tearDown(self):
+        for player in self.players:
+            player.close()
+        self.tmp.cleanup()
+
+    def processor(self) -> tuple:
+        proc = Processor(isr_addr=self.isr)
+        proc.set_instructions(self.program)
+        writes = StimulusTests.record_writes(proc)
+        player = StimulusPlayer(self.stim)
+        player.attach(proc)
+        self.players.append(player)
+        return proc, player, writes
+
+    def test_resume_is_bit_identical(self):
+        reference, _, expected = self.processor()
+        reference.run(cycles=30000)
+        proc, player, _ = self.processor()
+        checkpointer = Checkpointer(proc, self.path, every_cycles=3000, digest=self.digest, player=player)
+        execute = proc.execute
+
+        def preempted():
+            if proc.cycles >= 10001:
+                raise KeyboardInterrupt()
+            execute()
+
+        proc.execute = preempted
+        with self.assertRaises(KeyboardInterrupt):
+            checkpointer.run(cycles=30000)
+        checkpointer.close()
+        self.assertEqual(checkpointer.written + checkpointer.superseded, 3)
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+        resumed, player, writes = self.processor()
+        checkpointer = Checkpointer(resumed, self.path, every_seconds=0.01, digest=self.digest, player=player)
+        self.assertEqual(checkpointer.resume(), {})
+        self.assertEqual(resumed.cycles, 9000)
+        start = resumed.cycles
+        checkpointer.run(cycles=30000 - start)
+        checkpointer.close()
+        self.assertEqual(resumed.snapshot(), reference.snapshot())
+        self.assertEqual(writes, [w for w in expected if w[0] >= start])
+        self.assertIn(0x03, [port for _, port, _ in writes])
+        self.assertEqual(Checkpoint.load(self.path).cycles, 30000)
+
+    def test_format(self):
+        proc, _, _ = self.processor()
+        proc.run(cycles=1234)
+        checkpoint = Checkpoint(proc.snapshot(), 617, extras={"port_writes": 3})
+        data = checkpoint.to_bytes()
+        loaded = Checkpoint.from_bytes(data)
+        self.assertEqual((loaded.snapshot, loaded.dispatches, loaded.extras),
+                         (proc.snapshot(), 617, {"port_writes": 3}))
+        corrupt = bytearray(data)
+        corrupt[-1] ^= 0xFF
+        newer = CheckpointFormat.HEADER.pack(CheckpointFormat.MAGIC, CheckpointFormat.VERSION + 1, 0, 0, 0, 0)
+        for bad in (bytes(corrupt), newer, b"PSTM", data[:CheckpointFormat.HEADER.size] + b"x"):
+            with self.assertRaises(ValueError):
+                Checkpoint.from_bytes(bad)
+        checkpoint.save(self.path)
+        other = dict(self.program)
+        other[0] = op.DataOperation(op.DataOperation.OPS["LOAD"], ["s0", 0x01])
+        with self.assertRaises(ValueError):
+            Checkpointer(proc, self.path, digest=program_digest(other)).resume()
+
+
+class SweepTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.echo = self.assemble("start: INPUT s0, 01\nADD s1, s0\nOUTPUT s1, 02\nJUMP start\n")
+        self.count = self.assemble("start: ADD s1, 03\nOUTPUT s1, 04\nJUMP start\n")
+        self.stim = os.path.join(self.tmp.name, "sweep.stim")
+        with StimulusWriter(self.stim) as writer:
+            for cycle in range(0, 100000, 13):
+                writer.in_port(cycle, 0x01, cycle & 0xFF)
+        self.coordinator = SweepCoordinator(timeout=10)
+        self.workers = []
+
+    def tearDown(self):
+        self.coordinator.close()
+        for worker in self.workers:
+            worker.wait(timeout=30)
+        self.tmp.cleanup()
+
+    def assemble(self, text: str) -> dict:
+        assembler = Assembler(os.path.join(self.tmp.name, "sweep.psm"))
+        assembler.set_source(assembler.path, text)
+        assembler.parse()
+        return assembler.convert()
+
+    def worker(self, *args: str):
+        address = "%s:%d" % tuple(self.coordinator.address)
+        self.workers.append(subprocess.Popen([sys.executable, "-m", "picosim", "worker", address] + list(args),
+                                             cwd=StartupTests.ROOT, stderr=subprocess.DEVNULL))
+
+    def test_matches_local_runs(self):
+        coordinator = self.coordinator
+        programs = {coordinator.add_program(self.echo): self.echo, coordinator.add_program(self.count): self.count}
+        echo, count = list(programs)
+        stimulus = coordinator.add_stimulus(self.stim)
+        for idx in range(0, 12):
+            if idx % 2:
+                coordinator.submit(echo, cycles=20000, stimulus=stimulus, start=idx * 5000)
+            else:
+                coordinator.submit(count, instructions=5000 + idx)
+        coordinator.start()
+        # a node that takes jobs and dies, they are run again elsewhere
+        flaky = socket.create_connection(coordinator.address)
+        send_frame(flaky, SweepFormat.HELLO, json.dumps({"name": "flaky", "cores": 2, "programs": [],
+                                                         "stimuli": []}).encode())
+        while recv_frame(flaky)[0] != SweepFormat.JOB:
+            pass
+        flaky.close()
+        self.worker("--processes", "2")
+        self.worker("--processes", "2")
+        results = coordinator.wait(timeout=120)
+        self.assertEqual(coordinator.workers_lost, 1)
+        self.assertTrue(any(r.attempts == 2 for r in results))
+        for result in results:
+            job = coordinator.jobs[result.id]
+            local = execute_job(programs[job["program"]], job, self.stim if job["stimulus"] else None)
+            self.assertEqual(result.outcome(), local.outcome())
+            self.assertNotEqual(result.worker, "flaky")
+        self.assertEqual(results[1].cycles, 5000 + 20000)
+        # programs and the stimulus file went to each node once, if it ran a job needing them
+        for node in coordinator.nodes:
+            if node["name"] == "flaky":
+                continue
+            jobs = [coordinator.jobs[r.id] for r in results if r.worker == node["name"]]
+            self.assertEqual((node["programs"], node["stimuli"]),
+                             (len({job["program"] for job in jobs}), len({job["stimulus"] for job in jobs} - {None})))
+
+    def test_cache_and_errors(self):
+        cache = os.path.join(self.tmp.name, "cache")
+        coordinator = self.coordinator
+        program = coordinator.add_program(self.count)
+        underflow = coordinator.add_program(self.assemble("RETURN\n"))
+        coordinator.submit(program, cycles=100)
+        coordinator.submit(underflow, cycles=100)
+        self.worker("--processes", "1", "--cache", cache)
+        results = coordinator.wait(timeout=60)
+        self.assertIsNone(results[0].error)
+        # a job that raises is reported, not retried
+        self.assertIn("Stack underflow", results[1].error)
+        self.assertEqual(results[1].attempts, 1)
+        coordinator.submit(program, cycles=200)
+        self.worker("--processes", "1", "--cache", cache)
+        self.assertEqual(coordinator.wait(timeout=60)[2].cycles, 200)
+        # the restarted node still had the program
+        self.assertEqual(coordinator.nodes[-1]["programs"], 0)
+
+    def test_heartbeat(self):
+        # jobs running several times longer than the timeout, the node stays connected on heartbeats alone
+        coordinator = SweepCoordinator(timeout=0.5)
+        try:
+            program = coordinator.add_program(self.count)
+            for _ in range(0, 2):
+                coordinator.submit(program, instructions=300000)
+            address = "%s:%d" % tuple(coordinator.address)
+            self.workers.append(subprocess.Popen([sys.executable, "-m", "picosim", "worker", address, "--processes",
+                                                  "1", "--heartbeat", "0.1"], cwd=StartupTests.ROOT,
+                                                 stderr=subprocess.DEVNULL))
+            results = coordinator.wait(timeout=120)
+            self.assertEqual([(r.error, r.attempts, r.dispatches) for r in results], [(None, 1, 300000)] * 2)
+            self.assertGreater(min(r.seconds for r in results), coordinator.timeout)
+            self.assertEqual(coordinator.workers_lost, 0)
+        finally:
+            coordinator.close()
+
+
 if __name__ == '__main__':
     unittest.main()
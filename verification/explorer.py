@@ -0,0 +1,197 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import hashlib
+from collections import deque
+from typing import List, Dict, Callable, Iterable, Tuple, Optional, Set
+
+import ops.operations as op
+from system.memory import Memory
+from system.processor import Processor
+
+# in_port value driven for the step (None when the instruction is not an INPUT), interrupt pulsed for the step
+Choice = Tuple[Optional[int], bool]
+Assertion = Callable[[Processor], bool]
+
+
+class Finding(object):
+    ASSERTION = "assertion"
+    STACK_OVERFLOW = "stack overflow"
+    STACK_UNDERFLOW = "stack underflow"
+    TARGET = "target"
+
+    def __init__(self, kind: str, pc: int, trace: List[Choice], detail: str = ""):
+        self.kind = kind
+        # pc of the faulting instruction, or the pc reached
+        self.pc = pc
+        self.trace = trace
+        self.detail = detail
+
+    def __repr__(self):
+        return "%s at 0x%03X after %d steps%s" % (self.kind, self.pc, len(self.trace),
+                                                  " (%s)" % self.detail if self.detail else "")
+
+
+class ExplorationResult(object):
+    def __init__(self):
+        self.findings = []  # type: List[Finding]
+        self.states = 0  # type: int
+        self.transitions = 0  # type: int
+        self.depth = 0  # type: int
+        # False when the depth or state bound cut the search short
+        self.complete = True  # type: bool
+
+    def first(self, kind: str = None) -> Optional[Finding]:
+        for finding in self.findings:
+            if kind is None or finding.kind == kind:
+                return finding
+        return None
+
+
+class Explorer(object):
+    """
+    Breadth-first search over the reachable states of a program. Every step branches over the in_port values
+    when the next instruction is an INPUT, and over raising the interrupt for that step while interrupts are
+    enabled. States are deduplicated by a digest of Processor.state_key, so the first trace found to any
+    finding is a shortest one. The visited set holds at most max_states digests.
+    """
+    DIGEST_SIZE = 8  # type: int
+
+    def __init__(self, program: Dict[int, op.Instruction], isr_addr: int = 0x3FF, in_ports: Iterable[int] = None,
+                 interrupts: bool = True, depth: int = 64, max_states: int = 1000000,
+                 targets: Iterable[int] = (), assertions: Iterable[Tuple[str, Assertion]] = (),
+                 initial: Callable[[Processor], None] = None, stop_at_first: bool = True):
+        self.program = program
+        self.isr_addr = isr_addr
+        self.in_ports = list(range(0, 1 << Memory.REGISTER_WIDTH) if in_ports is None else in_ports)
+        self.interrupts = interrupts
+        self.depth = depth
+        self.max_states = max_states
+        self.targets = set(targets)  # type: Set[int]
+        self.assertions = list(assertions)  # type: List[Tuple[str, Assertion]]
+        self.initial = initial
+        self.stop_at_first = stop_at_first
+        self.proc = self.processor()
+
+    def processor(self) -> Processor:
+        proc = Processor(isr_addr=self.isr_addr)
+        proc.set_instructions(self.program)
+        if self.initial is not None:
+            self.initial(proc)
+        return proc
+
+    @staticmethod
+    def digest(key: bytes) -> bytes:
+        return hashlib.blake2b(key, digest_size=Explorer.DIGEST_SIZE).digest()
+
+    def reads_input(self, proc: Processor) -> bool:
+        instr = self.program.get(proc.manager.pc)
+        return isinstance(instr, op.DataOperation) and instr.operator is op.DataOperation.input_
+
+    def choices(self, proc: Processor) -> List[Choice]:
+        ports = self.in_ports if self.reads_input(proc) else [None]
+        pulses = (False, True) if self.interrupts and proc.interrupt_enabled else (False,)
+        return [(port, pulse) for pulse in pulses for port in ports]
+
+    @staticmethod
+    def apply(proc: Processor, choice: Choice):
+        port, pulse = choice
+        if port is not None:
+            proc.external.set_int_port(port)
+        proc.external.set_interrupt(pulse)
+        try:
+            proc.execute()
+        finally:
+            proc.external.set_interrupt(False)
+
+    def check(self, proc: Processor) -> Optional[Tuple[str, str]]:
+        for name, assertion in self.assertions:
+            if not assertion(proc):
+                return Finding.ASSERTION, name
+        if proc.manager.pc in self.targets:
+            return Finding.TARGET, ""
+        return None
+
+    def terminal(self, proc: Processor) -> bool:
+        return proc.outside_program() or proc.manager.pc not in self.program
+
+    def explore(self) -> ExplorationResult:
+        result = ExplorationResult()
+        proc = self.proc
+        # parent index and choice per discovered state, for rebuilding traces
+        nodes = [(-1, None)]  # type: List[Tuple[int, Optional[Choice]]]
+        visited = {Explorer.digest(proc.state_key())}
+        queue = deque([(proc.snapshot(), 0, 0)])
+        reported = set()  # type: Set[Tuple[str, int, str]]
+
+        def trace(node: int) -> List[Choice]:
+            steps = []
+            while nodes[node][0] >= 0:
+                steps.append(nodes[node][1])
+                node = nodes[node][0]
+            steps.reverse()
+            return steps
+
+        def report(kind: str, pc: int, node: int, detail: str = "", choice: Choice = None) -> bool:
+            if (kind, pc, detail) in reported:
+                return False
+            reported.add((kind, pc, detail))
+            steps = trace(node)
+            if choice is not None:
+                steps.append(choice)
+            result.findings.append(Finding(kind, pc, steps, detail))
+            return self.stop_at_first
+
+        found = self.check(proc)
+        if found is not None and report(found[0], proc.manager.pc, 0, found[1]):
+            result.states = len(visited)
+            return result
+
+        while len(queue):
+            snapshot, depth, node = queue.popleft()
+            result.depth = max(result.depth, depth)
+            proc.restore(snapshot)
+            if self.terminal(proc):
+                continue
+            if depth >= self.depth:
+                result.complete = False
+                continue
+            for idx, choice in enumerate(self.choices(proc)):
+                if idx:
+                    proc.restore(snapshot)
+                pc = proc.manager.pc
+                result.transitions += 1
+                try:
+                    Explorer.apply(proc, choice)
+                except IndexError as e:
+                    kind = Finding.STACK_OVERFLOW if "overflow" in str(e) else Finding.STACK_UNDERFLOW
+                    if report(kind, pc, node, choice=choice):
+                        result.states = len(visited)
+                        return result
+                    continue
+                key = Explorer.digest(proc.state_key())
+                if key in visited:
+                    continue
+                if len(visited) >= self.max_states:
+                    result.complete = False
+                    continue
+                visited.add(key)
+                nodes.append((node, choice))
+                child = len(nodes) - 1
+                found = self.check(proc)
+                if found is not None:
+                    if report(found[0], proc.manager.pc, child, found[1]):
+                        result.states = len(visited)
+                        return result
+                    continue
+                queue.append((proc.snapshot(), depth + 1, child))
+        result.states = len(visited)
+        return result
+
+    def replay(self, trace: List[Choice]) -> Processor:
+        """a fresh processor driven through a trace, a faulting last step raises like it did while exploring"""
+        proc = self.processor()
+        for choice in trace:
+            Explorer.apply(proc, choice)
+        return proc
@@ -0,0 +1,325 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import bisect
+import multiprocessing
+import random
+from collections import Counter
+from typing import List, Dict, Tuple, Optional, Iterable, Union
+
+import ops.operations as op
+from system.memory import Memory
+from system.processor import Processor, StopRun, installed_hook
+
+# (cycle, port_id, value) of an OUTPUT or OUTPUTK
+Write = Tuple[int, int, int]
+
+
+class Fault(object):
+    """Bits flipped in one location before the first instruction starting at or after cycle"""
+    REGISTER = "register"
+    DATA = "data"
+    STACK = "stack"
+    FLAGS = "flags"
+    PC = "pc"
+
+    TARGETS = (REGISTER, DATA, STACK, FLAGS, PC)
+    FLAG_NAMES = ("carry", "zero")
+    WIDTHS = {
+        REGISTER: Memory.REGISTER_WIDTH,
+        DATA: Memory.DATA_WIDTH,
+        STACK: Memory.STACK_WIDTH,
+        FLAGS: 1,
+        PC: Memory.PROGRAM_LENGTH.bit_length() - 1,
+    }  # type: Dict[str, int]
+
+    __slots__ = ("cycle", "target", "location", "mask")
+
+    def __init__(self, cycle: int, target: str, location: Union[str, int] = 0, mask: int = 1):
+        if target not in Fault.TARGETS:
+            raise ValueError("Unknown fault target %s" % target)
+        if not 0 < mask < 1 << Fault.WIDTHS[target]:
+            raise ValueError("Mask 0x%X does not fit %s" % (mask, target))
+        self.cycle = cycle
+        self.target = target
+        # register name, scratchpad address, stack row or flag name, unused for the pc
+        self.location = location
+        self.mask = mask
+
+    def apply(self, proc: Processor):
+        mem = proc.memory
+        if self.target == Fault.REGISTER:
+            mem.set_register(self.location, mem.fetch_register(self.location) ^ self.mask)
+        elif self.target == Fault.DATA:
+            mem.store_data(self.location, mem.fetch_data(self.location) ^ self.mask)
+        elif self.target == Fault.STACK:
+            row = mem.STACK[self.location]
+            row.set_value(row.value ^ self.mask)
+        elif self.target == Fault.FLAGS:
+            # fields are flipped directly like Processor.restore, hooked setters do not see the upset
+            if self.location == "carry":
+                proc.p_carry = not proc.p_carry
+            else:
+                proc.p_zero = not proc.p_zero
+        else:
+            proc.manager.jump((proc.manager.pc ^ self.mask) % Memory.PROGRAM_LENGTH)
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"cycle": self.cycle, "target": self.target, "location": self.location, "mask": self.mask}
+
+    def __repr__(self):
+        return "%s %s ^ 0x%X at cycle %d" % (self.target, self.location, self.mask, self.cycle)
+
+
+class Outcome(object):
+    """How a run with one fault ended, compared with the golden run"""
+    MASKED = "masked"
+    SDC = "silent data corruption"
+    HANG = "hang"
+    STACK_FAULT = "stack fault"
+
+    KINDS = (MASKED, SDC, HANG, STACK_FAULT)
+
+    __slots__ = ("fault", "kind", "cycle", "detail")
+
+    def __init__(self, fault: Fault, kind: str, cycle: int, detail: str = ""):
+        self.fault = fault
+        self.kind = kind
+        # cycle the outcome was decided at
+        self.cycle = cycle
+        self.detail = detail
+
+    def to_dict(self) -> Dict[str, object]:
+        result = self.fault.to_dict()
+        result.update({"outcome": self.kind, "decided": self.cycle, "detail": self.detail})
+        return result
+
+    def __repr__(self):
+        detail = " (%s)" % self.detail if self.detail else ""
+        return "%r: %s at cycle %d%s" % (self.fault, self.kind, self.cycle, detail)
+
+
+class Checkpoint(object):
+    __slots__ = ("cycle", "snapshot", "key", "writes")
+
+    def __init__(self, proc: Processor, writes: int):
+        self.cycle = proc.cycles
+        self.snapshot = proc.snapshot()
+        # state deciding the future, a faulty run reaching it at the same cycle is masked from then on
+        self.key = proc.state_key() + bytes((proc.interrupt,))
+        self.writes = writes
+
+
+class Campaign(object):
+    """
+    Single and multi-bit upsets against a golden run of cycles clock cycles. The golden run records every port
+    write and a checkpoint every checkpoint_every cycles. An injection restores the checkpoint before its cycle,
+    runs up to the fault, flips the bits and runs on until the outcome is decided:
+        silent data corruption  a port write differs from the golden one (port_id and value, and the cycle
+                                with timing=True), or there is a write the golden run did not make
+        stack fault             CALL, RETURN or an interrupt over- or underflows the stack
+        hang                    the run leaves the program, or falls short of the golden writes by the end of
+                                the golden run plus hang_margin cycles
+        masked                  the golden writes are all made, or the run reaches the state of a golden
+                                checkpoint at its cycle with the same writes, after which nothing can differ
+    in_port and the interrupt line come from an optional stimulus file (see system.stimulus), without one INPUT
+    reads 0x00. run() spreads the faults over a process pool.
+    """
+    def __init__(self, program: Dict[int, op.Instruction], cycles: int, isr_addr: int = 0x3FF,
+                 stimulus: str = None, checkpoint_every: int = 1000, hang_margin: int = None,
+                 timing: bool = False, processes: int = None, data_length: int = Memory.DATA_LENGTH):
+        self.program = program
+        self.isr_addr = isr_addr
+        self.data_length = data_length
+        self.stimulus = stimulus
+        self.checkpoint_every = max(1, checkpoint_every)
+        self.timing = timing
+        self.processes = processes if processes is not None else multiprocessing.cpu_count()
+        self.writes = []  # type: List[Write]
+        self.checkpoints = []  # type: List[Checkpoint]
+        self._proc = None  # type: Optional[Processor]
+        self._player = None
+        # the run being recorded or compared: (writes, golden writes to compare with or None)
+        self._recording = []  # type: List[Write]
+        self._expected = None  # type: Optional[List[Write]]
+        self._golden(cycles)
+        self.end = self.checkpoints[-1].cycle  # type: int
+        self.hang_margin = hang_margin if hang_margin is not None else max(self.end // 10, 1000)
+
+    def __getstate__(self):
+        # workers build their own processor and stimulus player
+        state = dict(self.__dict__)
+        state["_proc"] = None
+        state["_player"] = None
+        return state
+
+    def _processor(self) -> Processor:
+        if self._proc is not None:
+            return self._proc
+        proc = self._proc = Processor(isr_addr=self.isr_addr, data_length=self.data_length)
+        proc.set_instructions(self.program)
+        set_write_strobe = proc.set_write_strobe
+        set_k_write_strobe = proc.set_k_write_strobe
+
+        def write(cycle: int, port_id: int, value: int):
+            writes = self._recording
+            expected = self._expected
+            if expected is not None:
+                idx = len(writes)
+                if idx >= len(expected):
+                    if cycle <= self.end:
+                        raise StopRun(Outcome.SDC, "write 0x%02X to port 0x%02X the golden run did not make"
+                                        % (value, port_id))
+                elif expected[idx][1:] != (port_id, value) or (self.timing and expected[idx][0] != cycle):
+                    raise StopRun(Outcome.SDC, "write %d is 0x%02X to port 0x%02X at cycle %d, expected %r"
+                                    % (idx, value, port_id, cycle, expected[idx]))
+            writes.append((cycle, port_id, value))
+
+        def write_strobe(val: bool):
+            set_write_strobe(val)
+            if val:
+                write(proc.cycles, proc.p_port_id & 0xFF, proc.p_out_port & 0xFF)
+
+        def k_write_strobe(val: bool):
+            set_k_write_strobe(val)
+            if val:
+                write(proc.cycles, proc.p_port_id & 0xFF, proc.p_out_port & 0xFF)
+
+        for name, hook in (("set_write_strobe", write_strobe), ("set_k_write_strobe", k_write_strobe)):
+            installed_hook(proc, name)
+            setattr(proc, name, hook)
+        if self.stimulus is not None:
+            from system.stimulus import StimulusPlayer
+            self._player = StimulusPlayer(self.stimulus)
+            self._player.attach(proc)
+        return proc
+
+    def _golden(self, cycles: int):
+        proc = self._processor()
+        self._recording = self.writes
+        self._expected = None
+        self.checkpoints.append(Checkpoint(proc, 0))
+        while proc.cycles < cycles:
+            result = proc.run(cycles=min(self.checkpoint_every, cycles - proc.cycles))
+            self.checkpoints.append(Checkpoint(proc, len(self.writes)))
+            if result.reason == result.HALTED:
+                break
+
+    def _restore(self, checkpoint: Checkpoint) -> Processor:
+        proc = self._processor()
+        proc.restore(checkpoint.snapshot)
+        if self._player is not None:
+            # records at exactly the checkpoint cycle are applied before its next instruction
+            self._player.seek(proc.cycles - 1)
+        return proc
+
+    """INJECTION"""
+
+    def inject(self, fault: Fault) -> Outcome:
+        """run one fault to its outcome in this process"""
+        cycles = [c.cycle for c in self.checkpoints]
+        idx = max(0, bisect.bisect_right(cycles, fault.cycle) - 1)
+        start = self.checkpoints[idx]
+        proc = self._restore(start)
+        self._recording = list(self.writes[:start.writes])
+        self._expected = self.writes
+        try:
+            if proc.cycles < fault.cycle:
+                proc.run(cycles=fault.cycle - proc.cycles)
+            if proc.outside_program():
+                return Outcome(fault, Outcome.MASKED, proc.cycles, "the golden run ended first")
+            fault.apply(proc)
+            return self._finish(fault, proc, idx + 1)
+        finally:
+            self._expected = None
+
+    def _finish(self, fault: Fault, proc: Processor, idx: int) -> Outcome:
+        limit = self.end + self.hang_margin
+        while True:
+            # stop at the next golden checkpoint to look for convergence
+            while idx < len(self.checkpoints) and self.checkpoints[idx].cycle < proc.cycles:
+                idx += 1
+            stop = self.checkpoints[idx].cycle if idx < len(self.checkpoints) else limit
+            try:
+                result = proc.run(cycles=max(stop - proc.cycles, 1))
+            except IndexError as e:
+                return Outcome(fault, Outcome.STACK_FAULT, proc.cycles, str(e))
+            except KeyError:
+                return Outcome(fault, Outcome.HANG, proc.cycles,
+                               "runs into unprogrammed memory at 0x%03X" % proc.manager.pc)
+            if result.reason == Outcome.SDC:
+                return Outcome(fault, Outcome.SDC, proc.cycles, result.detail)
+            if result.reason == result.HALTED:
+                if len(self._recording) >= len(self.writes):
+                    return Outcome(fault, Outcome.MASKED, proc.cycles, "halted after the golden writes")
+                return Outcome(fault, Outcome.HANG, proc.cycles, "left the program at 0x%03X" % proc.manager.pc)
+            if idx < len(self.checkpoints):
+                checkpoint = self.checkpoints[idx]
+                if (proc.cycles == checkpoint.cycle and len(self._recording) == checkpoint.writes
+                        and proc.state_key() + bytes((proc.interrupt,)) == checkpoint.key):
+                    return Outcome(fault, Outcome.MASKED, proc.cycles, "converged")
+                idx += 1
+            if proc.cycles >= self.end and len(self._recording) >= len(self.writes):
+                # later writes are not compared, the upset may still be latent in the state
+                return Outcome(fault, Outcome.MASKED, proc.cycles, "latent")
+            if proc.cycles >= limit:
+                return Outcome(fault, Outcome.HANG, proc.cycles, "%d of %d golden writes made"
+                               % (len(self._recording), len(self.writes)))
+
+    def random_faults(self, count: int, seed: int = 0, bits: int = 1,
+                      targets: Iterable[str] = Fault.TARGETS) -> List[Fault]:
+        """faults at uniformly random cycles of the golden run, targets and locations, bits flipped per fault"""
+        rng = random.Random(seed)
+        targets = list(targets)
+        locations = {
+            Fault.REGISTER: Memory.REGISTER_NAMES,
+            Fault.DATA: list(range(0, self.data_length)),
+            Fault.STACK: list(range(0, Memory.STACK_LENGTH)),
+            Fault.FLAGS: list(Fault.FLAG_NAMES),
+            Fault.PC: [0],
+        }  # type: Dict[str, List[Union[str, int]]]
+        faults = []  # type: List[Fault]
+        for _ in range(0, count):
+            target = rng.choice(targets)
+            width = Fault.WIDTHS[target]
+            mask = 0
+            for bit in rng.sample(range(0, width), min(bits, width)):
+                mask |= 1 << bit
+            faults.append(Fault(rng.randrange(0, max(self.end, 1)), target, rng.choice(locations[target]), mask))
+        return faults
+
+    def run(self, faults: Iterable[Fault]) -> List[Outcome]:
+        """outcomes in the order of faults, from a pool of processes sharing the golden run"""
+        faults = list(faults)
+        if self.processes <= 1 or len(faults) < 2:
+            return [self.inject(f) for f in faults]
+        chunksize = max(len(faults) // (self.processes * 8), 1)
+        with multiprocessing.Pool(self.processes, initializer=_init_worker, initargs=(self,)) as pool:
+            return list(pool.imap(_inject_worker, faults, chunksize=chunksize))
+
+    @staticmethod
+    def summary(outcomes: Iterable[Outcome]) -> Dict[str, object]:
+        outcomes = list(outcomes)
+        kinds = Counter(o.kind for o in outcomes)
+        by_target = {}  # type: Dict[str, Dict[str, int]]
+        for o in outcomes:
+            counts = by_target.setdefault(o.fault.target, {k: 0 for k in Outcome.KINDS})
+            counts[o.kind] += 1
+        return {
+            "injections": len(outcomes),
+            "outcomes": {k: kinds.get(k, 0) for k in Outcome.KINDS},
+            "by_target": by_target,
+        }
+
+
+_worker_campaign = None  # type: Optional[Campaign]
+
+
+def _init_worker(campaign: Campaign):
+    global _worker_campaign
+    _worker_campaign = campaign
+
+
+def _inject_worker(fault: Fault) -> Outcome:
+    return _worker_campaign.inject(fault)
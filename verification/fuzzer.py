@@ -0,0 +1,258 @@
+"""
+PicoSim - Xilinx PicoBlaze Assembly Simulator in Python
+Copyright (C) 2017  Vadim Korolik - see LICENCE
+"""
+import multiprocessing
+import random
+from typing import List, Dict, Callable, Union, Tuple, Optional
+
+import ops.operations as op
+from ops.fusion import fuse
+from ops.memoize import memoize
+from system.memory import Memory
+from system.processor import Processor
+
+Spec = Tuple[str, List[Union[str, int]]]
+Engine = Callable[[Dict[int, op.Instruction]], Dict[int, op.Instruction]]
+
+# the reference engine: ArrayRow registers with the ripple adder ArithmeticOperation
+REFERENCE_OPS = dict(op.ALL_OPS)
+for _name, _func in op.ArithmeticOperation.OPS.items():
+    REFERENCE_OPS[_name] = (op.ArithmeticOperation, _func)
+
+
+def reference(operations: Dict[int, op.Instruction]) -> Dict[int, op.Instruction]:
+    return operations
+
+
+def memoize_and_fuse(operations: Dict[int, op.Instruction]) -> Dict[int, op.Instruction]:
+    return fuse(memoize(operations))
+
+
+ENGINES = {
+    "fused": fuse,
+    "memoized": memoize,
+    "memoized+fused": memoize_and_fuse,
+}  # type: Dict[str, Engine]
+
+
+class ProgramGenerator(object):
+    """Random valid instruction sequences, flow targets always stay within the program"""
+    ALU = ["ADD", "ADDCY", "SUB", "SUBCY", "AND", "OR", "XOR", "COMPARE", "TEST"]
+    SHIFTS = list(op.BitwiseOperation.OPS.keys())
+    DATA = ["LOAD", "FETCH", "STORE", "INPUT", "OUTPUT"]
+    FLOW = ["JUMP", "JUMP Z", "JUMP NZ", "JUMP C", "JUMP NC", "CALL", "CALL Z", "CALL NZ", "CALL C", "CALL NC",
+            "RETURN", "RETURN Z", "RETURN NZ", "RETURN C", "RETURN NC"]
+    # flow instructions with an address operand
+    TARGETED = {"JUMP", "JUMP Z", "JUMP NZ", "JUMP C", "JUMP NC", "CALL", "CALL Z", "CALL NZ", "CALL C", "CALL NC"}
+
+    def __init__(self, rng: random.Random, registers: int = 4):
+        self.rng = rng
+        # few registers so instructions actually depend on each other
+        self.registers = ['s%0.1x' % x for x in range(0, registers)]
+
+    def register(self) -> str:
+        return self.rng.choice(self.registers)
+
+    def operand(self) -> Union[str, int]:
+        return self.register() if self.rng.random() < 0.5 else self.rng.randint(0, 0xFF)
+
+    def instruction(self, length: int) -> Spec:
+        kind = self.rng.random()
+        if kind < 0.4:
+            return self.rng.choice(self.ALU), [self.register(), self.operand()]
+        if kind < 0.55:
+            return self.rng.choice(self.SHIFTS), [self.register()]
+        if kind < 0.8:
+            name = self.rng.choice(self.DATA)
+            if name == "LOAD":
+                return name, [self.register(), self.operand()]
+            if name in ("FETCH", "STORE"):
+                return name, [self.register(), self.rng.randint(0, Memory.DATA_LENGTH - 1)]
+            return name, [self.register(), self.rng.randint(0, 0xFF)]
+        name = self.rng.choice(self.FLOW)
+        if name in self.TARGETED:
+            # the address past the last instruction ends the run
+            return name, [self.rng.randint(0, length)]
+        return name, []
+
+    def program(self, length: int) -> List[Spec]:
+        return [self.instruction(length) for _ in range(0, length)]
+
+
+class InitialState(object):
+    def __init__(self, rng: random.Random):
+        self.registers = [rng.randint(0, 0xFF) for _ in range(0, Memory.NUM_REGISTERS)]
+        self.data = [rng.randint(0, 0xFF) for _ in range(0, Memory.DATA_LENGTH)]
+        self.carry = rng.random() < 0.5
+        self.zero = rng.random() < 0.5
+        self.in_port = rng.randint(0, 0xFF)
+
+    def apply(self, proc: Processor):
+        for idx, val in enumerate(self.registers):
+            proc.memory.set_register('s%0.1x' % idx, val)
+        for addr, val in enumerate(self.data):
+            proc.memory.store_data(addr, val)
+        proc.set_carry(self.carry)
+        proc.set_zero(self.zero)
+        proc.external.set_int_port(self.in_port)
+
+
+def build(program: List[Spec]) -> Dict[int, op.Instruction]:
+    operations = {}  # type: Dict[int, op.Instruction]
+    for address, (name, args) in enumerate(program):
+        cls, func = REFERENCE_OPS[name]
+        operations[address] = cls(func, list(args))
+    return operations
+
+
+def format_program(program: List[Spec]) -> str:
+    """PSM source of a program, hex literals without a postfix like the Assembler expects"""
+    lines = []
+    for name, args in program:
+        operands = ", ".join(x if isinstance(x, str) else "%02X" % x for x in args)
+        lines.append(("%s %s" % (name, operands)).strip())
+    return "\n".join(lines)
+
+
+def architectural_state(proc: Processor) -> Dict[str, object]:
+    mem = proc.memory
+    return {
+        "registers": [mem.fetch_register('s%0.1x' % x) for x in range(0, Memory.NUM_REGISTERS)],
+        "data": [mem.fetch_data(x) for x in range(0, Memory.DATA_LENGTH)],
+        "stack": [mem.STACK[x].value for x in range(0, mem.stack_pointer)],
+        "stack_pointer": mem.stack_pointer,
+        "pc": proc.manager.pc,
+        "carry": proc.external.carry,
+        "zero": proc.external.zero,
+        "port_id": proc.external.port_id,
+        "out_port": proc.external.out_port,
+        "read_strobe": proc.external.read_strobe,
+        "write_strobe": proc.external.write_strobe,
+        "interrupt_enabled": proc.interrupt_enabled,
+        "cycles": proc.cycles,
+    }
+
+
+def diff_states(expected: Dict[str, object], actual: Dict[str, object]) -> List[str]:
+    return ["%s: expected %r, got %r" % (k, expected[k], actual[k]) for k in expected if expected[k] != actual[k]]
+
+
+class Divergence(object):
+    def __init__(self, engine: str, program: List[Spec], state: InitialState, differences: List[str], seed: int = None):
+        self.engine = engine
+        self.program = program
+        self.state = state
+        self.differences = differences
+        self.seed = seed
+
+    def __repr__(self):
+        return "Divergence in %s (seed %r):\n%s\n--- program ---\n%s" % \
+               (self.engine, self.seed, "\n".join(self.differences), format_program(self.program))
+
+
+def step(proc: Processor) -> Optional[str]:
+    """execute one dispatch, returning the fault it raised"""
+    try:
+        proc.execute()
+    except (IndexError, KeyError) as e:
+        return "%s: %s" % (e.__class__.__name__, e)
+    return None
+
+
+def run_differential(program: List[Spec], state: InitialState, engine: Engine,
+                     max_cycles: int = 2000, block_cycles: int = 64) -> List[str]:
+    """
+    Run the reference and the engine in lockstep. The engine may retire several instructions per dispatch,
+    so the reference catches up to the engine's cycle count and full state is compared every block.
+    """
+    ref, fast = Processor(), Processor()
+    ref.set_instructions(build(program))
+    fast.set_instructions(engine(build(program)))
+    state.apply(ref)
+    state.apply(fast)
+
+    next_block = block_cycles
+    while fast.cycles < max_cycles:
+        if fast.outside_program():
+            break
+        fast_fault = step(fast)
+        ref_fault = None
+        while ref_fault is None and ref.cycles < fast.cycles and not ref.outside_program():
+            ref_fault = step(ref)
+        if fast_fault is not None and ref_fault is None and not ref.outside_program():
+            # a faulting dispatch does not retire, the reference has to reach the same instruction
+            ref_fault = step(ref)
+        if fast_fault is not None or ref_fault is not None:
+            if fast_fault != ref_fault:
+                return ["fault: expected %r, got %r" % (ref_fault, fast_fault)]
+            break
+        if fast.cycles >= next_block or fast.outside_program():
+            differences = diff_states(architectural_state(ref), architectural_state(fast))
+            if len(differences):
+                return differences
+            next_block = fast.cycles + block_cycles
+    return diff_states(architectural_state(ref), architectural_state(fast))
+
+
+def shrink(program: List[Spec], state: InitialState, engine: Engine, **kwargs) -> List[Spec]:
+    """Delta debugging: drop chunks of instructions while the engine still diverges"""
+    def remove(prog: List[Spec], start: int, count: int) -> List[Spec]:
+        result = []  # type: List[Spec]
+        for name, args in prog[:start] + prog[start + count:]:
+            if name in ProgramGenerator.TARGETED:
+                target = args[0]
+                if target >= start + count:
+                    target -= count
+                elif target > start:
+                    target = start
+                args = [target]
+            result.append((name, args))
+        return result
+
+    chunk = max(len(program) // 2, 1)
+    while chunk >= 1:
+        start = 0
+        while start < len(program):
+            candidate = remove(program, start, chunk)
+            if len(run_differential(candidate, state, engine, **kwargs)):
+                program = candidate
+            else:
+                start += chunk
+        chunk //= 2
+    return program
+
+
+def fuzz_one(seed: int, engines: Dict[str, Engine], length: int, max_cycles: int) -> Optional[Divergence]:
+    rng = random.Random(seed)
+    program = ProgramGenerator(rng).program(length)
+    state = InitialState(rng)
+    for name, engine in engines.items():
+        differences = run_differential(program, state, engine, max_cycles=max_cycles)
+        if len(differences):
+            minimal = shrink(program, state, engine, max_cycles=max_cycles)
+            return Divergence(name, minimal, state, run_differential(minimal, state, engine, max_cycles=max_cycles),
+                              seed)
+    return None
+
+
+def _fuzz_worker(args: tuple) -> Optional[Divergence]:
+    return fuzz_one(*args)
+
+
+class Fuzzer(object):
+    def __init__(self, engines: Dict[str, Engine] = None, length: int = 32, max_cycles: int = 2000,
+                 processes: int = None):
+        self.engines = engines if engines is not None else ENGINES
+        self.length = length
+        self.max_cycles = max_cycles
+        self.processes = processes if processes is not None else multiprocessing.cpu_count()
+
+    def run(self, iterations: int, seed: int = 0) -> List[Divergence]:
+        jobs = [(seed + i, self.engines, self.length, self.max_cycles) for i in range(0, iterations)]
+        if self.processes <= 1:
+            results = map(_fuzz_worker, jobs)
+            return [x for x in results if x is not None]
+        with multiprocessing.Pool(self.processes) as pool:
+            results = pool.imap_unordered(_fuzz_worker, jobs, chunksize=max(iterations // (self.processes * 4), 1))
+            return [x for x in results if x is not None]